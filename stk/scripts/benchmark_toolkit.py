@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+#
+#
+# Time (and measure the memory used by) the main STK operations on
+# synthetic datasets of increasing size. Results can be saved as JSON
+# and compared with an earlier run to spot regressions.
+#
+
+import argparse
+import os
+import sys
+import time
+import datetime
+import platform
+import subprocess
+import simplejson as json
+stk_path = os.path.join( os.path.realpath(os.path.dirname(__file__)), os.pardir )
+sys.path.insert(0, stk_path)
+stk_path = os.path.join( os.path.realpath(os.path.dirname(__file__)), os.pardir, os.pardir )
+sys.path.insert(0, stk_path)
+import stk.supertree_toolkit as stk
+import stk.stk_phyml as stk_phyml
+import stk.stk_newick as stk_newick
+import stk.stk_synthetic as stk_synthetic
+from stk.stk_exceptions import *
+try:
+    import resource
+except ImportError:
+    # no memory figures on this platform
+    resource = None
+
+# Number of trees in each dataset unless told otherwise
+DEFAULT_SCALES = [10, 100, 1000, 10000]
+# permute_tree is run on at most this many non-monophyletic trees
+PERMUTE_TREES = 10
+
+
+def _obtain_trees(XML, args):
+    stk.obtain_trees(XML)
+
+def _get_all_taxa(XML, args):
+    stk.get_all_taxa(XML, n_jobs=args.jobs)
+
+def _substitute_taxa(XML, args):
+    # rename one genus and delete another
+    old_taxa = [stk_synthetic.taxon_name(i) for i in range(20)]
+    new_taxa = [t.replace("Genus000", "Renamed") for t in old_taxa[:10]] + [None]*10
+    stk.substitute_taxa(XML, old_taxa, new_taxa, ignoreWarnings=True, n_jobs=args.jobs)
+
+def _create_matrix(XML, args):
+    stk.create_matrix(XML, ignoreWarnings=True, n_jobs=args.jobs)
+
+def _safe_taxonomic_reduction(XML, args):
+    stk.safe_taxonomic_reduction(XML, ignoreWarnings=True, n_jobs=args.jobs)
+
+def _data_overlap(XML, args):
+    stk.data_overlap(XML, ignoreWarnings=True)
+
+def _data_independence(XML, args):
+    stk.data_independence(XML, ignoreWarnings=True, n_jobs=args.jobs)
+
+def _create_subset(XML, args):
+    stk.create_subset(XML, {'years':['1990-1999'], 'characters':['cytb']}, ignoreWarnings=True)
+    stk.create_subset(XML, {'taxa':[stk_synthetic.taxon_name(0)]}, ignoreWarnings=True)
+
+def _permute_tree(XML, args):
+    trees = [t for t in stk.obtain_trees(XML).values() if "%" in t]
+    for t in trees[:PERMUTE_TREES]:
+        stk.permute_tree(t, matrix="hennig")
+
+def _data_summary(XML, args):
+    stk.data_summary(XML, detailed=True, ignoreWarnings=True)
+
+def _clean_data(XML, args):
+    stk.clean_data(XML)
+
+OPERATIONS = [("obtain_trees", _obtain_trees),
+              ("get_all_taxa", _get_all_taxa),
+              ("substitute_taxa", _substitute_taxa),
+              ("create_matrix", _create_matrix),
+              ("safe_taxonomic_reduction", _safe_taxonomic_reduction),
+              ("data_overlap", _data_overlap),
+              ("data_independence", _data_independence),
+              ("create_subset", _create_subset),
+              ("permute_tree", _permute_tree),
+              ("data_summary", _data_summary),
+              ("clean_data", _clean_data)]
+
+
+def main():
+
+    # do stuff
+    parser = argparse.ArgumentParser(
+         prog="benchmark_toolkit",
+         description="Time the main STK operations on synthetic datasets and save the results as JSON",
+         )
+    parser.add_argument(
+            '-v',
+            '--verbose',
+            action='store_true',
+            help="Verbose output: mainly progress reports.",
+            default=False
+            )
+    parser.add_argument(
+            '-s',
+            '--scales',
+            help="Comma-separated numbers of trees to benchmark with. Default is "+
+                 ",".join([str(s) for s in DEFAULT_SCALES]),
+            default=",".join([str(s) for s in DEFAULT_SCALES])
+            )
+    parser.add_argument(
+            '-o',
+            '--operations',
+            help="Comma-separated operations to benchmark. Default is all of: "+
+                 ", ".join([name for name, func in OPERATIONS]),
+            default=None
+            )
+    parser.add_argument(
+            '-r',
+            '--repeats',
+            type=int,
+            help="How many times to run each operation. The best time is reported. Default is 3",
+            default=3
+            )
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            help="Number of processes for the operations that can use them. Default is 1",
+            default=1
+            )
+    parser.add_argument(
+            '--taxa_per_tree',
+            type=int,
+            help="Number of taxa in each tree. Default is 20",
+            default=20
+            )
+    parser.add_argument(
+            '--overlap',
+            type=float,
+            help="Fraction of each tree's taxa shared with all other trees. Default is 0.5",
+            default=0.5
+            )
+    parser.add_argument(
+            '--non_monophyletic',
+            type=float,
+            help="Fraction of trees with a non-monophyletic taxon. Default is 0.1",
+            default=0.1
+            )
+    parser.add_argument(
+            '--weighted',
+            type=float,
+            help="Fraction of trees that are weighted. Default is 0.1",
+            default=0.1
+            )
+    parser.add_argument(
+            '--seed',
+            type=int,
+            help="Random seed for the synthetic data. Default is 0",
+            default=0
+            )
+    parser.add_argument(
+            '--compare',
+            help="JSON results of an earlier run to compare against",
+            default=None
+            )
+    parser.add_argument(
+            'output',
+            metavar='output',
+            nargs='?',
+            help="File to save the results to, as JSON",
+            default=None
+            )
+
+    args = parser.parse_args()
+    verbose = args.verbose
+
+    scales = [int(s) for s in args.scales.split(",")]
+    operations = OPERATIONS
+    if (not args.operations is None):
+        wanted = args.operations.split(",")
+        known = [name for name, func in OPERATIONS]
+        for w in wanted:
+            if (not w in known):
+                print "Unknown operation: "+w
+                sys.exit(-1)
+        operations = [(name, func) for name, func in OPERATIONS if name in wanted]
+
+    results = []
+    for n_trees in scales:
+        # roughly three trees per source and more taxa as the data grows
+        n_sources = max(1, n_trees // 3)
+        n_taxa = max(5*args.taxa_per_tree, 2*n_trees)
+        start = time.time()
+        XML = stk_synthetic.synthetic_phyml(n_sources=n_sources, n_trees=n_trees, n_taxa=n_taxa,
+                                            taxa_per_tree=args.taxa_per_tree, overlap=args.overlap,
+                                            non_monophyletic=args.non_monophyletic,
+                                            weighted=args.weighted, seed=args.seed)
+        if (verbose):
+            print "Made a dataset of %d trees and %d taxa in %.1fs" % (n_trees, n_taxa, time.time()-start)
+        for name, func in operations:
+            result = {'operation':name,
+                      'trees':n_trees,
+                      'sources':n_sources,
+                      'taxa':n_taxa}
+            result.update(_measure(func, XML, args))
+            results.append(result)
+            _print_result(result)
+
+    output = {'date':datetime.datetime.now().isoformat(),
+              'commit':_commit(),
+              'python':platform.python_version(),
+              'platform':platform.platform(),
+              'jobs':args.jobs,
+              'repeats':args.repeats,
+              'taxa_per_tree':args.taxa_per_tree,
+              'overlap':args.overlap,
+              'non_monophyletic':args.non_monophyletic,
+              'weighted':args.weighted,
+              'seed':args.seed,
+              'results':results}
+    if (not args.output is None):
+        f = open(args.output, "w")
+        json.dump(output, f, indent=2, sort_keys=True)
+        f.close()
+
+    if (not args.compare is None):
+        _compare(json.load(open(args.compare)), output)
+
+
+def _measure(func, XML, args):
+    """ Run func(XML, args) args.repeats times, each time in a child process
+    (where we can) so that each run starts with empty caches and we can
+    see how much memory it needed.
+
+    returns: dictionary of the times of each run, the best time, and the
+             peak memory of the process (KB) and how much of that the
+             operation added
+    """
+
+    seconds = []
+    peak = []
+    for i in range(args.repeats):
+        if (hasattr(os, "fork") and hasattr(os, "wait4")):
+            result = _measure_in_child(func, XML, args)
+        else:
+            result = _measure_here(func, XML, args)
+        if (not result['error'] is None):
+            return {'error':result['error']}
+        seconds.append(result['seconds'])
+        if (not result['peak_kb'] is None):
+            peak.append((result['peak_kb'], result['start_kb']))
+
+    measured = {'seconds':seconds,
+                'best':min(seconds),
+                'error':None,
+                'peak_kb':None,
+                'added_kb':None}
+    if (len(peak) > 0):
+        measured['peak_kb'] = max([p for p, s in peak])
+        measured['added_kb'] = max([max(0, p-s) for p, s in peak])
+    return measured
+
+
+def _run(func, XML, args):
+    stk_phyml.clear_dataset_cache()
+    stk_newick.tree_cache.invalidate()
+    start = time.time()
+    try:
+        func(XML, args)
+    except Exception as detail:
+        return None, "%s: %s" % (detail.__class__.__name__, getattr(detail, 'msg', str(detail)))
+    return time.time() - start, None
+
+
+def _measure_here(func, XML, args):
+    seconds, error = _run(func, XML, args)
+    return {'seconds':seconds, 'error':error, 'peak_kb':None, 'start_kb':None}
+
+
+def _measure_in_child(func, XML, args):
+    start_kb = _current_kb()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if (pid == 0):
+        os.close(read_end)
+        try:
+            seconds, error = _run(func, XML, args)
+            os.write(write_end, json.dumps({'seconds':seconds, 'error':error}))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    data = ""
+    while True:
+        chunk = os.read(read_end, 4096)
+        if (not chunk):
+            break
+        data += chunk
+    os.close(read_end)
+    pid, status, usage = os.wait4(pid, 0)
+    if (data == ""):
+        return {'seconds':None, 'error':"Benchmark process died (status %d)" % status,
+                'peak_kb':None, 'start_kb':None}
+    result = json.loads(data)
+    result['peak_kb'] = usage.ru_maxrss
+    result['start_kb'] = start_kb
+    return result
+
+
+def _current_kb():
+    """ How much memory we're using now (KB). Where we can't tell, our peak
+    so far, which the child's peak can't be less than anyway.
+    """
+
+    try:
+        f = open("/proc/self/statm")
+        pages = int(f.read().split()[1])
+        f.close()
+        return pages * resource.getpagesize() // 1024
+    except (IOError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _print_result(result):
+    if (not result['error'] is None):
+        print "%-26s %6d trees   failed: %s" % (result['operation'], result['trees'], result['error'])
+        return
+    line = "%-26s %6d trees %10.3f s" % (result['operation'], result['trees'], result['best'])
+    if (not result['added_kb'] is None):
+        line += " %10.1f MB" % (result['added_kb']/1024.)
+    print line
+
+
+def _compare(old, new):
+    """ Print the ratio of new to old times for the benchmarks in both
+    """
+
+    old_results = {}
+    for r in old['results']:
+        old_results[(r['operation'], r['trees'])] = r
+    print
+    print "Compared with %s (%s):" % (old.get('commit'), old.get('date'))
+    for r in new['results']:
+        key = (r['operation'], r['trees'])
+        if (not key in old_results or not r['error'] is None or not old_results[key].get('error') is None):
+            continue
+        old_best = old_results[key]['best']
+        ratio = r['best'] / max(old_best, 1e-9)
+        print "%-26s %6d trees %10.3f s -> %10.3f s  (%.2f x)" % (key[0], key[1], old_best, r['best'], ratio)
+
+
+def _commit():
+    """ The current git commit, if we're in a git checkout
+    """
+
+    try:
+        p = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=os.path.dirname(os.path.realpath(__file__)))
+        out, err = p.communicate()
+        if (p.returncode == 0):
+            return out.strip()
+    except OSError:
+        pass
+    return None
+
+
+if __name__ == "__main__":
+    main()
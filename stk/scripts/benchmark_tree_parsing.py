@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+#
+# Compare the speed of parsing trees via p4.read() with the direct
+# parser in stk_newick, using the trees in the test data
+#
+
+import argparse
+import os
+import sys
+import glob
+import time
+stk_path = os.path.join( os.path.realpath(os.path.dirname(__file__)), os.pardir )
+sys.path.insert(0, stk_path)
+stk_path = os.path.join( os.path.realpath(os.path.dirname(__file__)), os.pardir, os.pardir )
+sys.path.insert(0, stk_path)
+import stk.supertree_toolkit as stk
+import stk.stk_newick as stk_newick
+import stk.p4 as p4
+from stk.stk_exceptions import *
+
+def main():
+
+    # do stuff
+    parser = argparse.ArgumentParser(
+         prog="benchmark_tree_parsing",
+         description="Time the STK tree parser against p4.read() on a set of Phyml files",
+         )
+    parser.add_argument(
+            '-v',
+            '--verbose',
+            action='store_true',
+            help="Verbose output: mainly progress reports.",
+            default=False
+            )
+    parser.add_argument(
+            '-r',
+            '--repeats',
+            type=int,
+            help="How many times to parse each tree. Default is 10",
+            default=10
+            )
+    parser.add_argument(
+            'input_dir',
+            metavar='input_dir',
+            nargs='?',
+            help="Directory containing Phyml files. Default is the test data",
+            default=os.path.join(os.path.realpath(os.path.dirname(__file__)), os.pardir, "test", "data", "input")
+            )
+
+    args = parser.parse_args()
+    verbose = args.verbose
+    repeats = args.repeats
+    input_dir = args.input_dir
+
+    # grab every tree we can from the Phyml files
+    trees = []
+    for f in sorted(glob.glob(os.path.join(input_dir,"*.phyml"))):
+        try:
+            XML = stk.load_phyml(f)
+            t = stk.obtain_trees(XML)
+        except:
+            if (verbose):
+                print "Skipping "+f
+            continue
+        trees.extend(t.values())
+    # only keep the ones both parsers can read
+    good_trees = []
+    for t in trees:
+        try:
+            _p4_read(t)
+            stk_newick.parse_tree(t,fix_duplicate_taxa=True)
+            good_trees.append(t)
+        except p4.Glitch:
+            pass
+    trees = good_trees
+    print "Found "+str(len(trees))+" trees in "+input_dir
+
+    # check they agree
+    for t in trees:
+        old = _p4_read(t).writeNewick(fName=None,toString=True)
+        new = stk_newick.parse_tree(t,fix_duplicate_taxa=True).writeNewick(fName=None,toString=True)
+        if not old == new:
+            print "Parsers disagree on tree: "+t
+            sys.exit(-1)
+
+    start = time.time()
+    for i in range(repeats):
+        for t in trees:
+            _p4_read(t)
+    old_time = time.time() - start
+
+    start = time.time()
+    for i in range(repeats):
+        for t in trees:
+            stk_newick.parse_tree(t,fix_duplicate_taxa=True)
+    new_time = time.time() - start
+
+    n = len(trees)*repeats
+    print "p4.read():   %8.3f s  %10.1f trees/s" % (old_time, n/old_time)
+    print "stk_newick:  %8.3f s  %10.1f trees/s" % (new_time, n/new_time)
+    print "Speed up:    %8.2f x" % (old_time/new_time)
+
+
+def _p4_read(tree):
+    """ What the STK used to do to parse a tree
+    """
+    p4.var.doRepairDupedTaxonNames = 2
+    p4.var.warnReadNoFile = False
+    p4.var.nexus_warnSkipUnknownBlock = False
+    p4.var.trees = []
+    p4.read(tree)
+    p4.var.nexus_warnSkipUnknownBlock = True
+    p4.var.warnReadNoFile = True
+    p4.var.doRepairDupedTaxonNames = 0
+    t = p4.var.trees[0]
+    p4.var.trees = []
+    return t
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+#
+# Compare the speed of the helpers that rewrite taxon names in tree
+# strings (_correctly_quote_taxa, _collapse_nodes and
+# _remove_single_poly_taxa) with the regular expression versions they
+# replaced, on large random trees
+#
+
+import argparse
+import os
+import sys
+import re
+import random
+import time
+stk_path = os.path.join( os.path.realpath(os.path.dirname(__file__)), os.pardir )
+sys.path.insert(0, stk_path)
+stk_path = os.path.join( os.path.realpath(os.path.dirname(__file__)), os.pardir, os.pardir )
+sys.path.insert(0, stk_path)
+import stk.supertree_toolkit as stk
+import stk.stk_newick as stk_newick
+import stk.stk_synthetic as stk_synthetic
+import stk.p4 as p4
+from stk.stk_exceptions import *
+
+def main():
+
+    # do stuff
+    parser = argparse.ArgumentParser(
+         prog="benchmark_tree_rewriting",
+         description="Time the STK helpers that rewrite taxa in tree strings against the old regular expression versions",
+         )
+    parser.add_argument(
+            '-t',
+            '--taxa',
+            type=int,
+            help="Number of taxa in each tree. Default is 500",
+            default=500
+            )
+    parser.add_argument(
+            '-n',
+            '--trees',
+            type=int,
+            help="Number of trees. Default is 20",
+            default=20
+            )
+    parser.add_argument(
+            '-r',
+            '--repeats',
+            type=int,
+            help="How many times to rewrite each tree. Default is 3",
+            default=3
+            )
+    parser.add_argument(
+            '-s',
+            '--seed',
+            type=int,
+            help="Random seed. Default is 0",
+            default=0
+            )
+
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    trees = [_random_tree(args.taxa, rng) for i in range(args.trees)]
+    print "Made "+str(len(trees))+" trees of "+str(args.taxa)+" taxa"
+
+    helpers = [("_correctly_quote_taxa", _old_correctly_quote_taxa, stk._correctly_quote_taxa),
+               ("_collapse_nodes", _old_collapse_nodes, stk._collapse_nodes),
+               ("_remove_single_poly_taxa", _old_remove_single_poly_taxa, stk._remove_single_poly_taxa)]
+    for name, old, new in helpers:
+        # check they agree
+        for t in trees:
+            if not old(t) == new(t):
+                print "Old and new "+name+" disagree on tree: "+t
+                sys.exit(-1)
+
+        start = time.time()
+        for i in range(args.repeats):
+            stk_newick.tree_cache.invalidate()
+            for t in trees:
+                old(t)
+        old_time = time.time() - start
+
+        start = time.time()
+        for i in range(args.repeats):
+            # don't let the tree cache do the work for us
+            stk_newick.tree_cache.invalidate()
+            for t in trees:
+                new(t)
+        new_time = time.time() - start
+
+        n = len(trees)*args.repeats
+        print name
+        print "    regular expressions: %8.3f s  %10.1f trees/s" % (old_time, n/old_time)
+        print "    one pass:            %8.3f s  %10.1f trees/s" % (new_time, n/new_time)
+        print "    speed up:            %8.2f x" % (old_time/new_time)
+
+
+def _random_tree(n_taxa, rng):
+    """ A random tree with some quoted names, non-monophyletic taxa
+    (some of them next to each other) and branch lengths
+    """
+
+    taxa = []
+    for i in range(n_taxa):
+        t = stk_synthetic.taxon_name(i)
+        r = rng.random()
+        if (r < 0.05):
+            t = "'"+t.replace("_"," ")+"'"
+        elif (r < 0.1):
+            t = "'"+t+"=x'"
+        taxa.append(t)
+    # a few taxa are in the tree more than once
+    for t in rng.sample([t for t in taxa if not "'" in t], n_taxa//50):
+        i = taxa.index(t)
+        taxa[i] = t+"%1"
+        taxa.insert(rng.randrange(len(taxa)), t+"%2")
+        taxa.insert(i+1, t+"%3")
+    tree = stk_synthetic.random_tree(taxa, rng)
+    return re.sub(r"(sp0000[0-9])\)", r"\1:0.5)", tree)
+
+
+# What the STK used to do
+
+def _old_correctly_quote_taxa(tree):
+
+    taxa = list(stk._parse_tree_cached(tree).leaves)
+    new_taxa = {}
+    for t in taxa:
+       m = re.search('[\(|\)|\?|"|=|,|&|^|$|@|+]', t)
+       if (m == None):
+          new_taxa[t] = t.replace(" ","_")
+       else:
+          new_taxa[t] = "'" + t + "'"
+    modified_tree = tree
+    for t in taxa:
+        new = new_taxa[t]
+        look_for = re.escape(t)
+        modified_tree = re.sub(r"(?P<pretaxon>\(|,|\)| )"+look_for+r"(?P<posttaxon>\(|,|\)| |:)",'\g<pretaxon>'+new+'\g<posttaxon>',modified_tree)
+        t = "'" + t + "'"
+        look_for = re.escape(t)
+        modified_tree = re.sub(r"(?P<pretaxon>\(|,|\)| )"+look_for+r"(?P<posttaxon>\(|,|\)| |:)",'\g<pretaxon>'+new+'\g<posttaxon>',modified_tree)
+    return modified_tree
+
+
+def _old_collapse_nodes(in_tree):
+
+    modified_tree = re.sub(r"(?P<taxon>[a-zA-Z0-9_\+\= ]*)%[0-9]+",'\g<taxon>',in_tree)
+    try:
+        tree = stk._parse_tree(modified_tree,fixDuplicateTaxa=True)
+    except TreeParseError:
+        return ""
+    taxa = tree.getAllLeafNames(0)
+    for t in taxa:
+        try:
+            siblings = stk._get_all_siblings(tree.node(t))
+        except p4.Glitch:
+            continue
+        m = re.match('([a-zA-Z0-9_\+\=\?\. ]*)%[0-9]+', t)
+        if (not m == None):
+            t = m.group(1)
+        for s in siblings:
+            orig_s = s
+            m = re.match('([a-zA-Z0-9_\+\=\?\. ]*)%[0-9]+', s)
+            if (not m == None):
+                s = m.group(1)
+            if t == s:
+                tree.removeNode(tree.node(orig_s),alsoRemoveSingleChildParentNode=True,alsoRemoveBiRoot=False)
+    tree.getPreAndPostOrderAboveRoot()
+    for n in tree.iterPostOrder():
+        if n.getNChildren() == 1 and n.isLeaf == 0:
+            tree.collapseNode(n)
+    return tree.writeNewick(fName=None,toString=True).strip()
+
+
+def _old_remove_single_poly_taxa(tree):
+
+    try:
+        taxa = list(stk._parse_tree_cached(tree).taxa)
+    except TreeParseError:
+        return tree
+    numbers = {}
+    for t in taxa:
+        m = re.match('([a-zA-Z0-9_\+\= ]*)%([0-9]+)', t)
+        if (not m == None):
+            if (m.group(1) in numbers):
+                numbers[m.group(1)] = numbers[m.group(1)]+1
+            else:
+                numbers[m.group(1)] = 1
+        else:
+            numbers[t] = 1
+    for t in taxa:
+        m = re.match('([a-zA-Z0-9_\+\= ]*)%([0-9]+)', t)
+        if (not m == None):
+            if numbers[m.group(1)] == 1:
+                tree = re.sub(t,m.group(1),tree)
+    return tree
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,18 @@
 # for tree display
 #
 
-import urllib2
-from urllib import quote_plus
-import simplejson as json
 import argparse
 import os
 import sys
 stk_path = os.path.join( os.path.realpath(os.path.dirname(__file__)), os.pardir )
 sys.path.insert(0, stk_path)
 import supertree_toolkit as stk
+import stk_taxonomy_providers
 import csv
 
 taxonomy_levels = stk.taxonomy_levels
+eol = stk_taxonomy_providers.get_provider("eol")
+itis = stk_taxonomy_providers.get_provider("itis")
 
 def main():
 
@@ -75,23 +75,14 @@ def main():
             print "Looking up ", taxon
         # get the data from EOL on taxon
         # What about synonyms?
-        taxonq = quote_plus(taxon)
-        URL = "http://eol.org/api/search/1.0.json?q="+taxonq
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        data = json.load(f)
+        data = eol.search(taxon)
         # check if there's some data
         if len(data['results']) == 0:
             taxonomy[taxon] = {}
             continue
         ID = str(data['results'][0]['id']) # take first hit
         # Now look for taxonomies
-        URL = "http://eol.org/api/pages/1.0/"+ID+".json"
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        data = json.load(f)
+        data = eol.page(ID)
         if len(data['taxonConcepts']) == 0:
             taxonomy[taxon] = {}
             continue
@@ -105,11 +96,7 @@ def main():
                 if (pref_db.lower() in currentdb):
                     TID = str(db['identifier'])
                     break
-        URL="http://eol.org/api/hierarchy_entries/1.0/"+TID+".json"
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        data = json.load(f)
+        data = eol.hierarchy_entry(TID)
         this_taxonomy = {}
         this_taxonomy['provider'] = currentdb
         for a in data['ancestors']:
@@ -142,26 +129,13 @@ def main():
         if (verbose):
             print "Looking up ", g
         try:
-            URL="http://www.itis.gov/ITISWebService/jsonservice/searchByScientificName?srchKey="+quote_plus(g.strip())
-        except:
+            data = itis.search(g.strip())
+        except (KeyError, UnicodeError):
             continue
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        string = unicode(f.read(),"ISO-8859-1")
-        data = json.loads(string)
         if data['scientificNames'][0] == None:
             continue
         tsn = data["scientificNames"][0]["tsn"]
-        URL="http://www.itis.gov/ITISWebService/jsonservice/getFullHierarchyFromTSN?tsn="+str(tsn)
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        try:
-            string = unicode(f.read(),"ISO-8859-1")
-        except:
-            continue
-        data = json.loads(string)
+        data = itis.full_hierarchy(tsn)
         this_taxonomy = {}
         for level in data['hierarchyList']:
             if not level['rankName'].lower() in current_taxonomy_levels:
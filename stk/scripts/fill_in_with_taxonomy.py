@@ -20,8 +20,6 @@
 #    Jon Hill. jon.hill@york.ac.uk
 
 import urllib2
-from urllib import quote_plus
-import simplejson as json
 import argparse
 import copy
 import os
@@ -29,33 +27,27 @@ import sys
 stk_path = os.path.join( os.path.realpath(os.path.dirname(__file__)), os.pardir )
 sys.path.insert(0, stk_path)
 import supertree_toolkit as stk
+import stk_taxonomy_providers
 import csv
 from ete2 import Tree
 import tempfile
 import re
 
 taxonomy_levels = stk.taxonomy_levels
+eol = stk_taxonomy_providers.get_provider("eol")
+itis = stk_taxonomy_providers.get_provider("itis")
 #tlevels = ['species','genus','family','superfamily','suborder','order','class','phylum','kingdom']
 tlevels = ['species','genus', 'subfamily', 'family','infraorder','order','class','phylum','kingdom']
 
 def get_tree_taxa_taxonomy_eol(taxon):
 
-    taxonq = quote_plus(taxon)
-    URL = "http://eol.org/api/search/1.0.json?q="+taxonq
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    data = json.load(f)
+    data = eol.search(taxon)
     
     if data['results'] == []:
         return {}
     ID = str(data['results'][0]['id']) # take first hit
     # Now look for taxonomies
-    URL = "http://eol.org/api/pages/1.0/"+ID+".json"
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    data = json.load(f)
+    data = eol.page(ID)
     if len(data['taxonConcepts']) == 0:
         return {}
     TID = str(data['taxonConcepts'][0]['identifier']) # take first hit
@@ -66,11 +58,7 @@ def get_tree_taxa_taxonomy_eol(taxon):
         currentdb = db['nameAccordingTo'].lower()
         TID = str(db['identifier'])
         break
-    URL="http://eol.org/api/hierarchy_entries/1.0/"+TID+".json"
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    data = json.load(f)
+    data = eol.hierarchy_entry(TID)
     tax_array = {}
     tax_array['provider'] = currentdb
     for a in data['ancestors']:
@@ -133,31 +121,16 @@ def get_tree_taxa_taxonomy_worms(taxon):
 
 def get_tree_taxa_taxonomy_itis(taxon):
 
-    URL="http://www.itis.gov/ITISWebService/jsonservice/searchByScientificName?srchKey="+quote_plus(taxon.replace('_',' ').strip())
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)    
-    string = unicode(f.read(),"ISO-8859-1")
-    this_item = json.loads(string)
+    this_item = itis.search(taxon.replace('_',' ').strip())
     if this_item['scientificNames'] == [None]: # not found
         return {}
     tsn = this_item['scientificNames'][0]['tsn'] # there might be records that aren't valid - they point to the valid one though
     # so call another function to get any valid names
-    URL="http://www.itis.gov/ITISWebService/jsonservice/getAcceptedNamesFromTSN?tsn="+tsn
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    string = unicode(f.read(),"ISO-8859-1")
-    this_item = json.loads(string)
+    this_item = itis.accepted_names(tsn)
     if not this_item['acceptedNames'] == [None]:
         tsn = this_item['acceptedNames'][0]['acceptedTsn']
 
-    URL="http://www.itis.gov/ITISWebService/jsonservice/getFullHierarchyFromTSN?tsn="+str(tsn)
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    string = unicode(f.read(),"ISO-8859-1")
-    data = json.loads(string)
+    data = itis.full_hierarchy(tsn)
     # construct array
     this_taxonomy = {}
     for level in data['hierarchyList']:
@@ -175,12 +148,7 @@ def get_taxonomy_eol(taxonomy, start_otu, verbose,tmpfile=None,skip=False):
     def get_children(taxonomy, ID, aphiaIDsDone):
 
         # get data
-        URL="http://eol.org/api/hierarchy_entries/1.0/"+str(ID)+".json?common_names=false&synonyms=false&cache_ttl="
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        string = unicode(f.read(),"ISO-8859-1")
-        this_item = json.loads(string)
+        this_item = eol.hierarchy_entry(ID,query="common_names=false&synonyms=false&cache_ttl=")
         if this_item == None:
             return taxonomy  
         if this_item['taxonRank'].lower().strip() == 'species':
@@ -221,18 +189,9 @@ def get_taxonomy_eol(taxonomy, start_otu, verbose,tmpfile=None,skip=False):
             
 
     # main bit of the get_taxonomy_eol function
-    taxonq = quote_plus(start_otu)
-    URL = "http://eol.org/api/search/1.0.json?q="+taxonq
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    data = json.load(f)
+    data = eol.search(start_otu)
     start_id = str(data['results'][0]['id']) # this is the page ID. We get the species ID next
-    URL = "http://eol.org/api/pages/1.0/"+start_id+".json"
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    data = json.load(f)
+    data = eol.page(start_id)
     if len(data['taxonConcepts']) == 0:
         print "Error finding you start taxa. Spelling?"
         return None  
@@ -248,18 +207,12 @@ def get_taxonomy_eol(taxonomy, start_otu, verbose,tmpfile=None,skip=False):
 
 
 def get_taxonomy_itis(taxonomy, start_otu, verbose,tmpfile=None,skip=False):
-    import simplejson as json
         
     # this is the recursive function
     def get_children(taxonomy, ID, aphiaIDsDone):
 
         # get data
-        URL="http://www.itis.gov/ITISWebService/jsonservice/getFullRecordFromTSN?tsn="+ID
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        string = unicode(f.read(),"ISO-8859-1")
-        this_item = json.loads(string)
+        this_item = itis.full_record(ID)
         if this_item == None:
             return taxonomy
         if not this_item['usage']['taxonUsageRating'].lower() == 'valid':
@@ -272,12 +225,7 @@ def get_taxonomy_itis(taxonomy, start_otu, verbose,tmpfile=None,skip=False):
             if not taxon in taxonomy: # is a new taxon, not previously in the taxonomy
                 # get the taxonomy of this species
                 tsn = this_item["scientificName"]["tsn"]
-                URL="http://www.itis.gov/ITISWebService/jsonservice/getFullHierarchyFromTSN?tsn="+tsn
-                req = urllib2.Request(URL)
-                opener = urllib2.build_opener()
-                f = opener.open(req)
-                string = unicode(f.read(),"ISO-8859-1")
-                data = json.loads(string)
+                data = itis.full_hierarchy(tsn)
                 this_taxonomy = {}
                 for level in data['hierarchyList']:
                     if level['rankName'].lower() in taxonomy_levels:
@@ -293,12 +241,7 @@ def get_taxonomy_itis(taxonomy, start_otu, verbose,tmpfile=None,skip=False):
                 return taxonomy
 
         all_children = []
-        URL="http://www.itis.gov/ITISWebService/jsonservice/getHierarchyDownFromTSN?tsn="+ID
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        string = unicode(f.read(),"ISO-8859-1")
-        this_item = json.loads(string)
+        this_item = itis.hierarchy_down(ID)
         if this_item == None:
             return taxonomy
 
@@ -319,30 +262,15 @@ def get_taxonomy_itis(taxonomy, start_otu, verbose,tmpfile=None,skip=False):
             
 
     # main bit of the get_taxonomy_worms function
-    URL="http://www.itis.gov/ITISWebService/jsonservice/searchByScientificName?srchKey="+quote_plus(start_otu.strip())
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    string = unicode(f.read(),"ISO-8859-1")
-    this_item = json.loads(string)
+    this_item = itis.search(start_otu.strip())
     start_id = this_item['scientificNames'][0]['tsn'] # there might be records that aren't valid - they point to the valid one though
     # call it again via the ID this time to make sure we've got the right one.
     # so call another function to get any valid names
-    URL="http://www.itis.gov/ITISWebService/jsonservice/getAcceptedNamesFromTSN?tsn="+start_id
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    string = unicode(f.read(),"ISO-8859-1")
-    this_item = json.loads(string)
+    this_item = itis.accepted_names(start_id)
     if not this_item['acceptedNames'] == [None]:
         start_id = this_item['acceptedNames'][0]['acceptedTsn']
 
-    URL="http://www.itis.gov/ITISWebService/jsonservice/getFullRecordFromTSN?tsn="+start_id
-    req = urllib2.Request(URL)
-    opener = urllib2.build_opener()
-    f = opener.open(req)
-    string = unicode(f.read(),"ISO-8859-1")
-    this_item = json.loads(string)
+    this_item = itis.full_record(start_id)
     start_taxonomy_level = this_item['taxRank']['rankName'].lower()
 
     aphiaIDsDone = []
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" A local backbone taxonomy, for checking names without the network.
+
+A checklist dump - a Darwin Core style, tab-separated file of accepted
+names, synonyms and their classification, e.g. the GBIF backbone or a
+Catalogue of Life export - is imported once into an SQLite file. The
+columns used are:
+ - taxonID, scientificName, taxonRank, taxonomicStatus and
+   acceptedNameUsageID;
+ - canonicalName or scientificNameAuthorship, if there, to get the name
+   without its author;
+ - kingdom, phylum, class, order, family, genus and any other column named
+   after a rank in supertree_toolkit.taxonomy_levels.
+
+Names are then looked up in three ways:
+ - exact: the name (or a synonym of it) is in the checklist;
+ - fuzzy: a misspelling, found via a trigram index of genus (and other
+   one-word) names and then the edit distance of the whole name;
+ - genus: only the genus is known, which is enough to fill in the
+   classification of a new or missing species.
+
+Set a backbone (see set_backbone) and taxonomic_checker_list and
+create_taxonomy_from_taxa use it instead of EoL, PBDB and ITIS.
+"""
+
+import os
+import csv
+import time
+import sqlite3
+import threading
+import simplejson as json
+import stk_exceptions as excp
+import stk_profile
+
+# kinds of match
+EXACT = "exact"
+SYNONYM = "synonym"
+FUZZY = "fuzzy"
+GENUS = "genus"
+
+# most edits allowed between a name and a fuzzy match
+MAX_DISTANCE = 2
+# how many of the one-word names sharing the most trigrams with a name
+# are checked for a fuzzy match
+FUZZY_CANDIDATES = 50
+# ranks of species and the names below them
+_BELOW_GENUS = ['species', 'subspecies', 'variety', 'form', 'infraspecificname']
+# rows inserted at once while importing
+_IMPORT_CHUNK = 10000
+
+# the backbone in use when none is given
+_default_backbone = None
+
+
+class Backbone(object):
+    """ A checklist of names held in an SQLite file. Safe to share between
+    threads.
+    """
+
+    def __init__(self, filename):
+        """ Open (creating if needed) the backbone in filename. Use
+        ":memory:" for one that is not kept.
+        """
+
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS names ("+
+                         "id INTEGER PRIMARY KEY, taxon_id TEXT, "+
+                         "name TEXT NOT NULL COLLATE NOCASE, rank TEXT, accepted_id TEXT, "+
+                         "genus TEXT COLLATE NOCASE, classification TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS trigrams (trigram TEXT NOT NULL, length INTEGER NOT NULL, word TEXT NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+        self.provider = self._meta("source")
+        self.imported = self._meta("imported")
+
+    def _meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        if (row is None):
+            return None
+        return row[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+
+    def import_checklist(self, filename, verbose=False):
+        """ Import a Darwin Core style checklist (tab-separated, with a
+        header row). Replaces whatever was in the backbone.
+
+        returns: number of names imported
+        """
+
+        # the ranks a taxonomy can hold
+        from supertree_toolkit import taxonomy_levels
+
+        f = open(filename, "rU")
+        reader = csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+        try:
+            header = reader.next()
+        except StopIteration:
+            f.close()
+            raise excp.TaxonomyFileError("Checklist "+filename+" is empty")
+        # dwc:scientificName and scientificName are the same column
+        header = [h.strip().split(":")[-1] for h in header]
+        columns = dict([(header[i], i) for i in range(len(header))])
+        if (not "scientificName" in columns and not "canonicalName" in columns):
+            f.close()
+            raise excp.TaxonomyFileError("Checklist "+filename+" has no scientificName column")
+        ranks = [(h, columns[h]) for h in header if h.lower() in taxonomy_levels]
+
+        def column(row, name):
+            i = columns.get(name)
+            if (i is None or i >= len(row)):
+                return ""
+            return row[i].strip()
+
+        with self._lock:
+            self._db.execute("DROP INDEX IF EXISTS names_name")
+            self._db.execute("DROP INDEX IF EXISTS names_taxon_id")
+            self._db.execute("DROP INDEX IF EXISTS names_genus")
+            self._db.execute("DROP INDEX IF EXISTS names_accepted_id")
+            self._db.execute("DROP INDEX IF EXISTS trigrams_trigram")
+            self._db.execute("DELETE FROM names")
+            self._db.execute("DELETE FROM trigrams")
+            count = 0
+            words = set()
+            rows = []
+            for row in reader:
+                name = column(row, "canonicalName")
+                if (name == ""):
+                    name = canonical_name(column(row, "scientificName"),
+                                          column(row, "scientificNameAuthorship"))
+                if (name == ""):
+                    continue
+                rank = column(row, "taxonRank").lower()
+                taxon_id = column(row, "taxonID")
+                accepted_id = column(row, "acceptedNameUsageID")
+                status = column(row, "taxonomicStatus").lower()
+                if (accepted_id == taxon_id or not ("synonym" in status or "misapplied" in status)):
+                    # an accepted (or doubtful) name stands for itself
+                    accepted_id = None
+                elif (accepted_id == ""):
+                    # a synonym we can't follow
+                    continue
+                classification = {}
+                for r, i in ranks:
+                    if (i < len(row) and not row[i].strip() == ""):
+                        classification[r.lower()] = row[i].strip()
+                parts = name.split(" ")
+                genus = None
+                if (len(parts) > 1 or rank == "genus"):
+                    genus = parts[0]
+                if (len(parts) == 1):
+                    words.add(name)
+                elif (not genus is None):
+                    words.add(genus)
+                rows.append((taxon_id, name, rank, accepted_id, genus,
+                             json.dumps(classification, sort_keys=True)))
+                if (len(rows) == _IMPORT_CHUNK):
+                    count += self._insert(rows)
+                    rows = []
+                    if (verbose):
+                        print "Imported "+str(count)+" names"
+            count += self._insert(rows)
+            f.close()
+            trigrams = []
+            for w in words:
+                for t in _trigrams(w):
+                    trigrams.append((t, len(w), w))
+            self._db.executemany("INSERT INTO trigrams (trigram, length, word) VALUES (?,?,?)", trigrams)
+            self._db.execute("CREATE INDEX names_name ON names (name)")
+            self._db.execute("CREATE INDEX names_taxon_id ON names (taxon_id)")
+            self._db.execute("CREATE INDEX names_genus ON names (genus)")
+            self._db.execute("CREATE INDEX names_accepted_id ON names (accepted_id)")
+            self._db.execute("CREATE INDEX trigrams_trigram ON trigrams (trigram, length, word)")
+            self.provider = os.path.basename(filename)
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?,?)", ("source", self.provider))
+            self.imported = str(time.time())
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?,?)", ("imported", self.imported))
+            self._db.commit()
+        if (verbose):
+            print "Imported "+str(count)+" names from "+filename
+        return count
+
+    def _insert(self, rows):
+        self._db.executemany("INSERT INTO names (taxon_id, name, rank, accepted_id, genus, classification) "+
+                             "VALUES (?,?,?,?,?,?)", rows)
+        return len(rows)
+
+    def _names(self, name):
+        with self._lock:
+            return self._db.execute("SELECT taxon_id, name, rank, accepted_id, classification FROM names "+
+                                    "WHERE name=?", (name,)).fetchall()
+
+    def _accepted(self, row):
+        # the accepted row for a row (the row itself if it is accepted)
+        if (row[3] is None):
+            return row
+        with self._lock:
+            accepted = self._db.execute("SELECT taxon_id, name, rank, accepted_id, classification FROM names "+
+                                        "WHERE taxon_id=? AND accepted_id IS NULL", (row[3],)).fetchone()
+        return accepted
+
+    def _match(self, row, kind, distance=0):
+        accepted = self._accepted(row)
+        if (accepted is None):
+            return None
+        return {'name':row[1],
+                'accepted':accepted[1],
+                'rank':accepted[2],
+                'classification':json.loads(accepted[4]),
+                'kind':kind,
+                'distance':distance}
+
+    def synonyms(self, name):
+        """ The synonyms in the checklist of an accepted name, sorted
+        """
+
+        synonyms = set()
+        for row in self._names(normalise(name)):
+            if (not row[3] is None or row[0] == ""):
+                continue
+            with self._lock:
+                for s in self._db.execute("SELECT name FROM names WHERE accepted_id=?", (row[0],)):
+                    synonyms.add(s[0])
+        return sorted(synonyms)
+
+    def _similar_words(self, word, max_distance):
+        # one-word names within max_distance edits of word, via the
+        # trigrams they share. Each edit changes at most three trigrams,
+        # and the length by at most one, so the rest can't be close enough
+        trigrams = _trigrams(word)
+        with self._lock:
+            candidates = self._db.execute("SELECT word, COUNT(*) AS shared FROM trigrams "+
+                                          "WHERE trigram IN ("+",".join("?"*len(trigrams))+") "+
+                                          "AND length BETWEEN ? AND ? GROUP BY word HAVING shared >= ? "+
+                                          "ORDER BY shared DESC, word LIMIT ?",
+                                          trigrams+[len(word)-max_distance, len(word)+max_distance,
+                                                    len(trigrams)-3*max_distance, FUZZY_CANDIDATES]).fetchall()
+        similar = []
+        for w, n in candidates:
+            d = edit_distance(word.lower(), w.lower(), max_distance)
+            if (d <= max_distance):
+                similar.append((d, w))
+        return similar
+
+    def fuzzy(self, name, max_distance=MAX_DISTANCE):
+        """ Names in the checklist within max_distance edits of name (but
+        not name itself), as a list of (distance, name), closest first.
+        The genus is matched first, so only a handful of names are
+        compared in full.
+        """
+
+        name = normalise(name)
+        parts = name.split(" ")
+        if (len(parts) == 1):
+            return sorted([(d, w) for d, w in self._similar_words(name, max_distance)
+                           if d > 0])
+        genus = parts[0]
+        rest = " ".join(parts[1:]).lower()
+        with self._lock:
+            known = self._db.execute("SELECT 1 FROM names WHERE genus=? LIMIT 1", (genus,)).fetchone()
+        if (known is None):
+            genera = self._similar_words(genus, max_distance)
+        else:
+            genera = [(0, genus)]
+        found = {}
+        for dg, g in genera:
+            with self._lock:
+                rows = self._db.execute("SELECT name FROM names WHERE genus=?", (g,)).fetchall()
+            for r in rows:
+                other = r[0].split(" ")
+                if (not len(other) == len(parts)):
+                    continue
+                d = dg + edit_distance(rest, " ".join(other[1:]).lower(), max_distance - dg)
+                if (d <= max_distance and d > 0):
+                    found[r[0]] = min(d, found.get(r[0], d))
+        return sorted([(d, n) for n, d in found.items()])
+
+    def resolve(self, name, fuzzy=True, genus=True, max_distance=MAX_DISTANCE):
+        """ Find a name in the checklist. Returns a list of matches, each a
+        dictionary of:
+         - name: the name matched in the checklist
+         - accepted: the accepted name it stands for
+         - rank and classification (a dictionary of rank to name) of the
+           accepted name
+         - kind: EXACT, SYNONYM, FUZZY or GENUS
+         - distance: number of edits between name and the match
+        Exact and synonym matches are tried first, then fuzzy ones (the
+        closest), then the genus on its own. An empty list if nothing is
+        found.
+        """
+
+        stk_profile.count("backbone lookups")
+        name = normalise(name)
+        matches = []
+        for row in self._names(name):
+            if (row[3] is None):
+                m = self._match(row, EXACT)
+            else:
+                m = self._match(row, SYNONYM)
+            if (not m is None):
+                matches.append(m)
+        if (len(matches) == 0 and fuzzy):
+            close = self.fuzzy(name, max_distance)
+            for d, n in close:
+                if (d > close[0][0]):
+                    break
+                for row in self._names(n):
+                    m = self._match(row, FUZZY, d)
+                    if (not m is None):
+                        matches.append(m)
+        parts = name.split(" ")
+        if (len(matches) == 0 and genus and len(parts) > 1):
+            for row in self._names(parts[0]):
+                if (row[2] == "genus"):
+                    m = self._match(row, GENUS)
+                    if (not m is None):
+                        matches.append(m)
+        # accepted names first; each accepted name once
+        matches.sort(key=lambda m: [EXACT, SYNONYM, FUZZY, GENUS].index(m['kind']))
+        seen = set()
+        unique = []
+        for m in matches:
+            if (not m['accepted'] in seen):
+                seen.add(m['accepted'])
+                unique.append(m)
+        return unique
+
+    def check(self, taxon):
+        """ Check a taxon name, as taxonomic_checker_list does: returns a
+        list of the name (if it is accepted) or the names it could be,
+        the accepted one first, and a status:
+         - green: the name is accepted
+         - yellow: the name is a synonym or misspelling of one other name
+         - amber: it could be one of several names
+         - red: not found
+        Names use underscores.
+        """
+
+        matches = [m for m in self.resolve(taxon, genus=False)]
+        if (len(matches) == 0):
+            return [[taxon], 'red']
+        accepted = [m['accepted'].replace(" ", "_") for m in matches]
+        if (matches[0]['kind'] == EXACT and accepted[0] == taxon):
+            return [[taxon], 'green']
+        if (len(matches) > 1):
+            return [accepted, 'amber']
+        names = [accepted[0]]
+        for s in self.synonyms(matches[0]['accepted']):
+            s = s.replace(" ", "_")
+            if (not s in names):
+                names.append(s)
+        return [names, 'yellow']
+
+    def taxonomy(self, taxon):
+        """ A taxonomy for taxon (a dictionary of rank to name, plus the
+        provider), as create_taxonomy makes from EoL. Synonyms get the
+        classification of their accepted name and species that aren't in
+        the checklist that of their genus. Fuzzy matches are only used if
+        there is one. None if the name isn't found.
+        """
+
+        matches = self.resolve(taxon)
+        if (len(matches) == 0 or (matches[0]['kind'] == FUZZY and len(matches) > 1)):
+            return None
+        m = matches[0]
+        entry = dict(m['classification'])
+        rank = m['rank']
+        parts = m['accepted'].split(" ")
+        if (m['kind'] == GENUS):
+            entry['genus'] = m['accepted']
+            entry['species'] = normalise(taxon)
+        elif (rank in _BELOW_GENUS):
+            entry['genus'] = parts[0]
+            entry['species'] = " ".join(parts[0:2])
+        elif (not rank is None and not rank == ""):
+            entry[rank] = m['accepted']
+        entry['provider'] = self.provider
+        return entry
+
+
+def normalise(name):
+    """ A taxon name as the checklist has it: spaces not underscores and
+    no quotes
+    """
+
+    return " ".join(name.replace("'", "").replace("_", " ").split())
+
+
+def canonical_name(scientific_name, authorship=""):
+    """ A scientific name without its author and year, e.g. "Gallus gallus
+    (Linnaeus, 1758)" is "Gallus gallus". Authors are capitalised or in
+    brackets; epithets are not.
+    """
+
+    name = scientific_name.strip()
+    if (not authorship == "" and name.endswith(authorship)):
+        return " ".join(name[:-len(authorship)].split())
+    parts = name.split()
+    if (len(parts) == 0):
+        return ""
+    kept = [parts[0]]
+    for p in parts[1:]:
+        if (p[0].isupper() or p[0] in "(&,0123456789"):
+            break
+        kept.append(p)
+    return " ".join(kept)
+
+
+def _trigrams(word):
+    word = " "+word.lower()+" "
+    return list(set([word[i:i+3] for i in range(len(word)-2)]))
+
+
+def edit_distance(a, b, limit=None):
+    """ Levenshtein distance between two strings. If limit is given, any
+    distance over it comes back as limit+1, which is quicker to find.
+    """
+
+    if (limit is None):
+        limit = max(len(a), len(b))
+    if (abs(len(a) - len(b)) > limit):
+        return limit+1
+    previous = range(len(b)+1)
+    for i in range(1, len(a)+1):
+        current = [i] + [0]*len(b)
+        ca = a[i-1]
+        for j in range(1, len(b)+1):
+            cost = 0 if ca == b[j-1] else 1
+            current[j] = min(previous[j]+1, current[j-1]+1, previous[j-1]+cost)
+        if (min(current) > limit):
+            return limit+1
+        previous = current
+    return min(previous[-1], limit+1)
+
+
+def get_backbone():
+    """ The backbone in use when none is given, or None if there isn't one
+    """
+
+    return _default_backbone
+
+
+def set_backbone(backbone):
+    """ Set the backbone used when none is given. backbone can be a
+    Backbone, the filename of one, or None to look names up online.
+    """
+
+    global _default_backbone
+    if (backbone is None or isinstance(backbone, Backbone)):
+        _default_backbone = backbone
+    else:
+        _default_backbone = Backbone(backbone)
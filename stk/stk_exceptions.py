@@ -143,3 +143,24 @@ class NoneCompleteTaxonomy(Error):
     def __init__(self, msg):
         self.msg = msg
 
+
+class TooManyPermutationsError(Error):
+    """Exception raised when permuting a tree would give more trees
+    than we were asked to allow
+    Attributes:
+          msg -- explaination of error
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class TaxonomyFileError(Error):
+    """Exception raised when a taxonomy file (CSV or snapshot) or a checklist
+    can't be read
+    Attributes:
+          msg -- explaination of error
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
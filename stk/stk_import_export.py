@@ -32,6 +32,7 @@ import supertree_toolkit
 from copy import deepcopy
 from supertree_toolkit import _parse_xml
 import stk_exceptions
+import stk_newick
 import stk.p4
 import unicodedata
 import string as python_string
@@ -88,13 +89,7 @@ def export_to_old(xml, output_dir, verbose=False, ignoreWarnings=False):
             os.mkdir(tree_dir)
             # save the tree data
             tree = t.xpath("tree/tree_string/string_value")[0].text
-            stk.p4.var.warnReadNoFile = False
-            stk.p4.var.trees = []
-            stk.p4.read(tree)
-            stk.p4.var.warnReadNoFile = True
-            trees = stk.p4.var.trees
-            stk.p4.var.trees = []
-            tree = trees[0].writeNewick(fName=None,toString=True).strip()
+            tree = stk_newick.parse_tree(tree).writeNewick(fName=None,toString=True).strip()
             out_tree_file = open(os.path.join(tree_dir,name+"_tree_"+str(tree_no)+".tre"),"w")
             out_tree_file.write('#NEXUS\nBEGIN TREES;\nTree tree_1 = [&u] ')
             out_tree_file.write(tree)
@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Tree parsing for the STK.
+
+p4.read() works out whether its argument is a file, a glob or a string
+(so every parse costs an os.path.exists and a glob.glob call), its
+tokeniser keeps state in module globals and it hands the trees back via
+the global p4.var.trees. Here, plain Newick strings are read directly into
+p4 Tree objects without touching the filesystem or any global state, so
+they can be parsed from several threads at once. Anything else (Nexus,
+comments, badly formed trees) is passed to p4.read() under a lock, so the
+results and error messages are the same as they always were.
+"""
+
+import sys
+sys.path.insert(0,"../../")
+import re
+import string
+import hashlib
+import threading
+from collections import OrderedDict
+import stk.p4 as p4
+import stk_profile
+
+# p4's tokeniser keeps state in module globals and p4.read() hands its
+# results back in p4.var, so anything that goes via p4 takes this lock
+_p4_lock = threading.Lock()
+
+# Tokens of a plain Newick tree: quoted names, the punctuation we deal with,
+# unquoted words and then anything else (which sends us back to p4)
+_newick_tokens = re.compile(r"('(?:[^']|'')+')|([(),;:])|([^\s()\[\]{}\\/,;:=*'\"`+\-<>]+)|(\S)")
+_name_start = string.letters + string.digits + "'_#\\/\"()"
+# Tokens for rewriting leaf labels: quoted names, unquoted names (or
+# branch lengths), punctuation, spaces and comments, and anything else
+_label_tokens = re.compile(r"('(?:[^']|'')*')|([^\s()\[\],:;']+)|([(),:;])|(\s+|\[[^\]]*\])|(.)", re.DOTALL)
+
+
+class _NotSimpleNewick(Exception):
+    """ Raised when a tree string uses something the quick
+    reader doesn't handle. We then let p4 have a go.
+    """
+    pass
+
+
+def parse_tree(tree, fix_duplicate_taxa=False):
+    """ Parse a Newick (or Nexus) string and return the first tree as
+    a p4 Tree object. Duplicate taxa raise a p4.Glitch unless
+    fix_duplicate_taxa is set, in which case they are renamed A%1, A%2, etc.
+    """
+
+    trees = parse_trees(tree, fix_duplicate_taxa=fix_duplicate_taxa)
+    if (len(trees) == 0):
+        raise p4.Glitch("No tree found in the input")
+    return trees[0]
+
+
+def parse_trees(tree_block, fix_duplicate_taxa=True):
+    """ Parse a string containing one or more trees, either as
+    a Nexus file or a series of Newick strings, to a list of p4
+    Tree objects
+    """
+
+    if (tree_block.lstrip()[0:1] == '('):
+        try:
+            with stk_profile.timer("tree parse"):
+                trees = _read_newick(tree_block)
+                for t in trees:
+                    _check_duplicate_taxa(t, fix_duplicate_taxa)
+        except _NotSimpleNewick:
+            return _read_with_p4(tree_block, fix_duplicate_taxa)
+        return trees
+
+    # Nexus, single taxon trees and the like
+    return _read_with_p4(tree_block, fix_duplicate_taxa)
+
+
+def _read_newick(content):
+    """ Read a series of Newick trees, building the same p4 Tree
+    objects as Tree.parseNewick() does. Comments, branch lengths in odd
+    formats, malformed trees, etc. raise _NotSimpleNewick so that p4
+    can deal with them (and raise the errors users are used to).
+    """
+
+    trees = []
+    tokens = _newick_tokens.finditer(content)
+    for m in tokens:
+        if (not m.group(2) == '('):
+            raise _NotSimpleNewick
+        t = p4.Tree()
+        t.name = 't%i' % len(trees)
+        _read_one_newick(t, tokens)
+        t.initFinish()
+        trees.append(t)
+
+    return trees
+
+
+def _read_one_newick(t, tokens):
+    """ Fill in tree t from the tokens. The opening paren has
+    already been read.
+    """
+
+    nodes = t.nodes
+    last_child = {}
+    root = p4.Node()
+    root.isLeaf = 1
+    root.nodeNum = 0
+    t.root = root
+    nodes.append(root)
+    stack = [root]
+    is_after_paren = True
+    is_after_comma = False
+    paren_level = 1
+
+    for m in tokens:
+        quoted, punct, word, other = m.groups()
+        if (not other is None):
+            raise _NotSimpleNewick
+        if (not quoted is None):
+            tok = quoted[1:-1].replace("''", "'")
+            if (tok in ['(', ')', ',', ':', ';'] or not tok[0] in _name_start):
+                raise _NotSimpleNewick
+        elif (not word is None):
+            tok = word
+            if (not tok[0] in _name_start):
+                raise _NotSimpleNewick
+        else:
+            tok = None
+
+        if (punct == '('):
+            if not (is_after_paren or is_after_comma):
+                raise _NotSimpleNewick
+            n = p4.Node()
+            parent = stack[-1]
+            n.parent = parent
+            if (parent.leftChild is None):
+                parent.leftChild = n
+            else:
+                last_child[parent].sibling = n
+            last_child[parent] = n
+            n.nodeNum = len(nodes)
+            nodes.append(n)
+            stack.append(n)
+            is_after_paren = True
+            paren_level += 1
+        elif (punct == ','):
+            if (is_after_paren or is_after_comma):
+                raise _NotSimpleNewick
+            stack.pop()
+            if (len(stack) == 0):
+                raise _NotSimpleNewick
+            is_after_comma = True
+        elif (punct == ')'):
+            if (len(stack) == 0):
+                raise _NotSimpleNewick
+            stack.pop()
+            is_after_paren = False
+            is_after_comma = False
+            paren_level -= 1
+            if (paren_level < 0 or len(stack) == 0):
+                raise _NotSimpleNewick
+        elif (punct == ':'):
+            try:
+                brlen = next(tokens).group(3)
+                stack[-1].br.len = float(brlen)
+            except (StopIteration, IndexError, TypeError, ValueError):
+                raise _NotSimpleNewick
+        elif (punct == ';'):
+            if (not paren_level == 0 or not len(stack) == 1):
+                raise _NotSimpleNewick
+            if (root.leftChild and root.leftChild.sibling):
+                root.isLeaf = 0
+            root.br = None
+            return
+        elif not (is_after_paren or is_after_comma):
+            # name of an internal node
+            if (stack[-1].name):
+                raise _NotSimpleNewick
+            stack[-1].name = tok
+        else:
+            # a new terminal node
+            if (tok[0] in string.digits and not p4.var.nexus_allowAllDigitNames):
+                try:
+                    int(tok)
+                    raise _NotSimpleNewick
+                except ValueError:
+                    pass
+            if (not p4.func.nexusCheckName(tok)):
+                raise _NotSimpleNewick
+            n = p4.Node()
+            n.isLeaf = 1
+            n.name = tok
+            parent = stack[-1]
+            n.parent = parent
+            if (parent.leftChild is None):
+                parent.leftChild = n
+            else:
+                last_child[parent].sibling = n
+            last_child[parent] = n
+            n.nodeNum = len(nodes)
+            nodes.append(n)
+            stack.append(n)
+            is_after_paren = False
+            is_after_comma = False
+
+    # ran out of tokens before the ';'
+    raise _NotSimpleNewick
+
+
+def _check_duplicate_taxa(tree, fix_duplicate_taxa):
+    """ Does the same job as p4's Tree.checkDupedTaxonNames (with
+    doRepairDupedTaxonNames = 2), but is told what to do, rather than
+    looking at p4.var
+    """
+
+    lo_names = []
+    for n in tree.nodes:
+        if n.isLeaf and n.name:
+            lo_names.append(n.name.lower())
+    counts = {}
+    for lo_name in lo_names:
+        counts[lo_name] = counts.get(lo_name,0) + 1
+    duplicates = [lo_name for lo_name in lo_names if counts[lo_name] > 1]
+    if (len(duplicates) == 0):
+        return
+
+    if (not fix_duplicate_taxa):
+        # let p4 complain about it
+        raise _NotSimpleNewick
+
+    repair_counter = {}
+    for n in tree.nodes:
+        if n.isLeaf and n.name and counts[n.name.lower()] > 1:
+            lo_name = n.name.lower()
+            repair_counter[lo_name] = repair_counter.get(lo_name,0) + 1
+            n.name = '%s%%%i' % (n.name, repair_counter[lo_name])
+
+
+def leaf_spans(tree):
+    """ Where the leaf labels are in a Newick string: a list of
+    (start, end, name) in the order they are written, with name as p4
+    reads it (no quotes, '' for a quote). One pass over the string; nothing
+    is parsed. Comments, branch lengths and internal node labels are
+    skipped. Raises a p4.Glitch if the string isn't Newick we understand.
+    """
+
+    spans = []
+    pos = 0
+    depth = 0
+    # a leaf label can come next
+    expect_leaf = True
+    # a branch length comes next
+    after_colon = False
+    # a label (or branch length) has just been read
+    after_label = False
+    for m in _label_tokens.finditer(tree):
+        quoted, word, punct, skip, other = m.groups()
+        if (not other is None):
+            raise p4.Glitch("Can't read the tree at character "+str(pos)+": "+tree[pos:pos+20])
+        pos = m.end()
+        if (not skip is None):
+            continue
+        if (punct is None):
+            if (after_colon):
+                after_colon = False
+            elif (after_label):
+                raise p4.Glitch("Unexpected "+m.group(0)+" at character "+str(m.start()))
+            elif (expect_leaf):
+                if (quoted is None):
+                    name = word
+                else:
+                    name = quoted[1:-1].replace("''", "'")
+                spans.append((m.start(), m.end(), name))
+            # otherwise it's the name of an internal node
+            expect_leaf = False
+            after_label = True
+        elif (punct == '('):
+            if (not expect_leaf):
+                raise p4.Glitch("Unexpected ( at character "+str(m.start()))
+            depth += 1
+        elif (expect_leaf or after_colon):
+            raise p4.Glitch("Missing name or branch length at character "+str(m.start()))
+        elif (punct == ':'):
+            after_colon = True
+        else:
+            if (punct == ')'):
+                depth -= 1
+            if (depth < 0 or (punct == ';' and not depth == 0)):
+                raise p4.Glitch("Unbalanced brackets at character "+str(m.start()))
+            expect_leaf = not (punct == ')')
+            after_label = False
+    if (not depth == 0 or after_colon):
+        raise p4.Glitch("The tree is incomplete")
+    return spans
+
+
+def rewrite_leaves(tree, rename, spans=None):
+    """ Rewrite the leaf labels of a Newick string in one pass.
+    rename(name, text) is given each leaf's name (as p4 reads it) and its
+    text in the string (e.g. with quotes) and returns the text to put in
+    its place. Everything else is left exactly as it was. Pass in the
+    leaf_spans() of the tree if you already have them.
+    """
+
+    if (spans is None):
+        spans = leaf_spans(tree)
+    pieces = []
+    last = 0
+    for start, end, name in spans:
+        text = tree[start:end]
+        new_text = rename(name, text)
+        if (new_text == text):
+            continue
+        pieces.append(tree[last:start])
+        pieces.append(new_text)
+        last = end
+    if (last == 0):
+        return tree
+    pieces.append(tree[last:])
+    return "".join(pieces)
+
+
+def topology_fingerprint(tree):
+    """ A hash of a p4 tree's leaf names, its bipartitions (splits) and the
+    number of children of its root. Two trees have the same fingerprint
+    when the STK would call them the same tree: same taxa, a Robinson-Foulds
+    distance of zero and the same root, whatever order the children of
+    each node are written in and ignoring branch lengths.
+    """
+
+    leaves = []
+    # the leaves below each node we've been to and not yet its parent
+    below = {}
+    clades = []
+    for n in tree.iterPostOrder():
+        if (n.isLeaf):
+            leaves.append(n.name)
+            below[n.nodeNum] = frozenset([n.name])
+            continue
+        names = frozenset()
+        for c in n.iterChildren():
+            names = names.union(below.pop(c.nodeNum))
+        below[n.nodeNum] = names
+        if (not n == tree.root):
+            clades.append(names)
+    leaves.sort()
+    all_leaves = frozenset(leaves)
+    splits = set()
+    for names in clades:
+        # write each split as the side without the first taxon in it,
+        # so that both sides of a split give the same thing
+        if (leaves[0] in names):
+            names = all_leaves.difference(names)
+        # leaves on their own and the whole tree are in every tree
+        if (len(names) > 1 and len(names) < len(all_leaves) - 1):
+            splits.add("\t".join(sorted(names)))
+    # names can contain nearly anything, but not tabs or newlines
+    canonical = "\n".join(["\t".join(leaves)] + sorted(splits) + [str(tree.root.getNChildren())])
+    if (isinstance(canonical, unicode)):
+        canonical = canonical.encode("utf-8")
+    return hashlib.sha1(canonical).hexdigest()
+
+
+@stk_profile.timed("p4 read")
+def _read_with_p4(tree_block, fix_duplicate_taxa):
+    """ The old way: set up p4.var, call p4.read() and take the trees
+    out of p4.var.trees. Only one thread can do this at a time.
+    """
+
+    _p4_lock.acquire()
+    try:
+        saved_repair = p4.var.doRepairDupedTaxonNames
+        saved_warn = p4.var.warnReadNoFile
+        saved_skip = p4.var.nexus_warnSkipUnknownBlock
+        saved_trees = p4.var.trees
+        try:
+            if (fix_duplicate_taxa):
+                p4.var.doRepairDupedTaxonNames = 2
+            p4.var.warnReadNoFile = False
+            p4.var.nexus_warnSkipUnknownBlock = False
+            p4.var.trees = []
+            p4.read(tree_block)
+            trees = p4.var.trees
+        finally:
+            p4.var.doRepairDupedTaxonNames = saved_repair
+            p4.var.warnReadNoFile = saved_warn
+            p4.var.nexus_warnSkipUnknownBlock = saved_skip
+            p4.var.trees = saved_trees
+    finally:
+        _p4_lock.release()
+
+    return trees
+
+
+############ Parsed tree cache ############
+
+# Default number of parsed trees to hold on to
+TREE_CACHE_SIZE = 5000
+
+
+class CachedTree(object):
+    """ A parsed tree and its leaf names, as held in the tree cache.
+
+    The tree object is shared with everyone else who parsed the same string,
+    so it must not be altered. Anything that wants to edit a tree should
+    call parse_tree() and get its own copy. The leaf names are tuples and
+    frozensets, so they can't be changed by accident.
+    """
+
+    __slots__ = ['tree', 'leaves', 'taxa', 'taxa_set', 'percent_bases', '_fingerprint']
+
+    def __init__(self, tree):
+        self.tree = tree
+        # as p4 gives them, e.g. with spaces
+        self.leaves = tuple(tree.getAllLeafNames(tree.root))
+        # with underscores, as _getTaxaFromNewick gives them
+        self.taxa = tuple([t.replace(" ","_") for t in self.leaves])
+        self.taxa_set = frozenset(self.taxa)
+        # "A" for every "A%1", etc. so we can spot non-monophyletic taxa quickly
+        bases = set()
+        for t in self.taxa:
+            i = t.find('%')
+            while (i > -1):
+                bases.add(t[:i])
+                i = t.find('%',i+1)
+        self.percent_bases = frozenset(bases)
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        """ topology_fingerprint() of the tree, worked out the first time
+        it's asked for
+        """
+
+        if (self._fingerprint is None):
+            self._fingerprint = topology_fingerprint(self.tree)
+        return self._fingerprint
+
+    def contains(self, taxon):
+        """ Same test as _tree_contains: the taxon, or a
+        non-monophyletic version of it (taxon%N) is in the tree
+        """
+
+        return taxon in self.taxa_set or taxon in self.percent_bases
+
+    def count(self, taxon):
+        """ How many leaves are either the taxon or taxon%N
+        """
+
+        if (not self.contains(taxon)):
+            return 0
+        count = 0
+        for t in self.taxa:
+            if (t == taxon):
+                count += 1
+            if (t.startswith(taxon+"%")):
+                count += 1
+        return count
+
+
+class TreeCache(object):
+    """ A bounded, least-recently-used store of parsed trees,
+    keyed on the tree string.
+
+    Trees are never edited in place by the STK - an edit produces a new
+    Newick string - so an entry can't go stale. If a caller does need to
+    forget a tree (e.g. it has altered the shared object), use invalidate().
+    """
+
+    def __init__(self, size=TREE_CACHE_SIZE):
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tree, fix_duplicate_taxa=False):
+        """ Return the CachedTree for this tree string, parsing it if needed.
+        Parsing errors (p4.Glitch) are passed on and nothing is stored.
+        """
+
+        key = (tree, fix_duplicate_taxa)
+        self._lock.acquire()
+        try:
+            entry = self._trees.pop(key, None)
+            if (not entry is None):
+                self._trees[key] = entry
+                self.hits += 1
+                stk_profile.count("tree cache hits")
+                return entry
+            self.misses += 1
+            stk_profile.count("tree cache misses")
+        finally:
+            self._lock.release()
+
+        # parse outside the lock - another thread might parse the
+        # same tree at the same time, but the result is the same
+        entry = CachedTree(parse_tree(tree, fix_duplicate_taxa=fix_duplicate_taxa))
+        if (self._size > 0):
+            self._lock.acquire()
+            try:
+                self._trees[key] = entry
+                while (len(self._trees) > self._size):
+                    self._trees.popitem(last=False)
+            finally:
+                self._lock.release()
+        return entry
+
+    def invalidate(self, tree=None):
+        """ Forget a tree, or everything if no tree is given
+        """
+
+        self._lock.acquire()
+        try:
+            if (tree is None):
+                self._trees.clear()
+            else:
+                self._trees.pop((tree, False), None)
+                self._trees.pop((tree, True), None)
+        finally:
+            self._lock.release()
+
+    def set_size(self, size):
+        """ Change the number of trees held. 0 turns the cache off.
+        """
+
+        self._lock.acquire()
+        try:
+            self._size = size
+            while (len(self._trees) > self._size):
+                self._trees.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._trees)
+
+    def stats(self):
+        """ Dictionary of the cache size, number of trees held, and hits/misses
+        """
+
+        return {'size': self._size,
+                'trees': len(self._trees),
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+# The cache shared by the supertree_toolkit helpers
+tree_cache = TreeCache()
+
+
+def cached_tree(tree, fix_duplicate_taxa=False):
+    """ The shared, read-only CachedTree for a tree string
+    """
+
+    return tree_cache.get(tree, fix_duplicate_taxa=fix_duplicate_taxa)
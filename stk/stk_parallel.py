@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Running per-tree work over a pool of processes.
+
+Workers are handed Newick strings (plus anything that is the same for
+every tree, which is sent to each worker once) and hand back plain
+python data, so no p4 or lxml objects cross process boundaries. Results
+come back in the same order as the trees went in.
+"""
+
+import multiprocessing
+import stk_exceptions as excp
+
+# Below this many trees it's quicker to do the work ourselves
+PARALLEL_MIN_TREES = 50
+
+# what the workers share, set when the pool starts
+_shared = None
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def _call_worker(args):
+    func, item = args
+    try:
+        return True, func(item, _shared)
+    except excp.Error as detail:
+        # our exceptions don't pickle (they take a msg, but don't pass
+        # it up to Exception), so send the class and message back instead
+        return False, (detail.__class__, getattr(detail, 'msg', str(detail)))
+
+
+def use_pool(n_items, n_jobs):
+    """ Is it worth starting a pool of n_jobs processes for n_items trees?
+    """
+
+    return (not n_jobs is None and n_jobs > 1 and n_items >= PARALLEL_MIN_TREES)
+
+
+def map_trees(func, items, n_jobs=1, shared=None, chunksize=None):
+    """ Return [func(item, shared) for item in items], with the calls spread
+    over n_jobs processes. func must be a module-level function so that it
+    can be sent to the workers. Exceptions raised by func are raised here.
+
+    Small inputs, or n_jobs of 1 (or None), run in this process.
+    """
+
+    items = list(items)
+    if (not use_pool(len(items), n_jobs)):
+        return [func(item, shared) for item in items]
+
+    if (chunksize is None):
+        chunksize = max(1, len(items) // (4*n_jobs))
+    pool = multiprocessing.Pool(processes=n_jobs, initializer=_init_worker, initargs=(shared,))
+    try:
+        results = pool.map(_call_worker, [(func, item) for item in items], chunksize)
+        pool.close()
+        for i in range(len(results)):
+            ok, results[i] = results[i]
+            if (not ok):
+                error_class, msg = results[i]
+                raise error_class(msg)
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
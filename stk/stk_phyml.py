@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" In-memory Phyml document model.
+
+A PhymlDataset parses a Phyml document once and keeps the lxml tree, along
+with some indexes (source name, tree name, taxa per tree and trees per taxon)
+that are built lazily the first time they are needed. The supertree_toolkit
+functions still take and return XML strings; internally they work on a
+PhymlDataset and only serialise when they have to hand a string back.
+"""
+
+from collections import OrderedDict, defaultdict
+from copy import deepcopy
+from lxml import etree
+import stk_exceptions as excp
+import stk_profile
+
+# How many parsed documents we keep hold of, keyed by their XML string
+DATASET_CACHE_SIZE = 4
+_dataset_cache = OrderedDict()
+
+
+class PhymlDataset(object):
+    """ A parsed Phyml document plus indexes into it.
+
+    Anything that edits the tree strings or removes source_trees/sources
+    should go through the methods below so the indexes stay valid. If you
+    edit xml_root directly, call invalidate() afterwards.
+    """
+
+    def __init__(self, XML=None, xml_root=None):
+        """ Create a dataset from either a Phyml string or an existing
+        lxml root element (which is then owned by the dataset)
+        """
+
+        if (xml_root is None):
+            if (XML is None):
+                raise excp.InvalidSTKData("No Phyml data supplied")
+            xml_root = parse_phyml_string(XML)
+        self.xml_root = xml_root
+        self.invalidate()
+
+    @classmethod
+    def from_file(cls, filename):
+        """ Load a Phyml file from disk
+        """
+
+        parser = etree.XMLParser(remove_blank_text=True)
+        with stk_profile.timer("xml parse"):
+            xml_root = etree.parse(filename,parser).getroot()
+        return cls(xml_root=xml_root)
+
+    def invalidate(self):
+        """ Drop all derived indexes. They will be rebuilt on demand.
+        """
+
+        self._sources = None
+        self._source_trees = None
+        self._name_counts = None
+        self._parsed_trees = {}
+        self._taxon_index = None
+        self._subset_index = None
+
+    def copy(self):
+        """ Return an independent copy of this dataset
+        """
+
+        return PhymlDataset(xml_root=deepcopy(self.xml_root))
+
+    def tostring(self):
+        """ Serialise the document back to a Phyml string
+        """
+
+        with stk_profile.timer("xml serialise"):
+            return etree.tostring(self.xml_root,pretty_print=True)
+
+    def save(self, filename):
+        """ Write the document to disk
+        """
+
+        f = open(filename,"w")
+        f.write(self.tostring())
+        f.close()
+
+    ############ indexes ############
+
+    def _build_index(self):
+        """ Walk the document once and index the sources and source_trees.
+        Unnamed trees are given the name create_tree_name would give them,
+        but the name is not written into the document.
+        """
+
+        self._sources = OrderedDict()
+        self._source_trees = OrderedDict()
+        self._name_counts = defaultdict(int)
+        for s in self.xml_root.iter("source"):
+            try:
+                s_name = s.attrib['name']
+            except KeyError:
+                s_name = None
+            if (not s_name is None):
+                self._sources[s_name] = s
+            tree_count = 1
+            for st in s.iterchildren("source_tree"):
+                if 'name' in st.attrib:
+                    self._name_counts[st.attrib['name']] += 1
+                    if not st.attrib['name'] == "":
+                        tree_count += 1
+            for st in s.iterchildren("source_tree"):
+                try:
+                    t_name = st.attrib['name']
+                except KeyError:
+                    if (s_name is None):
+                        t_name = str(tree_count)
+                    else:
+                        t_name = s_name + "_" + str(tree_count)
+                    tree_count += 1
+                self._source_trees[t_name] = st
+
+    def _get_sources(self):
+        if (self._sources is None):
+            self._build_index()
+        return self._sources
+
+    def _get_source_trees(self):
+        if (self._source_trees is None):
+            self._build_index()
+        return self._source_trees
+
+    def source_names(self):
+        """ All source names, in document order
+        """
+
+        return self._get_sources().keys()
+
+    def source(self, name):
+        """ The source element with this name
+        """
+
+        try:
+            return self._get_sources()[name]
+        except KeyError:
+            raise excp.InvalidSTKData("No source called "+name+" in the data")
+
+    def source_tree_names(self):
+        """ All source_tree names, in document order
+        """
+
+        return self._get_source_trees().keys()
+
+    def source_tree(self, name):
+        """ The source_tree element with this name
+        """
+
+        try:
+            return self._get_source_trees()[name]
+        except KeyError:
+            raise excp.InvalidSTKData("No tree called "+name+" in the data")
+
+    def has_unique_tree(self, name):
+        """ True if exactly one source_tree carries this name. Names made
+        up for unnamed trees do not count.
+        """
+
+        self._get_source_trees()
+        return self._name_counts[name] == 1
+
+    def tree_string(self, name):
+        """ The Newick string for a tree, or None if the tree is empty
+        """
+
+        st = self.source_tree(name)
+        value = st.find("tree/tree_string/string_value")
+        if (value is None):
+            return None
+        return value.text
+
+    def trees(self):
+        """ Dictionary of tree name to tree string, as obtain_trees
+        returns. Empty trees are skipped.
+        """
+
+        trees = {}
+        for name, st in self._get_source_trees().iteritems():
+            value = st.find("tree/tree_string/string_value")
+            if (not value is None and not value.text is None):
+                trees[name] = value.text
+
+        return trees
+
+    def parsed_tree(self, name):
+        """ The p4 tree object for a tree. This is shared, so do not
+        alter it; dupe() it first if you need to.
+        """
+
+        return self._cached_tree(name).tree
+
+    def _cached_tree(self, name):
+        if (not name in self._parsed_trees):
+            # parsed trees are shared via the tree cache
+            from supertree_toolkit import _parse_tree_cached
+            self._parsed_trees[name] = _parse_tree_cached(self.tree_string(name))
+        return self._parsed_trees[name]
+
+    def tree_taxa(self, name):
+        """ List of taxa (with underscores, not spaces) in a tree
+        """
+
+        return list(self._cached_tree(name).taxa)
+
+    def _get_taxon_index(self):
+        if (self._taxon_index is None):
+            self._taxon_index = {}
+            for name in self.trees():
+                for t in self.tree_taxa(name):
+                    self._taxon_index.setdefault(t,set()).add(name)
+        return self._taxon_index
+
+    def all_taxa(self):
+        """ Unique list of all taxa in all trees (unsorted)
+        """
+
+        return self._get_taxon_index().keys()
+
+    def trees_containing(self, taxon):
+        """ Names of the trees that contain this taxon
+        """
+
+        return list(self._get_taxon_index().get(taxon.replace(" ","_"),[]))
+
+    def subset_index(self):
+        """ The stk_subset.SubsetIndex create_subset queries
+        """
+
+        if (self._subset_index is None):
+            from stk_subset import SubsetIndex
+            self._subset_index = SubsetIndex(self)
+        return self._subset_index
+
+    ############ mutators ############
+
+    def _forget_tree(self, name):
+        self._parsed_trees.pop(name,None)
+        self._taxon_index = None
+        self._subset_index = None
+
+    def set_tree_string(self, name, tree):
+        """ Swap the Newick string of a tree for a new one
+        """
+
+        st = self.source_tree(name)
+        st.xpath("tree/tree_string/string_value")[0].text = tree
+        self._forget_tree(name)
+
+    def remove_tree(self, name, delete_empty_source=False):
+        """ Remove a source_tree. If delete_empty_source is set and the
+        source no longer contains any trees, the source goes too.
+        """
+
+        st = self.source_tree(name)
+        s = st.getparent()
+        s.remove(st)
+        del self._source_trees[name]
+        self._name_counts[name] -= 1
+        self._forget_tree(name)
+        if (delete_empty_source and len(s.xpath("source_tree")) == 0):
+            s.getparent().remove(s)
+            self._sources = None
+            self._source_trees = None
+
+    def remove_source(self, name):
+        """ Remove a source and all of its trees
+        """
+
+        s = self.source(name)
+        s.getparent().remove(s)
+        self.invalidate()
+
+    def set_tree_weight(self, name, weight):
+        """ Set the weight of a tree, adding the weight element if needed
+        """
+
+        set_source_tree_weight(self.source_tree(name),weight)
+
+
+def set_source_tree_weight(source_tree, weight):
+    """ Set the weight on a source_tree element
+    """
+
+    if source_tree.xpath("tree/weight/real_value") == []:
+        # add weights
+        weights_element = etree.Element("weight")
+        weights_element.tail="\n"
+        real_value = etree.SubElement(weights_element,'real_value')
+        real_value.attrib['rank'] = '0'
+        real_value.tail = '\n'
+        real_value.text = str(weight)
+        source_tree.xpath("tree")[0].append(weights_element)
+    else:
+        source_tree.xpath("tree/weight/real_value")[0].text = str(weight)
+
+
+def parse_phyml_string(xml_string):
+    """ Lxml cannot parse non-unicode characters
+    so we strip these characters beforehand.
+    """
+
+    with stk_profile.timer("xml parse"):
+        xml_string = "".join(i for i in xml_string if ord(i)<128)
+        return etree.fromstring(xml_string)
+
+
+def get_dataset(XML):
+    """ Return a PhymlDataset for XML, which may be a Phyml string or a
+    dataset already. Datasets for strings are cached, so calling this
+    repeatedly with the same string only parses it once. The returned
+    dataset is shared - use editable_dataset if you want to change it.
+    """
+
+    if (isinstance(XML, PhymlDataset)):
+        return XML
+    try:
+        dataset = _dataset_cache.pop(XML)
+        stk_profile.count("dataset cache hits")
+    except KeyError:
+        stk_profile.count("dataset cache misses")
+        dataset = PhymlDataset(XML)
+        while (len(_dataset_cache) >= DATASET_CACHE_SIZE):
+            _dataset_cache.popitem(last=False)
+    _dataset_cache[XML] = dataset
+    return dataset
+
+
+def editable_dataset(XML):
+    """ Return a PhymlDataset that the caller can alter. A dataset passed
+    in is edited in place; a string gets a private copy.
+    """
+
+    if (isinstance(XML, PhymlDataset)):
+        return XML
+    return get_dataset(XML).copy()
+
+
+def dataset_result(XML, dataset):
+    """ Hand back the result of an edit in the form the caller gave us:
+    the dataset itself if one was passed in, otherwise a Phyml string.
+    The dataset is remembered against that string so the next call that
+    receives it does not need to parse it again.
+    """
+
+    if (isinstance(XML, PhymlDataset)):
+        return dataset
+    XML = dataset.tostring()
+    while (len(_dataset_cache) >= DATASET_CACHE_SIZE):
+        _dataset_cache.popitem(last=False)
+    _dataset_cache[XML] = dataset
+    return XML
+
+
+def clear_dataset_cache():
+    """ Forget all cached documents
+    """
+
+    _dataset_cache.clear()
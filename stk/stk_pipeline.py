@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Running a chain of processing stages with checkpoints.
+
+Each stage is a function that takes the current state (a dictionary: the
+Phyml, taxonomy and so on) and returns the new one. When a stage finishes,
+its output is saved along with a hash of everything that went into it:
+the state it was given, its options and the contents of any files it
+reads. Next time round a stage whose hash matches its checkpoint is not
+run again; its saved output is used instead. Because the output of one
+stage is the input to the next, changing the options of a stage means
+that stage and those after it are run, but not those before it.
+
+A run that crashes or is interrupted therefore carries on from the last
+stage that finished.
+"""
+
+import os
+import sys
+import time
+import hashlib
+import cPickle
+from collections import Mapping
+import stk_profile
+
+# bump this if the checkpoint format changes
+CHECKPOINT_VERSION = 1
+
+
+def _update_hash(h, value):
+    """ Feed a value (built from dicts, lists, strings and numbers) into a
+    hash so that equal values always hash the same, whatever the order of
+    dictionary keys
+    """
+
+    if (isinstance(value, Mapping)):
+        # a dict or anything that looks like one, e.g. a Taxonomy
+        h.update("d%d:" % len(value))
+        for k in sorted(value):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    elif (isinstance(value, (list, tuple))):
+        h.update("l%d:" % len(value))
+        for v in value:
+            _update_hash(h, v)
+    elif (isinstance(value, unicode)):
+        value = value.encode("utf-8")
+        h.update("u%d:" % len(value))
+        h.update(value)
+    elif (isinstance(value, str)):
+        h.update("s%d:" % len(value))
+        h.update(value)
+    elif (value is None or isinstance(value, (bool, int, long, float))):
+        h.update("v"+repr(value)+":")
+    else:
+        data = cPickle.dumps(value, 2)
+        h.update("p%d:" % len(data))
+        h.update(data)
+
+
+def hash_value(value):
+    """ A hex digest of a value (see _update_hash)
+    """
+
+    h = hashlib.sha1()
+    _update_hash(h, value)
+    return h.hexdigest()
+
+
+def hash_file(filename):
+    """ A hex digest of a file's contents, or of None if there is no file
+    """
+
+    if (filename is None or not os.path.exists(filename)):
+        return hash_value(None)
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    while True:
+        data = f.read(1 << 20)
+        if (not data):
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
+
+class Stage(object):
+    """ One step of a Pipeline
+    """
+
+    def __init__(self, name, func, options=None, files=None, version=1):
+        """ func(state) returns the new state. options are anything else
+        the stage's output depends on and files are the names of files it
+        reads. Change version when the stage's code changes in a way that
+        alters its output.
+        """
+
+        self.name = name
+        self.func = func
+        self.options = options
+        self.files = files or []
+        self.version = version
+
+    def key(self, state_hash):
+        """ Hash of everything this stage's output depends on
+        """
+
+        return hash_value([CHECKPOINT_VERSION, self.name, self.version, state_hash,
+                           self.options, [hash_file(f) for f in self.files]])
+
+
+class Pipeline(object):
+    """ A list of stages, run in order, with checkpoints kept in
+    checkpoint_dir. With no checkpoint_dir, nothing is saved.
+    """
+
+    def __init__(self, checkpoint_dir=None, restart=False, verbose=False, out=None):
+        """ restart ignores (and replaces) any existing checkpoints. Stage
+        timings are reported to out (standard output by default).
+        """
+
+        self.checkpoint_dir = checkpoint_dir
+        self.restart = restart
+        self.verbose = verbose
+        if (out is None):
+            out = sys.stdout
+        self.out = out
+        self.stages = []
+        # (stage name, seconds, was the checkpoint used) for each stage run
+        self.timings = []
+
+    def add(self, name, func, options=None, files=None, version=1):
+        self.stages.append(Stage(name, func, options=options, files=files, version=version))
+
+    def _checkpoint_file(self, i):
+        name = "".join([c if c.isalnum() else "_" for c in self.stages[i].name.lower()])
+        return os.path.join(self.checkpoint_dir, "%02d_%s.checkpoint" % (i, name))
+
+    def _load_checkpoint(self, i, key):
+        if (self.checkpoint_dir is None or self.restart):
+            return None
+        filename = self._checkpoint_file(i)
+        if (not os.path.exists(filename)):
+            return None
+        try:
+            f = open(filename, "rb")
+            checkpoint = cPickle.load(f)
+            f.close()
+        except Exception:
+            # a damaged checkpoint is no checkpoint
+            return None
+        if (not checkpoint.get('key') == key):
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, i, key, state, seconds):
+        if (self.checkpoint_dir is None):
+            return
+        if (not os.path.exists(self.checkpoint_dir)):
+            os.makedirs(self.checkpoint_dir)
+        filename = self._checkpoint_file(i)
+        # write then move, so an interrupted write can't leave a bad file
+        temp_file = filename + ".tmp"
+        f = open(temp_file, "wb")
+        cPickle.dump({'key':key, 'state':state, 'seconds':seconds}, f, 2)
+        f.close()
+        if (os.path.exists(filename)):
+            os.remove(filename)
+        os.rename(temp_file, filename)
+
+    def _report(self, message):
+        self.out.write(message+"\n")
+        self.out.flush()
+
+    def run(self, state=None):
+        """ Run the stages (or pick up their checkpoints) and return the
+        final state
+        """
+
+        if (state is None):
+            state = {}
+        self.timings = []
+        n_stages = len(self.stages)
+        for i in range(n_stages):
+            stage = self.stages[i]
+            key = stage.key(hash_value(state))
+            checkpoint = self._load_checkpoint(i, key)
+            if (not checkpoint is None):
+                state = checkpoint['state']
+                self.timings.append((stage.name, 0.0, True))
+                self._report("Stage %d/%d (%s): using saved results from an earlier run" % (i+1, n_stages, stage.name))
+                continue
+            if (self.verbose):
+                self._report("Stage %d/%d (%s): starting" % (i+1, n_stages, stage.name))
+            start = time.time()
+            try:
+                with stk_profile.stage(stage.name):
+                    state = stage.func(state)
+            except KeyboardInterrupt:
+                if (not self.checkpoint_dir is None):
+                    self._report("\nInterrupted during stage %d (%s). Run again to carry on from here." % (i+1, stage.name))
+                raise
+            seconds = time.time() - start
+            self._save_checkpoint(i, key, state, seconds)
+            self.timings.append((stage.name, seconds, False))
+            self._report("Stage %d/%d (%s): %.1fs" % (i+1, n_stages, stage.name, seconds))
+
+        return state
+
+    def clear(self):
+        """ Remove all checkpoints
+        """
+
+        if (self.checkpoint_dir is None or not os.path.exists(self.checkpoint_dir)):
+            return
+        for f in os.listdir(self.checkpoint_dir):
+            if (f.endswith(".checkpoint") or f.endswith(".checkpoint.tmp")):
+                os.remove(os.path.join(self.checkpoint_dir, f))
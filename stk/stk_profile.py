@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Counters and timers for seeing where the time goes.
+
+The hot paths (XML and tree parsing, p4, network requests, caches, the
+matrix writer) call count() and timer() as they go. These do nothing
+unless profiling has been switched on with enable(), so they cost next to
+nothing in a normal run.
+
+Work can be split into stages (e.g. a CLI command, or the stages of
+process) with stage(); the report shows what was counted and timed in
+each of them.
+"""
+
+import sys
+import time
+import threading
+
+enabled = False
+_lock = threading.Lock()
+# name -> number
+_counters = {}
+# name -> [calls, seconds]
+_timers = {}
+# finished (and open) stages, in the order they started
+_stages = []
+_depth = 0
+
+
+def enable():
+    """ Start counting (from zero)
+    """
+
+    global enabled
+    reset()
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    global _depth
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        del _stages[:]
+        _depth = 0
+
+
+def count(name, n=1):
+    """ Add n to a counter
+    """
+
+    if (not enabled):
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def add_time(name, seconds, calls=1):
+    """ Add to a timer directly
+    """
+
+    if (not enabled):
+        return
+    with _lock:
+        t = _timers.setdefault(name, [0, 0.0])
+        t[0] += calls
+        t[1] += seconds
+
+
+class _Timer(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        add_time(self.name, time.time() - self.start)
+        return False
+
+
+class _NoTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_no_timer = _NoTimer()
+
+
+def timer(name):
+    """ Context manager that times what it wraps, e.g.
+
+    with stk_profile.timer("tree parse"):
+        ...
+    """
+
+    if (not enabled):
+        return _no_timer
+    return _Timer(name)
+
+
+def timed(name):
+    """ Decorator version of timer()
+    """
+
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            if (not enabled):
+                return func(*args, **kwargs)
+            with _Timer(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
+
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global _depth
+        with _lock:
+            self.record = {'name':self.name,
+                           'depth':_depth,
+                           'seconds':None,
+                           'counters':dict(_counters),
+                           'timers':dict([(k, list(v)) for k, v in _timers.iteritems()])}
+            _stages.append(self.record)
+            _depth += 1
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        global _depth
+        seconds = time.time() - self.start
+        with _lock:
+            _depth -= 1
+            # what was counted while we were running
+            before = self.record['counters']
+            self.record['counters'] = dict([(k, v - before.get(k, 0)) for k, v in _counters.iteritems()
+                                            if not v == before.get(k, 0)])
+            before = self.record['timers']
+            timers = {}
+            for k, v in _timers.iteritems():
+                b = before.get(k, [0, 0.0])
+                if (not v[0] == b[0]):
+                    timers[k] = {'calls':v[0] - b[0], 'seconds':v[1] - b[1]}
+            self.record['timers'] = timers
+            self.record['seconds'] = seconds
+        return False
+
+
+def stage(name):
+    """ Context manager marking a stage of the work. Stages can be nested.
+    """
+
+    if (not enabled):
+        return _no_timer
+    return _Stage(name)
+
+
+def summary():
+    """ Everything counted so far, as a dictionary that can be saved as
+    JSON: the totals and the stages
+    """
+
+    with _lock:
+        timers = {}
+        for k, v in _timers.iteritems():
+            timers[k] = {'calls':v[0], 'seconds':v[1]}
+        return {'counters':dict(_counters),
+                'timers':timers,
+                'stages':[dict(s) for s in _stages if not s['seconds'] is None]}
+
+
+def report(out=None):
+    """ Write a readable breakdown of each stage to out (standard output by
+    default)
+    """
+
+    if (out is None):
+        out = sys.stdout
+    s = summary()
+    out.write("\nProfile\n")
+    out.write("%-40s %10s %12s\n" % ("Stage / timer / counter", "calls", "seconds"))
+    for st in s['stages']:
+        indent = "  "*st['depth']
+        out.write("%-40s %10s %12.3f\n" % (indent+st['name'], "", st['seconds']))
+        for name in sorted(st['timers']):
+            t = st['timers'][name]
+            out.write("%-40s %10d %12.3f\n" % (indent+"  "+name, t['calls'], t['seconds']))
+        for name in sorted(st['counters']):
+            out.write("%-40s %10d\n" % (indent+"  "+name, st['counters'][name]))
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Dataset statistics in one go.
+
+data_summary used to call obtain_trees, get_all_taxa, get_all_characters,
+get_character_numbers, get_fossil_taxa, get_publication_years and
+get_analyses_used in turn, each walking the whole document again.
+statistics() walks the document once, gets the taxa from the trees the
+dataset has already parsed, and keeps the result against a hash of the
+document, so summarising the same data again costs a hash of the string.
+
+Missing attributes are skipped, as the get_* functions do when told to
+ignore errors, and trees that can't be parsed contribute no taxa.
+"""
+
+import gc
+import hashlib
+import logging
+from collections import OrderedDict
+import stk_exceptions as excp
+import stk_phyml
+import stk_profile
+
+# How many sets of statistics we keep, keyed on the hash of the document
+STATISTICS_CACHE_SIZE = 8
+_statistics_cache = OrderedDict()
+
+
+class DatasetStatistics(object):
+    """ The numbers data_summary reports for a dataset:
+
+    project_name       - the name of the project
+    trees              - dictionary of tree name to tree string
+    taxa               - sorted list of all taxa in the trees
+    characters         - dictionary of character type to character names,
+                         in order of type
+    character_numbers  - dictionary of character name to how often it's used
+    fossils            - list of fossil taxa
+    publication_years  - dictionary of year to number of publications
+    analyses           - sorted list of the analyses used
+    """
+
+    def __init__(self, project_name=None, trees=None, taxa=None, characters=None,
+                 character_numbers=None, fossils=None, publication_years=None,
+                 analyses=None):
+        self.project_name = project_name
+        self.trees = trees or {}
+        self.taxa = taxa or []
+        self.characters = characters or {}
+        self.character_numbers = character_numbers or {}
+        self.fossils = fossils or []
+        self.publication_years = publication_years or {}
+        self.analyses = analyses or []
+
+    def summary(self, detailed=False):
+        """ The text of data_summary for these statistics
+        """
+
+        years = self.publication_years.keys()
+        years.sort()
+        chars = self.character_numbers.keys()
+        chars.sort()
+
+        output_string  = "======================\n"
+        output_string += " Data summary of: " + self.project_name + "\n"
+        output_string += "======================\n\n"
+
+        output_string += "Number of taxa: "+str(len(self.taxa))+"\n"
+        output_string += "Number of characters: "+str(len(chars))+"\n"
+        output_string += "Number of character types: "+str(len(self.characters))+"\n"
+        output_string += "Number of trees: "+str(len(self.trees))+"\n"
+        output_string += "Number of fossil taxa: "+str(len(self.fossils))+"\n"
+        output_string += "Number of analyses: "+str(len(self.analyses))+"\n"
+        output_string += "Data spans: "+str(years[0])+" - "+str(years[-1])+"\n"
+
+        if (detailed):
+            # append additional info including full list of characters
+            # full list of taxa and full list of fossil taxa
+            output_string += "\nPublication years:\n"
+            output_string += "----------------------\n"
+            for i in range(years[0],years[-1]+1):
+                output_string += "    "+str(i)+": "+str(self.publication_years.get(i,0))+"\n"
+            output_string += "----------------------\n"
+
+            output_string += "\n\nCharacter Type List:\n"
+            output_string += "----------------------\n"
+            for c in self.characters:
+                output_string += "     "+c+"    " + "\n"
+            output_string += "----------------------\n"
+
+            output_string += "\n\nAnalyses Used:\n"
+            output_string += "----------------------\n"
+            for a in self.analyses:
+                output_string += "     "+a+"\n"
+            output_string += "----------------------\n"
+
+            output_string += "\n\nCharacter List:\n"
+            output_string += "----------------------\n"
+            for c in chars:
+                output_string += "     "+c+"    "+str(self.character_numbers[c])+"("+str(float(self.character_numbers[c])/float(len(self.trees))*100.)+"%)\n"
+            output_string += "----------------------\n"
+
+            output_string += "\n\nTaxa List:\n"
+            output_string += "----------------------\n"
+            for t in self.taxa:
+                output_string += "     "+t+"\n"
+            output_string += "----------------------\n"
+
+        return output_string
+
+
+def statistics(XML):
+    """ The DatasetStatistics of a dataset (Phyml string or
+    stk_phyml.PhymlDataset). These are shared, so don't alter them.
+    """
+
+    if (isinstance(XML, stk_phyml.PhymlDataset)):
+        content = XML.tostring()
+    else:
+        content = XML
+    if (isinstance(content, unicode)):
+        content = content.encode("utf-8")
+    key = hashlib.sha1(content).hexdigest()
+    try:
+        stats = _statistics_cache.pop(key)
+        stk_profile.count("statistics cache hits")
+    except KeyError:
+        stk_profile.count("statistics cache misses")
+        with stk_profile.timer("statistics"):
+            stats = _statistics(stk_phyml.get_dataset(XML))
+        while (len(_statistics_cache) >= STATISTICS_CACHE_SIZE):
+            _statistics_cache.popitem(last=False)
+    _statistics_cache[key] = stats
+    return stats
+
+
+def clear_statistics_cache():
+    """ Forget all statistics
+    """
+
+    _statistics_cache.clear()
+
+
+def _statistics(dataset):
+
+    xml_root = dataset.xml_root
+    project_name = xml_root.xpath('/phylo_storage/project_name/string_value')[0].text
+
+    characters = {}
+    character_numbers = {}
+    fossils = []
+    seen_fossils = set()
+    publication_years = {}
+    analyses = set()
+    for e in xml_root.iter("character", "fossil", "optimality_criterion", "year"):
+        if (e.tag == "character"):
+            name = e.attrib.get('name')
+            if (not name is None):
+                character_numbers[name] = character_numbers.get(name, 0) + 1
+            c_type = e.attrib.get('type')
+            if (not c_type is None):
+                names = characters.setdefault(c_type, [])
+                if (not name is None and not name in names):
+                    names.append(name)
+        elif (e.tag == "fossil"):
+            name = e.getparent().attrib.get('name')
+            if (not name is None and not name in seen_fossils):
+                seen_fossils.add(name)
+                fossils.append(name)
+        elif (e.tag == "optimality_criterion"):
+            name = e.attrib.get('name')
+            if (not name is None):
+                analyses.add(name)
+        else:
+            try:
+                year = int(e.xpath('integer_value')[0].text)
+                publication_years[year] = publication_years.get(year, 0) + 1
+            except (TypeError, IndexError, ValueError):
+                # a year with no (or no sensible) value
+                pass
+
+    # the trees the dataset has parsed (or the tree cache has) are reused.
+    # Parsing makes a lot of objects that are all kept, so the collector
+    # would only be scanning them over and over
+    trees = dataset.trees()
+    taxa = set()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for name in trees:
+            try:
+                taxa.update(dataset.tree_taxa(name))
+            except excp.TreeParseError as detail:
+                logging.warning(detail.msg)
+    finally:
+        if (gc_was_enabled):
+            gc.enable()
+    taxa = list(taxa)
+    taxa.sort()
+    c_types = characters.keys()
+    c_types.sort()
+    characters = OrderedDict([(t, characters[t]) for t in c_types])
+    analyses = list(analyses)
+    analyses.sort()
+
+    return DatasetStatistics(project_name=project_name, trees=trees, taxa=taxa,
+                             characters=characters, character_numbers=character_numbers,
+                             fossils=fossils, publication_years=publication_years,
+                             analyses=analyses)
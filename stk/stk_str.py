@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Safe taxonomic reduction on packed bit-planes.
+
+The character matrix is stored as a "coded" plane (bit set where the cell
+is not missing) plus enough state planes to tell the character states
+apart (one for binary MRP data). Each plane is packed 8 characters to a
+byte, so comparing one taxon against all the others is a handful of
+whole-row AND/XOR operations rather than a loop over characters.
+
+The taxon x taxon comparison is split into blocks of rows, which can be
+farmed out to a process pool.
+"""
+
+import numpy
+import multiprocessing
+
+MISSING_CHAR = "?"
+# Rows of the equivalence matrix handed to each worker at a time
+STR_BLOCK_SIZE = 64
+
+# number of set bits in each possible byte
+_popcount = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.int64)
+
+# the planes, as seen by pool workers
+_worker_data = None
+
+
+def bit_planes(matrix, missing_char=MISSING_CHAR):
+    """ Pack a character matrix (taxa on i, characters on j) into
+    bit-planes.
+
+    returns: coded plane, list of state planes and a list of the number
+             of missing characters for each taxon
+    """
+
+    matrix = numpy.asarray(matrix)
+    if (matrix.ndim != 2):
+        matrix = matrix.reshape((len(matrix), -1))
+    nChars = matrix.shape[1]
+    coded = (matrix != missing_char)
+    # give each state a number; missing cells are zero in every state plane
+    states = numpy.unique(matrix[coded])
+    state_index = numpy.zeros(matrix.shape, dtype=numpy.int64)
+    state_index[coded] = numpy.searchsorted(states, matrix[coded])
+    nPlanes = max(1, int(numpy.ceil(numpy.log2(max(len(states), 1)))))
+    state_planes = []
+    for p in range(nPlanes):
+        plane = ((state_index >> p) & 1).astype(bool) & coded
+        state_planes.append(numpy.packbits(plane, axis=1))
+    coded = numpy.packbits(coded, axis=1)
+    missing = nChars - _popcount[coded].sum(axis=1)
+    missing = [int(m) for m in missing]
+
+    return coded, state_planes, missing
+
+
+def compare_rows(start, end, coded, state_planes, missing, taxa):
+    """ Work out the equivalent taxa for rows start to end-1 of the matrix.
+
+    returns: list, one entry per row, of [taxon, class, missing] lists
+             in matrix order, where class is one of A-E as in PerEQ
+    """
+
+    results = []
+    for i in range(start, end):
+        x_coded = coded[i]
+        both_coded = x_coded & coded
+        # any coded character where the two taxa differ
+        non_equiv = numpy.zeros(len(taxa), dtype=bool)
+        for p in state_planes:
+            non_equiv |= ((p[i] ^ p) & both_coded).any(axis=1)
+        xMiss_yCode = ((~x_coded) & coded).any(axis=1)
+        xCode_yMiss = (x_coded & (~coded)).any(axis=1)
+        equiv_taxa = []
+        for j in numpy.flatnonzero(~non_equiv):
+            if (taxa[j] == taxa[i]):
+                continue
+            if (not xMiss_yCode[j] and not xCode_yMiss[j]):
+                if (missing[i] == 0):
+                    cls = "A"
+                else:
+                    cls = "B"
+            elif (not xMiss_yCode[j]):
+                cls = "C"
+            elif (not xCode_yMiss[j]):
+                cls = "E"
+            else:
+                cls = "D"
+            equiv_taxa.append([taxa[j], cls, missing[j]])
+        results.append(equiv_taxa)
+
+    return results
+
+
+def _init_worker(coded, state_planes, missing, taxa):
+    global _worker_data
+    _worker_data = (coded, state_planes, missing, taxa)
+
+
+def _compare_block(block):
+    start, end = block
+    coded, state_planes, missing, taxa = _worker_data
+    return compare_rows(start, end, coded, state_planes, missing, taxa)
+
+
+def equivalent_taxa(matrix, taxa, missing_char=MISSING_CHAR, n_jobs=1, block_size=None, verbose=False):
+    """ Find the taxa that are equivalent to each taxon in the matrix.
+
+    n_jobs > 1 spreads the blocks of rows over a process pool.
+
+    returns: list of equivalent taxa for each taxon (see compare_rows) and
+             the number of missing characters for each taxon
+    """
+
+    coded, state_planes, missing = bit_planes(matrix, missing_char=missing_char)
+    nTaxa = len(taxa)
+    if (block_size is None):
+        block_size = STR_BLOCK_SIZE
+    block_size = max(1, int(block_size))
+    blocks = [(s, min(s+block_size, nTaxa)) for s in range(0, nTaxa, block_size)]
+
+    equivs = []
+    if (n_jobs is None or n_jobs <= 1 or len(blocks) <= 1):
+        for start, end in blocks:
+            equivs.extend(compare_rows(start, end, coded, state_planes, missing, taxa))
+            if (verbose):
+                print "Done taxa "+str(end)+" of "+str(nTaxa)
+    else:
+        pool = multiprocessing.Pool(processes=n_jobs, initializer=_init_worker,
+                                    initargs=(coded, state_planes, missing, list(taxa)))
+        try:
+            for block, result in zip(blocks, pool.imap(_compare_block, blocks)):
+                equivs.extend(result)
+                if (verbose):
+                    print "Done taxa "+str(block[1])+" of "+str(nTaxa)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    return equivs, missing
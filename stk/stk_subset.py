@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Answering create_subset queries from an index.
+
+create_subset used to take every source out of a copy of the data and
+then scan all of the sources once for each kind of search term. A
+SubsetIndex walks the document once and records, for each year, character,
+character type, analysis, taxon and fossil flag, the sources or trees that
+have it. A query is then a few set operations.
+
+The index belongs to a stk_phyml.PhymlDataset (see subset_index()) and so
+lasts as long as the dataset does: asking several questions of the same
+data builds it once. The taxa are only indexed if a query asks about them,
+as that means parsing every tree.
+
+Each term filters the trees in turn, just as the old scans did, so the
+results are the same:
+ - "and" searches keep the sources that match every term, with the trees
+   that match every tree term.
+ - "or" searches keep the sources that match any term. A source's trees
+   are still those that match every tree term.
+"""
+
+from collections import defaultdict
+
+
+class SubsetIndex(object):
+    """ Sources, trees and what they contain, for one dataset. Sources and
+    trees are numbered in document order.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        # source number -> source element
+        self.sources = []
+        # tree number -> source_tree element, and the source it's in
+        self.trees = []
+        self.tree_source = []
+        self.years = defaultdict(set)
+        self.character_types = defaultdict(set)
+        self.characters = defaultdict(set)
+        # tree number -> set of its character types or names
+        self.tree_character_types = []
+        self.tree_characters = []
+        self.analyses = defaultdict(set)
+        # trees without an optimality criterion are not removed
+        # by an analysis search
+        self.no_analysis = set()
+        self.all_extant = set()
+        self.all_fossil = set()
+        self._taxa = None
+
+        for s in dataset.xml_root.iter("source"):
+            i = len(self.sources)
+            self.sources.append(s)
+            year = s.find(".//year")
+            if (not year is None):
+                value = year.find("integer_value")
+                if (not value is None and not value.text is None):
+                    self.years[int(value.text)].add(i)
+            for st in s.iter("source_tree"):
+                j = len(self.trees)
+                self.trees.append(st)
+                self.tree_source.append(i)
+                types = set()
+                names = set()
+                for c in st.iter("character"):
+                    types.add(c.attrib['type'])
+                    names.add(c.attrib['name'])
+                for t in types:
+                    self.character_types[t].add(j)
+                for n in names:
+                    self.characters[n].add(j)
+                self.tree_character_types.append(types)
+                self.tree_characters.append(names)
+                criteria = list(st.iter("optimality_criterion"))
+                if (len(criteria) == 0):
+                    self.no_analysis.add(j)
+                for o in criteria:
+                    self.analyses[o.attrib['name']].add(j)
+                if (len(list(st.iter("all_extant"))) > 0):
+                    self.all_extant.add(j)
+                elif (len(list(st.iter("all_fossil"))) > 0):
+                    self.all_fossil.add(j)
+
+    def _get_taxa(self):
+        """ taxon -> trees that contain it, or a non-monophyletic version
+        of it (taxon%N). Built the first time it is needed.
+        """
+
+        if (self._taxa is None):
+            # parsed trees are shared via the tree cache
+            from supertree_toolkit import _parse_tree_cached
+            import stk_exceptions as excp
+            taxa = defaultdict(set)
+            for j in range(len(self.trees)):
+                value = self.trees[j].find("tree/tree_string/string_value")
+                if (value is None or value.text is None):
+                    continue
+                try:
+                    tree = _parse_tree_cached(value.text)
+                except excp.TreeParseError:
+                    continue
+                for t in tree.taxa_set.union(tree.percent_bases):
+                    taxa[t].add(j)
+            self._taxa = taxa
+        return self._taxa
+
+    def _character_trees(self, terms, index, tree_sets, andSearch, includeMultiple):
+        if (andSearch and includeMultiple):
+            # trees with all of the terms (and maybe others)
+            trees = None
+            for t in terms:
+                if (trees is None):
+                    trees = set(index.get(t, ()))
+                else:
+                    trees &= index.get(t, set())
+            return trees
+        elif (not andSearch):
+            # trees with any of them
+            trees = set()
+            for t in terms:
+                trees |= index.get(t, set())
+            return trees
+        else:
+            # trees with nothing but them
+            terms = set(terms)
+            return set([j for j in range(len(self.trees)) if tree_sets[j].issubset(terms)])
+
+    def query(self, search_terms, andSearch=True, includeMultiple=True):
+        """ The sources that match the search terms (as create_subset takes
+        them, with the years already a list of years) and the trees in each
+        that match. Returns a list of (source element, list of source_tree
+        elements), in the order create_subset adds them.
+        """
+
+        all_sources = set(range(len(self.sources)))
+        sources = all_sources
+        trees = set(range(len(self.trees)))
+        # for an "or" search, the sources each term matched, in turn
+        matched = []
+
+        # each step is the sources (years) or the trees the term keeps,
+        # and for trees, the trees that count as a match for their source
+        # (only different for analyses)
+        steps = []
+        years = search_terms.get('years', [])
+        if (len(years) > 0):
+            keep = set()
+            for y in years:
+                keep |= self.years.get(y, set())
+            steps.append(('sources', keep, None))
+        charTypes = search_terms.get('character_types', [])
+        if (len(charTypes) > 0):
+            keep = self._character_trees(charTypes, self.character_types, self.tree_character_types,
+                                         andSearch, includeMultiple)
+            steps.append(('trees', keep, keep))
+        chars = search_terms.get('characters', [])
+        if (len(chars) > 0):
+            keep = self._character_trees(chars, self.characters, self.tree_characters,
+                                         andSearch, includeMultiple)
+            steps.append(('trees', keep, keep))
+        analyses = search_terms.get('analyses', [])
+        if (len(analyses) > 0):
+            match = set()
+            for a in analyses:
+                match |= self.analyses.get(a, set())
+            steps.append(('trees', match | self.no_analysis, match))
+        taxa = search_terms.get('taxa', [])
+        if (len(taxa) > 0):
+            index = self._get_taxa()
+            keep = set()
+            for t in taxa:
+                keep |= index.get(t.replace(" ","_").replace("'",""), set())
+            steps.append(('trees', keep, keep))
+        fossil = search_terms.get('fossil', None)
+        if (fossil == "all_extant"):
+            steps.append(('trees', self.all_extant, self.all_extant))
+        elif (fossil == "all_fossil"):
+            steps.append(('trees', self.all_fossil, self.all_fossil))
+
+        for kind, keep, match in steps:
+            if (kind == 'sources'):
+                hit = sources & keep
+            else:
+                # only trees of the sources still in the running
+                # (all of them for an "or" search) are looked at
+                hit = set([self.tree_source[j] for j in (trees & match)]) & sources
+                trees = trees & keep
+            if (andSearch):
+                sources = hit
+            else:
+                matched.append(sorted(hit))
+
+        if (andSearch):
+            order = sorted(sources)
+        else:
+            # a source matched by more than one term ends up where it
+            # was last added
+            last = {}
+            flat = [i for hit in matched for i in hit]
+            for k in range(len(flat)):
+                last[flat[k]] = k
+            order = [i for k, i in enumerate(flat) if last[i] == k]
+
+        kept = defaultdict(list)
+        for j in sorted(trees):
+            kept[self.tree_source[j]].append(self.trees[j])
+        return [(self.sources[i], kept[i]) for i in order]
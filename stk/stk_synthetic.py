@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Made-up Phyml datasets of any size, for benchmarking and testing.
+
+The datasets are valid STK data (they pass _check_data) and are the same
+every time for the same arguments. Taxa are called GenusNNN_spNNNNN, so
+they fall into genera of ten species. How much the trees share taxa is
+set by overlap: that fraction of each tree's taxa come from a core of
+taxa shared by all trees and the rest are picked from all of the taxa.
+"""
+
+import random
+from lxml import etree
+
+# character names and types picked from for each tree
+CHARACTERS = [("molecular", "cytb"), ("molecular", "ND2"), ("molecular", "12S"),
+              ("molecular", "COI"), ("molecular", "RAG1"), ("morphological", "skeletal"),
+              ("morphological", "plumage"), ("behavioural", "song")]
+ANALYSES = ["Maximum Parsimony", "Maximum Likelihood", "Bayesian", "Neighbour Joining"]
+# species per genus
+SPECIES_PER_GENUS = 10
+
+
+def taxon_name(i):
+    """ The name of taxon i in a synthetic dataset
+    """
+
+    return "Genus%03d_sp%05d" % (i // SPECIES_PER_GENUS, i)
+
+
+def random_tree(taxa, rng):
+    """ A random, fully resolved Newick string for a list of taxa
+    """
+
+    subtrees = list(taxa)
+    while (len(subtrees) > 1):
+        i = rng.randrange(len(subtrees))
+        a = subtrees.pop(i)
+        j = rng.randrange(len(subtrees))
+        subtrees[j] = "(" + a + "," + subtrees[j] + ")"
+    return subtrees[0] + ";"
+
+
+def synthetic_phyml(n_sources=10, n_trees=None, n_taxa=None, taxa_per_tree=20, overlap=0.5,
+                    non_monophyletic=0.1, weighted=0.0, seed=0, project_name="synthetic"):
+    """ Create a synthetic Phyml dataset and return it as a string.
+
+    n_sources: number of sources
+    n_trees: number of trees (default one per source); shared out between the sources
+    n_taxa: number of different taxa (default five times taxa_per_tree)
+    taxa_per_tree: number of taxa in each tree
+    overlap: fraction (0-1) of each tree's taxa taken from a core shared by every tree
+    non_monophyletic: fraction of trees that contain a non-monophyletic taxon
+                      (one taxon twice, as Taxon%1 and Taxon%2)
+    weighted: fraction of trees given a weight other than 1
+    seed: random seed - the same arguments and seed give the same dataset
+    """
+
+    if (n_trees is None):
+        n_trees = n_sources
+    if (n_taxa is None):
+        n_taxa = 5*taxa_per_tree
+    taxa_per_tree = min(taxa_per_tree, n_taxa)
+    rng = random.Random(seed)
+    taxa = [taxon_name(i) for i in range(n_taxa)]
+    core = taxa[:min(n_taxa, taxa_per_tree)]
+
+    root = etree.Element("phylo_storage")
+    _string_value(etree.SubElement(root, "project_name"), project_name)
+    sources = etree.SubElement(root, "sources")
+    source_elements = []
+    for i in range(n_sources):
+        year = 1990 + (i % 30)
+        name = "Author%05d_%d" % (i, year)
+        s = etree.SubElement(sources, "source", name=name)
+        article = etree.SubElement(etree.SubElement(s, "bibliographic_information"), "article")
+        author = etree.SubElement(etree.SubElement(article, "authors"), "author")
+        _string_value(etree.SubElement(author, "surname"), "Author%05d" % i)
+        _string_value(etree.SubElement(author, "other_names"), "A.")
+        _string_value(etree.SubElement(article, "title"), "Synthetic source %d" % i)
+        y = etree.SubElement(etree.SubElement(article, "year"), "integer_value", rank="0")
+        y.text = str(year)
+        source_elements.append((name, s))
+
+    tree_counts = [0]*n_sources
+    for i in range(n_trees):
+        # spread the trees over the sources
+        source = i % n_sources
+        name, s = source_elements[source]
+        tree_counts[source] += 1
+        n_core = int(round(overlap*taxa_per_tree))
+        tree_taxa = rng.sample(core, n_core)
+        chosen = set(tree_taxa)
+        while (len(tree_taxa) < taxa_per_tree):
+            t = taxa[rng.randrange(n_taxa)]
+            if (not t in chosen):
+                chosen.add(t)
+                tree_taxa.append(t)
+        if (rng.random() < non_monophyletic and len(tree_taxa) > 2):
+            t = tree_taxa.pop(0)
+            tree_taxa.extend([t+"%1", t+"%2"])
+        st = etree.SubElement(s, "source_tree", name=name+"_"+str(tree_counts[source]))
+        tree = etree.SubElement(st, "tree")
+        _string_value(etree.SubElement(tree, "tree_string"), random_tree(tree_taxa, rng))
+        _string_value(etree.SubElement(tree, "figure_legend"), "NA")
+        _string_value(etree.SubElement(tree, "figure_number"), "1")
+        _string_value(etree.SubElement(tree, "page_number"), "1")
+        etree.SubElement(etree.SubElement(tree, "tree_inference"), "optimality_criterion",
+                         name=rng.choice(ANALYSES))
+        _string_value(etree.SubElement(etree.SubElement(tree, "topology"), "outgroup"),
+                      tree_taxa[-1].split("%")[0])
+        if (rng.random() < weighted):
+            weight = etree.SubElement(etree.SubElement(tree, "weight"), "real_value", rank="0")
+            weight.text = str(rng.choice([0.25, 0.5]))
+        etree.SubElement(etree.SubElement(st, "taxa_data"), "all_extant")
+        characters = etree.SubElement(st, "character_data")
+        for c_type, c_name in sorted(rng.sample(CHARACTERS, rng.randint(1, 3))):
+            etree.SubElement(characters, "character", type=c_type, name=c_name)
+
+    # sources we didn't give a tree to would fail _check_data
+    for (name, s), count in zip(source_elements, tree_counts):
+        if (count == 0):
+            sources.remove(s)
+    etree.SubElement(root, "history")
+
+    return etree.tostring(root, pretty_print=True)
+
+
+def _string_value(parent, text):
+    value = etree.SubElement(parent, "string_value", lines="1")
+    value.text = text
+    return value
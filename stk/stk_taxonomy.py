@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" A compact taxonomy.
+
+A taxonomy is usually a dictionary of dictionaries: {otu: {rank: name,
+'provider': ...}}. For a few thousand taxa that's fine, but a backbone
+of a few hundred thousand taxa holds millions of small dictionaries and
+copies of the same few thousand genus and family names.
+
+A Taxonomy keeps each name once, in a string table, and stores one array
+of string numbers per rank (-1 where a taxon has nothing at that rank).
+It looks like the dictionary it replaces: taxonomy[otu] gives a new
+{rank: name} dictionary. As that is a copy, change a taxon by assigning
+its entry back (taxonomy[otu] = entry).
+
+Taxonomies are read from and written to the usual CSV file (read_csv and
+write_csv) and can be saved as a snapshot (save and load), which is the
+arrays as they are and loads much faster than the CSV.
+"""
+
+import csv
+import gc
+import itertools
+import operator
+from array import array
+from collections import MutableMapping
+import numpy
+import stk_exceptions as excp
+
+# what goes in a CSV file for a rank a taxon doesn't have
+MISSING = "-"
+PROVIDER = "provider"
+SNAPSHOT_VERSION = 1
+# snapshots are numpy .npz files, which are zip files
+_SNAPSHOT_MAGIC = "PK"
+# how many rows of a CSV file are added at once
+CSV_CHUNK = 10000
+
+
+class Taxonomy(MutableMapping):
+    """ A taxonomy dictionary, {otu: {rank: name}}, stored by column.
+    """
+
+    def __init__(self, taxonomy=None):
+        # the string table
+        self._strings = []
+        self._string_ids = {}
+        # otu -> row and row -> otu (None once removed)
+        self._rows = {}
+        self._otus = []
+        # rank -> array of string numbers, one per row
+        self._columns = {}
+        self._ranks = []
+        # rows of a CSV file that couldn't be read: (row number, message)
+        self.malformed = []
+        if (not taxonomy is None):
+            for otu in taxonomy:
+                self[otu] = taxonomy[otu]
+
+    def _ids(self):
+        """ name -> its number in the string table. A loaded snapshot only
+        makes this when something is added.
+        """
+
+        if (self._string_ids is None):
+            self._string_ids = dict(itertools.izip(self._strings, itertools.count()))
+        return self._string_ids
+
+    def _string_id(self, name):
+        string_ids = self._ids()
+        try:
+            return string_ids[name]
+        except KeyError:
+            if (isinstance(name, str)):
+                name = intern(name)
+            i = len(self._strings)
+            self._strings.append(name)
+            string_ids[name] = i
+            return i
+
+    def _add_strings(self, names):
+        """ Put the names that aren't in the string table into it
+        """
+
+        string_ids = self._ids()
+        new = [intern(n) if isinstance(n, str) else n for n in set(names).difference(string_ids)]
+        start = len(self._strings)
+        self._strings.extend(new)
+        string_ids.update(zip(new, xrange(start, start+len(new))))
+
+    def _column(self, rank):
+        try:
+            return self._columns[rank]
+        except KeyError:
+            column = array('i', [-1]) * len(self._otus)
+            self._columns[rank] = column
+            self._ranks.append(rank)
+            return column
+
+    def ranks(self):
+        """ The ranks (and provider) any taxon has, in the order first seen
+        """
+
+        return list(self._ranks)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __contains__(self, otu):
+        return otu in self._rows
+
+    def __getitem__(self, otu):
+        row = self._rows[otu]
+        strings = self._strings
+        entry = {}
+        for rank in self._ranks:
+            i = self._columns[rank][row]
+            if (i >= 0):
+                entry[rank] = strings[i]
+        return entry
+
+    def __setitem__(self, otu, entry):
+        if (isinstance(otu, str)):
+            otu = intern(otu)
+        try:
+            row = self._rows[otu]
+        except KeyError:
+            row = len(self._otus)
+            self._otus.append(otu)
+            self._rows[otu] = row
+            for column in self._columns.itervalues():
+                column.append(-1)
+        else:
+            for column in self._columns.itervalues():
+                column[row] = -1
+        for rank, name in entry.iteritems():
+            if (isinstance(name, list)):
+                # some providers give a species as [genus, epithet]
+                name = " ".join(name)
+            self._column(rank)[row] = self._string_id(name)
+
+    def __delitem__(self, otu):
+        row = self._rows.pop(otu)
+        self._otus[row] = None
+        for column in self._columns.itervalues():
+            column[row] = -1
+
+    def get_rank(self, otu, rank, default=None):
+        """ taxonomy[otu].get(rank, default), without making the entry
+        """
+
+        try:
+            i = self._columns[rank][self._rows[otu]]
+        except KeyError:
+            return default
+        if (i < 0):
+            return default
+        return self._strings[i]
+
+    def _csv_rows(self, ranks):
+        """ The rows of a CSV file of the taxonomy, made a column at a time
+        """
+
+        rows = [row for row in range(len(self._otus)) if not self._otus[row] is None]
+        # -1 picks the last string: what we write for nothing
+        strings = map(_encode, self._strings) + [MISSING]
+        columns = [[_encode(self._otus[row]) for row in rows]]
+        for rank in list(ranks) + [PROVIDER]:
+            if (rank in self._columns):
+                column = self._columns[rank]
+                columns.append(map(strings.__getitem__, [column[row] for row in rows]))
+            else:
+                columns.append([MISSING] * len(rows))
+        return zip(*columns)
+
+    def save(self, filename):
+        """ Save a snapshot of the taxonomy, for load() to read
+        """
+
+        rows = [row for row in range(len(self._otus)) if not self._otus[row] is None]
+        columns = numpy.empty((len(self._ranks), len(rows)), dtype=numpy.intc)
+        for i in range(len(self._ranks)):
+            column = numpy.frombuffer(self._columns[self._ranks[i]], dtype=numpy.intc)
+            columns[i] = column[rows]
+        f = open(filename, "wb")
+        try:
+            numpy.savez(f, version=numpy.array([SNAPSHOT_VERSION]),
+                        strings=_pack(self._strings), ranks=_pack(self._ranks),
+                        otus=_pack([self._otus[row] for row in rows]), columns=columns)
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, filename):
+        """ Read a snapshot written by save()
+        """
+
+        try:
+            data = numpy.load(filename)
+            version = int(data['version'][0])
+            if (not version == SNAPSHOT_VERSION):
+                raise excp.TaxonomyFileError("Taxonomy snapshot "+filename+" is version "+str(version)+
+                                             ". Save it again from the CSV file.")
+            strings = _unpack(data['strings'])
+            ranks = _unpack(data['ranks'])
+            otus = _unpack(data['otus'])
+            columns = data['columns']
+        except (IOError, KeyError, ValueError) as detail:
+            raise excp.TaxonomyFileError("Could not read the taxonomy snapshot "+filename+": "+str(detail))
+
+        taxonomy = cls()
+        taxonomy._strings = strings
+        taxonomy._string_ids = None
+        taxonomy._otus = otus
+        taxonomy._rows = dict(itertools.izip(otus, itertools.count()))
+        taxonomy._ranks = ranks
+        for i in range(len(ranks)):
+            taxonomy._columns[ranks[i]] = array('i', columns[i].astype(numpy.intc).tostring())
+        return taxonomy
+
+
+def _pack(strings):
+    """ A list of strings as a numpy array of bytes, each ended by a \\0
+    """
+
+    encoded = []
+    for s in strings:
+        if (isinstance(s, unicode)):
+            s = s.encode("utf-8")
+        encoded.append(s+"\0")
+    return numpy.array(bytearray("".join(encoded)), dtype=numpy.uint8)
+
+
+def _unpack(packed):
+    return map(intern, packed.tostring().split("\0")[:-1])
+
+
+def is_snapshot(filename):
+    """ True if the file is a snapshot rather than a CSV file
+    """
+
+    f = open(filename, "rb")
+    try:
+        return f.read(len(_SNAPSHOT_MAGIC)) == _SNAPSHOT_MAGIC
+    finally:
+        f.close()
+
+
+def read_csv(filename):
+    """ Read a taxonomy CSV file (as write_csv or the create_taxonomy
+    command write them): a header of OTU, the ranks and the data source,
+    then one row per OTU. Rows with the wrong number of columns are
+    skipped and listed in the taxonomy's malformed attribute.
+    """
+
+    taxonomy = Taxonomy()
+    ranks = _read_csv(filename, _add_csv_rows, taxonomy, taxonomy.malformed)
+    # even if there were no rows
+    for rank in ranks:
+        taxonomy._column(rank)
+    return taxonomy
+
+
+def read_csv_dict(filename):
+    """ Read a taxonomy CSV file as read_csv does, but into a dictionary,
+    {otu: {rank: name}}
+
+    returns: the dictionary, and a list of the rows that couldn't be
+    read, as (row number, message)
+    """
+
+    taxonomy = {}
+    malformed = []
+    _read_csv(filename, _add_csv_dict_rows, taxonomy, malformed)
+    return taxonomy, malformed
+
+
+def _read_csv(filename, add_rows, taxonomy, malformed):
+    """ Read a taxonomy CSV file a chunk of rows at a time, and give each
+    chunk to add_rows(taxonomy, rows, ranks, rank_columns). Rows with the
+    wrong number of columns are added to malformed.
+
+    returns: the ranks in the file (the data source as PROVIDER)
+    """
+
+    # lots of small lists and strings, none of which are cyclic
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(filename, 'rU') as csvfile:
+            reader = csv.reader(csvfile, delimiter=',')
+            try:
+                header = reader.next()
+            except StopIteration:
+                return []
+            n_columns = len(header)
+            # the columns of each rank (a rank may be there twice)
+            ranks = []
+            rank_columns = {}
+            for i in range(1, n_columns-1) + [n_columns-1]:
+                rank = header[i]
+                if (i == n_columns-1):
+                    rank = PROVIDER
+                if (not rank in rank_columns):
+                    ranks.append(rank)
+                rank_columns.setdefault(rank, []).append(i)
+
+            row_number = 1
+            while True:
+                chunk = list(itertools.islice(reader, CSV_CHUNK))
+                if (len(chunk) == 0):
+                    break
+                lengths = map(len, chunk)
+                if (not lengths.count(n_columns) == len(chunk)):
+                    good = []
+                    for i in range(len(chunk)):
+                        if (lengths[i] == n_columns):
+                            good.append(chunk[i])
+                        elif (lengths[i] > 0):
+                            malformed.append((row_number+i+1, "expected "+str(n_columns)+
+                                              " columns, found "+str(lengths[i])))
+                    chunk = good
+                row_number += len(lengths)
+                add_rows(taxonomy, chunk, ranks, rank_columns)
+    finally:
+        if (gc_was_enabled):
+            gc.enable()
+    return ranks
+
+
+def _add_csv_dict_rows(taxonomy, rows, ranks, rank_columns):
+    """ Add some rows of a CSV file to a taxonomy dictionary, filling in
+    their entries a column at a time
+    """
+
+    if (len(rows) == 0):
+        return
+    columns = zip(*rows)
+    entries = [{} for row in rows]
+    # in the order of the columns, so the later column of a rank wins
+    column_ranks = dict([(i, rank) for rank in ranks for i in rank_columns[rank]])
+    for i in sorted(column_ranks):
+        rank = column_ranks[i]
+        values = columns[i]
+        if (rank == PROVIDER):
+            # the data source is always kept, even if missing
+            for entry, name in itertools.izip(entries, values):
+                entry[rank] = name
+            continue
+        n_missing = values.count(MISSING)
+        if (n_missing == len(values)):
+            continue
+        if (n_missing == 0):
+            for entry, name in itertools.izip(entries, values):
+                entry[rank] = name
+        else:
+            for entry, name in itertools.izip(entries, values):
+                if (not name == MISSING):
+                    entry[rank] = name
+    taxonomy.update(itertools.izip([o.replace(" ", "_") for o in columns[0]], entries))
+
+
+def _add_csv_rows(taxonomy, rows, ranks, rank_columns):
+    """ Add some rows of a CSV file to a taxonomy, a column at a time
+    """
+
+    if (len(rows) == 0):
+        return
+    # the ranks in the order of the file
+    for rank in ranks:
+        taxonomy._column(rank)
+    columns = zip(*rows)
+    otus = [o.replace(" ", "_") for o in columns[0]]
+    if (any(map(taxonomy._rows.__contains__, otus)) or len(set(otus)) < len(otus)):
+        # an OTU we already have is replaced, so go a row at a time
+        for i in range(len(rows)):
+            taxonomy[otus[i]] = _csv_entry(rows[i], ranks, rank_columns)
+        return
+
+    start = len(taxonomy._otus)
+    taxonomy._otus.extend(otus)
+    taxonomy._rows.update(itertools.izip(otus, itertools.count(start)))
+    for rank in ranks:
+        merged = None
+        for i in rank_columns[rank]:
+            # the data source is always kept, even if missing
+            ids = _column_ids(taxonomy, columns[i], rank == PROVIDER)
+            if (merged is None):
+                merged = ids
+            else:
+                # the later column wins, where it has a name
+                merged = array('i', [b if b >= 0 else a for a, b in zip(merged, ids)])
+        taxonomy._columns[rank].extend(merged)
+    # and the ranks not in this file
+    for rank in taxonomy._ranks:
+        if (not rank in rank_columns):
+            taxonomy._columns[rank].extend(array('i', [-1]) * len(otus))
+
+
+def _column_ids(taxonomy, values, keep_missing):
+    """ The string numbers of a column of names, worked out in one go,
+    with -1 for MISSING unless keep_missing is set
+    """
+
+    n = len(values)
+    if (values.count(values[0]) == n and (keep_missing or not values[0] == MISSING)):
+        # one name all the way down (the class, say)
+        return array('i', [taxonomy._string_id(values[0])]) * n
+    names = set(values)
+    if (not keep_missing):
+        names.discard(MISSING)
+    if (len(names) == 0):
+        return array('i', [-1]) * n
+    string_ids = taxonomy._ids()
+    if (len(names) == n and not any(map(string_ids.__contains__, names))):
+        # all different, and all new (the species, say), so they go on
+        # the end of the string table in order. With nothing to share,
+        # they're not interned
+        start = len(taxonomy._strings)
+        taxonomy._strings.extend(values)
+        string_ids.update(itertools.izip(values, itertools.count(start)))
+        return array('i', xrange(start, start+n))
+    taxonomy._add_strings(names)
+    lookup = dict(zip(names, map(string_ids.__getitem__, names)))
+    if (not keep_missing):
+        lookup[MISSING] = -1
+    if (n == 1):
+        return array('i', [lookup[values[0]]])
+    return array('i', operator.itemgetter(*values)(lookup))
+
+
+def _csv_entry(row, ranks, rank_columns):
+    entry = {}
+    for rank in ranks:
+        for i in rank_columns[rank]:
+            if (rank == PROVIDER or not row[i] == MISSING):
+                entry[rank] = row[i]
+    return entry
+
+
+def write_csv(taxonomy, filename, ranks):
+    """ Write a taxonomy (a Taxonomy or a dictionary) as a CSV file, with
+    the given ranks as columns
+    """
+
+    with open(filename, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['OTU'] + list(ranks) + ['Provider'])
+        if (isinstance(taxonomy, Taxonomy)):
+            writer.writerows(taxonomy._csv_rows(ranks))
+            return
+        for otu in taxonomy:
+            entry = taxonomy[otu]
+            row = [_encode(otu)]
+            for rank in ranks:
+                row.append(_encode(entry.get(rank, MISSING)))
+            row.append(_encode(entry.get(PROVIDER, MISSING)))
+            writer.writerow(row)
+
+
+def _encode(name):
+    if (isinstance(name, list)):
+        name = " ".join(name)
+    if (isinstance(name, unicode)):
+        return name.encode("utf-8")
+    return name
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" On-disk cache of taxonomy lookups.
+
+Two kinds of record live in the same SQLite file:
+ - the raw body of every EoL, PBDB and ITIS response, keyed by provider
+   and URL;
+ - finished taxonomies, keyed by taxon name (provider "taxonomy"). These
+   are what create_taxonomy stores for each taxon and what a taxonomy CSV
+   can be used to warm the cache with.
+
+Records older than the time-to-live are ignored (and replaced when the
+lookup is next made), so a cache can be used offline for as long as the
+TTL allows.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+import simplejson as json
+import stk_profile
+
+# Where the cache lives unless told otherwise
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".stk", "taxonomy_cache.sqlite")
+# Thirty days, in seconds
+DEFAULT_TTL = 30*24*60*60
+# provider name used for finished taxonomies
+TAXONOMY = "taxonomy"
+
+# the cache used when none is given: None means not opened yet and
+# False means caching is switched off
+_default_cache = None
+
+
+class TaxonomyCache(object):
+    """ A persistent store of taxonomy lookups. Safe to share between
+    threads; several processes can use the same file.
+    """
+
+    def __init__(self, filename=DEFAULT_CACHE_FILE, ttl=DEFAULT_TTL):
+        """ Open (creating if needed) the cache in filename. Use ":memory:"
+        for a cache that is not kept. ttl is in seconds; None means records
+        never expire.
+        """
+
+        if (not filename == ":memory:"):
+            dirname = os.path.dirname(os.path.abspath(filename))
+            if (not os.path.exists(dirname)):
+                os.makedirs(dirname)
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses ("+
+                         "provider TEXT NOT NULL, key TEXT NOT NULL, "+
+                         "body BLOB, fetched REAL NOT NULL, "+
+                         "PRIMARY KEY (provider, key))")
+        self._db.commit()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stores = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _fresh(self, fetched):
+        return (self.ttl is None or time.time() - fetched <= self.ttl)
+
+    def get(self, provider, key):
+        """ The cached body for key (e.g. a URL) from this provider, or None
+        if we don't have it or it is older than the TTL
+        """
+
+        with self._lock:
+            row = self._db.execute("SELECT body, fetched FROM responses WHERE provider=? AND key=?",
+                                   (provider, key)).fetchone()
+            if (row is None):
+                self.misses += 1
+                stk_profile.count("taxonomy cache misses")
+                return None
+            if (not self._fresh(row[1])):
+                self.expired += 1
+                self.misses += 1
+                stk_profile.count("taxonomy cache misses")
+                return None
+            self.hits += 1
+            stk_profile.count("taxonomy cache hits")
+        return str(row[0])
+
+    def put(self, provider, key, body, fetched=None):
+        """ Store a response body (a byte string) for key from this provider
+        """
+
+        if (fetched is None):
+            fetched = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses (provider, key, body, fetched) VALUES (?,?,?,?)",
+                             (provider, key, sqlite3.Binary(body), fetched))
+            self._db.commit()
+            self.stores += 1
+
+    def get_taxonomy(self, taxon):
+        """ The cached taxonomy (a dictionary of level to name) for a taxon,
+        or None
+        """
+
+        body = self.get(TAXONOMY, _taxon_key(taxon))
+        if (body is None):
+            return None
+        return json.loads(body)
+
+    def put_taxonomy(self, taxon, taxonomy, fetched=None):
+        self.put(TAXONOMY, _taxon_key(taxon), json.dumps(taxonomy, sort_keys=True), fetched=fetched)
+
+    def warm(self, taxonomy):
+        """ Store every taxon of a taxonomy dictionary (as returned by
+        load_taxonomy or create_taxonomy). Existing records are replaced.
+
+        returns: number of taxa stored
+        """
+
+        fetched = time.time()
+        rows = []
+        for taxon in taxonomy:
+            rows.append((TAXONOMY, _taxon_key(taxon),
+                         sqlite3.Binary(json.dumps(taxonomy[taxon], sort_keys=True)), fetched))
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO responses (provider, key, body, fetched) VALUES (?,?,?,?)",
+                                 rows)
+            self._db.commit()
+            self.stores += len(rows)
+        return len(rows)
+
+    def purge(self, expired_only=True):
+        """ Remove expired records, or everything if expired_only is False
+
+        returns: number of records removed
+        """
+
+        with self._lock:
+            if (expired_only):
+                if (self.ttl is None):
+                    return 0
+                cur = self._db.execute("DELETE FROM responses WHERE fetched < ?", (time.time() - self.ttl,))
+            else:
+                cur = self._db.execute("DELETE FROM responses")
+            self._db.commit()
+        return cur.rowcount
+
+    def stats(self):
+        """ Dictionary of cache statistics: the hits, misses (of which
+        expired), stores made through this object, plus the number of
+        records (and how many of those are stale) for each provider
+        """
+
+        with self._lock:
+            rows = self._db.execute("SELECT provider, fetched FROM responses").fetchall()
+        providers = {}
+        stale = 0
+        for provider, fetched in rows:
+            providers[provider] = providers.get(provider, 0) + 1
+            if (not self._fresh(fetched)):
+                stale += 1
+        return {'file':self.filename,
+                'ttl':self.ttl,
+                'records':len(rows),
+                'stale':stale,
+                'providers':providers,
+                'hits':self.hits,
+                'misses':self.misses,
+                'expired':self.expired,
+                'stores':self.stores}
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+def _taxon_key(taxon):
+    # taxonomies are keyed with spaces or underscores depending on where
+    # they came from
+    return taxon.replace("_"," ").strip()
+
+
+def get_cache():
+    """ The cache in use when none is given, opened at DEFAULT_CACHE_FILE
+    the first time it's asked for. None if caching is off or the file
+    can't be opened.
+    """
+
+    global _default_cache
+    if (_default_cache is None):
+        try:
+            _default_cache = TaxonomyCache()
+        except (sqlite3.Error, OSError, IOError):
+            _default_cache = False
+    if (_default_cache is False):
+        return None
+    return _default_cache
+
+
+def set_cache(cache):
+    """ Set the cache used when none is given. cache can be a TaxonomyCache,
+    a filename, or None to switch caching off.
+    """
+
+    global _default_cache
+    if (cache is None):
+        _default_cache = False
+    elif (isinstance(cache, TaxonomyCache)):
+        _default_cache = cache
+    else:
+        _default_cache = TaxonomyCache(cache)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Higher taxa to the taxa in them.
+
+A taxonomy (as load_taxonomy or create_taxonomy give it) maps each taxon
+to its ranks: {'Gallus_gallus': {'genus':'Gallus', 'order':'Galliformes',
+...}}. Finding everything in Galliformes means looking at every entry.
+A TaxonomyIndex turns it round once - (rank, name) to the taxa with that
+name at that rank - so the same question costs as much as the answer.
+Names are interned, as the same few genus and family names appear in
+thousands of entries.
+"""
+
+# keys of a taxonomy entry that are not ranks
+NOT_RANKS = ['provider']
+
+
+def _intern(name):
+    if (isinstance(name, str)):
+        return intern(name)
+    return name
+
+
+class TaxonomyIndex(object):
+    """ An index of a taxonomy dictionary by rank and name. Build a new
+    one if the taxonomy changes.
+    """
+
+    def __init__(self, taxonomy):
+        self.taxonomy = taxonomy
+        # (rank, name) -> set of taxa
+        self._members = {}
+        # name -> set of ranks it is found at
+        self._ranks = {}
+        for taxon, entry in taxonomy.iteritems():
+            taxon = _intern(taxon)
+            for rank, name in entry.iteritems():
+                if (rank in NOT_RANKS or name is None or name == ""):
+                    continue
+                rank = _intern(rank)
+                name = _intern(name.replace(" ", "_"))
+                key = (rank, name)
+                if (not key in self._members):
+                    self._members[key] = set()
+                    self._ranks.setdefault(name, set()).add(rank)
+                self._members[key].add(taxon)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, name):
+        return name.replace(" ", "_") in self._ranks
+
+    def ranks(self, name):
+        """ The ranks a name is found at, e.g. ['family'] (sorted)
+        """
+
+        return sorted(self._ranks.get(name.replace(" ", "_"), []))
+
+    def members(self, name, rank=None):
+        """ The taxa in the taxonomy that are in this higher taxon, at the
+        given rank or (by default) at any rank. An empty set if the name
+        isn't in the taxonomy. Don't alter what you're given.
+        """
+
+        name = name.replace(" ", "_")
+        if (not rank is None):
+            return self._members.get((rank, name), frozenset())
+        ranks = self._ranks.get(name, ())
+        if (len(ranks) == 1):
+            for r in ranks:
+                return self._members[(r, name)]
+        members = set()
+        for r in ranks:
+            members |= self._members[(r, name)]
+        return members
+
+    def expand(self, names, rank=None):
+        """ A list of the names plus, for each one that is a higher taxon,
+        the taxa in it. Each name appears once, in the order first found.
+        """
+
+        expanded = []
+        seen = set()
+        for name in names:
+            for n in [name] + sorted(self.members(name, rank)):
+                if (not n in seen):
+                    seen.add(n)
+                    expanded.append(n)
+        return expanded
+
+
+def taxonomy_index(taxonomy):
+    """ A TaxonomyIndex for a taxonomy dictionary, or the index itself if
+    that is what we were given
+    """
+
+    if (isinstance(taxonomy, TaxonomyIndex)):
+        return taxonomy
+    return TaxonomyIndex(taxonomy)
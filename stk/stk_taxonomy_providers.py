@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" The online taxonomy services (EoL, PBDB and ITIS).
+
+Each service is a TaxonomyProvider with one method per API call we make.
+Providers keep their HTTP connections open between requests (one per
+host per thread), time requests out, retry failed requests a few times
+with an increasing wait, and limit how many requests are made to a host
+at once (and, optionally, per second). Responses go through the taxonomy cache (stk_taxonomy_cache).
+
+Errors are raised as urllib2.HTTPError (the service answered, but not
+with a 200) or urllib2.URLError (we couldn't talk to it), as urllib2
+itself would.
+
+For testing and benchmarking a provider can be pointed at a stand-in
+server (see FixtureServer) or read straight from a fixture directory,
+which holds one file per response in a sub-directory per provider. The
+file name is the quoted request (see fixture_name).
+"""
+
+import os
+import time
+import socket
+import hashlib
+import httplib
+import urllib2
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from urllib import quote, quote_plus
+from StringIO import StringIO
+import simplejson as json
+import stk_taxonomy_cache
+import stk_profile
+
+# seconds to wait for a service to answer
+DEFAULT_TIMEOUT = 30
+# number of times a failed request is tried again...
+DEFAULT_RETRIES = 3
+# ...waiting this long (in seconds) the first time, doubling each time
+DEFAULT_BACKOFF = 1.0
+# requests to a single host at any one time
+MAX_PER_HOST = 4
+# requests per second to a single host; None for no limit
+DEFAULT_RATE = None
+MAX_REDIRECTS = 5
+USER_AGENT = "supertree-toolkit"
+
+# these might work if we ask again
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+_REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+# limits on requests per host, shared by all providers
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+# open connections, per thread, keyed by scheme and host
+_connections = threading.local()
+
+
+class _HostLimit(object):
+    """ At most max_requests requests to a host at once and, if rate is
+    set, no more than rate requests a second
+    """
+
+    def __init__(self, max_requests, rate=None):
+        self._semaphore = threading.BoundedSemaphore(max_requests)
+        self._lock = threading.Lock()
+        self.rate = rate
+        self._next = 0
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        if (self.rate):
+            with self._lock:
+                now = time.time()
+                wait = self._next - now
+                self._next = max(now, self._next) + 1.0/self.rate
+            if (wait > 0):
+                time.sleep(wait)
+        return self
+
+    def __exit__(self, *args):
+        self._semaphore.release()
+
+
+def set_host_limit(host, max_requests, rate=None):
+    """ Allow at most max_requests requests to host (e.g. "eol.org") at once
+    and, if rate is given, at most rate requests per second
+    """
+
+    with _host_limits_lock:
+        _host_limits[host] = _HostLimit(max_requests, rate)
+
+
+def _host_limit(host, max_requests):
+    with _host_limits_lock:
+        if (not host in _host_limits):
+            _host_limits[host] = _HostLimit(max_requests, DEFAULT_RATE)
+        return _host_limits[host]
+
+
+def _get_connection(scheme, netloc, timeout):
+    pool = getattr(_connections, 'pool', None)
+    if (pool is None):
+        pool = _connections.pool = {}
+    key = (scheme, netloc)
+    if (key in pool):
+        return pool[key], True
+    if (scheme == "https"):
+        conn = httplib.HTTPSConnection(netloc, timeout=timeout)
+    else:
+        conn = httplib.HTTPConnection(netloc, timeout=timeout)
+    pool[key] = conn
+    return conn, False
+
+
+def _drop_connection(scheme, netloc):
+    pool = getattr(_connections, 'pool', {})
+    conn = pool.pop((scheme, netloc), None)
+    if (not conn is None):
+        conn.close()
+
+
+def close_connections():
+    """ Close the connections this thread has open
+    """
+
+    pool = getattr(_connections, 'pool', {})
+    for conn in pool.values():
+        conn.close()
+    pool.clear()
+
+
+def fixture_name(resource):
+    """ The file name used for a request (the part of the URL after the
+    provider's base URL) in a fixture directory. Long requests are hashed.
+    """
+
+    name = quote(resource, safe='')
+    if (len(name) > 200):
+        name = hashlib.sha1(resource).hexdigest()
+    return name
+
+
+class TaxonomyProvider(object):
+    """ Base class for the services. Subclasses set name, base_url and,
+    if the service doesn't send UTF-8, encoding.
+    """
+
+    name = None
+    base_url = None
+    encoding = None
+
+    def __init__(self, base_url=None, fixture_dir=None, record=False, cache=None,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 max_per_host=MAX_PER_HOST):
+        """ base_url replaces the real service, e.g. with a stand-in server.
+        If fixture_dir is given, responses are read from there instead of
+        the network; with record set, missing ones are fetched and saved.
+        cache is a TaxonomyCache, None for the default cache or False for
+        none.
+        """
+
+        if (not base_url is None):
+            self.base_url = base_url.rstrip("/")
+        self.fixture_dir = fixture_dir
+        self.record = record
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_per_host = max_per_host
+        self.requests = 0
+
+    def url(self, resource):
+        return self.base_url + resource
+
+    def _get_cache(self):
+        if (self.cache is False or not self.fixture_dir is None):
+            return None
+        if (self.cache is None):
+            return stk_taxonomy_cache.get_cache()
+        return self.cache
+
+    def get(self, resource):
+        """ The body of the response to resource (the path and query after
+        the base URL), from the fixtures, the cache or the service
+        """
+
+        url = self.url(resource)
+        if (not self.fixture_dir is None):
+            filename = os.path.join(self.fixture_dir, self.name, fixture_name(resource))
+            if (os.path.exists(filename)):
+                f = open(filename, "rb")
+                body = f.read()
+                f.close()
+                return body
+            if (not self.record):
+                raise urllib2.HTTPError(url, 404, "No fixture for this request", {}, StringIO(""))
+            body = self.fetch(url)
+            save_fixture(self.fixture_dir, self.name, resource, body)
+            return body
+
+        cache = self._get_cache()
+        if (not cache is None):
+            body = cache.get(self.name, url)
+            if (not body is None):
+                return body
+        body = self.fetch(url)
+        if (not cache is None):
+            cache.put(self.name, url, body)
+        return body
+
+    def get_json(self, resource):
+        body = self.get(resource)
+        if (not self.encoding is None):
+            body = unicode(body, self.encoding)
+        return json.loads(body)
+
+    def fetch(self, url):
+        """ GET url from the network, following redirects
+        """
+
+        for i in range(MAX_REDIRECTS+1):
+            status, reason, response, body = self._request(url)
+            if (status in _REDIRECT_STATUS and not response.getheader('location') is None):
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if (status != 200):
+                raise urllib2.HTTPError(url, status, reason, response.msg, StringIO(body))
+            return body
+        raise urllib2.HTTPError(url, status, "Too many redirects", response.msg, StringIO(body))
+
+    @stk_profile.timed("network requests")
+    def _request(self, url):
+        """ One GET, retried if the connection fails or the service is busy
+        """
+
+        parts = urlparse.urlsplit(url)
+        path = parts.path or "/"
+        if (parts.query):
+            path += "?" + parts.query
+        limit = _host_limit(parts.hostname, self.max_per_host)
+        attempt = 0
+        while True:
+            reused = False
+            try:
+                with limit:
+                    conn, reused = _get_connection(parts.scheme, parts.netloc, self.timeout)
+                    try:
+                        conn.request("GET", path, headers={'User-Agent':USER_AGENT})
+                        response = conn.getresponse()
+                        body = response.read()
+                    except (socket.error, httplib.HTTPException):
+                        _drop_connection(parts.scheme, parts.netloc)
+                        raise
+                    if (response.will_close):
+                        _drop_connection(parts.scheme, parts.netloc)
+                    self.requests += 1
+            except (socket.error, httplib.HTTPException) as detail:
+                if (reused):
+                    # the server gave up on our idle connection; that
+                    # doesn't count as a failure
+                    continue
+                if (attempt >= self.retries or isinstance(detail, socket.gaierror)):
+                    # no point asking again if the host name doesn't resolve
+                    raise urllib2.URLError(detail)
+            else:
+                if (not response.status in _RETRY_STATUS or attempt >= self.retries):
+                    return response.status, response.reason, response, body
+            time.sleep(self.backoff * 2**attempt)
+            attempt += 1
+
+
+class EoLProvider(TaxonomyProvider):
+    """ The Encyclopedia of Life
+    """
+
+    name = "eol"
+    base_url = "http://eol.org"
+
+    def search(self, name):
+        return self.get_json("/api/search/1.0.json?q="+quote_plus(name))
+
+    def page(self, page_id, query=None):
+        resource = "/api/pages/1.0/"+str(page_id)+".json"
+        if (not query is None):
+            resource += "?"+query
+        return self.get_json(resource)
+
+    def hierarchy_entry(self, entry_id, query=None):
+        resource = "/api/hierarchy_entries/1.0/"+str(entry_id)+".json"
+        if (not query is None):
+            resource += "?"+query
+        return self.get_json(resource)
+
+
+class PBDBProvider(TaxonomyProvider):
+    """ The Paleobiology Database
+    """
+
+    name = "pbdb"
+    base_url = "http://paleobiodb.org"
+
+    def taxon(self, name):
+        return self.get_json("/data1.1/taxa/single.json?name="+quote_plus(name)+"&show=phylo&vocab=pbdb")
+
+
+class ITISProvider(TaxonomyProvider):
+    """ The Integrated Taxonomic Information System
+    """
+
+    name = "itis"
+    base_url = "http://www.itis.gov/ITISWebService/jsonservice"
+    encoding = "ISO-8859-1"
+
+    def search(self, name):
+        return self.get_json("/searchByScientificName?srchKey="+quote_plus(name))
+
+    def accepted_names(self, tsn):
+        return self.get_json("/getAcceptedNamesFromTSN?tsn="+str(tsn))
+
+    def full_hierarchy(self, tsn):
+        return self.get_json("/getFullHierarchyFromTSN?tsn="+str(tsn))
+
+    def full_record(self, tsn):
+        return self.get_json("/getFullRecordFromTSN?tsn="+str(tsn))
+
+    def hierarchy_down(self, tsn):
+        return self.get_json("/getHierarchyDownFromTSN?tsn="+str(tsn))
+
+
+PROVIDERS = {'eol':EoLProvider, 'pbdb':PBDBProvider, 'itis':ITISProvider}
+
+# the providers in use, created when first asked for
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name):
+    """ The provider in use for a service ("eol", "pbdb" or "itis")
+    """
+
+    with _providers_lock:
+        if (not name in _providers):
+            _providers[name] = PROVIDERS[name]()
+        return _providers[name]
+
+
+def set_provider(name, provider):
+    with _providers_lock:
+        _providers[name] = provider
+
+
+def configure(stand_in=None, fixture_dir=None, record=False, **kwargs):
+    """ Replace all the providers. stand_in is the base URL of a server
+    standing in for all of the services (e.g. FixtureServer.url); each
+    service is under /<name> on it. Other keyword arguments are passed to
+    the providers.
+    """
+
+    with _providers_lock:
+        for name in PROVIDERS:
+            base_url = None
+            if (not stand_in is None):
+                base_url = stand_in.rstrip("/") + "/" + name
+            _providers[name] = PROVIDERS[name](base_url=base_url, fixture_dir=fixture_dir,
+                                               record=record, **kwargs)
+
+
+def reset():
+    """ Go back to the real services with the default settings
+    """
+
+    with _providers_lock:
+        _providers.clear()
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stand_in._count('connections')
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        stand_in._start_request()
+        try:
+            if (stand_in.delay):
+                time.sleep(stand_in.delay)
+            status, body = stand_in.response(self.path)
+        finally:
+            stand_in._end_request()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(object):
+    """ A local HTTP server standing in for the taxonomy services. It
+    serves /<provider><request> from the file
+    <fixture_dir>/<provider>/<fixture_name(request)>, and 404 if there is
+    no such file.
+
+    delay (seconds) is added to every request and the first fail_first
+    requests get a 503, to look more like the real thing. requests,
+    connections and max_in_flight count what the server has seen.
+    """
+
+    def __init__(self, fixture_dir, port=0, delay=0, fail_first=0):
+        self.fixture_dir = fixture_dir
+        self.delay = delay
+        self.fail_first = fail_first
+        self.requests = 0
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", port), _FixtureHandler)
+        self._server.stand_in = self
+        self.port = self._server.server_address[1]
+        self.url = "http://127.0.0.1:"+str(self.port)
+        self._thread = None
+
+    def _count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def _start_request(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _end_request(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def response(self, path):
+        """ Status and body to send for a request path
+        """
+
+        with self._lock:
+            if (self.fail_first > 0):
+                self.fail_first -= 1
+                return 503, ""
+        provider, sep, resource = path.lstrip("/").partition("/")
+        filename = os.path.join(self.fixture_dir, provider, fixture_name("/"+resource))
+        if (not provider in PROVIDERS or not os.path.exists(filename)):
+            return 404, ""
+        f = open(filename, "rb")
+        body = f.read()
+        f.close()
+        return 200, body
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def save_fixture(fixture_dir, provider, resource, body):
+    """ Write a response into a fixture directory; resource is the request
+    after the provider's base URL, e.g. "/api/search/1.0.json?q=Gallus+gallus"
+    """
+
+    dirname = os.path.join(fixture_dir, provider)
+    if (not os.path.exists(dirname)):
+        os.makedirs(dirname)
+    f = open(os.path.join(dirname, fixture_name(resource)), "wb")
+    f.write(body)
+    f.close()
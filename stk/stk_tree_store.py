@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Sidecar store of per-tree results, for incremental reprocessing.
+
+Most of the work in create_matrix, data_independence, data_overlap and
+substitute_taxa is done one tree at a time: parse the tree, list its taxa,
+build its MRP sub-matrix. When a handful of sources are added to a large
+dataset, all that work is the same as last time for every other tree.
+A TreeStore keeps it in an SQLite file next to the Phyml:
+
+ - trees: results for each Newick string, keyed by a hash of the string -
+   the leaf names, the MRP sub-matrix, the topology fingerprint and whether
+   the tree is already in the form substitute_taxa leaves trees in. Each
+   is worked out the first time something asks for it.
+ - source_trees: for each source_tree, a hash of the element, the hash of
+   its tree string, and its characters and analyses. update() compares
+   these with a dataset to find the trees that were added, removed or
+   changed since the last run.
+
+Each run that opens the store is numbered, and each tree result notes the
+last run that used it. expire() drops the results no recent run has used,
+which also covers the intermediate trees a run makes (after substitutions,
+say) that are not in the input file.
+
+The supertree_toolkit functions do the work; this just keeps the results.
+"""
+
+import os
+import sqlite3
+import hashlib
+import cPickle
+import threading
+from lxml import etree
+import stk_profile
+
+# bump this if what we store, or how it's worked out, changes. A store
+# with a different version is emptied when it's opened.
+STORE_VERSION = 3
+# what we know about each tree string
+FIELDS = ['leaves', 'matrix', 'topology', 'normal']
+# results not used by any of this many runs are dropped by expire()
+KEEP_RUNS = 5
+
+
+def sidecar_file(phyml_file):
+    """ The store used for a Phyml file: data.phyml keeps its results
+    in data.stkstore
+    """
+
+    return os.path.splitext(phyml_file)[0] + ".stkstore"
+
+
+def tree_hash(tree):
+    """ Hash of a Newick string, as used to key the trees table
+    """
+
+    if (isinstance(tree, unicode)):
+        tree = tree.encode("utf-8")
+    return hashlib.sha1(tree).hexdigest()
+
+
+def element_hash(source_tree):
+    """ Hash of a source_tree element (all of it, as serialised)
+    """
+
+    return hashlib.sha1(etree.tostring(source_tree)).hexdigest()
+
+
+class TreeStore(object):
+    """ Per-tree results kept between runs. Safe to share between threads.
+    """
+
+    def __init__(self, filename=":memory:"):
+        """ Open (creating if needed) the store in filename
+        """
+
+        if (not filename == ":memory:"):
+            dirname = os.path.dirname(os.path.abspath(filename))
+            if (not os.path.exists(dirname)):
+                os.makedirs(dirname)
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS info (version INTEGER, run INTEGER)")
+        row = self._db.execute("SELECT version FROM info").fetchone()
+        if (not row is None and not row[0] == STORE_VERSION):
+            self._db.execute("DROP TABLE IF EXISTS trees")
+            self._db.execute("DROP TABLE IF EXISTS source_trees")
+            self._db.execute("DROP TABLE info")
+            self._db.execute("CREATE TABLE info (version INTEGER, run INTEGER)")
+            row = None
+        if (row is None):
+            self._db.execute("INSERT INTO info (version, run) VALUES (?,?)", (STORE_VERSION, 0))
+        self.run = self._db.execute("SELECT run FROM info").fetchone()[0]
+        self._db.execute("CREATE TABLE IF NOT EXISTS trees ("+
+                         "hash TEXT PRIMARY KEY, leaves BLOB, matrix BLOB, "+
+                         "topology TEXT, normal INTEGER, used INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS source_trees ("+
+                         "name TEXT PRIMARY KEY, element TEXT NOT NULL, tree TEXT, "+
+                         "characters BLOB, analyses BLOB)")
+        self._db.commit()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def start_run(self):
+        """ Start a new run: the results used from now on are marked as
+        used by it
+        """
+
+        with self._lock:
+            self.run += 1
+            self._db.execute("UPDATE info SET run=?", (self.run,))
+            self._db.commit()
+        return self.run
+
+    ############ trees ############
+
+    def get_trees(self, hashes, fields):
+        """ What we know of each tree (by tree_hash). Returns a dictionary of
+        hash to a dictionary of field to value, holding only the trees that
+        have all of the fields asked for.
+        """
+
+        hashes = list(set(hashes))
+        columns = ", ".join(fields)
+        found = {}
+        with self._lock:
+            # sqlite limits the number of parameters in a query
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i+500]
+                rows = self._db.execute("SELECT hash, "+columns+" FROM trees WHERE hash IN ("+
+                                        ",".join("?"*len(chunk))+")", chunk).fetchall()
+                for row in rows:
+                    if (None in row[1:]):
+                        continue
+                    found[row[0]] = dict(zip(fields, [_decode(f, v) for f, v in zip(fields, row[1:])]))
+                self._db.execute("UPDATE trees SET used=? WHERE hash IN ("+
+                                 ",".join("?"*len(chunk))+")", [self.run] + chunk)
+            self._db.commit()
+            self.hits += len(found)
+            self.misses += len(hashes) - len(found)
+        stk_profile.count("tree store hits",len(found))
+        stk_profile.count("tree store misses",len(hashes) - len(found))
+        return found
+
+    def put_trees(self, results):
+        """ Store results: a dictionary of tree hash to a dictionary of
+        field to value. Fields already stored for a tree are kept.
+        """
+
+        with self._lock:
+            for h in results:
+                self._db.execute("INSERT OR IGNORE INTO trees (hash, used) VALUES (?,?)", (h, self.run))
+                values = results[h]
+                fields = [f for f in FIELDS if f in values]
+                if (len(fields) == 0):
+                    continue
+                self._db.execute("UPDATE trees SET "+", ".join([f+"=?" for f in fields])+" WHERE hash=?",
+                                 [_encode(f, values[f]) for f in fields] + [h])
+            self._db.commit()
+
+    ############ source trees ############
+
+    def update(self, dataset):
+        """ Bring the source_trees table up to date with a PhymlDataset.
+
+        returns: dictionary of the names of the trees that were 'added',
+                 'removed' or 'changed' since the last update, plus the
+                 number 'unchanged'
+        """
+
+        with self._lock:
+            known = dict(self._db.execute("SELECT name, element FROM source_trees").fetchall())
+        changes = {'added':[], 'removed':[], 'changed':[], 'unchanged':0}
+        rows = []
+        names = dataset.source_tree_names()
+        for name in names:
+            st = dataset.source_tree(name)
+            h = element_hash(st)
+            if (known.get(name) == h):
+                changes['unchanged'] += 1
+                continue
+            if (name in known):
+                changes['changed'].append(name)
+            else:
+                changes['added'].append(name)
+            tree = dataset.tree_string(name)
+            if (not tree is None):
+                tree = tree_hash(tree)
+            characters = sorted([c.attrib['name'] for c in st.xpath("character_data/character")])
+            analyses = [a.attrib.get('name') for a in st.xpath("tree/tree_inference/optimality_criterion")]
+            rows.append((name, h, tree, sqlite3.Binary(cPickle.dumps(characters, 2)),
+                         sqlite3.Binary(cPickle.dumps(analyses, 2))))
+        current = set(names)
+        changes['removed'] = [name for name in known if not name in current]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO source_trees (name, element, tree, characters, analyses) "+
+                                 "VALUES (?,?,?,?,?)", rows)
+            self._db.executemany("DELETE FROM source_trees WHERE name=?", [(n,) for n in changes['removed']])
+            self._db.commit()
+        return changes
+
+    def source_tree(self, name):
+        """ What we know of a source_tree as of the last update: a dictionary
+        with the 'tree' hash, 'characters' and 'analyses'. None if we don't
+        know the tree.
+        """
+
+        with self._lock:
+            row = self._db.execute("SELECT tree, characters, analyses FROM source_trees WHERE name=?",
+                                   (name,)).fetchone()
+        if (row is None):
+            return None
+        return {'tree':row[0],
+                'characters':cPickle.loads(str(row[1])),
+                'analyses':cPickle.loads(str(row[2]))}
+
+    ############ housekeeping ############
+
+    def prune(self):
+        """ Remove the results for tree strings no source_tree uses any more
+
+        returns: the number removed
+        """
+
+        with self._lock:
+            cur = self._db.execute("DELETE FROM trees WHERE hash NOT IN "+
+                                   "(SELECT tree FROM source_trees WHERE tree IS NOT NULL)")
+            self._db.commit()
+        return cur.rowcount
+
+    def expire(self, runs=KEEP_RUNS):
+        """ Remove the results that none of the last runs (this one
+        included) have used
+
+        returns: the number removed
+        """
+
+        with self._lock:
+            cur = self._db.execute("DELETE FROM trees WHERE used IS NULL OR used <= ?", (self.run - runs,))
+            self._db.commit()
+        return cur.rowcount
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM trees")
+            self._db.execute("DELETE FROM source_trees")
+            self._db.commit()
+
+    def stats(self):
+        """ Dictionary of the number of trees and source_trees held, plus
+        the hits and misses for tree results
+        """
+
+        with self._lock:
+            n_trees = self._db.execute("SELECT COUNT(*) FROM trees").fetchone()[0]
+            n_source_trees = self._db.execute("SELECT COUNT(*) FROM source_trees").fetchone()[0]
+        return {'file':self.filename,
+                'trees':n_trees,
+                'source_trees':n_source_trees,
+                'hits':self.hits,
+                'misses':self.misses}
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM trees").fetchone()[0]
+
+
+def _encode(field, value):
+    if (field == 'topology'):
+        return value
+    if (field == 'normal'):
+        return int(value)
+    return sqlite3.Binary(cPickle.dumps(value, 2))
+
+
+def _decode(field, value):
+    if (field == 'topology'):
+        return str(value)
+    if (field == 'normal'):
+        return bool(value)
+    return cPickle.loads(str(value))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+#
+#    Supertree Toolkit. Software for managing and manipulating sources
+#    trees ready for supretree construction.
+#    Copyright (C) 2013, Jon Hill, Katie Davis
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Jon Hill. jon.hill@imperial.ac.uk.
+
+""" Checking a dataset in one go.
+
+_check_data used to run four checks (unique names, taxa in their trees,
+informative trees and sources with trees), each of which parsed the whole
+Phyml again. validate() walks the document once, parses each tree once,
+and collects everything it finds into a ValidationReport rather than
+stopping at the first problem. The report can then raise the same
+errors, in the same order, as the old checks did.
+
+Reports are kept against a hash of the document, so checking the same
+data again (as nearly every function does unless told not to) costs a
+hash of the string.
+"""
+
+import hashlib
+from collections import OrderedDict
+import stk_exceptions as excp
+import stk_phyml
+import stk_parallel
+import stk_profile
+
+# How many reports we keep, keyed on the hash of the document
+REPORT_CACHE_SIZE = 8
+_report_cache = OrderedDict()
+
+# The kinds of problem, in the order they are raised by raise_errors
+UNNAMED_SOURCE = "unnamed_source"
+DUPLICATE_SOURCE_NAME = "duplicate_source_name"
+DUPLICATE_TREE_NAME = "duplicate_tree_name"
+UNNAMED_TREE = "unnamed_tree"
+MISSING_TAXON = "missing_taxon"
+TREE_PARSE = "tree_parse"
+UNINFORMATIVE_TREE = "uninformative_tree"
+EMPTY_SOURCE = "empty_source"
+
+
+class Issue(object):
+    """ One problem with a dataset: what kind it is, the source or tree
+    it is in, and a message for the user
+    """
+
+    __slots__ = ['kind', 'name', 'message']
+
+    def __init__(self, kind, name, message):
+        self.kind = kind
+        self.name = name
+        self.message = message
+
+    def __repr__(self):
+        return "Issue(%r, %r, %r)" % (self.kind, self.name, self.message)
+
+
+class ValidationReport(object):
+    """ Everything validate() found wrong with a dataset
+    """
+
+    def __init__(self, issues=None):
+        if (issues is None):
+            issues = []
+        self.issues = issues
+
+    def __len__(self):
+        return len(self.issues)
+
+    def ok(self):
+        """ True if nothing is wrong
+        """
+
+        return len(self.issues) == 0
+
+    def by_kind(self, kind):
+        """ The issues of one kind, in document order
+        """
+
+        return [i for i in self.issues if i.kind == kind]
+
+    def messages(self):
+        return [i.message for i in self.issues]
+
+    def raise_errors(self):
+        """ Raise the first error the old checks would have raised:
+        NotUniqueError for names, InvalidSTKData for taxa not in their
+        tree, TreeParseError, UninformativeTreeError, then InvalidSTKData
+        for sources without trees. Each holds all the problems of its kind.
+        """
+
+        issues = self.by_kind(UNNAMED_SOURCE)
+        if (len(issues) > 0):
+            raise excp.InvalidSTKData("".join([i.message+"\n" for i in issues]))
+        issues = self.by_kind(DUPLICATE_SOURCE_NAME) + self.by_kind(DUPLICATE_TREE_NAME)
+        if (len(issues) > 0):
+            raise excp.NotUniqueError("".join([i.message+"\n" for i in issues]))
+        issues = self.by_kind(UNNAMED_TREE) + self.by_kind(MISSING_TAXON)
+        if (len(issues) > 0):
+            raise excp.InvalidSTKData("".join([i.message+"\n" for i in issues]))
+        issues = self.by_kind(TREE_PARSE)
+        if (len(issues) > 0):
+            raise excp.TreeParseError(issues[0].message)
+        issues = self.by_kind(UNINFORMATIVE_TREE)
+        if (len(issues) > 0):
+            raise excp.UninformativeTreeError("".join(["\n"+i.message for i in issues]))
+        issues = self.by_kind(EMPTY_SOURCE)
+        if (len(issues) > 0):
+            raise excp.InvalidSTKData("".join([i.message+"\n" for i in issues]))
+
+
+def validate(XML, n_jobs=1):
+    """ Check a dataset (Phyml string or stk_phyml.PhymlDataset) and
+    return a ValidationReport. n_jobs processes are used to check
+    the trees.
+    """
+
+    if (isinstance(XML, stk_phyml.PhymlDataset)):
+        content = XML.tostring()
+    else:
+        content = XML
+    if (isinstance(content, unicode)):
+        content = content.encode("utf-8")
+    key = hashlib.sha1(content).hexdigest()
+    try:
+        report = _report_cache.pop(key)
+        stk_profile.count("validation cache hits")
+    except KeyError:
+        stk_profile.count("validation cache misses")
+        with stk_profile.timer("validate"):
+            report = _validate(stk_phyml.get_dataset(XML), n_jobs)
+        while (len(_report_cache) >= REPORT_CACHE_SIZE):
+            _report_cache.popitem(last=False)
+    _report_cache[key] = report
+    return report
+
+
+def clear_report_cache():
+    """ Forget all reports
+    """
+
+    _report_cache.clear()
+
+
+def _validate(dataset, n_jobs):
+
+    issues = []
+    source_names = {}
+    tree_names = {}
+    # source_tree name, tree string, for the trees we need to parse
+    trees = []
+    empty_sources = []
+    for s in dataset.xml_root.iter("source"):
+        s_name = s.attrib.get('name')
+        if (s_name is None):
+            issues.append(Issue(UNNAMED_SOURCE, None,
+                                "A source is not named. Please run the auto-name function on these data."))
+        else:
+            source_names[s_name] = source_names.get(s_name, 0) + 1
+            if (source_names[s_name] == 2):
+                issues.append(Issue(DUPLICATE_SOURCE_NAME, s_name,
+                                    "The source names in the dataset are not unique. Please run the auto-name function on these data. Name: "+s_name))
+        has_tree = False
+        for st in s.iterchildren("source_tree"):
+            t_name = st.attrib.get('name')
+            if (t_name is None):
+                issues.append(Issue(UNNAMED_TREE, s_name,
+                                    "Tree in "+str(s_name)+" is not named. Run the name_trees function"))
+            elif (not t_name == ""):
+                tree_names[t_name] = tree_names.get(t_name, 0) + 1
+                if (tree_names[t_name] == 2):
+                    issues.append(Issue(DUPLICATE_TREE_NAME, t_name,
+                                        "The tree names in the dataset are not unique. Please run the auto-name function on these data with replace or edit by hand. Name: "+t_name))
+            value = st.find("tree/tree_string/string_value")
+            if (value is None or value.text is None):
+                continue
+            has_tree = True
+            tree = value.text
+            # are the taxa listed for this tree in it?
+            for taxon in st.iter("taxon"):
+                xml_taxon = taxon.attrib['name']
+                if (tree.find(xml_taxon) == -1):
+                    issues.append(Issue(MISSING_TAXON, t_name,
+                                        "Taxon: "+xml_taxon+" is not in the tree "+str(t_name)))
+            trees.append((t_name, tree))
+        if (not has_tree):
+            empty_sources.append(Issue(EMPTY_SOURCE, s_name, "Source "+str(s_name)+" has no trees"))
+
+    problems = stk_parallel.map_trees(_tree_problem_worker, [t for name, t in trees], n_jobs=n_jobs)
+    for (t_name, tree), problem in zip(trees, problems):
+        if (problem is None):
+            continue
+        kind, message = problem
+        if (kind == TREE_PARSE):
+            issues.append(Issue(TREE_PARSE, t_name, message))
+        elif (kind == "taxa"):
+            issues.append(Issue(UNINFORMATIVE_TREE, t_name,
+                                "Tree "+str(t_name)+" contains only 2 taxa and is not informative"))
+        else:
+            issues.append(Issue(UNINFORMATIVE_TREE, t_name,
+                                "Tree "+str(t_name)+" doesn't contain any clades and is not informative"))
+    issues.extend(empty_sources)
+
+    return ValidationReport(issues)
+
+
+def _tree_problem_worker(tree, shared=None):
+    """ What is wrong with a tree string: (TREE_PARSE, message) if it
+    can't be parsed, ("taxa", None) or ("clades", None) if it's
+    not informative. None if it's fine.
+    """
+
+    # parsed trees are shared via the tree cache
+    from supertree_toolkit import _parse_tree_cached, _informative_problem
+    try:
+        cached = _parse_tree_cached(tree)
+    except excp.TreeParseError as detail:
+        return (TREE_PARSE, detail.msg)
+    problem = _informative_problem(cached.tree)
+    if (problem is None):
+        return None
+    return (problem, None)
@@ -43,14 +43,28 @@ import datetime
 import indent
 import unicodedata
 import stk_internals
+import stk_phyml
+import stk_newick
+import stk_str
+import stk_parallel
+import stk_taxonomy_cache
+import stk_taxonomy_providers
+import stk_tree_store
+import stk_profile
+import stk_validate
+import stk_taxonomy_index
+import stk_taxonomy
+import stk_backbone
+import stk_statistics
 from copy import deepcopy
 import Queue
 import threading
 import urllib2
-from urllib import quote_plus
-import simplejson as json
 import time
 import types
+import heapq
+import bisect
+import itertools
 
 #plt.ion()
 
@@ -59,9 +73,22 @@ sys.setrecursionlimit(50000)
 IDENTICAL = 0
 SUBSET = 1
 PLATFORM = sys.platform
+# MRP matrices are int8 arrays: 0, 1 or missing
+MRP_MISSING = -1
+# so indexing with MRP_MISSING gives the '?'
+_MRP_CHARS = numpy.array(['0','1','?'],dtype='S1')
+# permute_tree makes a matrix from the permuted trees themselves up to this
+# many permutations, and from the clades of the tree above it
+PERMUTATION_ENUMERATE_LIMIT = 1000
 #Logging
 import logging
-logging.basicConfig(filename='supertreetoolkit.log', level=logging.DEBUG, format='%(asctime)s %(levelname)s:%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+# warnings go to supertreetoolkit.log, which is only created when there is
+# something to write. The verbose options turn on the INFO messages.
+if (len(logging.getLogger().handlers) == 0):
+    _log_handler = logging.FileHandler('supertreetoolkit.log', delay=True)
+    _log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s:%(message)s', '%m/%d/%Y %I:%M:%S %p'))
+    logging.getLogger().addHandler(_log_handler)
+    logging.getLogger().setLevel(logging.WARNING)
 
 # taxonomy levels
 # What we get from EOL
@@ -70,6 +97,8 @@ current_taxonomy_levels = ['species','genus','family','order','class','phylum','
 extra_taxonomy_levels = ['superfamily','infraorder','suborder','superorder','subclass','subphylum','superphylum','infrakingdom','subkingdom']
 # all of them in order
 taxonomy_levels = ['species','subgenus','genus','tribe','subfamily','family','superfamily','subsection','section','parvorder','infraorder','suborder','order','superorder','subclass','class','superclass','subphylum','phylum','superphylum','infrakingdom','subkingdom','kingdom']
+# taxonomies saved with this extension are snapshots, not CSV files
+TAXONOMY_SNAPSHOT_EXT = ".stktax"
 
 SPECIES = taxonomy_levels[0]
 GENUS = taxonomy_levels[1]
@@ -100,7 +129,7 @@ def get_project_name(XML):
     Get the name of the dataset currently being worked on
     """
 
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
 
     return xml_root.xpath('/phylo_storage/project_name/string_value')[0].text 
 
@@ -195,7 +224,7 @@ def get_all_source_names(XML):
     """ From a full XML-PHYML string, extract all source names.
     """
 
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     find = etree.XPath("//source")
     sources = find(xml_root)
     names = []
@@ -210,7 +239,7 @@ def get_all_tree_names(XML):
     """ From a full XML-PHYML string, extract all tree names.
     """
 
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     find = etree.XPath("//source")
     sources = find(xml_root)
     names = []
@@ -282,7 +311,6 @@ def create_tree_name(XML,source_tree_element):
     i.e. sources/source/source_tree
     """
 
-    xml_root = _parse_xml(XML)
     source = source_tree_element.getparent()
     # count current trees
     tree_count = 1
@@ -667,164 +695,49 @@ def export_bibliography(XML,filename,format="bibtex"):
     
     return
 
-def safe_taxonomic_reduction(XML, matrix=None, taxa=None, verbose=False, queue=None, ignoreWarnings=False):
+def safe_taxonomic_reduction(XML, matrix=None, taxa=None, verbose=False, queue=None, ignoreWarnings=False, n_jobs=1, block_size=None):
     """ Perform STR on data to remove taxa that 
     provide no useful additional information. Based on PerEQ (Jeffery and Wilkson, unpublished).
+
+    The taxon comparison is done on a packed bit representation of the matrix
+    (see stk_str) in blocks of block_size taxa. Set n_jobs > 1 to spread
+    those blocks over a pool of processes.
     """
 
     if not ignoreWarnings and not XML == None:
-        _check_data(XML)
+        _check_data(XML,n_jobs=n_jobs)
 
     # Algorithm descibed by Jeffery and Wilkson, unpublshed. 
     # Obtained original from http://www.uni-oldenburg.de/en/biology/systematics-and-evolutionary-biology/programs/
     # and modified for *supertrees*, which mainly involves cutting
     # out stuff to do with multiple state characters as we only have binary characters.
 
-    missing_char = "?"
-    TotalInvalid = 0
-
+    missing_char = stk_str.MISSING_CHAR
     if (not matrix==None):
         if (taxa == None):
             raise excp.InvalidSTKData("If you supply a matrix to STR, you also need to supply taxa")
     else:
         # create matrix, but keep the matrix as an array
-        # and get the taxa - hence we replicate most
-        # create matrix code
-        # *******REFACTOR: Split create_matrix into multiple 
-        # functions, so we can just call them here and in create_matrix
-        # get all trees
+        # and get the taxa
         trees = obtain_trees(XML)
         # and the taxa
         taxa = []
         taxa.append("MRP_Outgroup")
         taxa.extend(get_all_taxa(XML))
-        # our matrix, we'll then append the submatrix
-        # to this to make a 2D matrix
-        # Our matrix is of length nTaxa on the i dimension
-        # and nCharacters in the j direction
-        matrix = []
-        charsets = []
-        current_char = 1
-        for key in trees:
-            if (verbose):
-                print "Reading tree: "+key
-            submatrix, tree_taxa = _assemble_tree_matrix(trees[key])
-            nChars = len(submatrix[0,:])
-            # loop over characters in the submatrix
-            for i in range(1,nChars):
-                # loop over taxa. Add '?' for an "unknown" taxa, otherwise
-                # get 0 or 1 from submatrix. May as well turn into a string whilst
-                # we're at it
-                current_row = []
-                for taxon in taxa:
-                    if (taxon in tree_taxa):
-                        # get taxon index
-                        t_index = tree_taxa.index(taxon)
-                        # then get correct matrix entry - note:
-                        # submatrix transposed wrt main matrix
-                        current_row.append(str(int(submatrix[t_index,i])))
-                    elif (taxon == "MRP_Outgroup"):
-                        current_row.append('0')
-                    else:
-                        current_row.append('?')
-                matrix.append(current_row)
-            charsets.append(str(current_char) + "-" + str(current_char + nChars-2))
-            current_char += nChars-1
-        matrix = numpy.array(matrix)
-        matrix = matrix.transpose()
-
-    new_matrix = matrix
-    nChars = len(matrix[0][:])
-    # this is the heavy loop
-    t1 = 0
-    equiv_matrix = []
-    missing_chars = []
-    # count missing chars for each taxon
-    for taxon in taxa:
-        chars_t1 = numpy.asarray(matrix[t1][:])
-        missing = 0
-        for c in chars_t1:
-            if c == missing_char:
-                missing+=1
-        missing_chars.append(missing)
-        t1+=1
+        matrix, charsets, names, weights = _mrp_matrix(trees, taxa, n_jobs=n_jobs)
+        missing_char = MRP_MISSING
 
-    nTaxa = len(taxa)
-
-    t1 = 0
-    for taxon in taxa:
-        t2 = 0
-        equiv_matrix.append([taxon,missing_chars[t1]])
-        equiv_taxa = []
-        for taxon2 in taxa:
-            if (taxon2 == taxon):
-                t2 += 1
-                continue
-            NonEquiv = 0
-            t2_missing = missing_chars[t2]
-            yMissing = 0
-            xMissing = 0
-            Symmetric = 1
-            xMiss_yCode = 0
-            xCode_yMiss = 0
-            for i in range(nChars):
-                char1 = matrix[t1][i]
-                char2 = matrix[t2][i]
-                if ((char1 != missing_char) and (char2 != missing_char)) :
-                    if(char1 != char2):
-                        NonEquiv = 1
-                elif((char1 == missing_char) and (char2 != missing_char)):
-                    TotalInvalid+=1
-                    xMissing = 1
-                    xMiss_yCode = 1
-                    Symmetric = 0
-                elif((char1 != missing_char) and (char2 == missing_char)):
-                    TotalInvalid+=1
-                    yMissing = 1
-                    xCode_yMiss = 1
-                    Symmetric = 0
-                elif((char1 == missing_char) and (char2 == missing_char)):
-                    TotalInvalid+=1
-                    yMissing = 1
-                    xMissing = 1
-			
-            t2 = t2+1
-
-            if (NonEquiv == 1):
-                continue
-            else:
-                if(Symmetric == 1):
-                    if((xMissing == 0) and (yMissing == 0)):
-                        equiv_taxa.append([taxon2,"A",t2_missing])
-                        continue
-                    else:
-                        equiv_taxa.append([taxon2,"B",t2_missing])
-                        continue
-                elif(Symmetric == 0):
-                    if((xMissing == 0) and (yMissing == 1)):
-                        equiv_taxa.append([taxon2,"C",t2_missing])
-                        continue
-                    elif((xMissing == 1) and (yMissing == 0)):
-                        equiv_taxa.append([taxon2,"E",t2_missing])
-                        continue
-                    elif((xMissing == 1) and (yMissing == 1)):
-                        if((xCode_yMiss == 1) and (xMiss_yCode == 1)):
-                            equiv_taxa.append([taxon2,"D",t2_missing])
-                            continue
-                        elif(xMiss_yCode == 0):
-                            equiv_taxa.append([taxon2,"C",t2_missing])
-                            continue
-                        elif(xCode_yMiss == 0):
-                            equiv_taxa.append([taxon2,"E",t2_missing])
-                            continue
-        if (len(equiv_taxa) > 0):
-            equiv_matrix[t1].extend([equiv_taxa])
+    # this is the heavy bit
+    equivs, missing_chars = stk_str.equivalent_taxa(matrix,taxa,missing_char=missing_char,
+                                                    n_jobs=n_jobs,block_size=block_size,verbose=verbose)
+    equiv_matrix = []
+    for t1 in range(len(taxa)):
+        equiv_matrix.append([taxa[t1],missing_chars[t1]])
+        if (len(equivs[t1]) > 0):
+            equiv_matrix[t1].extend([equivs[t1]])
         else:
             equiv_matrix[t1].extend(["No equivalence"])
-        t1 += 1
-        if (verbose):
-            print "Done taxa "+str(t1)+" of "+str(nTaxa)
-            
+
     can_replace = []
     # need to work out which taxa to remove
     for i in range(len(taxa)):
@@ -1151,7 +1064,7 @@ def get_all_characters(XML,ignoreErrors=False):
     """Returns a dictionary containing a list of characters within each 
     character type"""
 
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     find = etree.XPath("//character")
     characters = find(xml_root)
 
@@ -1195,7 +1108,7 @@ def get_publication_year_tree(XML,name):
     # Our input tree has name source_no, so find the source by stripping off the number
     source_name, number = name.rsplit("_",1)
     number = int(number.replace("_",""))
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     # By getting source, we can then loop over each source_tree
     find = etree.XPath("//source")
     sources = find(xml_root)
@@ -1232,7 +1145,7 @@ def get_characters_from_tree(XML,name,sort=False):
     # Our input tree has name source_no, so find the source by stripping off the number
     source_name, number = name.rsplit("_",1)
     number = int(number.replace("_",""))
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     # By getting source, we can then loop over each source_tree
     find = etree.XPath("//source")
     sources = find(xml_root)
@@ -1266,7 +1179,7 @@ def get_character_types_from_tree(XML,name,sort=False):
     # Our input tree has name source_no, so find the source by stripping off the number
     source_name, number = name.rsplit("_",1)
     number = int(number.replace("_",""))
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     # By getting source, we can then loop over each source_tree
     find = etree.XPath("//source")
     sources = find(xml_root)
@@ -1300,7 +1213,7 @@ def get_characters_used(XML):
  
     c_ = []
  
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     find = etree.XPath("//character")
     chars = find(xml_root)
 
@@ -1318,7 +1231,7 @@ def get_character_numbers(XML,ignoreErrors=False):
     """ Return the number of trees that use each character
     """
 
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     find = etree.XPath("//character")
     characters = find(xml_root)
 
@@ -1339,11 +1252,12 @@ def get_taxa_from_tree(XML, tree_name, sort=False):
     """Return taxa from a single tree based on name
     """
 
-    trees = obtain_trees(XML)
+    dataset = stk_phyml.get_dataset(XML)
+    trees = dataset.trees()
     taxa_list = []
     for t in trees:
         if t == tree_name:
-            tree = _parse_tree(trees[t]) 
+            tree = dataset.parsed_tree(t)
             terminals = tree.getAllLeafNames(tree.root)
             for term in terminals:
                 taxa_list.append(str(term))
@@ -1362,7 +1276,7 @@ def get_fossil_taxa(XML):
 
     f_ = []
 
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     find = etree.XPath("//fossil")
     fossils = find(xml_root)
 
@@ -1384,7 +1298,7 @@ def get_analyses_used(XML,ignoreErrors=False):
 
     a_ = []
 
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     find = etree.XPath("//optimality_criterion")
     analyses = find(xml_root)
 
@@ -1409,7 +1323,7 @@ def get_publication_years(XML):
     """
 
     year_dict = defaultdict(int)
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     find = etree.XPath("//year")
     years = find(xml_root)
 
@@ -1427,27 +1341,8 @@ def obtain_trees(XML):
     Output: dictionary of tree strings, with key indicating treename (unique)
     """
 
-    xml_root = _parse_xml(XML)
-    # By getting source, we can then loop over each source_tree
-    # within that source and construct a unique name
-    find = etree.XPath("//source")
-    sources = find(xml_root)
-    trees = {}
-
-    # loop through all sources
-    for s in sources:
-        for t in s.xpath("source_tree/tree/tree_string"):
-            try:
-                t_name = t.getparent().getparent().attrib['name']
-            except KeyError:
-                # no name, so make one!
-                t_name = create_tree_name(XML,t.getparent().getparent())
-                t.getparent().getparent().attrib['name'] = t_name
-            # append to dictionary, with source_name_tree_no = tree_string
-            if (not t.xpath("string_value")[0].text == None):
-                trees[t_name] = t.xpath("string_value")[0].text
-
-    return trees
+    # The dataset names any unnamed trees as create_tree_name would
+    return stk_phyml.get_dataset(XML).trees()
 
 def amalgamate_trees(XML,format="nexus",anonymous=False,ignoreWarnings=False):
     """ Create a string containing all trees in the XML.
@@ -1502,7 +1397,7 @@ def get_taxa_from_tree_for_taxonomy(tree, pretty=False, ignoreErrors=False):
 
     return taxa_list
 
-def get_all_taxa(XML, pretty=False, ignoreErrors=False):
+def get_all_taxa(XML, pretty=False, ignoreErrors=False, n_jobs=1):
     """ Produce a taxa list by scanning all trees within 
     a PHYML file. 
 
@@ -1511,20 +1406,13 @@ def get_all_taxa(XML, pretty=False, ignoreErrors=False):
     Setting pretty=True means all underscores will be
     replaced by spaces"""
 
-    trees = obtain_trees(XML)
+    dataset = stk_phyml.get_dataset(XML)
+    trees = dataset.trees()
 
     taxa_list = []
 
-    for tname in trees.keys():
-        t = trees[tname]
-        try:
-            taxa_list.extend(_getTaxaFromNewick(t))
-        except excp.TreeParseError as detail:
-            if (ignoreErrors):
-                logging.warning(detail.msg)
-                pass
-            else:
-                raise TreeParseError( detail.msg )
+    for taxa in stk_parallel.map_trees(_tree_taxa_worker,trees.values(),n_jobs=n_jobs,shared=ignoreErrors):
+        taxa_list.extend(taxa)
 
     # now uniquify the list of taxa
     taxa_list = _uniquify(taxa_list)
@@ -1541,7 +1429,7 @@ def get_weights(XML):
         (value)
     """
 
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     # By getting source, we can then loop over each source_tree
     # within that source and construct a unique name
     find = etree.XPath("//source")
@@ -1571,7 +1459,7 @@ def get_weights(XML):
 def get_outgroup(XML):
     """ For each tree, get the outgroup defined in the schema
     """
-    xml_root = _parse_xml(XML)
+    xml_root = stk_phyml.get_dataset(XML).xml_root
     # By getting source, we can then loop over each source_tree
     # within that source and construct a unique name
     find = etree.XPath("//source")
@@ -1603,12 +1491,19 @@ def get_outgroup(XML):
     return outgroups
 
 
-def create_matrix(XML,format="hennig",quote=False,taxonomy=None,outgroups=False,ignoreWarnings=False, verbose=False):
+def create_matrix(XML,format="hennig",quote=False,taxonomy=None,outgroups=False,ignoreWarnings=False, verbose=False, outfile=None, n_jobs=1, store=None):
     """ From all trees in the XML, create a matrix
+
+    The matrix is returned as a string, unless outfile (an open file) is
+    given, in which case it is written straight to the file.
+
+    store is an optional stk_tree_store.TreeStore. The taxa and MRP
+    sub-matrix of any tree it already knows are taken from it rather than
+    worked out again.
     """
 
     if not ignoreWarnings:
-        _check_data(XML)
+        _check_data(XML,n_jobs=n_jobs)
 
     weights = None
 
@@ -1639,8 +1534,8 @@ def create_matrix(XML,format="hennig",quote=False,taxonomy=None,outgroups=False,
 
     # and the taxa
     taxa = []
-    for t in trees:
-        taxa.extend(_getTaxaFromNewick(trees[t]))
+    for result in _tree_results(trees.values(),['leaves'],store=store,n_jobs=n_jobs):
+        taxa.extend([t.replace(" ","_") for t in result['leaves']])
     taxa = _uniquify(taxa)
     if (not taxonomy == None):
         taxa.extend(_getTaxaFromNewick(taxonomy))
@@ -1648,23 +1543,22 @@ def create_matrix(XML,format="hennig",quote=False,taxonomy=None,outgroups=False,
         taxa.sort()
     taxa.insert(0,"MRP_Outgroup")
         
-    return _create_matrix(trees, taxa, format=format, quote=quote, weights=weights,verbose=verbose)
+    return _create_matrix(trees, taxa, format=format, quote=quote, weights=weights,verbose=verbose,outfile=outfile,n_jobs=n_jobs,store=store)
 
 
-def create_matrix_from_trees(trees,format="hennig"):
-    """ Given a dictionary of trees, create a matrix
+def create_matrix_from_trees(trees,format="hennig",outfile=None,n_jobs=1,store=None):
+    """ Given a dictionary of trees, create a matrix. As create_matrix,
+    outfile can be an open file to write the matrix to and store can be a
+    stk_tree_store.TreeStore.
     """
 
     taxa = []
-    for t in trees:
-        tree = _parse_tree(trees[t])
-        terminals = tree.getAllLeafNames(tree.root)
-        for term in terminals:
-            taxa.append(str(term))
+    for result in _tree_results(trees.values(),['leaves'],store=store,n_jobs=n_jobs):
+        taxa.extend(result['leaves'])
     
     taxa = _uniquify(taxa)
 
-    return _create_matrix(trees, taxa, format=format)
+    return _create_matrix(trees, taxa, format=format, outfile=outfile, n_jobs=n_jobs, store=store)
 
 
 def load_phyml(filename):
@@ -1694,6 +1588,32 @@ def _sort_sub_taxa(old_taxa, new_taxa):
 
     return old_taxa, new_taxa
 
+def _expand_sub_taxa(old_taxa, new_taxa, taxonomy):
+    """
+    Add the taxa in any higher taxa in old_taxa, each straight after
+    the higher taxon and with the same substitution. Taxa already in
+    old_taxa keep their own substitution.
+    """
+
+    index = stk_taxonomy_index.taxonomy_index(taxonomy)
+    seen = set([t.replace(" ","_") for t in old_taxa])
+    expanded_old = []
+    expanded_new = []
+    for i in range(len(old_taxa)):
+        new = None
+        if (new_taxa):
+            new = new_taxa[i]
+        expanded_old.append(old_taxa[i])
+        expanded_new.append(new)
+        for taxon in sorted(index.members(old_taxa[i])):
+            if (not taxon in seen):
+                seen.add(taxon)
+                expanded_old.append(taxon)
+                expanded_new.append(new)
+    if (not new_taxa):
+        expanded_new = new_taxa
+    return expanded_old, expanded_new
+
 def _sub_deal_with_existing_only(existing_taxa,old_taxa, new_taxa, generic_match):
     import csv
     corrected_taxa = []
@@ -1734,7 +1654,7 @@ def _sub_deal_with_existing_only(existing_taxa,old_taxa, new_taxa, generic_match
     return new_taxa
 
 
-def substitute_taxa(XML, old_taxa, new_taxa=None, only_existing=False, ignoreWarnings=False, verbose=False, skip_existing=False, generic_match=False):
+def substitute_taxa(XML, old_taxa, new_taxa=None, only_existing=False, ignoreWarnings=False, verbose=False, skip_existing=False, generic_match=False, n_jobs=1, store=None, taxonomy=None):
     """
     Swap the taxa in the old_taxa array for the ones in the
     new_taxa array
@@ -1746,34 +1666,57 @@ def substitute_taxa(XML, old_taxa, new_taxa=None, only_existing=False, ignoreWar
     Returns a new XML with the taxa swapped from each tree and any taxon
     elements for those taxa removed. It's up to the calling function to
     do something sensible with this infomation
+
+    n_jobs > 1 substitutes the trees using a pool of processes
+
+    store is an optional stk_tree_store.TreeStore. Trees it knows contain
+    none of the old_taxa (and that substituting would otherwise leave as
+    they are) are not touched.
+
+    taxonomy is an optional taxonomy (as load_taxonomy returns) or
+    stk_taxonomy_index.TaxonomyIndex. If given, an old taxon that is a
+    higher taxon (e.g. Galliformes) also substitutes all the taxa in it.
     """
 
     if not ignoreWarnings:
-        _check_data(XML)
+        _check_data(XML,n_jobs=n_jobs)
 
     
     old_taxa, new_taxa = _sort_sub_taxa(old_taxa,new_taxa)
+    if (not taxonomy is None):
+        old_taxa, new_taxa = _expand_sub_taxa(old_taxa,new_taxa,taxonomy)
 
     # Sort incoming taxa
     if (only_existing):
-        existing_taxa = get_all_taxa(XML)
+        existing_taxa = get_all_taxa(XML,n_jobs=n_jobs)
         new_taxa = _sub_deal_with_existing_only(existing_taxa,old_taxa, new_taxa, generic_match)
 
     # need to check for uniquessness of souce names - error is not unique
     _check_uniqueness(XML)
 
-    # grab all trees and store as bio.phylo.tree objects
-    trees = obtain_trees(XML)
+    # work on a single copy of the document and write all the trees into
+    # it, rather than re-serialising the XML after every tree
+    dataset = stk_phyml.editable_dataset(XML)
+    trees = dataset.trees()
 
-    for name in trees.iterkeys():
-        tree = trees[name]
-        new_tree = _sub_taxa_in_tree(tree,old_taxa,new_taxa,skip_existing=skip_existing)
-        XML = _swap_tree_in_XML(XML,new_tree,name)
+    names = trees.keys()
+    for name in names:
+        if (not dataset.has_unique_tree(name)):
+            raise excp.NotUniqueError("Two or more source_trees have the same name. Please fix this.")
+    sub_table = _compile_sub_table(old_taxa)
+    if (not store is None):
+        results = _tree_results([trees[name] for name in names],['leaves','normal'],store=store,n_jobs=n_jobs)
+        names = [name for name, result in zip(names,results)
+                 if not result['normal'] or _leaves_match_sub_table(result['leaves'],sub_table)]
+    new_trees = stk_parallel.map_trees(_sub_taxa_worker,[trees[name] for name in names],n_jobs=n_jobs,
+                                       shared=(old_taxa,new_taxa,skip_existing,sub_table))
+    for name, new_tree in zip(names,new_trees):
+        dataset.set_tree_string(name,new_tree)
  
     # now loop over all taxon elements in the XML, and 
     # remove/sub as necessary
     i = 0
-    xml_root = _parse_xml(XML)
+    xml_root = dataset.xml_root
     xml_taxa = []
     xml_outgroup = []
     # grab all taxon elements and store
@@ -1784,16 +1727,19 @@ def substitute_taxa(XML, old_taxa, new_taxa=None, only_existing=False, ignoreWar
             xml_taxa.append(ele)
         if (ele.tag == "outgroup"):
             xml_outgroup.append(ele)
+    # and index the taxon elements by name, keeping them in document order
+    xml_taxa_by_name = {}
+    for n in range(len(xml_taxa)):
+        xml_taxa_by_name.setdefault(xml_taxa[n].attrib.get('name'),[]).append((n,xml_taxa[n]))
    
     i = 0
     for taxon in old_taxa:
         if (new_taxa == None or new_taxa[i] == None):
             # need to search for elements that have the right name and delete them
-            for ele in xml_taxa:
-                if (ele.attrib['name'] == taxon):
-                    # You remove the element by getting the 
-                    # deleting it from the parent
-                    ele.getparent().remove(ele)
+            for n, ele in xml_taxa_by_name.pop(taxon,[]):
+                # You remove the element by getting the 
+                # deleting it from the parent
+                ele.getparent().remove(ele)
             for ele in xml_outgroup:
                 if (taxon in ele.xpath("string_value")[0].text):
                     outgroup = ele.xpath("string_value")[0].text
@@ -1810,26 +1756,26 @@ def substitute_taxa(XML, old_taxa, new_taxa=None, only_existing=False, ignoreWar
                     else:
                         ele.xpath("string_value")[0].text = ",".join(new_outgroup_taxa)
         else:
-            for ele in xml_taxa:
+            for n, ele in xml_taxa_by_name.pop(taxon,[]):
                 new_taxa_info = []
-                if (ele.attrib['name'] == taxon):
-                    nt = new_taxa[i].split(",") # incoming polytomy, maybe
-                    new_taxa_info.extend(nt)
-                    if (len(new_taxa_info) == 1):
-                        # straight swap
-                        ele.attrib['name'] = new_taxa_info[0]
-                    else:
-                        # we need to construct multiple taxa blocks!
-                        taxa_parent = ele.getparent()
-                        original_ele = deepcopy(ele)
-                        ele.getparent().remove(ele)
-                        for nt in new_taxa_info:
-                            temp_ele = deepcopy(original_ele)
-                            temp_ele.attrib['name'] = nt
-                            # add comment re: this was originally
-                            comment = etree.SubElement(temp_ele,"comment")
-                            comment.text = "Was originally "+taxon+" and was subbed"
-                            taxa_parent.append(temp_ele)
+                nt = new_taxa[i].split(",") # incoming polytomy, maybe
+                new_taxa_info.extend(nt)
+                if (len(new_taxa_info) == 1):
+                    # straight swap
+                    ele.attrib['name'] = new_taxa_info[0]
+                    bisect.insort(xml_taxa_by_name.setdefault(new_taxa_info[0],[]),(n,ele))
+                else:
+                    # we need to construct multiple taxa blocks!
+                    taxa_parent = ele.getparent()
+                    original_ele = deepcopy(ele)
+                    ele.getparent().remove(ele)
+                    for nt in new_taxa_info:
+                        temp_ele = deepcopy(original_ele)
+                        temp_ele.attrib['name'] = nt
+                        # add comment re: this was originally
+                        comment = etree.SubElement(temp_ele,"comment")
+                        comment.text = "Was originally "+taxon+" and was subbed"
+                        taxa_parent.append(temp_ele)
 
             for ele in xml_outgroup:
                 if (taxon in ele.xpath("string_value")[0].text):
@@ -1849,10 +1795,10 @@ def substitute_taxa(XML, old_taxa, new_taxa=None, only_existing=False, ignoreWar
 
         i = i+1
 
-    return etree.tostring(xml_root,pretty_print=True)
+    return stk_phyml.dataset_result(XML,dataset)
 
 
-def substitute_taxa_in_trees(trees, old_taxa, new_taxa=None, only_existing = False, ignoreWarnings=False, verbose=False,generic_match=False):
+def substitute_taxa_in_trees(trees, old_taxa, new_taxa=None, only_existing = False, ignoreWarnings=False, verbose=False,generic_match=False, n_jobs=1, taxonomy=None):
     """
     Swap the taxa in the old_taxa array for the ones in the
     new_taxa array
@@ -1864,9 +1810,13 @@ def substitute_taxa_in_trees(trees, old_taxa, new_taxa=None, only_existing = Fal
     Returns a new list of trees with the taxa swapped from each tree 
     It's up to the calling function to
     do something sensible with this infomation
+
+    taxonomy expands higher taxa in old_taxa, as for substitute_taxa
     """
 
     old_taxa, new_taxa = _sort_sub_taxa(old_taxa,new_taxa)
+    if (not taxonomy is None):
+        old_taxa, new_taxa = _expand_sub_taxa(old_taxa,new_taxa,taxonomy)
 
     # Sort incoming taxa
     if (only_existing):
@@ -1876,20 +1826,33 @@ def substitute_taxa_in_trees(trees, old_taxa, new_taxa=None, only_existing = Fal
         existing_taxa = _uniquify(existing_taxa)
         new_taxa = _sub_deal_with_existing_only(existing_taxa,old_taxa, new_taxa, generic_match)
     
-    new_trees = []
-    for tree in trees:
-        new_trees.append(_sub_taxa_in_tree(tree,old_taxa,new_taxa))
+    sub_table = _compile_sub_table(old_taxa)
+    new_trees = stk_parallel.map_trees(_sub_taxa_worker,trees,n_jobs=n_jobs,
+                                       shared=(old_taxa,new_taxa,False,sub_table))
  
     return new_trees
 
 
 
-def permute_tree(tree,matrix="hennig",treefile=None,verbose=False):
+def permute_tree(tree,matrix="hennig",treefile=None,verbose=False,max_permutations=None,enumerate_trees=None):
     """ Permute a tree where there is uncertianty in taxa location.
     Output either a tree file or matrix file of all possible 
     permutations.
 
-    Note this is a recursive algorithm.
+    The matrix is made from the permuted trees, as a tree file is:
+    characters are repeated once for each tree they are in, and of trees
+    that differ only in where they are rooted just one is used. If there
+    are more than PERMUTATION_ENUMERATE_LIMIT permutations (or
+    enumerate_trees is False) it is worked out from the clades of the
+    tree instead, without making every permutation (see
+    _permuted_characters). That matrix holds each different character
+    once, so it has the same characters but fewer columns. Set
+    enumerate_trees to True to always make the trees.
+
+    Making the trees is a recursive algorithm. If max_permutations is
+    given and there would be more permutations than that (see
+    permutation_count) a TooManyPermutationsError is raised rather than
+    making them.
     """
 
     # check format strings
@@ -1938,6 +1901,26 @@ def permute_tree(tree,matrix="hennig",treefile=None,verbose=False):
     if (verbose):
         print "This tree requires a of "+str(total)+ " permutations"
 
+    if (enumerate_trees == None):
+        enumerate_trees = total <= PERMUTATION_ENUMERATE_LIMIT
+    if (treefile == None and not enumerate_trees):
+        taxa = []
+        taxa.append("MRP_Outgroup")
+        taxa.extend(names_unique)
+        characters = _permuted_characters(tree)
+        mrp = numpy.zeros((len(taxa),len(characters)),dtype=numpy.int8)
+        t_index = dict([(taxa[i],i) for i in range(len(taxa))])
+        for j in range(len(characters)):
+            mrp[[t_index[t] for t in characters[j]],j] = 1
+        charsets = None
+        if (len(characters) > 0):
+            charsets = ["1-"+str(len(characters))]
+        return _create_matrix_string(mrp,taxa,charsets=charsets,names=["permutations"],format=matrix)
+
+    if (not max_permutations == None and total > max_permutations):
+        raise excp.TooManyPermutationsError("This tree has "+str(total)+" permutations, more than the "+
+                                            str(max_permutations)+" allowed")
+
     trees_saved = []
     # I hate recursive functions, but it actually is the
     # best way to do this.
@@ -1979,14 +1962,14 @@ def permute_tree(tree,matrix="hennig",treefile=None,verbose=False):
         _permute(0,tree)
 
     # check none are actually equal and store as dictionary
+    # Where trees are the same, the last one is kept
+    fingerprints = [tree_fingerprint(t) for t in trees_saved]
+    last = {}
+    for i in range(0,len(trees_saved)):
+        last[fingerprints[i]] = i
     count = 1
     for i in range(0,len(trees_saved)):
-        equal = False
-        for j in range(i+1,len(trees_saved)):
-            if (_trees_equal(trees_saved[i],trees_saved[j])):
-                equal = True
-                break
-        if (not equal):
+        if (last[fingerprints[i]] == i):
             permuted_trees["tree_"+str(count)] = trees_saved[i]
             count += 1
             
@@ -2008,6 +1991,91 @@ def permute_tree(tree,matrix="hennig",treefile=None,verbose=False):
     return output_string
 
 
+def permutation_count(tree):
+    """ The number of trees permute_tree would make from a tree: the
+    product of the number of places each non-monophyletic taxon appears
+    """
+
+    counts = {}
+    for name in _parse_tree_cached(_correctly_quote_taxa(tree)).taxa:
+        if (not name.find('%') == -1):
+            name = name[0:name.find('%')]
+            counts[name] = counts.get(name,0) + 1
+    total = 1
+    for n in counts.values():
+        total = total * n
+    return total
+
+
+def _permuted_characters(tree):
+    """ The different MRP characters (sets of taxa, without the %N)
+    of all the trees permute_tree would make from a tree, without
+    making them.
+
+    A permuted tree keeps one copy of each non-monophyletic taxon, and
+    deleting the others leaves the clades of the tree made of the taxa
+    that remain. So the clade below a node of the tree holds the taxa
+    that are only below it, plus any taxon with copies both below it and
+    elsewhere if that copy is the one kept - and each of those can be
+    kept or not independently of the others. The work is exponential in
+    the number of such taxa at a node, rather than in the number of
+    permutations.
+
+    returns: list of characters (frozensets of taxa), in the order first found
+    """
+
+    p4tree = _parse_tree_cached(tree).tree
+    # number of copies of each non-monophyletic taxon
+    total = {}
+    for name in _parse_tree_cached(tree).taxa:
+        if (not name.find('%') == -1):
+            name = name[0:name.find('%')]
+            total[name] = total.get(name,0) + 1
+    n_taxa = len(set([name.split('%')[0] for name in _parse_tree_cached(tree).taxa]))
+
+    characters = []
+    seen = set()
+    # for each node: taxa that only appear once, and the number of
+    # copies of each non-monophyletic taxon, below it
+    below = {}
+    for n in p4tree.iterPostOrder():
+        if (n.isLeaf):
+            name = n.name.replace(" ","_")
+            if (name.find('%') == -1):
+                below[n.nodeNum] = (set([name]), {})
+            else:
+                below[n.nodeNum] = (set(), {name[0:name.find('%')]:1})
+            continue
+        fixed = set()
+        copies = {}
+        for c in n.iterChildren():
+            c_fixed, c_copies = below.pop(c.nodeNum)
+            fixed.update(c_fixed)
+            for name in c_copies:
+                copies[name] = copies.get(name,0) + c_copies[name]
+        below[n.nodeNum] = (fixed, copies)
+        if (n == p4tree.root):
+            continue
+        always = set(fixed)
+        maybe = []
+        for name in sorted(copies):
+            if (copies[name] == total[name]):
+                always.add(name)
+            else:
+                maybe.append(name)
+        for k in range(len(maybe)+1):
+            for some in itertools.combinations(maybe,k):
+                character = frozenset(always.union(some))
+                # leaves on their own and the whole tree are not characters
+                if (len(character) < 2 or len(character) == n_taxa):
+                    continue
+                if (not character in seen):
+                    seen.add(character)
+                    characters.append(character)
+
+    return characters
+
+
 def data_summary(XML,detailed=False,ignoreWarnings=False):
     """Creates a text string that summarises the current data set via a number of 
     statistics such as the number of character types, distribution of years of publication,
@@ -2019,166 +2087,189 @@ def data_summary(XML,detailed=False,ignoreWarnings=False):
     if not ignoreWarnings:
         _check_data(XML)
 
-    xml_root = _parse_xml(XML)
-    proj_name = get_project_name(XML)
+    return dataset_statistics(XML).summary(detailed)
 
-    output_string  = "======================\n"
-    output_string += " Data summary of: " + proj_name + "\n" 
-    output_string += "======================\n\n"
+def dataset_statistics(XML):
+    """ Gather the numbers data_summary reports (the trees, taxa, characters,
+    fossils, publication years and analyses) in one pass over the dataset.
+    Returns a stk_statistics.DatasetStatistics, which is remembered, so
+    asking again for the same data is quick. Don't alter what you get back.
+    """
 
-    trees = obtain_trees(XML)
-    taxa = get_all_taxa(XML, pretty=False, ignoreErrors=True)
-    characters = get_all_characters(XML,ignoreErrors=True)
-    char_numbers = get_character_numbers(XML,ignoreErrors=True)
-    fossils = get_fossil_taxa(XML)
-    publication_years = get_publication_years(XML)
-    analyses = get_analyses_used(XML,ignoreErrors=True)
-    years = publication_years.keys()
-    years.sort()
-    chars = char_numbers.keys()
-    chars.sort()
-
-    output_string += "Number of taxa: "+str(len(taxa))+"\n"
-    output_string += "Number of characters: "+str(len(chars))+"\n"
-    output_string += "Number of character types: "+str(len(characters))+"\n"
-    output_string += "Number of trees: "+str(len(trees))+"\n"
-    output_string += "Number of fossil taxa: "+str(len(fossils))+"\n"
-    output_string += "Number of analyses: "+str(len(analyses))+"\n"
-    output_string += "Data spans: "+str(years[0])+" - "+str(years[-1])+"\n"
-
-
-    if (detailed):
-        # append additional info including full list of characters
-        # full list of taxa and full list of fossil taxa
-        output_string += "\nPublication years:\n"
-        output_string += "----------------------\n"
-        for i in range(years[0],years[-1]+1):
-            output_string += "    "+str(i)+": "+str(publication_years[i])+"\n"
-        output_string += "----------------------\n"
-
-        output_string += "\n\nCharacter Type List:\n"
-        output_string += "----------------------\n"
-        for c in characters:
-            output_string += "     "+c+"    " + "\n"
-        output_string += "----------------------\n"
+    return stk_statistics.statistics(XML)
 
-        output_string += "\n\nAnalyses Used:\n"
-        output_string += "----------------------\n"
-        for a in analyses:
-            output_string += "     "+a+"\n"
-        output_string += "----------------------\n"
+def warm_taxonomy_cache(taxonomy_csv, cache=None):
+    """ Fill the taxonomy cache from a taxonomy CSV file (as written by
+    save_taxonomy or "stk create_taxonomy") so those taxa are not looked
+    up again. Returns the number of taxa added.
+    """
 
+    if (cache is None):
+        cache = stk_taxonomy_cache.get_cache()
+    if (cache is None):
+        return 0
+    return cache.warm(load_taxonomy(taxonomy_csv))
 
-        output_string += "\n\nCharacter List:\n"
-        output_string += "----------------------\n"
-        for c in chars:
-            output_string += "     "+c+"    "+str(char_numbers[c])+"("+str(float(char_numbers[c])/float(len(trees))*100.)+"%)\n"
-        output_string += "----------------------\n"
-        
-        output_string += "\n\nTaxa List:\n"
-        output_string += "----------------------\n"
-        for t in taxa:
-            output_string += "     "+t+"\n"
-        output_string += "----------------------\n"
+def _check_taxon_name(t, verbose=False):
+    """ Look a single name up on EoL and return its entry for the
+    equivalents dictionary (see taxonomic_checker_list) """
 
+    # check the name on EoL - what if it's a synonym? Does EoL still return a result?
+    # if not, is there another API function to do this?
+    # search for the taxon and grab the name - if you search for a recognised synonym on EoL then
+    # you get the original ('correct') name - shorten this to two words and you're done.
+    taxon = t.replace("_"," ")
+    if (verbose):
+        print "Looking up ", taxon
+    # get the data from EOL on taxon
+    eol = stk_taxonomy_providers.get_provider("eol")
+    data = eol.search(taxon)
+    # check if there's some data
+    if len(data['results']) == 0:
+        return [[t],'red']
+    amber = False
+    if len(data['results']) > 1:
+        # this is not great - we have multiple hits for this taxon - needs the user to go back and warn about this
+        # for automatic processing we'll just take the first one though
+        # colour is amber in this case
+        amber = True
+    ID = str(data['results'][0]['id']) # take first hit
+    try:
+        data = eol.page(ID,query="images=0&videos=0&sounds=0&maps=0&text=0&iucn=false&subjects=overview&licenses=all&details=true&common_names=true&synonyms=true&references=true&vetted=0")
+    except urllib2.HTTPError:
+        return [[t],'red']
+    if len(data['scientificName']) == 0:
+        # not found a scientific name, so set as red
+        return [[t],'red']
+    correct_name = data['scientificName'].encode("ascii","ignore")
+    # we only want the first two bits of the name, not the original author and year if any
+    temp_name = correct_name.split(' ')
+    if (len(temp_name) > 2):
+        correct_name = ' '.join(temp_name[0:2])
+    correct_name = correct_name.replace(' ','_')
+
+    # build up the output dictionary - original name is key, synonyms/missing is value
+    if (correct_name == t):
+        # if the original matches the 'correct', then it's green
+        return [[t], 'green']
+    else:
+        # if we managed to get something anyway, then it's yellow and create a list of possible synonyms with the 
+        # 'correct' taxon at the top
+        eol_synonyms = data['synonyms']
+        synonyms = []
+        for s in eol_synonyms:
+            ts = s['synonym'].encode("ascii","ignore")
+            temp_syn = ts.split(' ')
+            if (len(temp_syn) > 2):
+                temp_syn = ' '.join(temp_syn[0:2])
+                ts = temp_syn
+            if (s['relationship'] == "synonym"):
+                ts = ts.replace(" ","_")
+                synonyms.append(ts)
+        synonyms = _uniquify(synonyms)
+        # we need to put the correct name at the top of the list now
+        if (correct_name in synonyms):
+            synonyms.insert(0, synonyms.pop(synonyms.index(correct_name)))
+        elif len(synonyms) == 0:
+            synonyms.append(correct_name)
+        else:
+            synonyms.insert(0,correct_name)
 
-    return output_string
+        if (amber):
+            return [synonyms,'amber']
+        else:
+            return [synonyms,'yellow']
+    # if our search was empty, then it's red - see above
 
-def taxonomic_checker_list(name_list,existing_data=None,verbose=False):
+def _check_names_worker(tasks, results, stop, verbose):
+    while True:
+        task = tasks.get()
+        if (task is None):
+            break
+        i, t = task
+        if (stop.is_set()):
+            # something went wrong elsewhere; don't bother
+            results.put((i, t, None, None))
+            continue
+        try:
+            results.put((i, t, _check_taxon_name(t, verbose), None))
+        except:
+            stop.set()
+            results.put((i, t, None, sys.exc_info()))
+
+def taxonomic_checker_list(name_list,existing_data=None,verbose=False,threadNumber=5,progress=None,backbone=None):
     """ For each name in the database generate a database of the original name,
     possible synonyms and if the taxon is not know, signal that. We do this by
-    using the EoL API to grab synonyms of each taxon.  """
+    using the EoL API to grab synonyms of each taxon.
 
-    import urllib2
-    from urllib import quote_plus
-    import simplejson as json
+    Up to threadNumber names are looked up at once. Results are added to
+    the dictionary as they arrive and, if given, progress(done, total, name)
+    is called after each one. The result is the same however many threads
+    are used.
+
+    If there is a backbone (a stk_backbone.Backbone, or the one set with
+    stk_backbone.set_backbone), names are checked against that instead and
+    the network is not used.
+    """
 
     if existing_data == None:
         equivalents = {}
     else:
         equivalents = existing_data
-
-    # for each taxon, check the name on EoL - what if it's a synonym? Does EoL still return a result?
-    # if not, is there another API function to do this?
-    # search for the taxon and grab the name - if you search for a recognised synonym on EoL then
-    # you get the original ('correct') name - shorten this to two words and you're done.
-    for t in name_list:
-        if t in equivalents:
+    if (backbone is None):
+        backbone = stk_backbone.get_backbone()
+
+    to_check = _uniquify([t for t in name_list if not t in equivalents])
+    total = len(to_check)
+    if (not backbone is None):
+        for i in range(total):
+            t = to_check[i]
+            equivalents[t] = backbone.check(t)
+            if (not progress is None):
+                progress(i+1, total, t)
+        return equivalents
+    if (threadNumber is None or threadNumber <= 1 or total <= 1):
+        for i in range(total):
+            t = to_check[i]
+            equivalents[t] = _check_taxon_name(t, verbose)
+            if (not progress is None):
+                progress(i+1, total, t)
+        return equivalents
+
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    stop = threading.Event()
+    for i in range(total):
+        tasks.put((i, to_check[i]))
+    workers = []
+    for i in range(min(threadNumber, total)):
+        tasks.put(None)
+        w = threading.Thread(target=_check_names_worker, args=(tasks, results, stop, verbose))
+        w.setDaemon(True)
+        w.start()
+        workers.append(w)
+
+    # every name gets a result; only this thread touches equivalents
+    done = 0
+    error = None
+    for n in range(total):
+        i, t, entry, exc_info = results.get()
+        if (not exc_info is None):
+            # keep the error from the earliest name, as the serial version would
+            if (error is None or i < error[0]):
+                error = (i, exc_info)
             continue
-        taxon = t.replace("_"," ")
-        if (verbose):
-            print "Looking up ", taxon
-        # get the data from EOL on taxon
-        taxonq = quote_plus(taxon)
-        URL = "http://eol.org/api/search/1.0.json?q="+taxonq
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        data = json.load(f)
-        # check if there's some data
-        if len(data['results']) == 0:
-            equivalents[t] = [[t],'red']
+        if (entry is None):
             continue
-        amber = False
-        if len(data['results']) > 1:
-            # this is not great - we have multiple hits for this taxon - needs the user to go back and warn about this
-            # for automatic processing we'll just take the first one though
-            # colour is amber in this case
-            amber = True
-        ID = str(data['results'][0]['id']) # take first hit
-        URL = "http://eol.org/api/pages/1.0/"+ID+".json?images=0&videos=0&sounds=0&maps=0&text=0&iucn=false&subjects=overview&licenses=all&details=true&common_names=true&synonyms=true&references=true&vetted=0"       
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        
-        try:
-            f = opener.open(req)
-        except urllib2.HTTPError:
-            equivalents[t] = [[t],'red'] 
-            continue
-        data = json.load(f)
-        if len(data['scientificName']) == 0:
-            # not found a scientific name, so set as red
-            equivalents[t] = [[t],'red']            
-            continue
-        correct_name = data['scientificName'].encode("ascii","ignore")
-        # we only want the first two bits of the name, not the original author and year if any
-        temp_name = correct_name.split(' ')
-        if (len(temp_name) > 2):
-            correct_name = ' '.join(temp_name[0:2])
-        correct_name = correct_name.replace(' ','_')
-
-        # build up the output dictionary - original name is key, synonyms/missing is value
-        if (correct_name == t):
-            # if the original matches the 'correct', then it's green
-            equivalents[t] = [[t], 'green']
-        else:
-            # if we managed to get something anyway, then it's yellow and create a list of possible synonyms with the 
-            # 'correct' taxon at the top
-            eol_synonyms = data['synonyms']
-            synonyms = []
-            for s in eol_synonyms:
-                ts = s['synonym'].encode("ascii","ignore")
-                temp_syn = ts.split(' ')
-                if (len(temp_syn) > 2):
-                    temp_syn = ' '.join(temp_syn[0:2])
-                    ts = temp_syn
-                if (s['relationship'] == "synonym"):
-                    ts = ts.replace(" ","_")
-                    synonyms.append(ts)
-            synonyms = _uniquify(synonyms)
-            # we need to put the correct name at the top of the list now
-            if (correct_name in synonyms):
-                synonyms.insert(0, synonyms.pop(synonyms.index(correct_name)))
-            elif len(synonyms) == 0:
-                synonyms.append(correct_name)
-            else:
-                synonyms.insert(0,correct_name)
-
-            if (amber):
-                equivalents[t] = [synonyms,'amber']
-            else:
-                equivalents[t] = [synonyms,'yellow']
-        # if our search was empty, then it's red - see above
+        equivalents[t] = entry
+        done += 1
+        if (not progress is None):
+            progress(done, total, t)
+    for w in workers:
+        w.join()
+    if (not error is None):
+        exc_info = error[1]
+        raise exc_info[0], exc_info[1], exc_info[2]
 
     # up to the calling funciton to do something sensible with this
     # we build a dictionary of names and then a list of synonyms or the original name, then a tag if it's green, yellow, red.
@@ -2186,7 +2277,7 @@ def taxonomic_checker_list(name_list,existing_data=None,verbose=False):
 
     return equivalents
 
-def taxonomic_checker_tree(tree_file,existing_data=None,verbose=False):
+def taxonomic_checker_tree(tree_file,existing_data=None,verbose=False,threadNumber=5,progress=None,backbone=None):
     """ For each name in the database generate a database of the original name,
     possible synonyms and if the taxon is not know, signal that. We do this by
     using the EoL API to grab synonyms of each taxon.  """
@@ -2199,10 +2290,11 @@ def taxonomic_checker_tree(tree_file,existing_data=None,verbose=False):
     else:
         equivalents = existing_data
 
-    equivalents = taxonomic_checker_list(taxa,existing_data,verbose)
+    equivalents = taxonomic_checker_list(taxa,existing_data,verbose,threadNumber=threadNumber,progress=progress,
+                                         backbone=backbone)
     return equivalents
 
-def taxonomic_checker(XML,existing_data=None,verbose=False):
+def taxonomic_checker(XML,existing_data=None,verbose=False,threadNumber=5,progress=None,backbone=None):
     """ For each name in the database generate a database of the original name,
     possible synonyms and if the taxon is not know, signal that. We do this by
     using the EoL API to grab synonyms of each taxon.  """
@@ -2215,7 +2307,8 @@ def taxonomic_checker(XML,existing_data=None,verbose=False):
     else:
         equivalents = existing_data
 
-    equivalents = taxonomic_checker_list(taxa,existing_data,verbose)
+    equivalents = taxonomic_checker_list(taxa,existing_data,verbose,threadNumber=threadNumber,progress=progress,
+                                         backbone=backbone)
     return equivalents
 
 
@@ -2240,62 +2333,41 @@ def load_equivalents(equiv_csv):
     return equivalents
 
 def save_taxonomy(taxonomy, output_file):
+    """Save a taxonomy (dictionary or stk_taxonomy.Taxonomy) as a CSV file,
+    or as a snapshot if output_file ends in .stktax"""
 
-    import csv
-
-    with open(output_file, 'w') as f:
-        writer = csv.writer(f)
-        row = ['OTU']
-        row.extend(taxonomy_levels)
-        row.append('Provider')
-        writer.writerow(row)
-        for t in taxonomy:
-            species = t
-            row = []
-            row.append(t.encode('utf-8'))
-            for l in taxonomy_levels:
-                try:
-                    g = taxonomy[t][l]
-                except KeyError:
-                    g = '-'
-                row.append(g.encode('utf-8'))
-            try:
-                provider = taxonomy[t]['provider']
-            except KeyError:
-                provider = "-"
-            row.append(provider)
-
-            writer.writerow(row)
-
+    if (output_file.endswith(TAXONOMY_SNAPSHOT_EXT)):
+        if (not isinstance(taxonomy, stk_taxonomy.Taxonomy)):
+            taxonomy = stk_taxonomy.Taxonomy(taxonomy)
+        taxonomy.save(output_file)
+    else:
+        stk_taxonomy.write_csv(taxonomy, output_file, taxonomy_levels)
 
-def load_taxonomy(taxonomy_csv):
-    """Load in a taxonomy CSV file and convert to taxonomy Dict"""
-    
-    import csv
 
-    taxonomy = {}
+def load_taxonomy(taxonomy_csv, compact=False):
+    """Load in a taxonomy CSV file (or a snapshot saved by save_taxonomy)
+    and convert to taxonomy Dict
 
-    with open(taxonomy_csv, 'rU') as csvfile:
-        tax_reader = csv.reader(csvfile, delimiter=',')
-        try:
-            j = 0
-            for row in tax_reader:
-                if j == 0:
-                    tax_levels = row[1:-1]
-                    j += 1
-                    continue
-                i = 1
-                current_taxonomy = {}
-                for t in tax_levels:
-                    if not row[i] == '-':
-                        current_taxonomy[t] = row[i]
-                    i = i+ 1
-                current_taxonomy['provider'] = row[-1] # data source
-                taxonomy[row[0].replace(" ","_")] = current_taxonomy
-                j += 1
-        except:
-            pass
+    Rows with the wrong number of columns are skipped, with a warning.
+    compact returns a stk_taxonomy.Taxonomy, which uses much less memory
+    for a large taxonomy, rather than a dictionary"""
     
+    if (stk_taxonomy.is_snapshot(taxonomy_csv)):
+        taxonomy = stk_taxonomy.Taxonomy.load(taxonomy_csv)
+        if (compact):
+            return taxonomy
+        return dict(taxonomy.iteritems())
+
+    if (compact):
+        taxonomy = stk_taxonomy.read_csv(taxonomy_csv)
+        malformed = taxonomy.malformed
+    else:
+        # straight into a dictionary, rather than by way of a Taxonomy
+        taxonomy, malformed = stk_taxonomy.read_csv_dict(taxonomy_csv)
+    if (len(malformed) > 0):
+        print "Warning: skipped "+str(len(malformed))+" malformed rows in "+taxonomy_csv+":"
+        for line, message in malformed[:10]:
+            print "\tline "+str(line)+": "+message
     return taxonomy
 
 
@@ -2345,25 +2417,25 @@ class TaxonomyFetcher(threading.Thread):
             if not taxon in self.taxonomy: # is a new taxon, not previously in the taxonomy
                 #Release access to the taxonomy
                 self.lock.release()
+                cache = stk_taxonomy_cache.get_cache()
+                if (not cache is None):
+                    cached = cache.get_taxonomy(taxon)
+                    if (not cached is None):
+                        with self.lock:
+                            self.taxonomy[taxon] = cached
+                        self.queue.task_done()
+                        continue
                 if (self.verbose):
                     print "Looking up ", taxon
                     logging.info("Loolking up taxon: {}".format(str(taxon)))
                 try:
                     # get the data from EOL on taxon
-                    taxonq = quote_plus(taxon)
-                    URL = "http://eol.org/api/search/1.0.json?q="+taxonq
-                    req = urllib2.Request(URL)
-                    opener = urllib2.build_opener()
-                    f = opener.open(req)
-                    data = json.load(f)
+                    eol = stk_taxonomy_providers.get_provider("eol")
+                    data = eol.search(taxon)
                     # check if there's some data
                     if len(data['results']) == 0:
                         # try PBDB as it might be a fossil
-                        URL = "http://paleobiodb.org/data1.1/taxa/single.json?name="+taxonq+"&show=phylo&vocab=pbdb"
-                        req = urllib2.Request(URL)
-                        opener = urllib2.build_opener()
-                        f = opener.open(req)
-                        datapbdb = json.load(f)
+                        datapbdb = stk_taxonomy_providers.get_provider("pbdb").taxon(taxon)
                         if (len(datapbdb['records']) == 0):
                             # no idea!
                             with self.lock:
@@ -2410,11 +2482,7 @@ class TaxonomyFetcher(threading.Thread):
                                 
                     ID = str(data['results'][0]['id']) # take first hit
                     # Now look for taxonomies
-                    URL = "http://eol.org/api/pages/1.0/"+ID+".json"
-                    req = urllib2.Request(URL)
-                    opener = urllib2.build_opener()
-                    f = opener.open(req)
-                    data = json.load(f)
+                    data = eol.page(ID)
                     if len(data['taxonConcepts']) == 0:
                         with self.lock:
                             self.taxonomy[taxon] = {}
@@ -2430,11 +2498,7 @@ class TaxonomyFetcher(threading.Thread):
                             if (self.pref_db.lower() in currentdb):
                                 TID = str(db['identifier'])
                                 break
-                    URL="http://eol.org/api/hierarchy_entries/1.0/"+TID+".json"
-                    req = urllib2.Request(URL)
-                    opener = urllib2.build_opener()
-                    f = opener.open(req)
-                    data = json.load(f)
+                    data = eol.hierarchy_entry(TID)
                     this_taxonomy = {}
                     this_taxonomy['provider'] = currentdb
                     for a in data['ancestors']:
@@ -2469,6 +2533,8 @@ class TaxonomyFetcher(threading.Thread):
                     with self.lock:
                         #Send result to dictionary
                         self.taxonomy[taxon] = this_taxonomy
+                    if (not cache is None):
+                        cache.put_taxonomy(taxon, this_taxonomy)
                 except urllib2.HTTPError:
                     print("Network error when processing {} ".format(taxon,))
                     logging.info("Network error when processing {} ".format(taxon,))
@@ -2485,7 +2551,7 @@ class TaxonomyFetcher(threading.Thread):
             #Mark task as done
             self.queue.task_done()
 
-def create_taxonomy_from_taxa(taxa, taxonomy=None, pref_db=None, verbose=False, ignoreWarnings=False, threadNumber=5):
+def create_taxonomy_from_taxa(taxa, taxonomy=None, pref_db=None, verbose=False, ignoreWarnings=False, threadNumber=5, backbone=None):
     """Uses the taxa provided to generate a taxonomy for all the taxon available. 
     :param taxa: list of the taxa.
     :type taxa : list 
@@ -2502,6 +2568,9 @@ def create_taxonomy_from_taxa(taxa, taxonomy=None, pref_db=None, verbose=False,
     :type ignoreWarnings: boolean 
     :param threadNumber: Maximum number of threads to use for taxonomy processing.
     :type threadNumber: int
+    :param backbone: Local checklist to take the taxonomy from instead of
+    EoL and PBDB. If None, the one set with stk_backbone.set_backbone (if any).
+    :type backbone: stk_backbone.Backbone
     :returns: dictionary with resulting taxonomy for each taxon (keys) 
     :rtype: dictionary 
     """
@@ -2509,6 +2578,21 @@ def create_taxonomy_from_taxa(taxa, taxonomy=None, pref_db=None, verbose=False,
         logging.getLogger().setLevel(logging.INFO)
     if taxonomy is None:
         taxonomy = {}
+    if backbone is None:
+        backbone = stk_backbone.get_backbone()
+
+    if not backbone is None:
+        # all local, so no need for threads
+        for taxon in taxa :
+            if taxon in taxonomy :
+                continue
+            this_taxonomy = backbone.taxonomy(taxon)
+            if this_taxonomy is None :
+                # as for a name EoL doesn't know
+                this_taxonomy = {}
+            taxonomy[taxon] = this_taxonomy
+        logging.getLogger().setLevel(logging.WARNING)
+        return taxonomy
 
     lock = threading.Lock()
     queue = Queue.Queue()
@@ -2526,6 +2610,7 @@ def create_taxonomy_from_taxa(taxa, taxonomy=None, pref_db=None, verbose=False,
     #Wait till everyone finishes
     queue.join()
     logging.getLogger().setLevel(logging.WARNING)
+    return taxonomy
 
 def create_taxonomy_from_tree(tree, existing_taxonomy=None, pref_db=None, verbose=False, ignoreWarnings=False):
     """ Generates the taxonomy from a tree. Uses a similar method to the XML version but works directly on a string with the tree.
@@ -2557,11 +2642,12 @@ def create_taxonomy_from_tree(tree, existing_taxonomy=None, pref_db=None, verbos
     
     return taxonomy
 
-def create_taxonomy(XML, existing_taxonomy=None, pref_db=None, verbose=False, ignoreWarnings=False):
+def create_taxonomy(XML, existing_taxonomy=None, pref_db=None, verbose=False, ignoreWarnings=False, backbone=None):
     """Generates a taxonomy of the data from EoL data. This is stored as a
     dictionary of taxonomy for each taxon in the dataset. Missing data are
     encoded as '' (blank string). It's up to the calling function to store this
-    data to file or display it."""
+    data to file or display it. With a backbone (see create_taxonomy_from_taxa)
+    no network lookups are made."""
     
     starttime = time.time()
 
@@ -2573,7 +2659,7 @@ def create_taxonomy(XML, existing_taxonomy=None, pref_db=None, verbose=False, ig
     else:
         taxonomy = existing_taxonomy
     taxa = get_all_taxa(XML, pretty=True)
-    create_taxonomy_from_taxa(taxa, taxonomy)
+    create_taxonomy_from_taxa(taxa, taxonomy, backbone=backbone)
     #taxonomy = create_extended_taxonomy(taxonomy, starttime, verbose, ignoreWarnings)
     return taxonomy
 
@@ -2610,30 +2696,18 @@ def create_extended_taxonomy(taxonomy, starttime, verbose=False, ignoreWarnings=
         if (verbose):
             print "Looking up ", g
             logging.info("Looking up {}".format(str(g)))
+        itis = stk_taxonomy_providers.get_provider("itis")
         try:
-            URL="http://www.itis.gov/ITISWebService/jsonservice/searchByScientificName?srchKey="+quote_plus(g.strip())
-        except:
-            continue
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        try:
-            f = opener.open(req)
+            data = itis.search(g.strip())
         except urllib2.HTTPError:
             continue
-        string = unicode(f.read(),"ISO-8859-1")
-        data = json.loads(string)
+        except (KeyError, UnicodeError):
+            # can't make a query out of this name
+            continue
         if data['scientificNames'][0] == None:
             continue
         tsn = data["scientificNames"][0]["tsn"]
-        URL="http://www.itis.gov/ITISWebService/jsonservice/getFullHierarchyFromTSN?tsn="+str(tsn)
-        req = urllib2.Request(URL)
-        opener = urllib2.build_opener()
-        f = opener.open(req)
-        try:
-            string = unicode(f.read(),"ISO-8859-1")
-        except:
-            continue
-        data = json.loads(string)
+        data = itis.full_hierarchy(tsn)
         this_taxonomy = {}
         for level in data['hierarchyList']:
             if not level['rankName'].lower() in current_taxonomy_levels:
@@ -2647,75 +2721,99 @@ def create_extended_taxonomy(taxonomy, starttime, verbose=False, ignoreWarnings=
             if t in taxonomy:
                 if GENUS in taxonomy[t]:
                     if taxonomy[t][GENUS] == g:
-                        taxonomy[t].update(this_taxonomy)
+                        # assigned back, as a Taxonomy hands out copies
+                        entry = taxonomy[t]
+                        entry.update(this_taxonomy)
+                        taxonomy[t] = entry
 
     return taxonomy
 
-def generate_species_level_data(XML, taxonomy, ignoreWarnings=False, verbose=False):
+def generate_species_level_data(XML, taxonomy, ignoreWarnings=False, verbose=False, dry_run=False):
     """ Based on a taxonomy data set, amend the data to be at species level as
     far as possible.  This function creates an internal 'subs file' and calls
     the standard substitution functions.  The internal subs are generated by
     looping over the taxa and if not at species-level, working out which level
     they are at and then adding species already in the dataset to replace it
     via a polytomy. This has to be done in one step to avoid adding spurious
-    structure to the phylogenies """
+    structure to the phylogenies 
+
+    The taxonomy can have its taxa with spaces (as create_taxonomy gives
+    them) or underscores (as load_taxonomy does). Taxa that are not in it
+    are left alone.
+
+    If dry_run is set, the data are not changed and the subs are returned
+    instead, as two lists: the old taxa and the new taxa
+    """
 
     if not ignoreWarnings:
         _check_data(XML)
 
     # if taxonomic checker not done, warn
     if (not taxonomy):
-        raise NoneCompleteTaxonomy("Taxonomy is empty. Create a taxonomy first. You'll probably need to hand edit the file to complete")
+        raise excp.NoneCompleteTaxonomy("Taxonomy is empty. Create a taxonomy first. You'll probably need to hand edit the file to complete")
         return
 
     # if missing data in taxonomy, warn
     taxa = get_all_taxa(XML)
-    keys = taxonomy.keys()
-    if (not ignoreWarnings):
-        for t in taxa:
-            t = t.replace("_"," ")
-            if not t in keys:
+    entries = {}
+    for t in taxa:
+        entry = taxonomy.get(t.replace("_"," "))
+        if (entry is None):
+            entry = taxonomy.get(t)
+        if (entry is None):
+            if (not ignoreWarnings):
                 # This idea here is that the caller will catch this, then re-run with ignoreWarnings set to True
-                raise NoneCompleteTaxonomy("Taxonomy is not complete. I will soldier on anyway, but this might not work as intended")
+                raise excp.NoneCompleteTaxonomy("Taxonomy is not complete. I will soldier on anyway, but this might not work as intended")
+            continue
+        entries[t] = entry
 
-    # get all taxa - see above!
-    # for each taxa, if not at species level
+    # index the species in the data by each of their ranks, once
+    index = stk_taxonomy_index.TaxonomyIndex(
+                dict([(t, entry) for t, entry in entries.iteritems() if SPECIES in entry]))
+
+    # for each taxa, if not at species level, replace it with a polytomy
+    # of the species in the data at the level it's at
     new_taxa = []
     old_taxa = []
     for t in taxa:
+        if (not t in entries or SPECIES in entries[t]):
+            continue
         subs = []
-        t = t.replace("_"," ")
-        if (not SPECIES in taxonomy[t]): # the current taxon is not a species, but higher level taxon
+        name = t.replace("_"," ")
+        for tl in taxonomy_levels:
             # work out which level - should we encode this in the data to start with?
-            for tl in taxonomy_levels:
-                try:
-                    tax_data = taxonomy[t][tl]
-                except KeyError:
-                    continue
-                if (t == taxonomy[t][tl]):
-                    current_level = tl
-                    # find all species in the taxonomy that match this level
-                    for taxon in taxa:
-                        taxon = taxon.replace("_"," ")
-                        if (SPECIES in taxonomy[taxon]):
-                            try:
-                                if taxonomy[taxon][current_level] == t: # our current taxon
-                                    subs.append(taxon.replace(" ","_"))
-                            except KeyError:
-                                continue
+            if (entries[t].get(tl) == name):
+                subs.extend(sorted(index.members(name,rank=tl)))
 
         # create the sub
         if len(subs) > 0:
-            old_taxa.append(t.replace(" ","_"))
+            old_taxa.append(t)
             new_taxa.append(','.join(subs))
 
+    if (verbose):
+        _report_subs(old_taxa,new_taxa)
+    if (dry_run):
+        return old_taxa, new_taxa
+
     # call the sub
     new_XML = substitute_taxa(XML, old_taxa, new_taxa, verbose=verbose)
     new_XML = clean_data(new_XML)
     
     return new_XML
 
-def data_overlap(XML, overlap_amount=2, filename=None, detailed=False, show=False, verbose=False, ignoreWarnings=False):
+def _report_subs(old_taxa, new_taxa):
+    """ Say how big a substitution is about to be
+    """
+
+    import csv
+    n_new = 0
+    for n in new_taxa:
+        if (not n is None):
+            for row in csv.reader([n],delimiter=',',quotechar="'"):
+                n_new += len(row)
+    print "\t"+str(len(old_taxa))+" taxa to be replaced by "+str(n_new)+" taxa"
+
+def data_overlap(XML, overlap_amount=2, filename=None, detailed=False, show=False, verbose=False, ignoreWarnings=False, store=None):
     """ Calculate the amount of taxonomic overlap between source trees.
     The output is a True/False by default, but you can specify an 
     optional filename, which will save a nice graphic. For the GUI,
@@ -2726,21 +2824,18 @@ def data_overlap(XML, overlap_amount=2, filename=None, detailed=False, show=Fals
     true, a graphic is generated showing *all* trees. For data containing >200
     source trees this could be very big and take along time. More likely, you'll run
     out of memory.
+
+    matplotlib is only imported if a graphic is asked for.
+
+    store is an optional stk_tree_store.TreeStore to take the taxa of each
+    tree from.
     """
-    import matplotlib
-    if (sys.platform == "darwin"):
-        matplotlib.use('GTKAgg')
-    import pylab as plt
-    from matplotlib.ticker import MaxNLocator
-    from matplotlib import backends
     
     if not ignoreWarnings:
         _check_data(XML)
 
     sufficient_overlap = False
     key_list = None
-    # Create triangular matrix of connectivity
-    # This can then be used to create the graph
     # We don't need to record which taxa overlap, just the total number
 
     if (verbose):
@@ -2755,50 +2850,22 @@ def data_overlap(XML, overlap_amount=2, filename=None, detailed=False, show=Fals
     # Get some basic stats about them (how many, etc)
     tree_keys = trees.keys()
     nTrees = len(tree_keys)
-    
-    # Allocate out numpy NxN matrix
-    connectivity = numpy.zeros((nTrees,nTrees))
-
-    # Out matrix indices
-    i = 0; j = 0
 
     if (verbose):
         print "\tCalculating connectivity"
-    # loop over trees (i=0, N)
-    for i in range(0,nTrees):
-        # Grab the taxa from tree i
-        taxa_list_i = _getTaxaFromNewick(trees[tree_keys[i]])
-        taxa_set = set(taxa_list_i)
-
-        # loop over tree i+1 to end (j=i+1,N)
-        for j in range(i+1,nTrees):
-            matches = 0
-            # grab the taxa from tree j
-            taxa_list_j = _getTaxaFromNewick(trees[tree_keys[j]])
-
-            # Inspired by: http://stackoverflow.com/questions/1388818/how-can-i-compare-two-lists-in-python-and-return-matches
-            matches = len(taxa_set.intersection(taxa_list_j)) 
-
-            connectivity[i][j] = matches
-            
-    # For each pair of trees we now have the number of connective taxa between them.
+    # Grab the taxa from each tree, once
+    taxa_lists = []
+    for result in _tree_results([trees[k] for k in tree_keys],['leaves'],store=store):
+        taxa_lists.append([t.replace(" ","_") for t in result['leaves']])
+    edges = _overlap_edges(taxa_lists, overlap_amount)
+
+    # For each pair of trees we now know if they have sufficent matches.
     # Now check for any trees that don't have sufficent matches to any other tree
-    # We create an undirected graph, joining trees that have sufficient conenctivity
     if (verbose):
-        print "\tCreating graph"
-    G=nx.Graph()
-    G.add_nodes_from(tree_keys)
-    for i in range(0,nTrees):
-        for j in range(i+1,nTrees):
-            if (connectivity[i][j] >= overlap_amount):
-                if (verbose):
-                    print "Joining "+ tree_keys[i] +" " + tree_keys[j]
-                G.add_edge(tree_keys[i],tree_keys[j],label=str(i))
-
-    # That's out graph set up. Dead easy to test all nodes are connected - we can even get the number of seperate connected parts
-    connected_components = nx.connected_components(G)
-    if isinstance(connected_components, types.GeneratorType):
-        connected_components = list(connected_components)
+        print "\tFinding connected trees"
+        for i, j in edges:
+            print "Joining "+ tree_keys[i] +" " + tree_keys[j]
+    connected_components = _connected_trees(tree_keys, edges)
     if len(connected_components) == 1:
         sufficient_overlap = True
 
@@ -2806,134 +2873,291 @@ def data_overlap(XML, overlap_amount=2, filename=None, detailed=False, show=Fals
     key_list = connected_components
 
     if (not filename == None or show):
+        result = _data_overlap_graphic(tree_keys, edges, connected_components, filename=filename,
+                                       detailed=detailed, show=show, verbose=verbose)
+        if (show):
+            key_list, canvas = result
+            return sufficient_overlap, key_list, canvas
+        key_list = result
+
+    return sufficient_overlap, list(key_list)
+
+
+def _overlap_edges(taxa_lists, overlap_amount):
+    """ Find the pairs of trees that share at least overlap_amount taxa.
+    taxa_lists holds the taxa of each tree.
+
+    Each taxon is given a number, then we build a sparse taxon x tree
+    incidence (the trees each taxon is in). Row i of the product of that
+    with its transpose, i.e. the number of taxa tree i shares with every
+    other tree, is then a bincount over the trees of the taxa in tree i.
+
+    returns: sorted list of (i,j) pairs, i < j
+    """
+
+    nTrees = len(taxa_lists)
+    taxon_index = {}
+    tree_taxa = []
+    for taxa in taxa_lists:
+        ids = set()
+        for t in taxa:
+            ids.add(taxon_index.setdefault(t,len(taxon_index)))
+        tree_taxa.append(numpy.array(sorted(ids),dtype=numpy.int64))
+
+    # trees each taxon is in, as offsets into a flat array
+    if (nTrees > 0):
+        taxon_ids = numpy.concatenate(tree_taxa)
+    else:
+        taxon_ids = numpy.array([],dtype=numpy.int64)
+    tree_ids = numpy.repeat(numpy.arange(nTrees),[len(t) for t in tree_taxa])
+    order = numpy.argsort(taxon_ids,kind='mergesort')
+    taxon_trees = tree_ids[order]
+    offsets = numpy.concatenate(([0],numpy.cumsum(numpy.bincount(taxon_ids,minlength=len(taxon_index)))))
+
+    edges = []
+    for i in range(nTrees):
+        if (len(tree_taxa[i]) == 0):
+            continue
+        shared = numpy.concatenate([taxon_trees[offsets[t]:offsets[t+1]] for t in tree_taxa[i]])
+        counts = numpy.bincount(shared,minlength=nTrees)
+        counts[:i+1] = 0
+        for j in numpy.flatnonzero(counts >= overlap_amount):
+            edges.append((i,int(j)))
+
+    return edges
+
+
+def _connected_trees(tree_keys, edges):
+    """ Group trees into connected components using union-find.
+
+    Components are listed (as sets of tree names) in the same order as
+    networkx's connected_components would give them for a graph with
+    the trees added as nodes in tree_keys order.
+    """
+
+    parent = range(len(tree_keys))
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for i, j in edges:
+        root_i = find(i)
+        root_j = find(j)
+        if (root_i != root_j):
+            parent[root_j] = root_i
+
+    index = {}
+    for i in range(len(tree_keys)):
+        index[tree_keys[i]] = i
+    components = []
+    component_of_root = {}
+    # a dict filled in the same order as a networkx graph's nodes
+    # iterates in the same order
+    for key in index:
+        root = find(index[key])
+        if (not root in component_of_root):
+            component_of_root[root] = set()
+            components.append(component_of_root[root])
+        component_of_root[root].add(key)
+
+    return components
+
+
+def _data_overlap_graphic(tree_keys, edges, connected_components, filename=None, detailed=False, show=False, verbose=False):
+    """ Draw the data overlap graph, either with every tree (detailed)
+    or just the connected clusters. Saves to filename, or, if show
+    is set, returns a gtk canvas for the GUI.
+
+    returns: key_list (and canvas if show is set)
+    """
+    import matplotlib
+    if (sys.platform == "darwin"):
+        matplotlib.use('GTKAgg')
+    import pylab as plt
+    from matplotlib.ticker import MaxNLocator
+    from matplotlib import backends
+
+    # Create an undirected graph, joining trees that have sufficent conenctivity
+    G=nx.Graph()
+    G.add_nodes_from(tree_keys)
+    for i, j in edges:
+        G.add_edge(tree_keys[i],tree_keys[j],label=str(i))
+    key_list = connected_components
+
+    if (verbose):
+        print "\tCreating graphic:"
+    # create a graphic and save the file there
+    plt.ioff()
+    if detailed:
         if (verbose):
-            print "\tCreating graphic:"
-        # create a graphic and save the file there
-        plt.ioff()
-        if detailed:
-            if (verbose):
-                print "\t\tdetailed graphic in file: "+filename
-            # set the key_list to the keys - see below as to why we do this
-            key_list = tree_keys
-            # we want a detailed graphic instead
-            # The integer labelling will match the order in which we set
-            # up the nodes, which matches tree_keys
-            mapping = {}
-            i = 0
-            for key in tree_keys:
-                mapping[key] = str(i)
-                i += 1
-            G_relabelled = nx.relabel_nodes(G,mapping)
-            degrees = G_relabelled.degree() # we colour nodes by number of edges
-            # However, this is a dict and the colour argument of draw need an array of floats
-            colours = []
-            for key in G_relabelled.nodes_iter():
-                colours.append(float(len(G_relabelled.neighbors(key))))
-            # Define our colourmap, such that unconnected nodes stand out in red, with
-            # a smooth white to blue transition above this
-            # We need to normalize the colours array from (0,1) and find out where
-            # our minimum overlap value sits in there
-            if max(colours) == 0:
-                norm_cutoff = 0.5
-            else:
-                norm_cutoff = 0.5/(max(colours)+1)
-
-            # Our cut off is at 1 - i.e. one connected edge. 
-            from matplotlib.colors import LinearSegmentedColormap
-            cdict = {'red':   ((0.0, 1.0, 1.0),
-                               (norm_cutoff, 1.0, 1.0),
-                               (1.0, 0., 0.)),
-                     'green': ((0.0, 0.0, 0.0),
-                               (norm_cutoff, 0.0, 1.0),
-                               (1.0, 0.1, 0.1)),
-                     'blue':  ((0.0, 0.0, 0.0),
-                               (norm_cutoff, 0.0, 1.0),
-                               (1.0, 1.0, 1.0))}
-            custom = LinearSegmentedColormap('custom', cdict)
-            
-            # we now make a empty figure to generate a colourbar, then throw away
-            Z = [[0,0],[0,0]]
-            levels = numpy.arange(0,max(colours)+1,0.5)
-            CS3 = plt.contourf(Z, levels, cmap=custom)
-            plt.clf()
-            if show:
-                fig = plt.figure(dpi=90)
-            else:
-                fig = plt.figure(dpi=270)
-            ax = fig.add_subplot(111)
-            cs = nx.draw_networkx(G_relabelled,with_labels=True,ax=ax,node_color=colours,
-                                  cmap=custom,edge_color='k',node_size=100,font_size=8,vmax=max(colours),vmin=0)
-            limits=plt.axis('off')
-            #plt.axis('equal')
+            print "\t\tdetailed graphic in file: "+filename
+        # set the key_list to the keys - see below as to why we do this
+        key_list = tree_keys
+        # we want a detailed graphic instead
+        # The integer labelling will match the order in which we set
+        # up the nodes, which matches tree_keys
+        mapping = {}
+        i = 0
+        for key in tree_keys:
+            mapping[key] = str(i)
+            i += 1
+        G_relabelled = nx.relabel_nodes(G,mapping)
+        degrees = G_relabelled.degree() # we colour nodes by number of edges
+        # However, this is a dict and the colour argument of draw need an array of floats
+        colours = []
+        for key in G_relabelled.nodes_iter():
+            colours.append(float(len(G_relabelled.neighbors(key))))
+        # Define our colourmap, such that unconnected nodes stand out in red, with
+        # a smooth white to blue transition above this
+        # We need to normalize the colours array from (0,1) and find out where
+        # our minimum overlap value sits in there
+        if max(colours) == 0:
+            norm_cutoff = 0.5
+        else:
+            norm_cutoff = 0.5/(max(colours)+1)
+
+        # Our cut off is at 1 - i.e. one connected edge. 
+        from matplotlib.colors import LinearSegmentedColormap
+        cdict = {'red':   ((0.0, 1.0, 1.0),
+                           (norm_cutoff, 1.0, 1.0),
+                           (1.0, 0., 0.)),
+                 'green': ((0.0, 0.0, 0.0),
+                           (norm_cutoff, 0.0, 1.0),
+                           (1.0, 0.1, 0.1)),
+                 'blue':  ((0.0, 0.0, 0.0),
+                           (norm_cutoff, 0.0, 1.0),
+                           (1.0, 1.0, 1.0))}
+        custom = LinearSegmentedColormap('custom', cdict)
+        
+        # we now make a empty figure to generate a colourbar, then throw away
+        Z = [[0,0],[0,0]]
+        levels = numpy.arange(0,max(colours)+1,0.5)
+        CS3 = plt.contourf(Z, levels, cmap=custom)
+        plt.clf()
+        if show:
+            fig = plt.figure(dpi=90)
+        else:
+            fig = plt.figure(dpi=270)
+        ax = fig.add_subplot(111)
+        cs = nx.draw_networkx(G_relabelled,with_labels=True,ax=ax,node_color=colours,
+                              cmap=custom,edge_color='k',node_size=100,font_size=8,vmax=max(colours),vmin=0)
+        limits=plt.axis('off')
+        #plt.axis('equal')
+        ticks = MaxNLocator(integer=True,nbins=9)
+        pp=plt.colorbar(CS3, orientation='horizontal', format='%d', ticks=ticks)
+        pp.set_label("No. of connected trees")
+        if (show):
+            from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg as FigureCanvas
+            canvas = FigureCanvas(fig)  # a gtk.DrawingArea 
+            return key_list, canvas
+        else:
+            fig.savefig(filename)
+
+    else:
+        if (verbose):
+            print "\t\tsummmary graphic in file: "+filename
+
+        # Here, out key_list is our connectivity info
+        key_list = connected_components
+        # Summary graph - here we just graph the connected bits
+        Hs = nx.connected_component_subgraphs(G)
+        if isinstance(Hs, types.GeneratorType):
+            Hs = list(Hs)
+        G_new = nx.Graph()
+        # Add nodes (no edges this time)
+        G_new.add_nodes_from(Hs)
+        # Set the colour and size according to the number of trees in each cluster
+        # Unless there's only one cluster...
+        colours = []
+        sizes = []
+        for H in Hs:
+            colours.append(H.number_of_nodes())
+            sizes.append(100*H.number_of_nodes())
+        G_relabelled = nx.convert_node_labels_to_integers(G_new)
+        if (show):
+            fig = plt.figure(dpi=90)
+        else:
+            fig = plt.figure(dpi=270)
+        # make a throw-away plot to get a colourbar info
+        Z = [[0,0],[0,0]]
+        levels = plt.frange(0,max(colours)+0.01,(max(colours)+0.01)/256.)
+        CS3 = plt.contourf(Z,levels,cmap=plt.cm.Blues)
+        plt.clf()
+        ax = fig.add_subplot(111)
+        limits=plt.axis('off')
+        plt.axis('equal')
+        if (len(colours) > 1):
+            cs = nx.draw_shell(G_relabelled,with_labels=True,ax=ax,node_size=sizes,node_color=colours,
+                          vmax=max(colours),vmin=0,cmap=plt.cm.Blues,edge_color='k')
             ticks = MaxNLocator(integer=True,nbins=9)
             pp=plt.colorbar(CS3, orientation='horizontal', format='%d', ticks=ticks)
-            pp.set_label("No. of connected trees")
-            if (show):
-                from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg as FigureCanvas
-                canvas = FigureCanvas(fig)  # a gtk.DrawingArea 
-                return sufficient_overlap, key_list, canvas
-            else:
-                fig.savefig(filename)
-    
+            pp.set_label("No. connected edges")
         else:
-            if (verbose):
-                print "\t\tsummmary graphic in file: "+filename
-
-            # Here, out key_list is our connectivity info
-            key_list = connected_components
-            # Summary graph - here we just graph the connected bits
-            Hs = nx.connected_component_subgraphs(G)
-            if isinstance(Hs, types.GeneratorType):
-                Hs = list(Hs)
-            G_new = nx.Graph()
-            # Add nodes (no edges this time)
-            G_new.add_nodes_from(Hs)
-            # Set the colour and size according to the number of trees in each cluster
-            # Unless there's only one cluster...
-            colours = []
-            sizes = []
-            for H in Hs:
-                colours.append(H.number_of_nodes())
-                sizes.append(100*H.number_of_nodes())
-            G_relabelled = nx.convert_node_labels_to_integers(G_new)
-            if (show):
-                fig = plt.figure(dpi=90)
-            else:
-                fig = plt.figure(dpi=270)
-            # make a throw-away plot to get a colourbar info
-            Z = [[0,0],[0,0]]
-            levels = plt.frange(0,max(colours)+0.01,(max(colours)+0.01)/256.)
-            CS3 = plt.contourf(Z,levels,cmap=plt.cm.Blues)
-            plt.clf()
-            ax = fig.add_subplot(111)
+            cs = nx.draw_networkx(G_relabelled,with_labels=True,ax=ax,edge_color='k',node_color='w',node_size=500)
+        
             limits=plt.axis('off')
-            plt.axis('equal')
-            if (len(colours) > 1):
-                cs = nx.draw_shell(G_relabelled,with_labels=True,ax=ax,node_size=sizes,node_color=colours,
-                              vmax=max(colours),vmin=0,cmap=plt.cm.Blues,edge_color='k')
-                ticks = MaxNLocator(integer=True,nbins=9)
-                pp=plt.colorbar(CS3, orientation='horizontal', format='%d', ticks=ticks)
-                pp.set_label("No. connected edges")
-            else:
-                cs = nx.draw_networkx(G_relabelled,with_labels=True,ax=ax,edge_color='k',node_color='w',node_size=500)
-            
-                limits=plt.axis('off')
-            if (show):
-                from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg as FigureCanvas
-                canvas = FigureCanvas(fig)  # a gtk.DrawingArea 
-                return sufficient_overlap, key_list,canvas
-            else:
-                fig.savefig(filename)
+        if (show):
+            from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg as FigureCanvas
+            canvas = FigureCanvas(fig)  # a gtk.DrawingArea 
+            return key_list, canvas
+        else:
+            fig.savefig(filename)
+
+    return key_list
+
+def tree_fingerprint(tree):
+    """ A fingerprint (hash) of a tree string's taxa and topology. Trees
+    with the same taxa, a Robinson-Foulds distance of zero and the same
+    root have the same fingerprint, however they are written. It is worked
+    out once for each tree string and kept in the tree cache.
+    """
+
+    return _parse_tree_cached(tree).fingerprint
+
+
+def find_duplicate_trees(XML,ignoreWarnings=False,n_jobs=1,store=None):
+    """ Find trees in the dataset that are the same as each other (see
+    tree_fingerprint), whatever their characters or sources.
+
+    store is an optional stk_tree_store.TreeStore the fingerprints are
+    kept in between runs.
+
+    Returns a list of lists of tree names, one for each group of
+    identical trees
+    """
+
+    if not ignoreWarnings:
+        _check_data(XML,n_jobs=n_jobs)
+
+    trees = obtain_trees(XML)
+    tree_names = sorted(trees.keys())
+    results = _tree_results([trees[t] for t in tree_names],['topology'],store=store,n_jobs=n_jobs)
+
+    groups = {}
+    for tree_name, result in zip(tree_names,results):
+        groups.setdefault(result['topology'],[]).append(tree_name)
+    duplicates = [names for names in groups.values() if len(names) > 1]
+    duplicates.sort()
+
+    return duplicates
 
-    return sufficient_overlap, list(key_list)
 
-def data_independence(XML,make_new_xml=False,ignoreWarnings=False):
+def data_independence(XML,make_new_xml=False,ignoreWarnings=False,n_jobs=1,store=None):
     """ Return a list of sources that are not independent.
     This is decided on the source data and the characters.
+
+    store is an optional stk_tree_store.TreeStore the taxa of each tree
+    are taken from. Its record of the source_trees is left alone, as the
+    data may not be the file the store belongs to.
     """
 
     if not ignoreWarnings:
-        _check_data(XML)
+        _check_data(XML,n_jobs=n_jobs)
 
     # data storage:
     #
@@ -2948,10 +3172,18 @@ def data_independence(XML,make_new_xml=False,ignoreWarnings=False):
     data_ind = []
 
     trees = obtain_trees(XML)
-    for tree_name in trees:
-        taxa = get_taxa_from_tree(XML, tree_name, sort=True)
-        characters = get_characters_from_tree(XML, tree_name, sort=True)
-        data_ind.append([tree_name, characters, taxa])
+    tree_names = trees.keys()
+    if (store is None):
+        tree_taxa = stk_parallel.map_trees(_sorted_leaves_worker,[trees[t] for t in tree_names],n_jobs=n_jobs)
+        for tree_name, taxa in zip(tree_names,tree_taxa):
+            characters = get_characters_from_tree(XML, tree_name, sort=True)
+            data_ind.append([tree_name, characters, taxa])
+    else:
+        dataset = stk_phyml.get_dataset(XML)
+        results = _tree_results([trees[t] for t in tree_names],['leaves'],store=store,n_jobs=n_jobs)
+        for tree_name, result in zip(tree_names,results):
+            characters = sorted([c.attrib['name'] for c in dataset.source_tree(tree_name).xpath("character_data/character")])
+            data_ind.append([tree_name, characters, sorted(result['leaves'])])
     
     # Then sort based on the character string and taxa_list as secondary sort
     # Doing so means the tree_names that use the same characters
@@ -3020,28 +3252,17 @@ def add_weights(XML, names, weight):
         Returns a new XML
     """
 
-    xml_root = _parse_xml(XML)
+    dataset = stk_phyml.editable_dataset(XML)
     # By getting source, we can then loop over each source_tree
     find = etree.XPath("//source_tree")
-    sources = find(xml_root)
+    sources = find(dataset.xml_root)
     for s in sources:
         s_name = s.attrib['name']
         for n in names:
             if s_name == n:
-                if s.xpath("tree/weight/real_value") == []:
-                    # add weights
-                    weights_element = etree.Element("weight")
-                    weights_element.tail="\n"
-                    real_value = etree.SubElement(weights_element,'real_value')
-                    real_value.attrib['rank'] = '0'
-                    real_value.tail = '\n'
-                    real_value.text = str(weight)
-                    t = s.xpath("tree")[0]                    
-                    t.append(weights_element)
-                else:
-                    s.xpath("tree/weight/real_value")[0].text = str(weight)
+                stk_phyml.set_source_tree_weight(s,weight)
 
-    return etree.tostring(xml_root,pretty_print=True)
+    return stk_phyml.dataset_result(XML,dataset)
 
 
 def add_historical_event(XML, event_description):
@@ -3159,9 +3380,14 @@ def clean_data(XML):
 
 
 
-def replace_genera(XML,dry_run=False,ignoreWarnings=False):
+def replace_genera(XML,dry_run=False,ignoreWarnings=False,verbose=False):
     """ Remove all generic taxa by replacing them with a polytomy of
         all species in the dataset belonging to that genera
+
+        A species belongs to a genus if its name starts with the
+        genus, e.g. Larus_argentatus or 'Larus, sp. nov.'
+
+        dry_run returns the subs without carrying them out
     """
         
     if not ignoreWarnings:
@@ -3170,20 +3396,22 @@ def replace_genera(XML,dry_run=False,ignoreWarnings=False):
     # get all the taxa
     taxa = get_all_taxa(XML)
 
+    # find all the generic and index the rest by their genus, in one go
     generic = []
-    # find all the generic and build an internal subs file
-    for t in taxa:
-        t = t.replace(" ","_")
+    species = defaultdict(list)
+    for taxon in taxa:
+        t = taxon.replace(" ","_")
         if t.find("_") == -1:
             # no underscore, so just generic
             generic.append(t)
+        species[_genus_of(taxon)].append(taxon)
 
     subs = []
     generic_to_replace = []
     for t in generic:
         currentSub = []
-        for taxon in taxa:
-            if (not taxon == t) and taxon.find(t) > -1:
+        for taxon in species.get(t,[]):
+            if (not taxon == t):
                 m = re.search('[\(|\)|\.|\?|"|=|,|&|^|$|@|+]', taxon)
                 if (not m == None):
                     if taxon.find("'") == -1:
@@ -3193,6 +3421,8 @@ def replace_genera(XML,dry_run=False,ignoreWarnings=False):
             subs.append(",".join(currentSub))
             generic_to_replace.append(t)
     
+    if (verbose):
+        _report_subs(generic_to_replace,subs)
     if (dry_run):
         return None,generic_to_replace,subs
 
@@ -3202,6 +3432,13 @@ def replace_genera(XML,dry_run=False,ignoreWarnings=False):
 
     return XML,generic_to_replace,subs
 
+def _genus_of(taxon):
+    """ The genus part of a taxon name: everything up to the first space,
+    underscore or punctuation
+    """
+
+    return re.split('[ _\(\)\.\?"=,&^$@+\']', taxon.strip("'"), 1)[0]
+
 def subs_from_csv(filename):
     """Create taxonomic subs from a CSV file, where
        the first column is the old taxon and all other columns are the
@@ -3350,7 +3587,7 @@ def check_subs(XML,new_taxa):
     
     return
 
-def create_subset(XML,search_terms,andSearch=True,includeMultiple=True,ignoreWarnings=False):
+def create_subset(XML,search_terms,andSearch=True,includeMultiple=True,ignoreWarnings=False,taxonomy=None):
     """Create a new dataset which is a subset of the incoming one.
        searchTerms is a dict, with the following keys:
        years - list consisting of the years to include. An entry can contain two years seperated by -. A range will then
@@ -3370,8 +3607,9 @@ def create_subset(XML,search_terms,andSearch=True,includeMultiple=True,ignoreWar
        after (i.e. trees with mixed character sets will be ignored). This applies to characters and character_types
        only (as the other terms don't make sense with this off).
 
-       Note: this funtion is not (yet) taxonomically aware, so Galliformes will only return trees that actually have
-       a leaf called Galliformes. Gallus gallus will not match. 
+       Note: without a taxonomy this funtion is not taxonomically aware, so Galliformes will only return trees that
+       actually have a leaf called Galliformes. Gallus gallus will not match. Pass a taxonomy (as load_taxonomy
+       returns, or a stk_taxonomy_index.TaxonomyIndex) and a higher taxon in the taxa list matches the taxa in it too.
 
        Also note: The tree strings are searched for taxa, not the taxa elements (which are optional)
 
@@ -3401,235 +3639,40 @@ def create_subset(XML,search_terms,andSearch=True,includeMultiple=True,ignoreWar
     except KeyError:
         pass
 
-
-    # Easiest way to do this is to remove all sources from the incoming XML (after taking a copy!)
-    # and add them back if they match the request requirements. That way, we keep the history, etc, etc
-    original_XML = XML
-    xml_root = _parse_xml(XML)
-    orig_xml_root = _parse_xml(original_XML)
-
-    # remove sources
-    # Find all "source" trees
-    sources = []
-    for ele in xml_root.iter():
-        if (ele.tag == "source"):
-            sources.append(ele)
-    for s in sources:
-        s.getparent().remove(s)
+    # and expand any higher taxa, without altering the caller's list
+    if (not taxonomy is None and len(search_terms.get('taxa',[])) > 0):
+        search_terms = dict(search_terms)
+        search_terms['taxa'] = stk_taxonomy_index.taxonomy_index(taxonomy).expand(search_terms['taxa'])
+
+    # Build a copy of the data without any sources, then add back copies of the
+    # ones that match the request, with only their matching trees. That way, we
+    # keep the history, etc, etc
+    dataset = stk_phyml.get_dataset(XML)
+    matches = dataset.subset_index().query(search_terms,andSearch=andSearch,includeMultiple=includeMultiple)
+
+    orig_xml_root = dataset.xml_root
+    xml_root = etree.Element(orig_xml_root.tag,attrib=dict(orig_xml_root.attrib),nsmap=orig_xml_root.nsmap)
+    xml_root.text = orig_xml_root.text
+    for ele in orig_xml_root:
+        if (ele.tag == "sources"):
+            sources_ele = etree.SubElement(xml_root,"sources",attrib=dict(ele.attrib))
+            sources_ele.text = ele.text
+            sources_ele.tail = ele.tail
+        else:
+            xml_root.append(deepcopy(ele))
 
     # edit name (append _subset)
     proj_name = get_project_name(XML)
     proj_name += "_subset"
     xml_root.xpath('/phylo_storage/project_name/string_value')[0].text = proj_name
 
-    # this is the tricky part
-    # Loop over sources in the original data and if a tree matches the search requirements, add the source
-    # then add the matching tree
-    sources = []
-    for ele in orig_xml_root.iter():
-        if (ele.tag == "source"):
-            sources.append(ele)
-
-    matching_sources = []
-    # Years are first. This is easy - the source only has one year. 
-    # Note years is already [] is we get a key error
-    try:
-        years = search_terms['years']
-        if len(years) > 0:
-            for s in sources:
-                yrs = s.find(".//year")
-                y = int(yrs.xpath("integer_value")[0].text)
-                if y in years:
-                    matching_sources.append(s)
-            if (andSearch):
-                sources = matching_sources
-                matching_sources = []
-    except KeyError:
-        pass
-
-    # Now character types. Not easy - we need to check each source tree and add the source
-    # and matching source trees only.
-    try:
-        charTypes = search_terms['character_types']
-        if (len(charTypes) > 0):
-            for s in sources:
-                st = s.findall(".//source_tree")
-                include_source = False
-                for t in st:
-                    ct = t.findall(".//character")
-                    include = False
-                    if (andSearch and includeMultiple): # and search but tree can contain other types too
-                        # uniqify ct, sort and compare to sorted charTypes - charTypes is a subset 
-                        # of ct, include
-                        this_trees_chars = []
-                        for c in ct:
-                            this_trees_chars.append(c.attrib['type'])
-                        if (set(charTypes).issubset(this_trees_chars)):
-                            include = True
-                            include_source = True
-                        if (not include):    
-                            t.getparent().remove(t)
-                    elif (andSearch==False): # or search 
-                        for c in ct:
-                            if c.attrib['type'] in charTypes:
-                                include = True
-                                include_source = True
-                        if (not include):    
-                            t.getparent().remove(t)
-                    else: # and search and tree must contain *only* the search terms
-                        include = True
-                        for c in ct:
-                            if not c.attrib['type'] in charTypes:
-                                include = False
-                                break
-                        if (include):
-                            include_source = True                                
-                        if (not include):    
-                            t.getparent().remove(t)
-                if include_source:
-                    # This is the source with the non-matching source_tree elements removed
-                    matching_sources.append(s)
-            if (andSearch):
-                sources = matching_sources
-                matching_sources = []     
-    except KeyError:
-        charTypes = []
-
-
-    # Now character
-    try:
-        chars = search_terms['characters']
-        if (len(chars) > 0):
-            for s in sources:
-                st = s.findall(".//source_tree")
-                include_source = False
-                for t in st:
-                    ct = t.findall(".//character")
-                    include = False
-                    if (andSearch and includeMultiple): # and search but tree can contain other types too
-                        # uniqify ct, sort and compare to sorted charTypes - charTypes is a subset 
-                        # of ct, include
-                        this_trees_chars = []
-                        for c in ct:
-                            this_trees_chars.append(c.attrib['name'])
-                        if (set(chars).issubset(this_trees_chars)):
-                            include = True
-                            include_source = True
-                        if (not include):    
-                            t.getparent().remove(t)
-                    elif (andSearch==False): # or search 
-                        for c in ct:
-                            if c.attrib['name'] in chars:
-                                include = True
-                                include_source = True
-                        if (not include):    
-                            t.getparent().remove(t)
-                    else: # and search and tree must contain *only* the search terms
-                        include = True
-                        for c in ct:
-                            if not c.attrib['name'] in chars:
-                                include = False
-                                break
-                        if (include):
-                            include_source = True                                
-                        if (not include):    
-                            t.getparent().remove(t)
-                if include_source:
-                    # This is the source with the non-matching source_tree elements removed
-                    matching_sources.append(s)
-            if (andSearch):
-                sources = matching_sources
-                matching_sources = []  
-    except KeyError:
-        chars = []
-
-    # Now analyses
-    try:
-        analyses = search_terms['analyses'] # assume one only analysis is searched for?
-        if (len(analyses) > 0):
-            for s in sources:
-                oc = s.findall(".//optimality_criterion")
-                include = False
-                for o in oc:
-                    if o.attrib['name'] in analyses:
-                        include = True
-                    else:
-                        source_tree = o.getparent().getparent().getparent()
-                        source_tree.getparent().remove(source_tree)
-                if include:
-                    # This is the source with the non-matching source_tree elements removed
-                    matching_sources.append(s)
-            if (andSearch):
-                sources = matching_sources
-                matching_sources = []
-    except KeyError:
-        analyses = [] 
-
-    # Now taxa - if a tree contains any of the taxa listed, include it
-    try:
-        taxa = search_terms['taxa'] # assume one only analysis is searched for?
-        if (len(taxa) > 0):
-            for s in sources:
-                st = s.findall(".//source_tree")
-                include_source = False
-                for t in st:
-                    treestring = t.xpath("tree/tree_string/string_value")[0].text
-                    include = False
-                    for taxon in taxa:
-                        if (_tree_contains(taxon,treestring)):
-                            include = True
-                            include_source = True
-                            break
-                    if (not include):    
-                        t.getparent().remove(t)
-                if include_source:
-                    # This is the source with the non-matching source_tree elements removed
-                    matching_sources.append(s)
-            if (andSearch):
-                sources = matching_sources
-                matching_sources = []  
-    except KeyError:
-        taxa = [] 
-
-    # Finally, fossils. Just seach for all or none
-    try:
-        fossil = search_terms['fossil'] # can be none or all
-        if (fossil == "all_extant" or fossil == "all_fossil"):
-            for s in sources:
-                st = s.findall(".//source_tree")
-                include_source = False
-                for t in st:
-                    all_extant = False
-                    all_fossil = False
-                    if (len(t.findall(".//all_extant")) > 0):
-                        all_extant = True
-                    elif (len(t.findall(".//all_fossil")) > 0):
-                        all_fossil = True
-                    include = False
-                    if ((fossil == "all_extant" and all_extant) or
-                        (fossil == "all_fossil" and all_fossil)):
-                        include = True
-                        include_source = True
-                    if (not include):    
-                        t.getparent().remove(t)
-                if include_source:
-                    # This is the source with the non-matching source_tree elements removed
-                    matching_sources.append(s)
-            if (andSearch):
-                sources = matching_sources
-                matching_sources = []  
-    except KeyError:
-        taxa = [] 
-
-    # If we did an "and" search, the matching sources are in the sources list, otherwise
-    # they're in the matching_sources list
-    # So we can now append those sources to the stub of an XML we created at the begining
-    if (not andSearch):
-        sources = matching_sources
-
-    srcs = xml_root.xpath("phylo_storage/sources")
-    for s in sources:
-        xml_root[1].append(s)
+    for source, trees in matches:
+        keep = set(trees)
+        new_source = deepcopy(source)
+        for st, new_st in zip(source.iter("source_tree"),list(new_source.iter("source_tree"))):
+            if (not st in keep):
+                new_st.getparent().remove(new_st)
+        sources_ele.append(new_source)
     
     XML = etree.tostring(xml_root,pretty_print=True)
 
@@ -3810,7 +3853,7 @@ def _check_uniqueness(XML):
     """
 
     try:
-        xml_root = _parse_xml(XML)
+        xml_root = stk_phyml.get_dataset(XML).xml_root
         # By getting source, we can then loop over each source_tree
         # within that source and construct a unique name
         find = etree.XPath("//source")
@@ -3889,11 +3932,14 @@ def _assemble_tree_matrix(tree_string, verbose=False):
 
     return adjmat, names
 
-def _sub_taxa_in_tree(tree,old_taxa,new_taxa=None,skip_existing=False):
+def _sub_taxa_in_tree(tree,old_taxa,new_taxa=None,skip_existing=False,sub_table=None):
     """Swap the taxa in the old_taxa array for the ones in the
     new_taxa array
     
     If the new_taxa array is missing, simply delete the old_taxa
+
+    If you are applying the same substitutions to many trees, make
+    the sub_table once with _compile_sub_table and pass it in
     """
   
     tree = _correctly_quote_taxa(tree)
@@ -3911,22 +3957,26 @@ def _sub_taxa_in_tree(tree,old_taxa,new_taxa=None,skip_existing=False):
             print "Substitution failed. Old and new are different lengths"
             return # need to raise exception here
 
-    i = 0
-    for taxon in old_taxa:
+    if (sub_table == None):
+        sub_table = _compile_sub_table(old_taxa)
+
+    # Only look at the substitutions for taxa that are in the tree,
+    # in the order they were given. A substitution can bring in a taxon
+    # that a later one replaces, so we look again after each change
+    pending = _subs_for_tree(tree,sub_table)
+    heapq.heapify(pending)
+    last = -1
+    while (len(pending) > 0):
+        i = heapq.heappop(pending)
+        if (i <= last):
+            continue
+        last = i
         # tree contains the old_taxon, do something with it
-        taxon = taxon.replace(" ","_")
+        taxon = old_taxa[i].replace(" ","_")
         if (_tree_contains(taxon,tree)):
             if (new_taxa == None or new_taxa[i] == None):
-                p4tree = _parse_tree(tree) 
-                terminals = p4tree.getAllLeafNames(p4tree.root) 
-                count = 0
                 taxon_temp = taxon.replace("'","")
-                for t in terminals:
-                    t = t.replace(" ","_")
-                    if (t == taxon_temp):
-                        count += 1
-                    if (t.startswith(taxon_temp+"%")):
-                        count += 1 
+                count = _parse_tree_cached(tree).count(taxon_temp)
                 # we are deleting taxa - we might need multiple iterations
                 for t in range(0,count):
                     tree = _delete_taxon(taxon, tree)
@@ -3934,33 +3984,73 @@ def _sub_taxa_in_tree(tree,old_taxa,new_taxa=None,skip_existing=False):
             else:
                 # we are substituting
                 tree = _sub_taxon(taxon, new_taxa[i], tree, skip_existing=skip_existing)
-        i += 1
+            for j in _subs_for_tree(tree,sub_table):
+                if (j > i):
+                    heapq.heappush(pending,j)
 
     tree = _collapse_nodes(tree)
     tree = _remove_single_poly_taxa(tree)
 
     return tree 
 
+def _compile_sub_table(old_taxa):
+    """ Hash the taxa to be substituted, in the form _tree_contains
+    looks for them, against their positions in old_taxa
+    """
+
+    if (isinstance(old_taxa,str)):
+        old_taxa = [old_taxa]
+    sub_table = {}
+    for i in range(len(old_taxa)):
+        taxon = old_taxa[i].replace(" ","_").replace("'","")
+        sub_table.setdefault(taxon,[]).append(i)
+    return sub_table
+
+def _subs_for_tree(tree,sub_table):
+    """ Positions (in old_taxa) of the substitutions that apply to taxa
+    in this tree, including non-monophyletic versions of them (taxon%N)
+    """
+
+    try:
+        cached = _parse_tree_cached(tree)
+    except excp.TreeParseError:
+        return []
+    subs = []
+    for taxa in (cached.taxa_set, cached.percent_bases):
+        for t in taxa:
+            if (t in sub_table):
+                subs.extend(sub_table[t])
+    return subs
+
+def _leaves_match_sub_table(leaves,sub_table):
+    """ As _subs_for_tree, but just whether any substitution applies to
+    a tree with these leaves
+    """
+
+    for t in leaves:
+        t = t.replace(" ","_")
+        if (t in sub_table):
+            return True
+        i = t.find('%')
+        while (i > -1):
+            if (t[:i] in sub_table):
+                return True
+            i = t.find('%',i+1)
+    return False
+
 def _tree_contains(taxon,tree):
     """ Returns if a taxon is contained in the tree
     """
 
     taxon = taxon.replace(" ","_")
     try:
-        tree = _parse_tree(tree) 
+        tree = _parse_tree_cached(tree)
     except excp.TreeParseError:
         return False
-    terminals = tree.getAllLeafNames(tree.root)
     # p4 strips off ', so we need to do so for the input taxon
     taxon = taxon.replace("'","")
-    for t in terminals:
-        t = t.replace(" ","_")
-        if (t == taxon):
-            return True
-        if (t.startswith(taxon+"%")):
-            return True # match potential non-monophyletic taxa
-
-    return False
+    # also matches potential non-monophyletic taxa, i.e. taxon%1
+    return tree.contains(taxon)
 
 
 def _delete_taxon(taxon, tree):
@@ -4094,53 +4184,84 @@ def _sub_taxon(old_taxon, new_taxon, tree, skip_existing=False):
     # we might now need a final collapse - e.g. we might get ...(taxon1,taxon2),... due
     # to replacements, but they didn't collapse, so let's do this
     for i in range(10): # do at most 10 iterations
-        new_tree = _collapse_nodes(new_tree)
+        collapsed_tree = _collapse_nodes(new_tree)
+        if (collapsed_tree == new_tree):
+            # nothing more to collapse
+            break
+        new_tree = collapsed_tree
 
     return new_tree
 
+# characters that mean a taxon name has to be quoted in a tree string
+_needs_quotes = re.compile('[\(|\)|\?|"|=|,|&|^|$|@|+]')
+# a non-monophyletic taxon, e.g. A%1 (for _collapse_nodes and _remove_single_poly_taxa)
+_poly_taxon = re.compile('([a-zA-Z0-9_\+\=\?\. ]*)%[0-9]+')
+_single_poly_taxon = re.compile('([a-zA-Z0-9_\+\= ]*)%([0-9]+)')
+_percent_number = re.compile('%[0-9]+')
+
+def _quote_taxon(name, text):
+    if (_needs_quotes.search(name) == None and not "'" in name):
+        return name.replace(" ","_")
+    else:
+        # a quote in a quoted name is written twice
+        return "'" + name.replace("'","''") + "'"
+
 def _correctly_quote_taxa(tree):
     """ In order for the subs to work, we need to only quote taxa that need it, as otherwise 
         we might have have the same taxon, e.g. 'Gallus gallus' and Gallus_gallus being
         considered as different
     """
 
-    # get taxa from tree
-    t_obj = _parse_tree(tree)
-    taxa = t_obj.getAllLeafNames(0)
+    seen = set()
+    def quote(name, text):
+        # p4 won't have the same taxon twice
+        if (name.lower() in seen):
+            raise p4.Glitch("Duplicated taxon name "+name)
+        seen.add(name.lower())
+        return _quote_taxon(name, text)
 
-    new_taxa = {}
-    # set the taxon name correctly, including in quotes, if needed...
-    for t in taxa:
-       m = re.search('[\(|\)|\?|"|=|,|&|^|$|@|+]', t)
-       if (m == None):
-          new_taxa[t] = t.replace(" ","_")
-       else:
-          new_taxa[t] = "'" + t + "'"
-
-    # search for the taxa in the tree now, check if quoted already
-    modified_tree = tree
-    for t in taxa:
-        new = new_taxa[t]
-        look_for = re.escape(t)
-        modified_tree = re.sub(r"(?P<pretaxon>\(|,|\)| )"+look_for+r"(?P<posttaxon>\(|,|\)| |:)",'\g<pretaxon>'+new+'\g<posttaxon>',modified_tree)
-        # new try with quotes on original - they get stripped by p4
-        t = "'" + t + "'"
-        look_for = re.escape(t)
-        modified_tree = re.sub(r"(?P<pretaxon>\(|,|\)| )"+look_for+r"(?P<posttaxon>\(|,|\)| |:)",'\g<pretaxon>'+new+'\g<posttaxon>',modified_tree)
+    try:
+        return stk_newick.rewrite_leaves(tree, quote)
+    except p4.Glitch as detail:
+        raise excp.TreeParseError("Error parsing tree\n"+detail.msg+"\n"+tree[0:128] )
 
-    return modified_tree
+def _strip_percent(name, text):
+    return _percent_number.sub('', text)
+
+def _poly_base(name):
+    m = _poly_taxon.match(name)
+    if (m == None):
+        return name
+    return m.group(1)
 
 def _collapse_nodes(in_tree):
     """ Collapses nodes where the siblings are actually the same
         taxon, denoted by taxon1, taxon2, etc
     """
 
-    modified_tree = re.sub(r"(?P<taxon>[a-zA-Z0-9_\+\= ]*)%[0-9]+",'\g<taxon>',in_tree)  
     try:
-        tree = _parse_tree(modified_tree,fixDuplicateTaxa=True)
-    except excp.TreeParseError:
+        modified_tree = stk_newick.rewrite_leaves(in_tree, _strip_percent)
+        cached = _parse_tree_cached(modified_tree,fixDuplicateTaxa=True)
+    except (p4.Glitch, excp.TreeParseError):
         tree = ""
         return tree
+
+    # Most of the time there is nothing to do, and the shared copy of the
+    # tree can be written out as it is
+    collapse = False
+    for n in cached.tree.iterInternals():
+        if (n.getNChildren() == 1):
+            collapse = True
+            break
+        names = [c.name for c in n.iterChildren() if not c.name == None]
+        bases = [_poly_base(c) for c in names]
+        if (len(set(bases)) < len(bases)):
+            collapse = True
+            break
+    if (not collapse):
+        return cached.tree.writeNewick(fName=None,toString=True).strip()
+
+    tree = _parse_tree(modified_tree,fixDuplicateTaxa=True)
     taxa = tree.getAllLeafNames(0)
     
     for t in taxa:
@@ -4149,17 +4270,11 @@ def _collapse_nodes(in_tree):
             siblings = _get_all_siblings(tree.node(t))
         except p4.Glitch:
             continue
-        m = re.match('([a-zA-Z0-9_\+\=\?\. ]*)%[0-9]+', t)
-        if (not m == None):
-            t = m.group(1)
+        t = _poly_base(t)
         for s in siblings:
-            orig_s = s
-            m = re.match('([a-zA-Z0-9_\+\=\?\. ]*)%[0-9]+', s)
-            if (not m == None):
-                s = m.group(1)
-            if t == s:
+            if t == _poly_base(s):
                 # remove this
-                tree.removeNode(tree.node(orig_s),alsoRemoveSingleChildParentNode=True,alsoRemoveBiRoot=False)
+                tree.removeNode(tree.node(s),alsoRemoveSingleChildParentNode=True,alsoRemoveBiRoot=False)
 
     # Remove all the empty nodes we left laying around
     tree.getPreAndPostOrderAboveRoot()
@@ -4173,13 +4288,17 @@ def _remove_single_poly_taxa(tree):
     """ Count the numbers after % in taxa names """
 
     try:
-        taxa = _getTaxaFromNewick(tree)
-    except excp.TreeParseError:
+        spans = stk_newick.leaf_spans(tree)
+    except p4.Glitch:
+        return tree
+    if (len(set([name.lower() for start, end, name in spans])) < len(spans)):
+        # p4 won't read a tree with the same taxon twice
         return tree
+    taxa = [name.replace(" ","_") for start, end, name in spans]
 
     numbers = {}
     for t in taxa:
-        m = re.match('([a-zA-Z0-9_\+\= ]*)%([0-9]+)', t)
+        m = _single_poly_taxon.match(t)
         if (not m == None):
             if (m.group(1) in numbers):
                 numbers[m.group(1)] = numbers[m.group(1)]+1
@@ -4188,13 +4307,14 @@ def _remove_single_poly_taxa(tree):
         else:
             numbers[t] = 1
 
-    for t in taxa:
-        m = re.match('([a-zA-Z0-9_\+\= ]*)%([0-9]+)', t)
-        if (not m == None):
-            if numbers[m.group(1)] == 1:
-                tree = re.sub(t,m.group(1),tree) 
-    
-    return tree
+    def rename(name, text):
+        t = name.replace(" ","_")
+        m = _single_poly_taxon.match(t)
+        if (not m == None and numbers[m.group(1)] == 1):
+            return text.replace(t,m.group(1))
+        return text
+
+    return stk_newick.rewrite_leaves(tree, rename, spans)
 
 
 def _swap_tree_in_XML(XML, tree, name, delete=False):
@@ -4208,30 +4328,20 @@ def _swap_tree_in_XML(XML, tree, name, delete=False):
 
     # find the source_tree that has this name, then swap the tree
 
-    # Our input tree has name source_no, so find the source by stripping off the number
-    xml_root = _parse_xml(XML)
-    t = xml_root.xpath("//source_tree[@name=\'"+name+"\']")
-    if (len(t) != 1):
+    # We edit a copy of the dataset, which is then cached against the
+    # returned XML, so calling this in a loop doesn't re-parse each time
+    dataset = stk_phyml.editable_dataset(XML)
+    if (not dataset.has_unique_tree(name)):
         raise excp.NotUniqueError("Two or more source_trees have the same name. Please fix this.")
-    else:
-        t = t[0]
-    s = t.getparent()
 
     if (not tree == None):
-        t.xpath("tree/tree_string/string_value")[0].text = tree
-        # We can return as we're only replacing one tree
-        return etree.tostring(xml_root,pretty_print=True)
+        dataset.set_tree_string(name,tree)
     else:
-        # we need to get parent and remove
-        t.getparent().remove(t)
-        if (delete):
-            # we now need to check the source to check if there are
-            # any trees in this source now, if not, remove
-            if (len(s.xpath("source_tree")) == 0):
-                s.getparent().remove(s)
-        return etree.tostring(xml_root,pretty_print=True)
+        # if delete is set, and the source no longer contains any trees,
+        # the source is removed too
+        dataset.remove_tree(name,delete_empty_source=delete)
 
-    return XML
+    return stk_phyml.dataset_result(XML,dataset)
 
 
 def _check_taxa(XML,delete=False):
@@ -4250,26 +4360,19 @@ def _check_taxa(XML,delete=False):
 
     # for each source
     for s in sources:
-        # get a list of taxa in the XML
-        this_source = _parse_xml(etree.tostring(s))
-        trees = obtain_trees(etree.tostring(this_source))
         s_name = s.attrib['name']
-        taxa_ele = []
-        for name in trees.iterkeys():
-            tree_no = 1
-            for t in s.xpath("source_tree"):
-                try:
-                    t_name = t.attrib['name']
-                except KeyError:
-                    message = message + "Tree in "+s_name+" is not named. Run the name_trees function"+"\n"
-                    continue
-                if (t_name == name):
-                    find = etree.XPath(".//taxon")
-                    taxa_ele = find(t)
-
-            tree = trees[name]
+        for st in s.xpath("source_tree"):
+            try:
+                name = st.attrib['name']
+            except KeyError:
+                message = message + "Tree in "+s_name+" is not named. Run the name_trees function"+"\n"
+                continue
+            value = st.find("tree/tree_string/string_value")
+            if (value is None or value.text is None):
+                continue
+            tree = value.text
             # are the XML taxa in the tree?
-            for t in taxa_ele:
+            for t in st.xpath(".//taxon"):
                 xml_taxon = t.attrib['name']
                 if (tree.find(xml_taxon) == -1):
                     if (delete):
@@ -4304,13 +4407,11 @@ def _check_sources(XML,delete=True):
     message = ""
     # for each source
     for s in sources:
-        # get a list of taxa in the XML
-        this_source = _parse_xml(etree.tostring(s))
         name = s.attrib['name']
-        trees = obtain_trees(etree.tostring(this_source))
+        trees = s.xpath("source_tree/tree/tree_string/string_value[text()]")
         if (len(trees) < 1):
             if (not delete):
-                message =+ "Source "+name+" has no trees\n"
+                message += "Source "+name+" has no trees\n"
             else:
                 s.getparent().remove(s)
 
@@ -4324,25 +4425,27 @@ def _check_sources(XML,delete=True):
 
 
 
-def _check_data(XML):
+def _check_data(XML,n_jobs=1):
     """ Function to check various aspects of the dataset, including:
          - checking taxa in the XML for a source are included in the tree for that source
          - checking all source names are unique
+         - checking trees are informative
+         - checking all sources have trees
+        Raises an error for the first of these that fails. See validate_data.
     """
 
-    # check all names are unique - this is easy...
-    _check_uniqueness(XML) # this will raise an error is the test is not passed
+    stk_validate.validate(XML,n_jobs=n_jobs).raise_errors()
 
-    # now the taxa
-    _check_taxa(XML) # again will raise an error if test fails
+    return
 
-    # check trees are informative
-    _check_informative_trees(XML)
 
-    # check sources
-    _check_sources(XML,delete=False)
+def validate_data(XML,n_jobs=1):
+    """ Check the dataset as _check_data does, but rather than raising an
+    error, return a stk_validate.ValidationReport listing every problem found.
+    The report is remembered, so checking the same data again is quick.
+    """
 
-    return
+    return stk_validate.validate(XML,n_jobs=n_jobs)
 
 
 def _parse_xml(xml_string):
@@ -4351,8 +4454,12 @@ def _parse_xml(xml_string):
     beforehand. We can then send it to lxml.parser as normal
     """
 
-    xml_string = _removeNonAscii(xml_string)
-    XML = etree.fromstring(xml_string)
+    if (isinstance(xml_string, stk_phyml.PhymlDataset)):
+        # callers are free to alter what we give back
+        return deepcopy(xml_string.xml_root)
+    with stk_profile.timer("xml parse"):
+        xml_string = _removeNonAscii(xml_string)
+        XML = etree.fromstring(xml_string)
     return XML
 
 def _removeNonAscii(s): 
@@ -4364,13 +4471,7 @@ def _removeNonAscii(s):
 def _getTaxaFromNewick(tree):
     """ Get the terminal nodes from a Newick string"""
 
-    t_obj = _parse_tree(tree)
-    terminals = t_obj.getAllLeafNames(0)
-    taxa = []
-    for t in terminals:
-        taxa.append(t.replace(" ","_"))
-
-    return taxa
+    return list(_parse_tree_cached(tree).taxa)
 
 
 def _sort_data(xml_root):
@@ -4393,32 +4494,10 @@ def _sort_data(xml_root):
 
 
 def _trees_equal(t1,t2):
-    """ compare two trees using Robinson-Foulds metric
+    """ compare two trees using Robinson-Foulds metric (and the root)
     """
 
-    tree_1 = _parse_tree(t1)
-    tree_2 = _parse_tree(t2)
-    
-    # add the taxanames
-    # Sort, otherwose p4 things the txnames are different
-    names = tree_1.getAllLeafNames(tree_1.root)
-    names.sort()
-    tree_1.taxNames = names
-    names = tree_2.getAllLeafNames(tree_2.root)
-    names.sort()
-    tree_2.taxNames = names
-
-    same = False
-    try:
-        if (tree_1.topologyDistance(tree_2) == 0):
-            same = True # yep, the same
-            # but also check the root
-            if not tree_1.root.getNChildren() == tree_2.root.getNChildren():
-                same = False
-    except:
-        same = False # different taxa, so can't be the same!
-
-    return same
+    return tree_fingerprint(t1) == tree_fingerprint(t2)
 
 def _find_trees_for_permuting(XML):
     """
@@ -4434,80 +4513,109 @@ def _find_trees_for_permuting(XML):
 
     return permute_trees
 
-def _create_matrix(trees, taxa, format="hennig", quote=False, weights=None, verbose=False):
+def _create_matrix(trees, taxa, format="hennig", quote=False, weights=None, verbose=False, outfile=None, n_jobs=1, store=None):
     """
     Does the hard work on creating a matrix
+
+    If outfile (an open file) is given the matrix is written to it and
+    nothing is returned, otherwise the matrix is returned as a string
     """
 
-    # our matrix, we'll then append the submatrix
-    # to this to make a 2D matrix
-    # Our matrix is of length nTaxa on the i dimension
-    # and nCharacters in the j direction
-    matrix = []
+    matrix, charsets, names, weights_per_char = _mrp_matrix(trees, taxa, weights=weights, verbose=verbose, n_jobs=n_jobs, store=store)
+
+    if (outfile == None):
+        return _create_matrix_string(matrix,taxa,charsets=charsets,names=names,
+                                     format=format,quote=quote,weights=weights_per_char)
+    _write_matrix(outfile,matrix,taxa,charsets=charsets,names=names,
+                  format=format,quote=quote,weights=weights_per_char)
+
+
+def _mrp_matrix(trees, taxa, weights=None, verbose=False, n_jobs=1, store=None):
+    """
+    Build the MRP matrix for a set of trees as an int8 array, taxa on i
+    and characters on j. Cells are 0, 1 or MRP_MISSING. MRP_Outgroup is 0
+    for every character unless a tree actually contains it.
+
+    returns: matrix, charsets, tree names and the weight of each character
+             (None if weights is None)
+    """
+
+    t_index = {}
+    for i in range(len(taxa)-1,-1,-1):
+        t_index[taxa[i]] = i
+
+    # assemble each tree first so we know how big the matrix is
     charsets = []
+    names = []
     if (weights == None):
         weights_per_char = None
     else:
         weights_per_char = []
-    names = []
     current_char = 1
-    for key in trees:
-        if (not weights == None):
-            weight = weights[key]
+    keys = trees.keys()
+    submatrices = [r['matrix'] for r in _tree_results([trees[key] for key in keys],['matrix'],store=store,n_jobs=n_jobs,verbose=verbose)]
+    for key, (submatrix, tree_taxa) in zip(keys,submatrices):
         names.append(key)
-        submatrix, tree_taxa = _assemble_tree_matrix(trees[key], verbose=verbose)
         nChars = len(submatrix[0,:])
-        # loop over characters in the submatrix
-        for i in range(1,nChars):
-            if (not weights == None):
-                weights_per_char.append(weight)
-            # loop over taxa. Add '?' for an "unknown" taxa, otherwise
-            # get 0 or 1 from submatrix. May as well turn into a string whilst
-            # we're at it
-            current_row = []
-            for taxon in taxa:
-                if (taxon in tree_taxa):
-                    # get taxon index
-                    t_index = tree_taxa.index(taxon)
-                    # then get correct matrix entry - note:
-                    # submatrix transposed wrt main matrix
-                    current_row.append(str(int(submatrix[t_index,i])))
-                elif (taxon == "MRP_Outgroup"):
-                    current_row.append('0')
-                else:
-                    current_row.append('?')
-            matrix.append(current_row)
+        if (not weights == None):
+            weights_per_char.extend([weights[key]]*(nChars-1))
         charsets.append(str(current_char) + "-" + str(current_char + nChars-2))
         current_char += nChars-1
 
-    matrix = numpy.array(matrix)
-    matrix = matrix.transpose()
+    matrix = numpy.empty((len(taxa),current_char-1),dtype=numpy.int8)
+    matrix.fill(MRP_MISSING)
+    outgroup_rows = [i for i in range(len(taxa)) if taxa[i] == "MRP_Outgroup"]
+    start = 0
+    for submatrix, tree_taxa in submatrices:
+        end = start + len(submatrix[0,:]) - 1
+        if (end == start):
+            continue
+        matrix[outgroup_rows,start:end] = 0
+        # first occurrence of each taxon in the tree wins
+        rows = {}
+        for i in range(len(tree_taxa)-1,-1,-1):
+            if tree_taxa[i] in t_index:
+                rows[t_index[tree_taxa[i]]] = i
+        if (len(rows) > 0):
+            matrix[rows.keys(),start:end] = submatrix[rows.values(),1:]
+        start = end
 
-    return _create_matrix_string(matrix,taxa,charsets=charsets,names=names,
-                                 format=format,quote=quote,weights=weights_per_char)
+    return matrix, charsets, names, weights_per_char
 
 
-def _create_matrix_string(matrix,taxa,charsets=None,names=None,
-                          format='hennig',quote=False,weights=None):
+def _matrix_rows(matrix):
     """
-    Turns a matrix into a string
+    Yield each row of a matrix as a string. The matrix is either an MRP
+    int8 array from _mrp_matrix or rows of single characters.
+    """
+
+    if (isinstance(matrix,numpy.ndarray) and matrix.dtype == numpy.int8):
+        for row in matrix:
+            yield _MRP_CHARS[row].tostring()
+    else:
+        for row in matrix:
+            yield "".join(row)
+
+
+def _write_matrix(f,matrix,taxa,charsets=None,names=None,
+                  format='hennig',quote=False,weights=None):
     """
+    Writes a matrix to an open file, a row at a time
+    """
+
+    if (not format == 'hennig' and not format == 'nexus'):
+        raise excp.MatrixError("Invalid matrix format")
 
-    last_char = len(matrix[0])    
+    last_char = len(matrix[0])
+    stk_profile.count("matrix cells written",len(taxa)*last_char)
     if (format == 'hennig'):
-        matrix_string = "xread\n"
-        matrix_string += str(last_char) + " "+str(len(taxa))+"\n"
+        f.write("xread\n")
+        f.write(str(last_char) + " "+str(len(taxa))+"\n")
 
-        i = 0
-        for taxon in taxa:
-            matrix_string += taxon + "\t"
-            string = ""
-            for t in matrix[i][:]:
-                string += t
-            matrix_string += string + "\n"
-            i += 1
+        for taxon, row in zip(taxa, _matrix_rows(matrix)):
+            f.write(taxon + "\t" + row + "\n")
             
-        matrix_string += "\n"
+        f.write("\n")
         if (not weights == None):
             # get unique weights
             unique_weights = _uniquify(weights)
@@ -4515,51 +4623,53 @@ def _create_matrix_string(matrix,taxa,charsets=None,names=None,
                 # The float for the weight cannot start with 0, even if it's 0.5
                 # so we strip of the 0 to make .5 instead (lstrip). TNT is weird with formats...
                 # We also strip off trailing zeros for neatness (rstrip)
-                matrix_string += "ccode +[/"+("%.3f"%uw).lstrip('0').rstrip('0')
+                f.write("ccode +[/"+("%.3f"%uw).lstrip('0').rstrip('0'))
                 i = 0
                 for w in weights:
                     if (w == uw):
-                        matrix_string += " " + str(i)
+                        f.write(" " + str(i))
                     i += 1
-                matrix_string += ";\n"
-        matrix_string += "proc /;"
+                f.write(";\n")
+        f.write("proc /;")
     elif (format == 'nexus'):
-        matrix_string = "#nexus\n\nbegin data;\n"
-        matrix_string += "\tdimensions ntax = "+str(len(taxa)) +" nchar = "+str(last_char)+";\n"
-        matrix_string += "\tformat missing = ?"
-        matrix_string += ";\n"
-        matrix_string += "\n\tmatrix\n\n"
+        f.write("#nexus\n\nbegin data;\n")
+        f.write("\tdimensions ntax = "+str(len(taxa)) +" nchar = "+str(last_char)+";\n")
+        f.write("\tformat missing = ?")
+        f.write(";\n")
+        f.write("\n\tmatrix\n\n")
 
-        i = 0
-        for taxon in taxa:
+        for taxon, row in zip(taxa, _matrix_rows(matrix)):
             if (quote):
-                matrix_string += "'" + taxon + "'\t"
+                f.write("'" + taxon + "'\t")
             else:
-                matrix_string += taxon + "\t"
-            string = ""
-            for t in matrix[i][:]:
-                string += t
-            matrix_string += string + "\n"
-            i += 1
+                f.write(taxon + "\t")
+            f.write(row + "\n")
         if (not charsets == None):
             
-            matrix_string += "\t;\nend;\n\n"
-            matrix_string += "begin sets;\n"
+            f.write("\t;\nend;\n\n")
+            f.write("begin sets;\n")
             if (names == None):
                 names = []
-                i = 1
-                for c in charset:
-                    names.append("chars_"+str(i))
+                for i in range(len(charsets)):
+                    names.append("chars_"+str(i+1))
             i = 0
             for char in charsets:
-                matrix_string += "\tcharset "+names[i] + " "
-                matrix_string += char + "\n"
+                f.write("\tcharset "+names[i] + " ")
+                f.write(char + "\n")
                 i += 1
-        matrix_string += "end;\n\n"
-    else:
-        raise MatrixError("Invalid matrix format")
+        f.write("end;\n\n")
 
-    return matrix_string
+
+def _create_matrix_string(matrix,taxa,charsets=None,names=None,
+                          format='hennig',quote=False,weights=None):
+    """
+    Turns a matrix into a string
+    """
+
+    f = StringIO()
+    _write_matrix(f,matrix,taxa,charsets=charsets,names=names,
+                  format=format,quote=quote,weights=weights)
+    return f.getvalue()
 
     
 def _amalgamate_trees(trees,format,anonymous=False):
@@ -4665,27 +4775,24 @@ def _read_hennig_matrix(filename):
     return matrix,taxa
 
 
-def _check_informative_trees(XML,delete=False):
+def _check_informative_trees(XML,delete=False,n_jobs=1):
     """ Checks that all trees in the data set are informative and raises error if not
     """
 
     try:
-        trees = obtain_trees(XML)
+        dataset = stk_phyml.get_dataset(XML)
+        trees = dataset.trees()
     except:
         raise excp.InvalidSTKData("Error parsing the data to check trees")
     remove = []
     message=""
-    for t in trees:
-        tree = trees[t]
-        tree = _parse_tree(tree)
-
-        # check if tree contains more than two taxa
-        terminals = tree.getAllLeafNames(tree.root)
-        if (len(terminals) < 3):
+    names = trees.keys()
+    problems = stk_parallel.map_trees(_informative_worker,[trees[t] for t in names],n_jobs=n_jobs)
+    for t, problem in zip(names,problems):
+        if (problem == "taxa"):
             message = message+"\nTree "+t+" contains only 2 taxa and is not informative"
             remove.append(t)
-        # if tree contains three or more taxa, check it's rooted somewhere
-        elif (tree.getDegree(tree.root) == len(terminals)):
+        elif (problem == "clades"):
             message = message+"\nTree "+t+" doesn't contain any clades and is not informative"
             remove.append(t)
 
@@ -4701,24 +4808,102 @@ def _check_informative_trees(XML,delete=False):
 
         return XML
 
+# Per-tree work that can be run by stk_parallel.map_trees. Each gets
+# a Newick string and whatever is shared between all the trees
+
+def _informative_worker(tree, shared=None):
+    """ Why a tree is not informative: "taxa" if it has fewer than three,
+    "clades" if it has no clades. None if it's fine.
+    """
+
+    return _informative_problem(_parse_tree_cached(tree).tree)
+
+def _informative_problem(tree):
+    """ As _informative_worker, for a p4 tree object
+    """
+
+    # check if tree contains more than two taxa
+    terminals = tree.getAllLeafNames(tree.root)
+    if (len(terminals) < 3):
+        return "taxa"
+    # if tree contains three or more taxa, check it's rooted somewhere
+    elif (tree.getDegree(tree.root) == len(terminals)):
+        return "clades"
+    return None
+
+def _tree_taxa_worker(tree, ignoreErrors=False):
+    """ The taxa in a tree (with underscores). Unparsable trees have
+    no taxa if ignoreErrors is set.
+    """
+
+    try:
+        return list(_parse_tree_cached(tree).taxa)
+    except excp.TreeParseError as detail:
+        if (ignoreErrors):
+            logging.warning(detail.msg)
+            return []
+        else:
+            raise excp.TreeParseError( detail.msg )
+
+def _sorted_leaves_worker(tree, shared=None):
+    """ The leaf names of a tree, sorted, as get_taxa_from_tree gives them
+    """
+
+    return sorted([str(t) for t in _parse_tree_cached(tree).leaves])
+
+def _tree_results_worker(tree, shared):
+    fields, verbose = shared
+    results = {}
+    if ('leaves' in fields):
+        results['leaves'] = [str(t) for t in _parse_tree_cached(tree).leaves]
+    if ('matrix' in fields):
+        results['matrix'] = _assemble_tree_matrix(tree, verbose=verbose)
+    if ('topology' in fields):
+        results['topology'] = tree_fingerprint(tree)
+    if ('normal' in fields):
+        results['normal'] = (_sub_taxa_in_tree(tree,[]) == tree)
+    return results
+
+def _tree_results(trees, fields, store=None, n_jobs=1, verbose=False):
+    """ The per-tree results named in fields (see stk_tree_store.FIELDS)
+    for each of a list of tree strings, as a list of dictionaries. Results
+    for trees already in the store are taken from there; the rest are
+    worked out (once for each different tree) and added to it.
+    """
+
+    hashes = [stk_tree_store.tree_hash(t) for t in trees]
+    if (store is None):
+        found = {}
+    else:
+        found = store.get_trees(hashes,fields)
+    missing = []
+    missing_trees = []
+    for h, t in zip(hashes,trees):
+        if (not h in found):
+            found[h] = None
+            missing.append(h)
+            missing_trees.append(t)
+    new_results = stk_parallel.map_trees(_tree_results_worker,missing_trees,n_jobs=n_jobs,shared=(fields,verbose))
+    new_results = dict(zip(missing,new_results))
+    if (not store is None and len(new_results) > 0):
+        store.put_trees(new_results)
+    found.update(new_results)
+
+    return [found[h] for h in hashes]
+
+def _sub_taxa_worker(tree, shared):
+    old_taxa, new_taxa, skip_existing, sub_table = shared
+    return _sub_taxa_in_tree(tree,old_taxa,new_taxa,skip_existing=skip_existing,sub_table=sub_table)
+
 def _parse_trees(tree_block):
     """ Parse a string containing multiple trees 
         to a list of p4 tree objects
     """
    
     try:
-        p4.var.doRepairDupedTaxonNames = 2
-        p4.var.warnReadNoFile = False
-        p4.var.nexus_warnSkipUnknownBlock = False
-        p4.var.trees = []
-        p4.read(tree_block)
-        p4.var.nexus_warnSkipUnknownBlock = True
-        p4.var.warnReadNoFile = True
-        p4.var.doRepairDupedTaxonNames = 0
+        trees = stk_newick.parse_trees(tree_block,fix_duplicate_taxa=True)
     except p4.Glitch as detail:
         raise excp.TreeParseError("Error parsing tree\n"+detail.msg+"\n"+tree_block[0:128] )
-    trees = p4.var.trees
-    p4.var.trees = []
     return trees
 
 def _parse_tree(tree,fixDuplicateTaxa=False):
@@ -4726,20 +4911,22 @@ def _parse_tree(tree,fixDuplicateTaxa=False):
     """
 
     try:
-        if (fixDuplicateTaxa):
-            p4.var.doRepairDupedTaxonNames = 2
-        p4.var.warnReadNoFile = False
-        p4.var.nexus_warnSkipUnknownBlock = False
-        p4.var.trees = []
-        p4.read(tree)
-        p4.var.nexus_warnSkipUnknownBlock = True
-        p4.var.warnReadNoFile = True
-        if (fixDuplicateTaxa):
-            p4.var.doRepairDupedTaxonNames = 0
+        t = stk_newick.parse_tree(tree,fix_duplicate_taxa=fixDuplicateTaxa)
     except p4.Glitch as detail:
         raise excp.TreeParseError("Error parsing tree\n"+detail.msg+"\n"+tree[0:128] )
 
-    t = p4.var.trees[0]
-    p4.var.trees = []
     return t
 
+
+
+def _parse_tree_cached(tree,fixDuplicateTaxa=False):
+    """ Parse a newick string via the shared tree cache. Returns
+    a stk_newick.CachedTree, with the p4 tree object (tree) and the
+    leaf names (leaves, taxa, taxa_set). These are shared - do not
+    alter the tree; use _parse_tree if you need to.
+    """
+
+    try:
+        return stk_newick.cached_tree(tree,fix_duplicate_taxa=fixDuplicateTaxa)
+    except p4.Glitch as detail:
+        raise excp.TreeParseError("Error parsing tree\n"+detail.msg+"\n"+tree[0:128] )
@@ -0,0 +1,127 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import taxonomic_checker_list, create_taxonomy, load_phyml
+import stk.stk_backbone as stk_backbone
+from stk.stk_backbone import Backbone, canonical_name, edit_distance
+from stk.stk_exceptions import *
+import os
+import tempfile
+import shutil
+from util import *
+
+checklist = "data/input/backbone.tsv"
+
+class TestBackbone(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backbone = Backbone(":memory:")
+        self.backbone.import_checklist(checklist)
+
+    def tearDown(self):
+        stk_backbone.set_backbone(None)
+        self.backbone.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_canonical_name(self):
+        self.assert_(canonical_name("Gallus gallus (Linnaeus, 1758)") == "Gallus gallus")
+        self.assert_(canonical_name("Gallus gallus domesticus Linnaeus") == "Gallus gallus domesticus")
+        self.assert_(canonical_name("Phasianidae Vigors, 1825") == "Phasianidae")
+        self.assert_(canonical_name("Egretta tricolor (Statius Muller, 1776)","(Statius Muller, 1776)") == "Egretta tricolor")
+        self.assert_(canonical_name("Aves") == "Aves")
+        self.assert_(edit_distance("gallus","galus") == 1)
+        self.assert_(edit_distance("gallus","gallus") == 0)
+        self.assert_(edit_distance("gallus","varius") == 3)
+        self.assert_(edit_distance("gallus","varius",1) == 2)
+
+    def test_import(self):
+        self.assert_(len(self.backbone) == 22)
+        # a synonym of a name that isn't in the checklist is no help
+        self.assert_(self.backbone.resolve("Ardea lost") == [])
+        filename = os.path.join(self.tmpdir,"backbone.sqlite")
+        backbone = Backbone(filename)
+        self.assert_(backbone.import_checklist(checklist) == 22)
+        # importing again replaces what was there
+        self.assert_(backbone.import_checklist(checklist) == 22)
+        backbone.close()
+        backbone = Backbone(filename)
+        self.assert_(len(backbone) == 22)
+        self.assert_(backbone.provider == "backbone.tsv")
+        # so a rerun of "stk process" can tell a new import from the old one
+        self.assert_(not backbone.imported is None)
+        self.assert_(backbone.check("Gallus_gallus") == [["Gallus_gallus"],"green"])
+        backbone.close()
+        bad = os.path.join(self.tmpdir,"bad.tsv")
+        f = open(bad,"w")
+        f.write("taxonID\tname\n1\tAves\n")
+        f.close()
+        self.assertRaises(TaxonomyFileError,Backbone(":memory:").import_checklist,bad)
+
+    def test_resolve(self):
+        matches = self.backbone.resolve("Gallus gallus")
+        self.assert_(len(matches) == 1)
+        self.assert_(matches[0]['kind'] == stk_backbone.EXACT)
+        self.assert_(matches[0]['classification']['family'] == 'Phasianidae')
+        matches = self.backbone.resolve("Diomedea_melanophris")
+        self.assert_(matches[0]['kind'] == stk_backbone.SYNONYM)
+        self.assert_(matches[0]['accepted'] == "Thalassarche melanophris")
+        matches = self.backbone.resolve("Thalasarche melanophrys")
+        self.assert_(matches[0]['kind'] == stk_backbone.FUZZY)
+        self.assert_(matches[0]['distance'] == 2)
+        self.assert_(matches[0]['accepted'] == "Thalassarche melanophris")
+        self.assert_(self.backbone.resolve("Thalasarche melanophrys",fuzzy=False) == [])
+        matches = self.backbone.resolve("Gallus_newus")
+        self.assert_(matches[0]['kind'] == stk_backbone.GENUS)
+        self.assert_(matches[0]['accepted'] == "Gallus")
+        self.assert_(self.backbone.resolve("Galliformess")[0]['accepted'] == "Galliformes")
+        self.assert_(self.backbone.resolve("Nonexistent bird") == [])
+        self.assert_(self.backbone.fuzzy("Gallus galus") == [(1,"Gallus gallus")])
+        self.assert_(self.backbone.synonyms("Gallus gallus") == ["Phasianus gallus"])
+
+    def test_check(self):
+        self.assert_(self.backbone.check("Gallus_gallus") == [["Gallus_gallus"],"green"])
+        self.assert_(self.backbone.check("Phasianus_gallus") == [["Gallus_gallus","Phasianus_gallus"],"yellow"])
+        self.assert_(self.backbone.check("Galus_gallus") == [["Gallus_gallus","Phasianus_gallus"],"yellow"])
+        self.assert_(self.backbone.check("Ardea_candidissima") == [["Egretta_tricolor","Egretta_thula"],"amber"])
+        # a genus on its own doesn't make a species name right
+        self.assert_(self.backbone.check("Gallus_newus") == [["Gallus_newus"],"red"])
+        self.assert_(self.backbone.check("Nonexistent_bird") == [["Nonexistent_bird"],"red"])
+
+    def test_taxonomy(self):
+        entry = self.backbone.taxonomy("Gallus_gallus")
+        self.assertDictEqual(entry,{'kingdom':'Animalia','phylum':'Chordata','class':'Aves','order':'Galliformes',
+                                    'family':'Phasianidae','genus':'Gallus','species':'Gallus gallus',
+                                    'provider':'backbone.tsv'})
+        self.assert_(self.backbone.taxonomy("Gallus gallus domesticus")['species'] == 'Gallus gallus')
+        self.assert_(self.backbone.taxonomy("Diomedea melanophris")['species'] == 'Thalassarche melanophris')
+        entry = self.backbone.taxonomy("Gallus newus")
+        self.assert_(entry['species'] == 'Gallus newus')
+        self.assert_(entry['family'] == 'Phasianidae')
+        self.assertDictEqual(self.backbone.taxonomy("Phasianidae"),{'kingdom':'Animalia','phylum':'Chordata','class':'Aves',
+                                                                    'order':'Galliformes','family':'Phasianidae',
+                                                                    'provider':'backbone.tsv'})
+        self.assert_(self.backbone.taxonomy("Nonexistent bird") == None)
+
+    def test_offline_checker_and_taxonomy(self):
+        names = ["Gallus_gallus","Phasianus_gallus","Nonexistent_bird","Gallus_gallus"]
+        done = []
+        equivs = taxonomic_checker_list(names,backbone=self.backbone,progress=lambda d,t,n: done.append((d,t,n)))
+        self.assert_(len(equivs) == 3)
+        self.assert_(equivs['Phasianus_gallus'] == [["Gallus_gallus","Phasianus_gallus"],"yellow"])
+        self.assert_(equivs['Nonexistent_bird'] == [["Nonexistent_bird"],"red"])
+        self.assert_([d[0:2] for d in done] == [(1,3),(2,3),(3,3)])
+        # the backbone set for everyone is used if none is given
+        stk_backbone.set_backbone(self.backbone)
+        self.assert_(taxonomic_checker_list(["Gallus_gallus"]) == {"Gallus_gallus":[["Gallus_gallus"],"green"]})
+        XML = load_phyml("data/input/create_taxonomy.phyml")
+        taxonomy = create_taxonomy(XML)
+        self.assert_(len(taxonomy) == 5)
+        self.assert_(taxonomy['Gallus gallus']['order'] == 'Galliformes')
+        self.assert_(taxonomy['Egretta tricolor']['family'] == 'Ardeidae')
+        self.assert_(taxonomy['Archaeopteryx lithographica'] == {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,6 +25,7 @@ import sys
 # so we import local stk before any other
 sys.path.insert(0,"../../")
 from stk.supertree_toolkit import create_subset, _parse_xml
+import stk.stk_phyml as stk_phyml
 import os
 from lxml import etree
 from util import *
@@ -243,6 +244,30 @@ class TestSubset(unittest.TestCase):
         src_trs = root.findall(".//source_tree")
         self.assert_(len(src_trs) == 1)
 
+    def testIndexReused(self):
+        XML = etree.tostring(etree.parse('data/input/old_stk_input.phyml',parser),pretty_print=True)
+        create_subset(XML,{'years':[1999]})
+        index = stk_phyml.get_dataset(XML).subset_index()
+        new_XML = create_subset(XML,{'characters':["cytb"],'taxa':["Gallus gallus"]})
+        self.assert_(stk_phyml.get_dataset(XML).subset_index() is index)
+        root = _parse_xml(new_XML)
+        names = sorted([s.attrib['name'] for s in root.findall(".//source")])
+        self.assertListEqual(["Aragon_etal_1999","Baker_etal_2006"],names)
+        # the original is untouched
+        self.assert_(len(_parse_xml(XML).findall(".//source")) == len(index.sources))
+
+    def testOrYearsFossil(self):
+        XML = etree.tostring(etree.parse('data/input/old_stk_input.phyml',parser),pretty_print=True)
+        searchTerms = {'years':[1999], 'fossil':"all_fossil"}
+        new_XML = create_subset(XML,searchTerms,andSearch=False)
+        root = _parse_xml(new_XML)
+        names = sorted([s.attrib['name'] for s in root.findall(".//source")])
+        expected_names = ["Andersson_1999a","Andersson_1999b","Aragon_etal_1999","Baker_etal_2005","Baptista_Visser_1999"]
+        self.assertListEqual(expected_names,names)
+        # trees still have to match all the tree terms
+        src_trs = root.findall(".//source_tree")
+        self.assert_(len(src_trs) == 1)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,193 @@
+import unittest
+import math
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import _parse_tree, _parse_trees, obtain_trees, load_phyml
+from stk.supertree_toolkit import _correctly_quote_taxa, substitute_taxa_in_trees
+import stk.stk_newick as stk_newick
+import stk.p4 as p4
+import stk.stk_exceptions as excp
+import threading
+import os
+from util import *
+
+def _p4_read(tree):
+    p4.var.doRepairDupedTaxonNames = 2
+    p4.var.warnReadNoFile = False
+    p4.var.trees = []
+    p4.read(tree)
+    p4.var.warnReadNoFile = True
+    p4.var.doRepairDupedTaxonNames = 0
+    trees = p4.var.trees
+    p4.var.trees = []
+    return trees
+
+def _tree_signature(t):
+    return [(n.nodeNum, n.name, n.isLeaf, n.br and n.br.len, n.parent and n.parent.nodeNum,
+             n.sibling and n.sibling.nodeNum) for n in t.nodes]
+
+class TestNewickParser(unittest.TestCase):
+
+    def test_same_as_p4(self):
+        trees = ["((A,B),(C,D));",
+                 "((A:1.0,B:0.5)0.9:0.1,('Taxon (c)':1,'O''Brien':2e-05));",
+                 "((A_a, B_b)lbl, (C, (D, E)));",
+                 "(A,B,(C,D)[&comment]);",
+                 "((A,B),(C,D)); ((E,F),(G,H));"]
+        for t in trees:
+            old = _p4_read(t)
+            new = stk_newick.parse_trees(t)
+            self.assert_(len(old) == len(new))
+            for i in range(len(old)):
+                self.assert_(_tree_signature(old[i]) == _tree_signature(new[i]))
+                self.assert_(old[i].writeNewick(fName=None,toString=True) == new[i].writeNewick(fName=None,toString=True))
+
+    def test_same_as_p4_test_data(self):
+        XML = load_phyml("data/input/old_stk_input.phyml")
+        trees = obtain_trees(XML)
+        for t in trees:
+            old = _p4_read(trees[t])[0]
+            new = stk_newick.parse_tree(trees[t],fix_duplicate_taxa=True)
+            self.assert_(_tree_signature(old) == _tree_signature(new))
+
+    def test_duplicate_taxa(self):
+        tree = "((A,B),(A,C));"
+        self.assertRaises(p4.Glitch,stk_newick.parse_tree,tree)
+        self.assertRaises(excp.TreeParseError,_parse_tree,tree)
+        t = _parse_tree(tree,fixDuplicateTaxa=True)
+        names = t.getAllLeafNames(t.root)
+        names.sort()
+        self.assert_(names == ['A%1','A%2','B','C'])
+
+    def test_bad_tree(self):
+        self.assertRaises(excp.TreeParseError,_parse_tree,"((A,B),(C,D);")
+        self.assertRaises(excp.TreeParseError,_parse_tree,"((A,B),,(C,D));")
+
+    def test_nexus_block(self):
+        tree_block = "#NEXUS\nbegin trees;\ntree tree_1 = [&U] ((A,B),(C,D));\ntree tree_2 = [&U] ((A,C),(B,D));\nend;\n"
+        trees = _parse_trees(tree_block)
+        self.assert_(len(trees) == 2)
+        self.assert_(trees[1].writeNewick(fName=None,toString=True).strip() == "((A, C), (B, D));")
+
+    def test_no_global_state(self):
+        p4.var.trees = []
+        t = stk_newick.parse_tree("((A,B),(C,D));")
+        self.assert_(p4.var.trees == [])
+        self.assert_(p4.var.doRepairDupedTaxonNames == 0)
+
+    def test_threads(self):
+        trees = {}
+        for i in range(20):
+            trees[i] = "((A"+str(i)+",B),(C,(D,E"+str(i)+")));"
+        results = {}
+        errors = []
+        def parse(i):
+            try:
+                for j in range(20):
+                    t = stk_newick.parse_tree(trees[i])
+                    names = t.getAllLeafNames(t.root)
+                    names.sort()
+                    results[i] = names
+            except:
+                errors.append(i)
+        threads = [threading.Thread(target=parse,args=(i,)) for i in trees]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assert_(errors == [])
+        for i in trees:
+            self.assert_(results[i] == sorted(["A"+str(i),"B","C","D","E"+str(i)]))
+
+
+class TestTreeCache(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = stk_newick.TreeCache(size=10)
+        tree = "((A,B),(C,D));"
+        t1 = cache.get(tree)
+        t2 = cache.get(tree)
+        self.assert_(t1 is t2)
+        self.assert_(cache.stats() == {'size':10,'trees':1,'hits':1,'misses':1})
+        self.assert_(t1.taxa == ('A','B','C','D'))
+        self.assert_(t1.taxa_set == frozenset(['A','B','C','D']))
+
+    def test_lru_eviction(self):
+        cache = stk_newick.TreeCache(size=2)
+        cache.get("((A,B),(C,D));")
+        cache.get("((A,C),(B,D));")
+        cache.get("((A,B),(C,D));")
+        cache.get("((A,D),(B,C));")
+        self.assert_(len(cache) == 2)
+        cache.reset_stats()
+        cache.get("((A,B),(C,D));")
+        self.assert_(cache.hits == 1)
+        cache.get("((A,C),(B,D));")
+        self.assert_(cache.misses == 1)
+
+    def test_invalidate(self):
+        cache = stk_newick.TreeCache(size=10)
+        tree = "((A,B),(C,D));"
+        t1 = cache.get(tree)
+        cache.invalidate(tree)
+        self.assert_(len(cache) == 0)
+        self.assert_(not cache.get(tree) is t1)
+        cache.invalidate()
+        self.assert_(len(cache) == 0)
+        cache.set_size(0)
+        cache.get(tree)
+        self.assert_(len(cache) == 0)
+
+    def test_parse_errors_not_cached(self):
+        cache = stk_newick.TreeCache(size=10)
+        self.assertRaises(p4.Glitch,cache.get,"((A,B),(A,C));")
+        self.assert_(len(cache) == 0)
+        # but with duplicates fixed, it's fine
+        t = cache.get("((A,B),(A,C));",fix_duplicate_taxa=True)
+        self.assert_(t.contains('A'))
+        self.assert_(t.count('A') == 2)
+        self.assert_(not t.contains('D'))
+
+    def test_non_monophyletic(self):
+        cache = stk_newick.TreeCache(size=10)
+        t = cache.get("((A%1,B),(A%2,'C d'));")
+        self.assert_(t.contains('A'))
+        self.assert_(t.contains('A%1'))
+        self.assert_(t.contains('C_d'))
+        self.assert_(not t.contains('C d'))
+        self.assert_(t.leaves == ('A%1','B','A%2','C d'))
+        self.assert_(t.count('A') == 2)
+
+
+class TestLeafRewriting(unittest.TestCase):
+
+    def test_leaf_spans(self):
+        tree = "((A%1:0.5,'B c'),[comment]('D''s',E)Int:1.0);"
+        spans = stk_newick.leaf_spans(tree)
+        self.assert_([s[2] for s in spans] == ['A%1','B c',"D's",'E'])
+        self.assert_([tree[s[0]:s[1]] for s in spans] == ['A%1',"'B c'","'D''s'",'E'])
+        # the same leaves p4 finds
+        for t in ["(A,B,(C,D));", "((A:1,B:2):3,(C,D)E:4);", "(A, (B , C ));"]:
+            self.assert_([s[2] for s in stk_newick.leaf_spans(t)] == _parse_tree(t).getAllLeafNames(0))
+        self.assertRaises(p4.Glitch,stk_newick.leaf_spans,"((A,B),C;")
+        self.assertRaises(p4.Glitch,stk_newick.leaf_spans,"((A,B)),C);")
+        self.assertRaises(p4.Glitch,stk_newick.leaf_spans,"((A,),C);")
+
+    def test_rewrite_leaves(self):
+        tree = "((A%1:0.5,'B c'),('D''s',E)Int:1.0);"
+        new = stk_newick.rewrite_leaves(tree, lambda name, text: name.upper().replace(" ","_"))
+        self.assert_(new == "((A%1:0.5,B_C),(D'S,E)Int:1.0);")
+        # nothing to change gives back the same string
+        self.assert_(stk_newick.rewrite_leaves(tree, lambda name, text: text) is tree)
+
+    def test_quotes_in_names(self):
+        # a name with a quote in it stays quoted, with the quote doubled
+        tree = "((A,B),(C,'O''Brien''s_bird'));"
+        self.assert_(_correctly_quote_taxa(tree) == tree)
+        self.assert_(_correctly_quote_taxa("((A,B),(C,'O''Brien''s bird'));") == "((A,B),(C,'O''Brien''s bird'));")
+        self.assert_(substitute_taxa_in_trees([tree],'A','Z') == ["((Z, B), (C, 'O''Brien''s_bird'));"])
+
+
+if __name__ == '__main__':
+    unittest.main()
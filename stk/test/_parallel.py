@@ -0,0 +1,77 @@
+import unittest
+import math
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import substitute_taxa, get_all_taxa, create_matrix, data_independence, _check_informative_trees
+from stk.supertree_toolkit import substitute_taxa_in_trees, obtain_trees, load_phyml, _parse_tree_cached
+import stk.stk_parallel as stk_parallel
+import stk.stk_exceptions as excp
+import os
+from lxml import etree
+from util import *
+
+parser = etree.XMLParser(remove_blank_text=True)
+
+def _taxa_count(tree, shared):
+    return len(_parse_tree_cached(tree).taxa) + shared
+
+def _fail(tree, shared):
+    raise excp.TreeParseError("Failed on "+tree)
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.min_trees = stk_parallel.PARALLEL_MIN_TREES
+        # so our small test data actually uses a pool
+        stk_parallel.PARALLEL_MIN_TREES = 2
+
+    def tearDown(self):
+        stk_parallel.PARALLEL_MIN_TREES = self.min_trees
+
+    def test_map_trees_order(self):
+        trees = ["(A,(B,C));","((A,B),(C,D));","(A,(B,(C,(D,E))));"]*5
+        self.assert_(stk_parallel.map_trees(_taxa_count,trees,n_jobs=2,shared=10) == [13,14,15]*5)
+        self.assert_(stk_parallel.map_trees(_taxa_count,trees,n_jobs=1,shared=10) == [13,14,15]*5)
+
+    def test_serial_for_small_input(self):
+        stk_parallel.PARALLEL_MIN_TREES = 50
+        self.assert_(not stk_parallel.use_pool(10,4))
+        self.assert_(stk_parallel.use_pool(50,4))
+        self.assert_(not stk_parallel.use_pool(50,1))
+        self.assert_(not stk_parallel.use_pool(50,None))
+
+    def test_errors_raised(self):
+        trees = ["(A,(B,C));","((A,B),(C,D));"]
+        self.assertRaises(excp.TreeParseError,stk_parallel.map_trees,_fail,trees,n_jobs=2)
+
+    def test_same_as_serial(self):
+        XML = load_phyml("data/input/old_stk_input.phyml")
+        self.assert_(get_all_taxa(XML,n_jobs=2) == get_all_taxa(XML))
+        self.assert_(create_matrix(XML,n_jobs=2) == create_matrix(XML))
+        self.assert_(data_independence(XML,n_jobs=2) == data_independence(XML))
+        taxa = get_all_taxa(XML)
+        old_taxa = taxa[0:10]
+        new_taxa = [None,taxa[20]]+taxa[11:19]
+        self.assert_(substitute_taxa(XML,old_taxa,new_taxa,n_jobs=2) == substitute_taxa(XML,old_taxa,new_taxa))
+        trees = obtain_trees(XML).values()
+        self.assert_(substitute_taxa_in_trees(trees,old_taxa,new_taxa,n_jobs=2) == substitute_taxa_in_trees(trees,old_taxa,new_taxa))
+
+    def test_uninformative(self):
+        XML = etree.tostring(etree.parse('data/input/check_data_ind.phyml',parser),pretty_print=True)
+        XML = XML.replace("(Taxon_a,Taxon_b)","((Taxon_a,Taxon_b),Taxon_c)",1)
+        try:
+            _check_informative_trees(XML)
+            serial = None
+        except excp.UninformativeTreeError as detail:
+            serial = detail.msg
+        try:
+            _check_informative_trees(XML,n_jobs=2)
+            parallel = None
+        except excp.UninformativeTreeError as detail:
+            parallel = detail.msg
+        self.assert_(serial == parallel)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import math
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import obtain_trees, get_all_taxa, _swap_tree_in_XML, add_weights, get_weights
+from stk.supertree_toolkit import get_all_source_names, substitute_taxa
+from stk.stk_phyml import PhymlDataset, get_dataset, editable_dataset, clear_dataset_cache
+import stk.stk_exceptions as excp
+import os
+from lxml import etree
+from util import *
+# our test dataset
+
+single_source_input = "data/input/single_source.phyml"
+parser = etree.XMLParser(remove_blank_text=True)
+
+class TestPhymlDataset(unittest.TestCase):
+
+    def test_trees_match_obtain_trees(self):
+        XML = etree.tostring(etree.parse('data/input/create_matrix.phyml',parser),pretty_print=True)
+        dataset = PhymlDataset(XML)
+        trees = dataset.trees()
+        self.assert_(len(trees) == 3)
+        self.assert_(trees == obtain_trees(XML))
+        self.assert_(dataset.source_names() == get_all_source_names(XML))
+
+    def test_unnamed_trees(self):
+        XML = etree.tostring(etree.parse('data/input/create_matrix.phyml',parser),pretty_print=True)
+        xml_root = etree.fromstring(XML)
+        for st in xml_root.iter("source_tree"):
+            del st.attrib['name']
+        dataset = PhymlDataset(xml_root=xml_root)
+        names = dataset.source_tree_names()
+        self.assert_(len(names) == 3)
+        self.assert_(names[0] == get_all_source_names(XML)[0]+"_1")
+        # the document itself is not altered
+        self.assert_(etree.tostring(xml_root).find("source_tree name=") == -1)
+        self.assert_(not dataset.has_unique_tree(names[0]))
+
+    def test_taxa_index(self):
+        XML = etree.tostring(etree.parse('data/input/create_matrix.phyml',parser),pretty_print=True)
+        dataset = PhymlDataset(XML)
+        taxa = dataset.all_taxa()
+        taxa.sort()
+        self.assert_(taxa == get_all_taxa(XML))
+        for t in taxa:
+            for name in dataset.trees_containing(t):
+                self.assert_(t in dataset.tree_taxa(name))
+        self.assert_(dataset.trees_containing("Not_a_taxon") == [])
+
+    def test_swap_tree(self):
+        XML = etree.tostring(etree.parse(single_source_input,parser),pretty_print=True)
+        dataset = PhymlDataset(XML)
+        name = dataset.source_tree_names()[0]
+        dataset.set_tree_string(name,"(a,(b,c));")
+        self.assert_(dataset.tree_taxa(name) == ['a','b','c'])
+        self.assert_(dataset.trees_containing('b') == [name])
+        # the string function gives the same document
+        new_xml = _swap_tree_in_XML(XML,"(a,(b,c));",name)
+        self.assert_(new_xml == dataset.tostring())
+
+    def test_remove_tree(self):
+        XML = etree.tostring(etree.parse(single_source_input,parser),pretty_print=True)
+        dataset = PhymlDataset(XML)
+        name = dataset.source_tree_names()[0]
+        dataset.remove_tree(name,delete_empty_source=True)
+        self.assert_(dataset.trees() == {})
+        self.assert_(dataset.source_names() == [])
+        self.assertRaises(excp.InvalidSTKData,dataset.tree_string,name)
+
+    def test_weights(self):
+        XML = etree.tostring(etree.parse('data/input/create_matrix.phyml',parser),pretty_print=True)
+        dataset = PhymlDataset(XML)
+        name = dataset.source_tree_names()[0]
+        dataset.set_tree_weight(name,0.5)
+        new_xml = add_weights(XML,[name],0.5)
+        self.assert_(new_xml == dataset.tostring())
+        self.assert_(get_weights(dataset)[name] == 1.0)
+
+    def test_cache(self):
+        clear_dataset_cache()
+        XML = etree.tostring(etree.parse('data/input/create_matrix.phyml',parser),pretty_print=True)
+        dataset = get_dataset(XML)
+        self.assert_(get_dataset(XML) is dataset)
+        self.assert_(get_dataset(dataset) is dataset)
+        # editing a copy doesn't touch the cached one
+        copy = editable_dataset(XML)
+        self.assert_(not copy is dataset)
+        name = copy.source_tree_names()[0]
+        copy.set_tree_string(name,"(a,(b,c));")
+        self.assert_(not dataset.tree_string(name) == "(a,(b,c));")
+        # results of edits are cached against the new XML
+        new_xml = _swap_tree_in_XML(XML,"(a,(b,c));",name)
+        self.assert_(obtain_trees(new_xml)[name] == "(a,(b,c));")
+        self.assert_(obtain_trees(XML)[name] == dataset.tree_string(name))
+
+    def test_dataset_in_dataset_out(self):
+        XML = etree.tostring(etree.parse('data/input/create_matrix.phyml',parser),pretty_print=True)
+        dataset = PhymlDataset(XML)
+        result = substitute_taxa(dataset,"A","Z",ignoreWarnings=True)
+        self.assert_(result is dataset)
+        self.assert_(result.tostring() == substitute_taxa(XML,"A","Z",ignoreWarnings=True))
+        self.assert_("Z" in result.all_taxa())
+        self.assert_(not "A" in result.all_taxa())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+import stk.stk_pipeline as stk_pipeline
+from stk.stk_pipeline import Pipeline, hash_value
+import os
+import tempfile
+import shutil
+import StringIO
+from util import *
+
+class _Failure(Exception):
+    pass
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint_dir = os.path.join(self.tmpdir,"checkpoints")
+        self.input_file = os.path.join(self.tmpdir,"input.txt")
+        f = open(self.input_file,"w")
+        f.write("Gallus gallus")
+        f.close()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _pipeline(self, scale=2, fail_at=None, restart=False):
+        calls = self.calls
+        input_file = self.input_file
+        def load(state):
+            calls.append("load")
+            return {'data':open(input_file).read()}
+        def upper(state):
+            calls.append("upper")
+            if (fail_at == "upper"):
+                raise _Failure()
+            return {'data':state['data'].upper()}
+        def repeat(state):
+            calls.append("repeat")
+            if (fail_at == "repeat"):
+                raise KeyboardInterrupt()
+            return {'data':state['data']*scale}
+        out = StringIO.StringIO()
+        pipeline = Pipeline(checkpoint_dir=self.checkpoint_dir,restart=restart,out=out)
+        pipeline.add("load",load,files=[input_file])
+        pipeline.add("upper",upper)
+        pipeline.add("repeat",repeat,options={'scale':scale})
+        return pipeline, out
+
+    def test_hash_value(self):
+        self.assert_(hash_value({'a':1,'b':[1,"2"]}) == hash_value({'b':[1,"2"],'a':1}))
+        self.assert_(not hash_value([1,"2"]) == hash_value(["1",2]))
+        self.assert_(not hash_value(None) == hash_value("None"))
+
+    def test_rerun_cached(self):
+        pipeline, out = self._pipeline()
+        state = pipeline.run()
+        self.assert_(state['data'] == "GALLUS GALLUSGALLUS GALLUS")
+        self.assert_(self.calls == ["load","upper","repeat"])
+        self.assert_("Stage 3/3 (repeat): " in out.getvalue())
+        # second time round, nothing is run
+        pipeline, out = self._pipeline()
+        self.assert_(pipeline.run() == state)
+        self.assert_(self.calls == ["load","upper","repeat"])
+        self.assert_([t[2] for t in pipeline.timings] == [True,True,True])
+        self.assert_("using saved results" in out.getvalue())
+
+    def test_option_changed(self):
+        pipeline, out = self._pipeline()
+        pipeline.run()
+        self.calls[:] = []
+        pipeline, out = self._pipeline(scale=3)
+        state = pipeline.run()
+        self.assert_(state['data'] == "GALLUS GALLUS"*3)
+        self.assert_(self.calls == ["repeat"])
+
+    def test_file_changed(self):
+        pipeline, out = self._pipeline()
+        pipeline.run()
+        self.calls[:] = []
+        f = open(self.input_file,"w")
+        f.write("Struthio camelus")
+        f.close()
+        pipeline, out = self._pipeline()
+        state = pipeline.run()
+        self.assert_(state['data'] == "STRUTHIO CAMELUS"*2)
+        self.assert_(self.calls == ["load","upper","repeat"])
+
+    def test_resume(self):
+        pipeline, out = self._pipeline(fail_at="upper")
+        self.assertRaises(_Failure,pipeline.run)
+        self.calls[:] = []
+        pipeline, out = self._pipeline()
+        state = pipeline.run()
+        self.assert_(state['data'] == "GALLUS GALLUS"*2)
+        self.assert_(self.calls == ["upper","repeat"])
+
+    def test_interrupted(self):
+        pipeline, out = self._pipeline(fail_at="repeat")
+        self.assertRaises(KeyboardInterrupt,pipeline.run)
+        self.assert_("Interrupted during stage 3 (repeat)" in out.getvalue())
+        self.calls[:] = []
+        pipeline, out = self._pipeline()
+        pipeline.run()
+        self.assert_(self.calls == ["repeat"])
+
+    def test_restart(self):
+        pipeline, out = self._pipeline()
+        pipeline.run()
+        self.calls[:] = []
+        pipeline, out = self._pipeline(restart=True)
+        pipeline.run()
+        self.assert_(self.calls == ["load","upper","repeat"])
+        pipeline.clear()
+        self.assert_(os.listdir(self.checkpoint_dir) == [])
+
+    def test_no_checkpoints(self):
+        pipeline = Pipeline(out=StringIO.StringIO())
+        pipeline.add("one",lambda state: {'n':1})
+        self.assert_(pipeline.run() == {'n':1})
+        self.assert_(not os.path.exists(self.checkpoint_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
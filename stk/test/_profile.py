@@ -0,0 +1,95 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+import stk.stk_profile as stk_profile
+import stk.stk_newick as stk_newick
+from stk.stk_pipeline import Pipeline
+from stk.supertree_toolkit import create_matrix
+import StringIO
+import simplejson as json
+from lxml import etree
+from util import *
+parser = etree.XMLParser(remove_blank_text=True)
+
+class TestProfile(unittest.TestCase):
+
+    def tearDown(self):
+        stk_profile.disable()
+        stk_profile.reset()
+
+    def test_disabled(self):
+        stk_profile.count("things")
+        with stk_profile.timer("work"):
+            pass
+        with stk_profile.stage("stage"):
+            pass
+        summary = stk_profile.summary()
+        self.assert_(summary == {'counters':{}, 'timers':{}, 'stages':[]})
+
+    def test_counters_and_timers(self):
+        stk_profile.enable()
+        stk_profile.count("things")
+        stk_profile.count("things",4)
+        for i in range(3):
+            with stk_profile.timer("work"):
+                pass
+        @stk_profile.timed("decorated")
+        def f(x):
+            return x*2
+        self.assert_(f(2) == 4)
+        summary = stk_profile.summary()
+        self.assert_(summary['counters'] == {'things':5})
+        self.assert_(summary['timers']['work']['calls'] == 3)
+        self.assert_(summary['timers']['decorated']['calls'] == 1)
+        # enabling again starts from zero
+        stk_profile.enable()
+        self.assert_(stk_profile.summary()['counters'] == {})
+
+    def test_stages(self):
+        stk_profile.enable()
+        stk_profile.count("before")
+        with stk_profile.stage("outer"):
+            stk_profile.count("things")
+            with stk_profile.stage("inner"):
+                stk_profile.count("things",2)
+                with stk_profile.timer("work"):
+                    pass
+        stages = stk_profile.summary()['stages']
+        self.assert_([(s['name'],s['depth']) for s in stages] == [("outer",0),("inner",1)])
+        self.assert_(stages[0]['counters'] == {'things':3})
+        self.assert_(stages[1]['counters'] == {'things':2})
+        self.assert_(stages[1]['timers']['work']['calls'] == 1)
+        # and it can all be saved
+        json.loads(json.dumps(stk_profile.summary()))
+        out = StringIO.StringIO()
+        stk_profile.report(out)
+        self.assert_("  inner" in out.getvalue())
+
+    def test_hot_paths(self):
+        stk_profile.enable()
+        stk_newick.tree_cache.invalidate()
+        XML = etree.tostring(etree.parse('data/input/create_matrix.phyml',parser),pretty_print=True)
+        with stk_profile.stage("matrix"):
+            create_matrix(XML,ignoreWarnings=True)
+        stage = stk_profile.summary()['stages'][0]
+        self.assert_(stage['timers']['xml parse']['calls'] > 0)
+        self.assert_(stage['timers']['tree parse']['calls'] > 0)
+        self.assert_(stage['counters']['tree cache misses'] > 0)
+        self.assert_(stage['counters']['matrix cells written'] > 0)
+        stk_newick.parse_tree("#NEXUS\nbegin trees;\ntree t = (A,(B,C));\nend;\n")
+        self.assert_(stk_profile.summary()['timers']['p4 read']['calls'] == 1)
+
+    def test_pipeline_stages(self):
+        stk_profile.enable()
+        pipeline = Pipeline(out=StringIO.StringIO())
+        pipeline.add("one",lambda state: stk_profile.count("ones") or {'n':1})
+        pipeline.add("two",lambda state: {'n':2})
+        pipeline.run()
+        stages = stk_profile.summary()['stages']
+        self.assert_([s['name'] for s in stages] == ["one","two"])
+        self.assert_(stages[0]['counters'] == {'ones':1})
+
+
+if __name__ == '__main__':
+    unittest.main()
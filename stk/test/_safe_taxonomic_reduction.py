@@ -0,0 +1,117 @@
+import unittest
+import math
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import safe_taxonomic_reduction, read_matrix, subs_file_from_str
+import stk.stk_str as stk_str
+import os
+import numpy
+from lxml import etree
+from util import *
+
+parser = etree.XMLParser(remove_blank_text=True)
+
+def _old_equivalents(matrix, taxa):
+    """ The character by character comparison STR used to do
+    """
+    missing_char = "?"
+    nChars = len(matrix[0])
+    missing_chars = [list(matrix[t]).count(missing_char) for t in range(len(taxa))]
+    equivs = []
+    for t1 in range(len(taxa)):
+        equiv_taxa = []
+        for t2 in range(len(taxa)):
+            if (taxa[t1] == taxa[t2]):
+                continue
+            NonEquiv = 0
+            xMissing = yMissing = xMiss_yCode = xCode_yMiss = 0
+            Symmetric = 1
+            for i in range(nChars):
+                char1 = matrix[t1][i]
+                char2 = matrix[t2][i]
+                if ((char1 != missing_char) and (char2 != missing_char)):
+                    if (char1 != char2):
+                        NonEquiv = 1
+                elif ((char1 == missing_char) and (char2 != missing_char)):
+                    xMissing = xMiss_yCode = 1
+                    Symmetric = 0
+                elif ((char1 != missing_char) and (char2 == missing_char)):
+                    yMissing = xCode_yMiss = 1
+                    Symmetric = 0
+                else:
+                    xMissing = yMissing = 1
+            if (NonEquiv == 1):
+                continue
+            if (Symmetric == 1):
+                if (xMissing == 0 and yMissing == 0):
+                    cls = "A"
+                else:
+                    cls = "B"
+            elif (xMissing == 0 and yMissing == 1):
+                cls = "C"
+            elif (xMissing == 1 and yMissing == 0):
+                cls = "E"
+            elif (xCode_yMiss == 1 and xMiss_yCode == 1):
+                cls = "D"
+            elif (xMiss_yCode == 0):
+                cls = "C"
+            else:
+                cls = "E"
+            equiv_taxa.append([taxa[t2],cls,missing_chars[t2]])
+        equivs.append(equiv_taxa)
+    return equivs, missing_chars
+
+def _random_matrix(nTaxa, nChars, states, seed):
+    rand = numpy.random.RandomState(seed)
+    # few distinct rows, so there is something to find
+    base = rand.choice(list(states),size=(4,nChars))
+    matrix = base[rand.randint(0,4,size=nTaxa)]
+    mask = rand.random_sample((nTaxa,nChars)) < 0.3
+    matrix[mask] = '?'
+    return matrix, ["t"+str(i) for i in range(nTaxa)]
+
+
+class TestSTREngine(unittest.TestCase):
+
+    def test_same_as_old_binary(self):
+        for seed in range(5):
+            matrix, taxa = _random_matrix(30,13,"01",seed)
+            self.assert_(stk_str.equivalent_taxa(matrix,taxa) == _old_equivalents(matrix,taxa))
+
+    def test_same_as_old_multistate(self):
+        matrix, taxa = _random_matrix(25,20,"0123-",42)
+        self.assert_(stk_str.equivalent_taxa(matrix,taxa) == _old_equivalents(matrix,taxa))
+
+    def test_blocks(self):
+        matrix, taxa = _random_matrix(40,17,"01",7)
+        expected = _old_equivalents(matrix,taxa)
+        for block_size in [1,3,40,100]:
+            self.assert_(stk_str.equivalent_taxa(matrix,taxa,block_size=block_size) == expected)
+
+    def test_pool(self):
+        matrix, taxa = _random_matrix(40,17,"01",3)
+        expected = _old_equivalents(matrix,taxa)
+        self.assert_(stk_str.equivalent_taxa(matrix,taxa,n_jobs=2,block_size=7) == expected)
+
+    def test_missing_count(self):
+        matrix = [['0','?','1','?','?','?','?','?','?'],['1','1','1','1','1','1','1','1','1']]
+        coded, state_planes, missing = stk_str.bit_planes(matrix)
+        self.assert_(missing == [7,0])
+        self.assert_(len(state_planes) == 1)
+        self.assert_(coded.shape == (2,2))
+
+    def test_str_output_with_jobs(self):
+        XML = etree.tostring(etree.parse('data/input/create_matrix.phyml',parser),pretty_print=True)
+        output, can_replace = safe_taxonomic_reduction(XML)
+        output_jobs, can_replace_jobs = safe_taxonomic_reduction(XML,n_jobs=2,block_size=2)
+        self.assert_(output == output_jobs)
+        self.assert_(can_replace == can_replace_jobs)
+        matrix,taxa = read_matrix("data/input/matrix.nex")
+        output, can_replace = safe_taxonomic_reduction(XML=None,matrix=matrix,taxa=taxa,n_jobs=2,block_size=1)
+        self.assertListEqual(["B","B_b","D","F"],can_replace)
+        self.assertListEqual(['A = B,B_b,A'],subs_file_from_str(output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import dataset_statistics, data_summary, obtain_trees, get_all_taxa, get_all_characters
+from stk.supertree_toolkit import get_character_numbers, get_fossil_taxa, get_publication_years, get_analyses_used
+import stk.stk_statistics as stk_statistics
+import stk.stk_phyml as stk_phyml
+from stk.stk_exceptions import *
+from lxml import etree
+from util import *
+parser = etree.XMLParser(remove_blank_text=True)
+
+class TestStatistics(unittest.TestCase):
+
+    def test_same_as_get_functions(self):
+        for f in ['data/input/check_fossils.phyml','data/input/old_stk_input.phyml','data/input/sub_taxa.phyml']:
+            XML = etree.tostring(etree.parse(f,parser),pretty_print=True)
+            stats = dataset_statistics(XML)
+            self.assertDictEqual(stats.trees,obtain_trees(XML))
+            self.assertListEqual(stats.taxa,get_all_taxa(XML,ignoreErrors=True))
+            self.assertDictEqual(stats.characters,get_all_characters(XML,ignoreErrors=True))
+            self.assertDictEqual(stats.character_numbers,dict(get_character_numbers(XML,ignoreErrors=True)))
+            self.assertListEqual(stats.fossils,get_fossil_taxa(XML))
+            self.assertDictEqual(stats.publication_years,dict(get_publication_years(XML)))
+            self.assertListEqual(stats.analyses,get_analyses_used(XML,ignoreErrors=True))
+
+    def test_summary(self):
+        XML = etree.tostring(etree.parse('data/input/check_fossils.phyml',parser),pretty_print=True)
+        stats = dataset_statistics(XML)
+        self.assert_(stats.project_name == "matrix_test")
+        self.assert_(stats.fossils == ["A","B"])
+        self.assert_(stats.summary() == data_summary(XML))
+        self.assert_(stats.summary(detailed=True) == data_summary(XML,detailed=True))
+        self.assertRegexpMatches(stats.summary(),'Number of trees: 3')
+
+    def test_incomplete_years(self):
+        XML = etree.tostring(etree.parse('data/input/check_fossils.phyml',parser),pretty_print=True)
+        xml_root = etree.fromstring(XML)
+        years = xml_root.xpath("//year")
+        years[0].remove(years[0].find("integer_value"))
+        years[1].find("integer_value").text = "in press"
+        stats = dataset_statistics(etree.tostring(xml_root))
+        self.assert_(sum(stats.publication_years.values()) == len(years)-2)
+        self.assert_(stats.characters.keys() == sorted(stats.characters.keys()))
+        self.assertRegexpMatches(stats.summary(detailed=True),'Number of trees: 3')
+
+    def test_remembered(self):
+        XML = etree.tostring(etree.parse('data/input/check_fossils.phyml',parser),pretty_print=True)
+        stk_statistics.clear_statistics_cache()
+        stats = dataset_statistics(XML)
+        self.assert_(dataset_statistics(XML) is stats)
+        # same content, different object
+        self.assert_(dataset_statistics(str(bytearray(XML))) is stats)
+        self.assert_(dataset_statistics(stk_phyml.PhymlDataset(XML)).taxa == stats.taxa)
+        stk_statistics.clear_statistics_cache()
+        self.assert_(not dataset_statistics(XML) is stats)
+        # different data, different statistics
+        xml_root = etree.fromstring(XML)
+        xml_root.xpath("//character")[0].attrib['name'] = "Something_new"
+        self.assert_('Something_new' in dataset_statistics(etree.tostring(xml_root)).character_numbers)
+        self.assert_(not 'Something_new' in stats.character_numbers)
+
+
+if __name__ == '__main__':
+    unittest.main()
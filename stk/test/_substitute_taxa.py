@@ -10,7 +10,7 @@ from stk.supertree_toolkit import parse_subs_file, _check_data, _sub_taxa_in_tre
 from stk.supertree_toolkit import check_subs, _tree_contains, _correctly_quote_taxa, _remove_single_poly_taxa
 from stk.supertree_toolkit import _swap_tree_in_XML, substitute_taxa, get_all_taxa, _parse_tree, _delete_taxon
 from stk.supertree_toolkit import _collapse_nodes, import_tree, subs_from_csv, _getTaxaFromNewick, obtain_trees
-from stk.supertree_toolkit import generate_species_level_data
+from stk.supertree_toolkit import generate_species_level_data, _compile_sub_table
 from lxml import etree
 from util import *
 from stk.stk_exceptions import *
@@ -795,6 +795,28 @@ class TestSubs(unittest.TestCase):
         for t in trees:
             self.assert_(_trees_equal(trees[t], expected_trees[t]))
 
+    def test_auto_subs_dry_run(self):
+        XML = etree.tostring(etree.parse('data/input/auto_sub.phyml',parser),pretty_print=True)
+        taxonomy = {'Gallus': {'genus': 'Gallus', 'order': 'Galliformes'},
+                    'Gallus_varius': {'species': 'Gallus varius', 'genus': 'Gallus', 'order': 'Galliformes'},
+                    'Gallus_lafayetii': {'species': 'Gallus lafayetii', 'genus': 'Gallus', 'order': 'Galliformes'},
+                    'Pelecaniformes': {'order': 'Pelecaniformes'},
+                    'Platalea_leucorodia': {'species': 'Platalea leucorodia', 'genus': 'Platalea', 'order': 'Pelecaniformes'},
+                    'Ardea_goliath': {'species': 'Ardea goliath', 'genus': 'Ardea', 'order': 'Pelecaniformes'},
+                    'Ardea_humbloti': {'species': 'Ardea humbloti', 'genus': 'Ardea', 'order': 'Pelecaniformes'},
+                    'Thalassarche_melanophris': {'species': 'Thalassarche melanophris', 'genus': 'Thalassarche'}}
+        old_taxa, new_taxa = generate_species_level_data(XML, taxonomy, dry_run=True)
+        self.assertListEqual(old_taxa,['Gallus','Pelecaniformes'])
+        self.assertListEqual(new_taxa,['Gallus_lafayetii,Gallus_varius','Ardea_goliath,Ardea_humbloti,Platalea_leucorodia'])
+        # and with the taxa as create_taxonomy gives them
+        taxonomy = dict([(t.replace("_"," "),taxonomy[t]) for t in taxonomy])
+        self.assert_(generate_species_level_data(XML, taxonomy, dry_run=True) == (old_taxa, new_taxa))
+        # unless they are missing
+        del taxonomy['Gallus']
+        self.assertRaises(NoneCompleteTaxonomy,generate_species_level_data,XML,taxonomy,dry_run=True)
+        old_taxa, new_taxa = generate_species_level_data(XML, taxonomy, dry_run=True, ignoreWarnings=True)
+        self.assertListEqual(old_taxa,['Pelecaniformes'])
+
     def test_parrot_edge_case(self):
         """Random edge case where the tree dissappeared..."""
         trees = ["(((((((Agapornis_lilianae, Agapornis_nigrigenis), Agapornis_personata, Agapornis_fischeri), Agapornis_roseicollis), (Agapornis_pullaria, Agapornis_taranta)), Agapornis_cana), Loriculus_galgulus), Geopsittacus_occidentalis);"]
@@ -804,6 +826,23 @@ class TestSubs(unittest.TestCase):
         new_trees = substitute_taxa_in_trees(trees,old_taxa,new_taxa=new_taxa)
         self.assert_(answer, new_trees[0])
 
+    def test_sub_table(self):
+        sub_table = _compile_sub_table(["A a","B","A_a","'C'"])
+        self.assert_(sub_table == {'A_a':[0,2],'B':[1],'C':[3]})
+
+    def test_chained_subs(self):
+        # A becomes B, which is then replaced by E, as the subs are applied in order
+        new_tree = _sub_taxa_in_tree("((A,B),(C,D));",['A','B'],['B','E'])
+        self.assert_(new_tree == "(E, (C, D));")
+        # but not the other way round
+        new_tree = _sub_taxa_in_tree("((A,B),(C,D));",['B','A'],['E','B'])
+        self.assert_(new_tree == "((B, E), (C, D));")
+
+    def test_subs_not_in_tree(self):
+        sub_table = _compile_sub_table(['X','Y','A'])
+        new_tree = _sub_taxa_in_tree("((A%1,B),(A%2,D));",['X','Y','A'],['B','E',None],sub_table=sub_table)
+        self.assert_(new_tree == "(B, D);")
+
 if __name__ == '__main__':
     unittest.main()
  
@@ -13,7 +13,9 @@ from stk.supertree_toolkit import data_overlap, read_matrix, subs_file_from_str,
 from stk.supertree_toolkit import add_historical_event, _sort_data, _parse_xml, _check_sources, _swap_tree_in_XML, replace_genera
 from stk.supertree_toolkit import get_all_taxa, _get_all_siblings, _parse_tree, get_characters_used, _trees_equal, get_weights
 from stk.supertree_toolkit import get_outgroup, set_all_tree_names, create_tree_name, taxonomic_checker, load_taxonomy, load_equivalents
-from stk.supertree_toolkit import create_taxonomy, create_taxonomy_from_tree, get_all_tree_names
+from stk.supertree_toolkit import create_taxonomy, create_taxonomy_from_tree, get_all_tree_names, _overlap_edges, _connected_trees
+from stk.supertree_toolkit import tree_fingerprint, find_duplicate_trees
+from stk.stk_tree_store import TreeStore
 from lxml import etree
 from util import *
 from stk.stk_exceptions import *
@@ -287,6 +289,26 @@ class TestSTK(unittest.TestCase):
         # check that the first tree is removed
         self.assertNotRegexpMatches(new_xml,re.escape('((A:1.00000,B:1.00000)0.00000:0.00000,(F:1.00000,E:1.00000)0.00000:0.00000)0.00000:0.00000;'))
 
+    def test_tree_fingerprint(self):
+        # order of children and branch lengths don't matter
+        self.assert_(tree_fingerprint("((A,B),(C,D));") == tree_fingerprint("((D,C),(B:1.0,A:2.0));"))
+        # unrooted, as the RF distance is
+        self.assert_(tree_fingerprint("(A,(B,(C,D)));") == tree_fingerprint("(B,(A,(C,D)));"))
+        # but the root has to have the same number of children
+        self.assert_(not tree_fingerprint("(A,B,C);") == tree_fingerprint("((A,B),C);"))
+        self.assert_(not tree_fingerprint("((A,B),(C,D));") == tree_fingerprint("((A,C),(B,D));"))
+        self.assert_(not tree_fingerprint("((A,B),(C,D));") == tree_fingerprint("((A,B),(C,E));"))
+        self.assert_(_trees_equal("((A,B),(C,D));","((D,C),(B,A));"))
+
+    def test_find_duplicate_trees(self):
+        XML = etree.tostring(etree.parse('data/input/check_data_ind.phyml',parser),pretty_print=True)
+        expected = [['Hill_Davis_2011_1', 'Hill_Davis_2011_2', 'Hill_Davis_2011_3'], ['Hill_Davis_2013_1', 'Hill_Davis_2013_2']]
+        self.assertListEqual(expected, find_duplicate_trees(XML))
+        store = TreeStore()
+        self.assertListEqual(expected, find_duplicate_trees(XML,store=store))
+        self.assertListEqual(expected, find_duplicate_trees(XML,store=store))
+        self.assert_(store.hits > 0)
+
     def test_add_weights(self):
         """Add weights to a bunch of trees"""
         XML = etree.tostring(etree.parse('data/input/check_data_ind.phyml',parser),pretty_print=True)
@@ -332,6 +354,23 @@ class TestSTK(unittest.TestCase):
         self.assert_(overlap_ok)
         os.remove(temp_file)
 
+    def test_overlap_edges(self):
+        taxa_lists = [['A','B','C'],['B','C','D'],['D','E'],['F'],['A','C','E','A']]
+        self.assert_(_overlap_edges(taxa_lists,2) == [(0,1),(0,4)])
+        self.assert_(_overlap_edges(taxa_lists,1) == [(0,1),(0,4),(1,2),(1,4),(2,4)])
+        self.assert_(_overlap_edges(taxa_lists,3) == [])
+        self.assert_(_overlap_edges([],2) == [])
+
+    def test_connected_trees(self):
+        import networkx as nx
+        tree_keys = ["tree_"+str(i) for i in range(20)]
+        edges = [(0,5),(5,9),(2,3),(11,19),(3,12),(7,8),(8,15),(15,7)]
+        G = nx.Graph()
+        G.add_nodes_from(tree_keys)
+        for i, j in edges:
+            G.add_edge(tree_keys[i],tree_keys[j])
+        self.assert_(_connected_trees(tree_keys,edges) == list(nx.connected_components(G)))
+
     def test_data_overlap_against_old_stk(self):
         XML = etree.tostring(etree.parse('data/input/old_stk_input.phyml',parser),pretty_print=True)
         # Note - we also test PDF output is OK
@@ -503,6 +542,14 @@ class TestSTK(unittest.TestCase):
         self.assertListEqual(expected_genera,generic)
         self.assertListEqual(expected_subs,subs)
 
+    def test_replace_genera_names(self):
+        # only species whose names start with the genus are in it
+        XML = etree.tostring(etree.parse('data/input/old_stk_input.phyml',parser),pretty_print=True)
+        XML = _swap_tree_in_XML(XML,"(Larus, (Gallusia_sp, ('Larus, sp. nov.', Gallus)));","Aleixo_2002_1")
+        XML,generic,subs = replace_genera(XML,dry_run=True,ignoreWarnings=True)
+        self.assertListEqual(['Gallus','Larus','Struthio'],generic)
+        self.assertListEqual(["Gallus_gallus","'Larus,_sp._nov.',Larus_argentatus,Larus_marinus","Struthio_camelus"],subs)
+
     def test_replace_genera2(self):
         XML = etree.tostring(etree.parse('data/input/old_stk_input.phyml',parser),pretty_print=True)
         XML,generic,subs = replace_genera(XML)
@@ -0,0 +1,56 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import _check_data, obtain_trees, get_all_taxa, get_weights, get_all_source_names
+from stk.stk_synthetic import synthetic_phyml, random_tree, taxon_name
+from stk.supertree_toolkit import _getTaxaFromNewick
+import os
+import random
+from lxml import etree
+from util import *
+
+class TestSynthetic(unittest.TestCase):
+
+    def test_valid(self):
+        XML = synthetic_phyml(n_sources=20,n_trees=50,n_taxa=200,taxa_per_tree=15,
+                              non_monophyletic=0.2,weighted=0.2)
+        _check_data(XML)
+        schema = etree.RelaxNG(etree.parse(os.path.join("../../schema","phylo_storage.rng")))
+        self.assert_(schema.validate(etree.fromstring(XML)))
+        trees = obtain_trees(XML)
+        self.assert_(len(trees) == 50)
+        self.assert_(len(get_all_source_names(XML)) == 20)
+        for t in trees.values():
+            self.assert_(len(_getTaxaFromNewick(t)) in [15,16])
+        self.assert_(len([t for t in trees.values() if "%" in t]) > 0)
+        self.assert_(len(get_weights(XML)) == 50)
+        self.assert_(len(set(get_weights(XML).values())) > 1)
+
+    def test_same_each_time(self):
+        self.assert_(synthetic_phyml(seed=3) == synthetic_phyml(seed=3))
+        self.assert_(not synthetic_phyml(seed=3) == synthetic_phyml(seed=4))
+
+    def test_overlap(self):
+        # every tree has the same taxa if they all come from the core
+        XML = synthetic_phyml(n_sources=5,taxa_per_tree=10,overlap=1.0,non_monophyletic=0)
+        taxa = get_all_taxa(XML)
+        self.assert_(taxa == sorted([taxon_name(i) for i in range(10)]))
+        XML = synthetic_phyml(n_sources=5,taxa_per_tree=10,overlap=0.0,non_monophyletic=0)
+        self.assert_(len(get_all_taxa(XML)) > 10)
+
+    def test_more_sources_than_trees(self):
+        XML = synthetic_phyml(n_sources=10,n_trees=4)
+        _check_data(XML)
+        self.assert_(len(get_all_source_names(XML)) == 4)
+
+    def test_random_tree(self):
+        taxa = ["A","B","C","D","E"]
+        tree = random_tree(taxa,random.Random(1))
+        self.assert_(sorted(_getTaxaFromNewick(tree)) == taxa)
+        # fully resolved
+        self.assert_(tree.count("(") == len(taxa)-1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import load_taxonomy, save_taxonomy
+import stk.stk_taxonomy as stk_taxonomy
+from stk.stk_taxonomy import Taxonomy
+from stk.stk_taxonomy_index import TaxonomyIndex
+from stk.stk_exceptions import *
+import os
+import tempfile
+import shutil
+import numpy
+from util import *
+
+csv_file = "data/input/create_taxonomy.csv"
+
+class TestTaxonomy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_like_a_dict(self):
+        expected = load_taxonomy(csv_file)
+        taxonomy = load_taxonomy(csv_file,compact=True)
+        self.assert_(isinstance(taxonomy,Taxonomy))
+        self.assert_(taxonomy == expected)
+        self.assert_(len(taxonomy) == 5)
+        self.assertDictEqual(taxonomy['Gallus_gallus'],expected['Gallus_gallus'])
+        self.assert_(taxonomy.get_rank('Gallus_gallus','genus') == 'Gallus')
+        self.assert_(taxonomy.get_rank('Gallus_gallus','tribe') == None)
+        self.assert_(not 'Gallus gallus' in taxonomy)
+        # entries are copies, so are assigned back
+        entry = taxonomy['Gallus_gallus']
+        entry['tribe'] = 'Gallini'
+        del entry['superorder']
+        self.assert_(not 'tribe' in taxonomy['Gallus_gallus'])
+        taxonomy['Gallus_gallus'] = entry
+        self.assertDictEqual(taxonomy['Gallus_gallus'],entry)
+        self.assert_(taxonomy['Egretta_tricolor'] == expected['Egretta_tricolor'])
+        del taxonomy['Egretta_tricolor']
+        self.assert_(len(taxonomy) == 4)
+        self.assertRaises(KeyError,taxonomy.__getitem__,'Egretta_tricolor')
+        # names are held once
+        self.assert_(taxonomy['Gallus_gallus']['class'] is taxonomy['Thalassarche_melanophris']['class'])
+        self.assert_(TaxonomyIndex(taxonomy).members('Aves') == TaxonomyIndex(expected).members('Aves') - set(['Egretta_tricolor']))
+
+    def test_malformed_rows(self):
+        filename = os.path.join(self.tmpdir,"bad.csv")
+        lines = open(csv_file).readlines()
+        lines.insert(2,"Not_enough,columns\n")
+        lines.append("\n")
+        # a later row replaces an earlier one
+        lines.append(lines[1].replace("Archaeopteryx,","Archaeopteryxx,"))
+        f = open(filename,"w")
+        f.write("".join(lines))
+        f.close()
+        taxonomy = stk_taxonomy.read_csv(filename)
+        self.assert_(len(taxonomy.malformed) == 1)
+        self.assert_(taxonomy.malformed[0][0] == 3)
+        self.assert_(len(taxonomy) == 5)
+        self.assert_(taxonomy['Archaeopteryx_lithographica']['genus'] == 'Archaeopteryxx')
+        self.assert_(taxonomy['Gallus_gallus'] == load_taxonomy(csv_file)['Gallus_gallus'])
+        # and the same into a dictionary
+        as_dict, malformed = stk_taxonomy.read_csv_dict(filename)
+        self.assert_(isinstance(as_dict,dict))
+        self.assert_(malformed == taxonomy.malformed)
+        self.assert_(taxonomy == as_dict)
+
+    def test_save(self):
+        expected = load_taxonomy(csv_file)
+        taxonomy = load_taxonomy(csv_file,compact=True)
+        from_dict = os.path.join(self.tmpdir,"dict.csv")
+        from_taxonomy = os.path.join(self.tmpdir,"taxonomy.csv")
+        save_taxonomy(expected,from_dict)
+        save_taxonomy(taxonomy,from_taxonomy)
+        self.assert_(sorted(open(from_dict).readlines()) == sorted(open(from_taxonomy).readlines()))
+        self.assert_(load_taxonomy(from_taxonomy) == expected)
+
+    def test_snapshot(self):
+        expected = load_taxonomy(csv_file)
+        filename = os.path.join(self.tmpdir,"taxonomy.stktax")
+        save_taxonomy(expected,filename)
+        self.assert_(stk_taxonomy.is_snapshot(filename))
+        self.assert_(not stk_taxonomy.is_snapshot(csv_file))
+        taxonomy = load_taxonomy(filename,compact=True)
+        self.assert_(taxonomy == expected)
+        taxonomy['New_taxon'] = {'genus':'New','provider':u'Caf\xe9'}
+        save_taxonomy(taxonomy,filename)
+        self.assert_(load_taxonomy(filename)['New_taxon'] == {'genus':'New','provider':'Caf\xc3\xa9'})
+        # a snapshot from another version is refused
+        f = open(filename,"wb")
+        numpy.savez(f,version=numpy.array([stk_taxonomy.SNAPSHOT_VERSION+1]))
+        f.close()
+        self.assertRaises(TaxonomyFileError,load_taxonomy,filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
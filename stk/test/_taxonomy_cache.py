@@ -0,0 +1,101 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import warm_taxonomy_cache, create_taxonomy, load_taxonomy
+import stk.stk_taxonomy_cache as stk_taxonomy_cache
+from stk.stk_taxonomy_providers import EoLProvider
+import os
+import time
+import tempfile
+import shutil
+from lxml import etree
+from util import *
+parser = etree.XMLParser(remove_blank_text=True)
+
+class TestTaxonomyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir,"cache","taxonomy.sqlite")
+
+    def tearDown(self):
+        stk_taxonomy_cache._default_cache = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get(self):
+        cache = stk_taxonomy_cache.TaxonomyCache(self.filename)
+        self.assert_(cache.get("eol","http://eol.org/a") == None)
+        cache.put("eol","http://eol.org/a",'{"results": []}')
+        self.assert_(cache.get("eol","http://eol.org/a") == '{"results": []}')
+        # providers are kept apart
+        self.assert_(cache.get("itis","http://eol.org/a") == None)
+        stats = cache.stats()
+        self.assert_(stats['hits'] == 1)
+        self.assert_(stats['misses'] == 2)
+        self.assert_(stats['records'] == 1)
+        self.assert_(stats['providers'] == {'eol':1})
+        cache.close()
+        # and it's still there when we open it again
+        cache = stk_taxonomy_cache.TaxonomyCache(self.filename)
+        self.assert_(cache.get("eol","http://eol.org/a") == '{"results": []}')
+
+    def test_binary_body(self):
+        cache = stk_taxonomy_cache.TaxonomyCache(":memory:")
+        body = "{\"name\": \"Caf\xe9\"}"
+        cache.put("itis","u",body)
+        self.assert_(cache.get("itis","u") == body)
+
+    def test_ttl(self):
+        cache = stk_taxonomy_cache.TaxonomyCache(self.filename,ttl=60)
+        cache.put("eol","old","{}",fetched=time.time()-120)
+        cache.put("eol","new","{}")
+        self.assert_(cache.get("eol","old") == None)
+        self.assert_(cache.expired == 1)
+        self.assert_(cache.get("eol","new") == "{}")
+        self.assert_(cache.stats()['stale'] == 1)
+        self.assert_(cache.purge() == 1)
+        self.assert_(len(cache) == 1)
+        self.assert_(cache.purge(expired_only=False) == 1)
+        self.assert_(len(cache) == 0)
+
+    def test_warm(self):
+        cache = stk_taxonomy_cache.TaxonomyCache(self.filename)
+        n = warm_taxonomy_cache("data/input/create_taxonomy.csv",cache=cache)
+        self.assert_(n == 5)
+        taxonomy = load_taxonomy("data/input/create_taxonomy.csv")
+        # spaces or underscores, it's the same taxon
+        self.assertDictEqual(cache.get_taxonomy("Gallus gallus"),taxonomy['Gallus_gallus'])
+        self.assertDictEqual(cache.get_taxonomy("Gallus_gallus"),taxonomy['Gallus_gallus'])
+        self.assert_(cache.stats()['providers'] == {stk_taxonomy_cache.TAXONOMY:5})
+
+    def test_create_taxonomy_offline(self):
+        # with a warm cache, no lookups are needed
+        cache = stk_taxonomy_cache.TaxonomyCache(self.filename)
+        stk_taxonomy_cache.set_cache(cache)
+        warm_taxonomy_cache("data/input/create_taxonomy.csv")
+        XML = etree.tostring(etree.parse('data/input/create_taxonomy.phyml',parser),pretty_print=True)
+        cache.reset_stats()
+        taxonomy = create_taxonomy(XML)
+        expected = load_taxonomy("data/input/create_taxonomy.csv")
+        self.assert_(cache.misses == 0)
+        self.assert_(len(taxonomy) == 5)
+        for t in taxonomy:
+            self.assertDictEqual(taxonomy[t],expected[t.replace(" ","_")])
+
+    def test_lookup_cached(self):
+        # nothing is listening here, so this must come from the cache
+        cache = stk_taxonomy_cache.TaxonomyCache(self.filename)
+        cache.put("eol","http://localhost:1/api/search/1.0.json?q=Gallus+gallus",'{"results": []}')
+        eol = EoLProvider(base_url="http://localhost:1",cache=cache)
+        self.assert_(eol.search("Gallus gallus") == {"results": []})
+
+    def test_no_cache(self):
+        stk_taxonomy_cache.set_cache(None)
+        self.assert_(stk_taxonomy_cache.get_cache() == None)
+        stk_taxonomy_cache.set_cache(self.filename)
+        self.assert_(stk_taxonomy_cache.get_cache().filename == self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
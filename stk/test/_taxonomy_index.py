@@ -0,0 +1,70 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import create_subset, substitute_taxa, substitute_taxa_in_trees, load_taxonomy, _parse_xml
+from stk.stk_taxonomy_index import TaxonomyIndex, taxonomy_index
+from lxml import etree
+from util import *
+parser = etree.XMLParser(remove_blank_text=True)
+
+xiphorhynchus = ["Xiphorhynchus_erythropygius","Xiphorhynchus_flavigaster","Xiphorhynchus_guttatus"]
+taxonomy = {'Gallus_gallus':{'species':'Gallus gallus','genus':'Gallus','order':'Galliformes','provider':'Test'},
+            'Gallus_varius':{'species':'Gallus varius','genus':'Gallus','order':'Galliformes','provider':'Test'}}
+for t in xiphorhynchus:
+    taxonomy[t] = {'species':t.replace("_"," "),'genus':'Xiphorhynchus','family':'Dendrocolaptidae','provider':'Test'}
+
+class TestTaxonomyIndex(unittest.TestCase):
+
+    def test_members(self):
+        index = TaxonomyIndex(taxonomy)
+        self.assert_(index.members("Galliformes") == set(["Gallus_gallus","Gallus_varius"]))
+        self.assert_(index.members("Gallus",rank="genus") == set(["Gallus_gallus","Gallus_varius"]))
+        self.assert_(len(index.members("Gallus",rank="family")) == 0)
+        self.assert_(index.members("Gallus gallus") == set(["Gallus_gallus"]))
+        self.assert_(len(index.members("Not_here")) == 0)
+        self.assert_(index.ranks("Dendrocolaptidae") == ["family"])
+        self.assert_("Gallus" in index)
+        self.assert_(not "Test" in index)
+        self.assert_(taxonomy_index(index) is index)
+
+    def test_expand(self):
+        index = TaxonomyIndex(taxonomy)
+        self.assertListEqual(index.expand(["Xiphorhynchus","Xiphorhynchus_guttatus","Aves"]),
+                             ["Xiphorhynchus"]+xiphorhynchus+["Aves"])
+
+    def test_from_csv(self):
+        index = TaxonomyIndex(load_taxonomy("data/input/create_taxonomy.csv"))
+        self.assert_(index.members("Aves") == set(["Archaeopteryx_lithographica","Thalassarche_melanophris",
+                                                  "Egretta_tricolor","Gallus_gallus"]))
+        self.assert_(index.members("Phasianidae",rank="family") == set(["Gallus_gallus"]))
+
+    def test_create_subset(self):
+        XML = etree.tostring(etree.parse('data/input/old_stk_input.phyml',parser),pretty_print=True)
+        search_terms = {'taxa':["Galliformes"]}
+        self.assert_(len(_parse_xml(create_subset(XML,search_terms)).findall(".//source")) == 0)
+        new_XML = create_subset(XML,search_terms,taxonomy=taxonomy)
+        names = sorted([s.attrib['name'] for s in _parse_xml(new_XML).findall(".//source")])
+        self.assertListEqual(["Aragon_etal_1999","Baker_etal_2006"],names)
+        self.assert_(search_terms['taxa'] == ["Galliformes"])
+        self.assert_(create_subset(XML,{'taxa':["Xiphorhynchus"]},taxonomy=TaxonomyIndex(taxonomy)) ==
+                     create_subset(XML,{'taxa':xiphorhynchus}))
+
+    def test_substitute_taxa(self):
+        XML = etree.tostring(etree.parse('data/input/old_stk_input.phyml',parser),pretty_print=True)
+        expected = substitute_taxa(XML,xiphorhynchus,len(xiphorhynchus)*["Xiphorhynchus"],ignoreWarnings=True)
+        self.assert_(substitute_taxa(XML,"Xiphorhynchus","Xiphorhynchus",ignoreWarnings=True,taxonomy=taxonomy) == expected)
+        # deleting, and a taxon given its own substitution
+        expected = substitute_taxa(XML,["Gallus_gallus","Xiphorhynchus_guttatus"]+xiphorhynchus[:2],
+                                   ["Gallus_foo",None,None,None],ignoreWarnings=True)
+        self.assert_(substitute_taxa(XML,["Gallus_gallus","Xiphorhynchus","Xiphorhynchus_guttatus"],
+                                     ["Gallus_foo",None,None],ignoreWarnings=True,taxonomy=taxonomy) == expected)
+
+    def test_substitute_taxa_in_trees(self):
+        trees = ["(Gallus_gallus,(Gallus_varius,(A,B)));"]
+        self.assert_(substitute_taxa_in_trees(trees,"Galliformes","Gallus",taxonomy=taxonomy) ==
+                     substitute_taxa_in_trees(trees,["Gallus_gallus","Gallus_varius"],["Gallus","Gallus"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
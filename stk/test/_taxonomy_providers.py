@@ -0,0 +1,226 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import create_taxonomy_from_taxa, taxonomic_checker_list
+import stk.stk_taxonomy_providers as stk_taxonomy_providers
+from stk.stk_taxonomy_providers import EoLProvider, PBDBProvider, ITISProvider, FixtureServer, save_fixture
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
+import time
+from util import *
+
+def _write_fixtures(fixture_dir):
+    save_fixture(fixture_dir,"eol","/api/search/1.0.json?q=Gallus+gallus",'{"results": [{"id": 1049263}]}')
+    save_fixture(fixture_dir,"eol","/api/pages/1.0/1049263.json",
+                 '{"taxonConcepts": [{"identifier": 52794, "nameAccordingTo": "Species 2000"}]}')
+    save_fixture(fixture_dir,"eol","/api/hierarchy_entries/1.0/52794.json",
+                 '{"taxonRank": "Species", "ancestors": [{"taxonRank": "kingdom", "scientificName": "Animalia"},'+
+                 ' {"taxonRank": "genus", "scientificName": "Gallus Brisson, 1760"}]}')
+    save_fixture(fixture_dir,"eol","/api/search/1.0.json?q=Archaeopteryx+lithographica",'{"results": []}')
+    save_fixture(fixture_dir,"pbdb","/data1.1/taxa/single.json?name=Archaeopteryx+lithographica&show=phylo&vocab=pbdb",
+                 '{"records": [{"is_extant": 0, "genus": "Archaeopteryx", "class": "Aves", "rank": "species",'+
+                 ' "taxon_name": "Archaeopteryx lithographica"}]}')
+    save_fixture(fixture_dir,"itis","/searchByScientificName?srchKey=Gallus",
+                 '{"scientificNames": [{"tsn": "176085"}]}')
+
+_page_query = "images=0&videos=0&sounds=0&maps=0&text=0&iucn=false&subjects=overview&licenses=all&details=true&common_names=true&synonyms=true&references=true&vetted=0"
+
+def _write_checker_fixtures(fixture_dir, n=20):
+    # n names of each colour
+    for i in range(n):
+        save_fixture(fixture_dir,"eol","/api/search/1.0.json?q=Green+"+str(i),'{"results": [{"id": 1%d}]}' % i)
+        save_fixture(fixture_dir,"eol","/api/pages/1.0/1"+str(i)+".json?"+_page_query,
+                     '{"scientificName": "Green %d Linnaeus, 1758", "synonyms": []}' % i)
+        save_fixture(fixture_dir,"eol","/api/search/1.0.json?q=Yellow+"+str(i),'{"results": [{"id": 2%d}]}' % i)
+        save_fixture(fixture_dir,"eol","/api/pages/1.0/2"+str(i)+".json?"+_page_query,
+                     '{"scientificName": "Right %d", "synonyms": [{"synonym": "Yellow %d Smith", "relationship": "synonym"},'
+                     ' {"synonym": "Other %d", "relationship": "synonym"}, {"synonym": "Foo", "relationship": "common name"}]}' % (i,i,i))
+        save_fixture(fixture_dir,"eol","/api/search/1.0.json?q=Amber+"+str(i),'{"results": [{"id": 3%d}, {"id": 4%d}]}' % (i,i))
+        save_fixture(fixture_dir,"eol","/api/pages/1.0/3"+str(i)+".json?"+_page_query,
+                     '{"scientificName": "Right %d", "synonyms": []}' % i)
+        save_fixture(fixture_dir,"eol","/api/search/1.0.json?q=Red+"+str(i),'{"results": []}')
+        # found, but no page
+        save_fixture(fixture_dir,"eol","/api/search/1.0.json?q=Nopage+"+str(i),'{"results": [{"id": 5%d}]}' % i)
+
+def _checker_names(n=20):
+    names = []
+    for i in range(n):
+        for c in ["Green","Yellow","Amber","Red","Nopage"]:
+            names.append(c+"_"+str(i))
+    return names
+
+expected_taxonomy = {'Gallus gallus': {'provider': 'Species 2000', 'kingdom': 'Animalia', 'genus': 'Gallus', 'species': 'Gallus gallus'},
+                     'Archaeopteryx lithographica': {'provider': 'PBDB', 'genus': 'Archaeopteryx', 'class': 'Aves', 'species': 'Archaeopteryx lithographica'}}
+
+
+class TestTaxonomyProviders(unittest.TestCase):
+
+    def setUp(self):
+        self.fixture_dir = tempfile.mkdtemp()
+        _write_fixtures(self.fixture_dir)
+
+    def tearDown(self):
+        stk_taxonomy_providers.reset()
+        stk_taxonomy_providers.close_connections()
+        shutil.rmtree(self.fixture_dir)
+
+    def test_fixture_dir(self):
+        eol = EoLProvider(fixture_dir=self.fixture_dir)
+        self.assert_(eol.search("Gallus gallus") == {"results": [{"id": 1049263}]})
+        self.assert_(eol.page(1049263)['taxonConcepts'][0]['identifier'] == 52794)
+        self.assertRaises(urllib2.HTTPError,eol.search,"Gallus varius")
+        # ITIS is decoded for us
+        itis = ITISProvider(fixture_dir=self.fixture_dir)
+        self.assert_(itis.search("Gallus")['scientificNames'][0]['tsn'] == "176085")
+
+    def test_keep_alive(self):
+        with FixtureServer(self.fixture_dir) as server:
+            eol = EoLProvider(base_url=server.url+"/eol",cache=False)
+            for i in range(10):
+                self.assert_(eol.search("Gallus gallus") == {"results": [{"id": 1049263}]})
+            self.assert_(server.requests == 10)
+            self.assert_(server.connections == 1)
+            try:
+                eol.search("Gallus varius")
+                self.fail("Expected a 404")
+            except urllib2.HTTPError as detail:
+                self.assert_(detail.code == 404)
+
+    def test_retries(self):
+        with FixtureServer(self.fixture_dir,fail_first=2) as server:
+            pbdb = PBDBProvider(base_url=server.url+"/pbdb",cache=False,retries=3,backoff=0.01)
+            data = pbdb.taxon("Archaeopteryx lithographica")
+            self.assert_(data['records'][0]['genus'] == "Archaeopteryx")
+            self.assert_(server.requests == 3)
+        with FixtureServer(self.fixture_dir,fail_first=2) as server:
+            pbdb = PBDBProvider(base_url=server.url+"/pbdb",cache=False,retries=1,backoff=0.01)
+            try:
+                pbdb.taxon("Archaeopteryx lithographica")
+                self.fail("Expected a 503")
+            except urllib2.HTTPError as detail:
+                self.assert_(detail.code == 503)
+
+    def test_no_server(self):
+        server = FixtureServer(self.fixture_dir).start()
+        url = server.url
+        server.stop()
+        eol = EoLProvider(base_url=url+"/eol",cache=False,retries=1,backoff=0.01)
+        self.assertRaises(urllib2.URLError,eol.search,"Gallus gallus")
+
+    def test_host_limit(self):
+        stk_taxonomy_providers.set_host_limit("127.0.0.1",2)
+        try:
+            with FixtureServer(self.fixture_dir,delay=0.05) as server:
+                eol = EoLProvider(base_url=server.url+"/eol",cache=False)
+                def lookup():
+                    for i in range(3):
+                        eol.search("Gallus gallus")
+                threads = [threading.Thread(target=lookup) for i in range(6)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                self.assert_(server.requests == 18)
+                self.assert_(server.max_in_flight <= 2)
+        finally:
+            stk_taxonomy_providers.set_host_limit("127.0.0.1",stk_taxonomy_providers.MAX_PER_HOST)
+
+    def test_record(self):
+        record_dir = tempfile.mkdtemp()
+        try:
+            with FixtureServer(self.fixture_dir) as server:
+                eol = EoLProvider(base_url=server.url+"/eol",fixture_dir=record_dir,record=True)
+                eol.search("Gallus gallus")
+            # and now we don't need the server
+            eol = EoLProvider(fixture_dir=record_dir)
+            self.assert_(eol.search("Gallus gallus") == {"results": [{"id": 1049263}]})
+        finally:
+            shutil.rmtree(record_dir)
+
+    def test_create_taxonomy_stand_in(self):
+        with FixtureServer(self.fixture_dir) as server:
+            stk_taxonomy_providers.configure(stand_in=server.url,cache=False)
+            taxonomy = {}
+            create_taxonomy_from_taxa(expected_taxonomy.keys(),taxonomy)
+        self.maxDiff = None
+        self.assertDictEqual(taxonomy,expected_taxonomy)
+
+    def test_create_taxonomy_fixtures(self):
+        stk_taxonomy_providers.configure(fixture_dir=self.fixture_dir)
+        taxonomy = {}
+        create_taxonomy_from_taxa(expected_taxonomy.keys(),taxonomy)
+        self.maxDiff = None
+        self.assertDictEqual(taxonomy,expected_taxonomy)
+
+
+class TestTaxonomicChecker(unittest.TestCase):
+
+    def setUp(self):
+        self.fixture_dir = tempfile.mkdtemp()
+        _write_checker_fixtures(self.fixture_dir)
+        stk_taxonomy_providers.configure(fixture_dir=self.fixture_dir)
+
+    def tearDown(self):
+        stk_taxonomy_providers.reset()
+        shutil.rmtree(self.fixture_dir)
+
+    def test_colours(self):
+        equivs = taxonomic_checker_list(["Green_1","Yellow_1","Amber_1","Red_1","Nopage_1"],threadNumber=1)
+        self.assert_(equivs['Green_1'] == [['Green_1'],'green'])
+        self.assert_(equivs['Yellow_1'][0][0] == 'Right_1')
+        self.assert_(sorted(equivs['Yellow_1'][0]) == ['Other_1','Right_1','Yellow_1'])
+        self.assert_(equivs['Yellow_1'][1] == 'yellow')
+        self.assert_(equivs['Amber_1'] == [['Right_1'],'amber'])
+        self.assert_(equivs['Red_1'] == [['Red_1'],'red'])
+        self.assert_(equivs['Nopage_1'] == [['Nopage_1'],'red'])
+
+    def test_threads_same_as_serial(self):
+        names = _checker_names()
+        serial = taxonomic_checker_list(names,threadNumber=1)
+        for threads in [2,5,16]:
+            seen = []
+            def progress(done, total, name):
+                seen.append((done, total, name))
+            equivs = taxonomic_checker_list(names,threadNumber=threads,progress=progress)
+            self.assertDictEqual(equivs,serial)
+            self.assert_([d for d, t, n in seen] == range(1,len(names)+1))
+            self.assert_(sorted([n for d, t, n in seen]) == sorted(names))
+            self.assert_(set([t for d, t, n in seen]) == set([len(names)]))
+
+    def test_existing_data(self):
+        existing = {'Green_1':[['Something_else'],'yellow']}
+        seen = []
+        equivs = taxonomic_checker_list(["Green_1","Green_2","Green_2"],existing_data=existing,
+                                        progress=lambda d, t, n: seen.append(n))
+        self.assert_(equivs is existing)
+        self.assert_(equivs['Green_1'] == [['Something_else'],'yellow'])
+        self.assert_(equivs['Green_2'] == [['Green_2'],'green'])
+        self.assert_(seen == ['Green_2'])
+
+    def test_errors_raised(self):
+        names = _checker_names(5)+["Unknown_name"]
+        for threads in [1,4]:
+            self.assertRaises(urllib2.HTTPError,taxonomic_checker_list,names,threadNumber=threads)
+
+    def test_rate_limit(self):
+        stk_taxonomy_providers.set_host_limit("127.0.0.1",4,rate=50)
+        try:
+            with FixtureServer(self.fixture_dir) as server:
+                stk_taxonomy_providers.configure(stand_in=server.url,cache=False)
+                names = _checker_names(2)
+                start = time.time()
+                equivs = taxonomic_checker_list(names,threadNumber=4)
+                # 18 requests at 50 a second
+                self.assert_(time.time() - start > 17/50.)
+                self.assert_(server.requests == 18)
+                self.assert_(len(equivs) == len(names))
+        finally:
+            stk_taxonomy_providers.set_host_limit("127.0.0.1",stk_taxonomy_providers.MAX_PER_HOST)
+
+
+if __name__ == '__main__':
+    unittest.main()
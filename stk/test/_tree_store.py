@@ -0,0 +1,172 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import create_matrix, data_overlap, data_independence, substitute_taxa
+from stk.supertree_toolkit import _swap_tree_in_XML, tree_fingerprint, obtain_trees
+import stk.stk_tree_store as stk_tree_store
+from stk.stk_tree_store import TreeStore
+import stk.stk_phyml as stk_phyml
+import os
+import tempfile
+import shutil
+import sqlite3
+import subprocess
+import simplejson as json
+from lxml import etree
+from util import *
+parser = etree.XMLParser(remove_blank_text=True)
+
+class TestTreeStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir,"data.stkstore")
+        self.XML = etree.tostring(etree.parse('data/input/old_stk_input.phyml',parser),pretty_print=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sidecar_file(self):
+        self.assert_(stk_tree_store.sidecar_file("/data/birds.phyml") == "/data/birds.stkstore")
+
+    def test_create_matrix(self):
+        expected = create_matrix(self.XML,ignoreWarnings=True)
+        store = TreeStore(self.filename)
+        self.assert_(create_matrix(self.XML,ignoreWarnings=True,store=store) == expected)
+        n_trees = len(obtain_trees(self.XML))
+        self.assert_(store.hits == 0)
+        store.close()
+        # and again from the file, without working anything out
+        store = TreeStore(self.filename)
+        self.assert_(create_matrix(self.XML,ignoreWarnings=True,store=store) == expected)
+        self.assert_(store.misses == 0)
+        self.assert_(store.hits == 2*n_trees)
+
+    def test_changed_trees(self):
+        store = TreeStore(self.filename)
+        create_matrix(self.XML,ignoreWarnings=True,store=store)
+        # change one tree and remove another
+        XML = _swap_tree_in_XML(self.XML,"(A,(B,(C,D)));","Aleixo_2002_1")
+        XML = _swap_tree_in_XML(XML,None,"Aliabadian_etal_2007_2",delete=True)
+        store.reset_stats()
+        expected = create_matrix(XML,ignoreWarnings=True)
+        self.assert_(create_matrix(XML,ignoreWarnings=True,store=store) == expected)
+        # just the new tree, once for its taxa and once for its matrix
+        self.assert_(store.misses == 2)
+
+    def test_update(self):
+        store = TreeStore(self.filename)
+        changes = store.update(stk_phyml.get_dataset(self.XML))
+        n_trees = len(stk_phyml.get_dataset(self.XML).source_tree_names())
+        self.assert_(len(changes['added']) == n_trees)
+        self.assert_(changes['unchanged'] == 0)
+        self.assert_(store.source_tree("Aleixo_2002_1")['characters'] == ['ND2','ND3','cytb'])
+        self.assert_(store.source_tree("Aleixo_2002_1")['analyses'] == ['Maximum Parsimony'])
+        XML = _swap_tree_in_XML(self.XML,"(A,(B,(C,D)));","Aleixo_2002_1")
+        XML = _swap_tree_in_XML(XML,None,"Aliabadian_etal_2007_2",delete=True)
+        changes = store.update(stk_phyml.get_dataset(XML))
+        self.assert_(changes['added'] == [])
+        self.assert_(changes['changed'] == ['Aleixo_2002_1'])
+        self.assert_(changes['removed'] == ['Aliabadian_etal_2007_2'])
+        self.assert_(changes['unchanged'] == n_trees-2)
+        self.assert_(store.source_tree("Aliabadian_etal_2007_2") == None)
+
+    def test_prune(self):
+        store = TreeStore(self.filename)
+        store.update(stk_phyml.get_dataset(self.XML))
+        create_matrix(self.XML,ignoreWarnings=True,store=store)
+        n = len(store)
+        store.put_trees({stk_tree_store.tree_hash("(A,B,C);"):{'topology':"x"}})
+        self.assert_(len(store) == n+1)
+        self.assert_(store.prune() == 1)
+        self.assert_(len(store) == n)
+
+    def test_expire(self):
+        store = TreeStore(self.filename)
+        store.start_run()
+        create_matrix(self.XML,ignoreWarnings=True,store=store)
+        n = len(store)
+        store.put_trees({stk_tree_store.tree_hash("(A,B,C);"):{'topology':"x"}})
+        for i in range(stk_tree_store.KEEP_RUNS):
+            store.start_run()
+            create_matrix(self.XML,ignoreWarnings=True,store=store)
+        # only the tree nothing has used for a while goes
+        self.assert_(store.expire() == 1)
+        self.assert_(len(store) == n)
+        store.close()
+        self.assert_(TreeStore(self.filename).run == stk_tree_store.KEEP_RUNS+1)
+
+    def test_process_rerun(self):
+        # the results for the trees process makes along the way are kept
+        # for the next run, not just those for the input file's trees
+        for f in ["old_stk_input.phyml","old_stk_test_taxonomy.csv","backbone.tsv"]:
+            shutil.copy(os.path.join("data/input",f),self.tmpdir)
+        # process writes its own old_stk_test_taxonomy_checker.csv, so the
+        # checker results are given under other names. The second set has
+        # other names for the taxa, so a run with it makes other trees
+        shutil.copy("data/input/old_stk_test_taxonomy_checker.csv",os.path.join(self.tmpdir,"checker.csv"))
+        renamed = open(os.path.join(self.tmpdir,"renamed_checker.csv"),"w")
+        for line in open("data/input/old_stk_test_taxonomy_checker.csv"):
+            row = line.strip().split(",")
+            if (row[2] == "green"):
+                row = [row[0],row[0]+"_b","yellow"]
+            renamed.write(",".join(row)+"\n")
+        renamed.close()
+        stk = os.path.abspath(os.path.join(os.pardir,"stk"))
+        devnull = open(os.devnull,"w")
+        subprocess.check_call([sys.executable,stk,"import_backbone","backbone.tsv","backbone.sqlite"],
+                              cwd=self.tmpdir,stdout=devnull)
+        for equivalents in ["renamed_checker.csv","checker.csv","checker.csv"]:
+            subprocess.check_call([sys.executable,stk,"--backbone","backbone.sqlite","--incremental",
+                                   "--stats_json","stats.json","process","old_stk_input.phyml","out.tnt",
+                                   "--taxonomy_file","old_stk_test_taxonomy.csv",
+                                   "--equivalents_file",equivalents,
+                                   "--overwrite","--restart"],cwd=self.tmpdir,stdout=devnull,stderr=devnull)
+        devnull.close()
+        stats = json.load(open(os.path.join(self.tmpdir,"stats.json")))
+        self.assert_(stats['counters']['tree store hits'] > 0)
+        self.assert_(stats['counters']['tree store misses'] == 0)
+        store = TreeStore(os.path.join(self.tmpdir,"old_stk_input.stkstore"))
+        self.assert_(store.stats()['trees'] > 2*store.stats()['source_trees'])
+
+    def test_overlap_and_independence(self):
+        XML = etree.tostring(etree.parse('data/input/check_data_ind.phyml',parser),pretty_print=True)
+        store = TreeStore(self.filename)
+        for i in range(2):
+            self.assert_(data_overlap(XML,ignoreWarnings=True,store=store) == data_overlap(XML,ignoreWarnings=True))
+            self.assert_(data_independence(XML,ignoreWarnings=True,store=store) == data_independence(XML,ignoreWarnings=True))
+        # the store's record of the input file is not swapped for other data
+        store = TreeStore(self.filename)
+        store.update(stk_phyml.get_dataset(self.XML))
+        data_independence(XML,ignoreWarnings=True,store=store)
+        changes = store.update(stk_phyml.get_dataset(self.XML))
+        self.assert_(changes['added'] == [] and changes['changed'] == [] and changes['removed'] == [])
+
+    def test_substitute_taxa(self):
+        store = TreeStore(self.filename)
+        old_taxa = ["Xiphorhynchus_picus","Glyphorynchus_spirurus","Not_here"]
+        new_taxa = ["Xiphorhynchus_foo",None,"Still_not"]
+        expected = substitute_taxa(self.XML,old_taxa,new_taxa,ignoreWarnings=True)
+        for i in range(2):
+            self.assert_(substitute_taxa(self.XML,old_taxa,new_taxa,ignoreWarnings=True,store=store) == expected)
+
+    def test_topology_fingerprint(self):
+        self.assert_(tree_fingerprint("((A,B),(C,D));") == tree_fingerprint("((D,C),(B,A));"))
+        self.assert_(tree_fingerprint("((A:1,B:2),(C,D));") == tree_fingerprint("((A,B),(C,D));"))
+        self.assert_(not tree_fingerprint("((A,C),(B,D));") == tree_fingerprint("((A,B),(C,D));"))
+
+    def test_old_version(self):
+        store = TreeStore(self.filename)
+        store.put_trees({"a":{'topology':"x"}})
+        store.close()
+        db = sqlite3.connect(self.filename)
+        db.execute("UPDATE info SET version=?",(stk_tree_store.STORE_VERSION-1,))
+        db.commit()
+        db.close()
+        store = TreeStore(self.filename)
+        self.assert_(len(store) == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,14 +5,17 @@ import sys
 sys.path.insert(0,"../../")
 from stk.supertree_toolkit import import_tree, obtain_trees, get_all_taxa, _assemble_tree_matrix, create_matrix, _delete_taxon, _sub_taxon,_tree_contains
 from stk.supertree_toolkit import _swap_tree_in_XML, substitute_taxa, get_taxa_from_tree, get_characters_from_tree, amalgamate_trees, _uniquify
+from stk.supertree_toolkit import permutation_count, _permuted_characters
+from stk.stk_exceptions import TooManyPermutationsError
 from stk.supertree_toolkit import import_trees, import_tree, _trees_equal, _find_trees_for_permuting, permute_tree, get_all_source_names, _getTaxaFromNewick, _parse_tree
-from stk.supertree_toolkit import get_mrca
+from stk.supertree_toolkit import get_mrca, _mrp_matrix, MRP_MISSING
 import os
 from lxml import etree
 from util import *
 import StringIO
 import numpy
 import stk.p4 as p4
+import stk.supertree_toolkit as stk_toolkit
 # our test dataset
 import tempfile
 
@@ -311,6 +314,25 @@ class TestTreeManipulation(unittest.TestCase):
         self.assert_(matrix.find('Uraeginthus_cyanocephalus') == -1)
         self.assert_(matrix.find('Uraeginthus_bengalus') == -1)
 
+    def test_create_matrix_to_file(self):
+        XML = etree.tostring(etree.parse('data/input/weighted_trees.phyml',parser),pretty_print=True)
+        for f_format in ["hennig","nexus"]:
+            handle = StringIO.StringIO()
+            self.assert_(create_matrix(XML,format=f_format,outfile=handle) == None)
+            self.assert_(handle.getvalue() == create_matrix(XML,format=f_format))
+
+    def test_mrp_matrix(self):
+        trees = {'tree_1':"((A,B),(C,D));"}
+        taxa = ["MRP_Outgroup","A","B","C","D","E"]
+        matrix, charsets, names, weights = _mrp_matrix(trees,taxa)
+        self.assert_(matrix.dtype == numpy.int8)
+        self.assert_(matrix.shape == (6,2))
+        self.assert_(list(matrix[0]) == [0,0])
+        self.assert_(list(matrix[5]) == [MRP_MISSING,MRP_MISSING])
+        self.assert_(charsets == ["1-2"])
+        self.assert_(names == ['tree_1'])
+        self.assert_(weights == None)
+
 
     def test_delete_taxa(self):
         t = "((A_1,B_1),F_1,E_1,(G_1,H_1));"
@@ -495,6 +517,51 @@ class TestTreeMetaData(unittest.TestCase):
             self.assert_(False)
         # just check this runs and doesn't err
 
+    def test_permutation_count(self):
+        XML = etree.tostring(etree.parse('data/input/permute_trees.phyml',parser),pretty_print=True)
+        trees = obtain_trees(XML)
+        self.assert_(permutation_count(trees['Hill_2011_1']) == 6)
+        self.assert_(permutation_count(trees['Davis_2011_1']) == 2)
+        self.assert_(permutation_count("(A,(B,C));") == 1)
+        self.assertRaises(TooManyPermutationsError, permute_tree, trees['Hill_2011_1'], treefile="newick", max_permutations=5)
+
+    def test_permuted_characters(self):
+        # E is either with A or with C and D
+        tree = "(F,((A,E%1),(B,(C,D,E%2))));"
+        characters = set([tuple(sorted(c)) for c in _permuted_characters(tree)])
+        expected = set([('A','E'),('C','D'),('C','D','E'),('B','C','D'),('B','C','D','E'),
+                        ('A','B','C','D','E')])
+        self.assert_(characters == expected)
+
+    def test_permute_matrix(self):
+        XML = etree.tostring(etree.parse('data/input/permute_trees.phyml',parser),pretty_print=True)
+        trees = obtain_trees(XML)
+        # the characters (columns) of a matrix
+        def characters(matrix):
+            lines = matrix.split("\n")
+            start = [i for i in range(len(lines)) if lines[i].startswith("xread")][0] + 2
+            rows = []
+            for line in lines[start:]:
+                if (line.strip() in ["", ";"]):
+                    break
+                rows.append(line.split())
+            return set([frozenset([r[0] for r in rows if r[1][j] == '1']) for j in range(len(rows[0][1]))])
+        for name in ['Hill_2011_1','Davis_2011_1']:
+            from_trees = permute_tree(trees[name],enumerate_trees=True)
+            self.assert_(permute_tree(trees[name]) == from_trees)
+            # from the clades, each character is there once
+            from_clades = permute_tree(trees[name],enumerate_trees=False)
+            self.assert_(characters(from_trees).issubset(characters(from_clades)))
+        from_clades = permute_tree(trees['Davis_2011_1'],enumerate_trees=False)
+        self.assert_(characters(from_clades) == characters(permute_tree(trees['Davis_2011_1'],enumerate_trees=True)))
+        # which is what we get for trees with too many permutations to make
+        limit = stk_toolkit.PERMUTATION_ENUMERATE_LIMIT
+        stk_toolkit.PERMUTATION_ENUMERATE_LIMIT = 1
+        try:
+            self.assert_(permute_tree(trees['Davis_2011_1']) == from_clades)
+        finally:
+            stk_toolkit.PERMUTATION_ENUMERATE_LIMIT = limit
+
     def test_getTaxaFromNewick_quoted(self):
         tree = "((Bothropolys_multidentatus, Lithobius_obscurus, 'Lithobius variegatus rubriceps', Lithobius_forficatus, Australobius_scabrior, Eupolybothrus_fasciatus), (Shikokuobius_japonicus, (Dichelobius_flavens, Dichelobius_ACT, (Anopsobius_TAS, (Anopsobius_neozelanicus, Anopsobius_NSW))), (Zygethobius_pontis, Cermatobius_japonicus, (Henicops_brevilabiatus, Henicops_dentatus, Henicops_SEQLD, (Lamyctes_emarginatus, Lamyctes_coeculus, Lamyctes_inermipes, Lamyctes_africanus, Lamyctes_hellyeri), (Henicops_maculatus_TAS, (Henicops_maculatus_NSW, Henicops_maculatus_NZ))), ('Paralamyctes (Paralamyctes) spenceri', 'Paralamyctes (Paralamyctes) weberi', 'Paralamyctes (Paralamyctes) asperulus', 'Paralamyctes (Paralamyctes) prendinii', 'Paralamyctes (Paralamyctes) tridens', 'Paralamyctes (Paralamyctes) neverneverensis', 'Paralamyctes (Paralamyctes) harrisi', 'Paralamyctes (Paralamyctes) monteithi SEQLD', 'Paralamyctes (Paralamyctes) monteithi NEQLD', 'Paralamyctes (Paralamyctes) monteithi MEQLD', ('Paralamyctes (Haasiella) trailli', 'Paralamyctes (Haasiella) subicolus'), ('Paralamyctes chilensis', 'Paralamyctes wellingtonensis'), ('Paralamyctes (Nothofagobius) cassisi', 'Paralamyctes (Nothofagobius) mesibovi'), ('Paralamyctes (Thingathinga) ?grayi', ('Paralamyctes (Thingathinga) grayi NSW1', 'Paralamyctes (Thingathinga) grayi NSW2')), ('Paralamyctes (Thingathinga) validus NZ3', ('Paralamyctes (Thingathinga) validus NZ1', 'Paralamyctes (Thingathinga) validus NZ2'))))));"
         taxa = _getTaxaFromNewick(tree)
@@ -0,0 +1,79 @@
+import unittest
+import sys
+# so we import local stk before any other
+sys.path.insert(0,"../../")
+from stk.supertree_toolkit import validate_data, _check_data
+import stk.stk_validate as stk_validate
+import stk.stk_phyml as stk_phyml
+from stk.stk_exceptions import *
+from lxml import etree
+from util import *
+parser = etree.XMLParser(remove_blank_text=True)
+
+class TestValidate(unittest.TestCase):
+
+    def test_valid(self):
+        XML = etree.tostring(etree.parse('data/input/sub_taxa.phyml',parser),pretty_print=True)
+        report = validate_data(XML)
+        self.assert_(report.ok())
+        self.assert_(len(report) == 0)
+        report.raise_errors()
+
+    def test_all_problems(self):
+        # uninformative trees and a missing taxon are both reported
+        xml_root = etree.parse('data/input/clean_data.phyml',parser).getroot()
+        st = xml_root.xpath("//source_tree")[0]
+        taxa_data = st.find("taxa_data")
+        for c in taxa_data:
+            taxa_data.remove(c)
+        etree.SubElement(etree.SubElement(taxa_data,"mixed_fossil_and_extant"),"taxon",name="Not_here")
+        report = validate_data(etree.tostring(xml_root))
+        self.assert_(len(report.by_kind(stk_validate.UNINFORMATIVE_TREE)) == 4)
+        missing = report.by_kind(stk_validate.MISSING_TAXON)
+        self.assert_(len(missing) == 1)
+        self.assert_(missing[0].name == st.attrib['name'])
+        # the taxon is raised first, as it always was
+        self.assertRaises(InvalidSTKData,report.raise_errors)
+
+    def test_raises_as_before(self):
+        XML = etree.tostring(etree.parse('data/input/non_unique_names.phyml',parser),pretty_print=True)
+        self.assertRaises(NotUniqueError,_check_data,XML)
+        report = validate_data(XML)
+        self.assert_([i.name for i in report.by_kind(stk_validate.DUPLICATE_SOURCE_NAME)] == ["Hill_1996"])
+        self.assert_(len(report.by_kind(stk_validate.TREE_PARSE)) > 0)
+        XML = etree.tostring(etree.parse('data/input/clean_data.phyml',parser),pretty_print=True)
+        try:
+            _check_data(XML)
+            self.assert_(False)
+        except UninformativeTreeError as e:
+            self.assertRegexpMatches(e.msg,"contains only 2 taxa and is not informative")
+            self.assertRegexpMatches(e.msg,"doesn't contain any clades and is not informative")
+
+    def test_empty_source(self):
+        xml_root = etree.parse('data/input/create_matrix.phyml',parser).getroot()
+        source = xml_root.xpath("//source")[0]
+        for value in source.xpath("source_tree/tree/tree_string/string_value"):
+            value.text = None
+        report = validate_data(etree.tostring(xml_root))
+        issues = report.by_kind(stk_validate.EMPTY_SOURCE)
+        self.assert_([i.name for i in issues] == [source.attrib['name']])
+        try:
+            report.raise_errors()
+            self.assert_(False)
+        except InvalidSTKData as e:
+            self.assertRegexpMatches(e.msg,"has no trees")
+
+    def test_remembered(self):
+        XML = etree.tostring(etree.parse('data/input/sub_taxa.phyml',parser),pretty_print=True)
+        stk_validate.clear_report_cache()
+        report = validate_data(XML)
+        self.assert_(validate_data(XML) is report)
+        # same content, different object
+        self.assert_(validate_data(str(bytearray(XML))) is report)
+        self.assert_(validate_data(stk_phyml.PhymlDataset(XML)) is not None)
+        stk_validate.clear_report_cache()
+        self.assert_(not validate_data(XML) is report)
+
+
+if __name__ == '__main__':
+    unittest.main()
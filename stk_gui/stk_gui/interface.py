@@ -995,10 +995,10 @@ class Diamond:
     f = StringIO.StringIO()
     self.tree.write(f)
     XML = f.getvalue()
-    data_summary_ok = False
+    # check the data, then summarise it whatever the check finds. The
+    # statistics behind the summary are only gathered once
     try:
-        data_summary = stk.data_summary(XML,detailed=True,ignoreWarnings=False)
-        data_summary_ok = True
+        stk.validate_data(XML).raise_errors()
     except NotUniqueError as detail:
         msg = "Failed to summarise data correctly - non-unique data.\n"+detail.msg
         dialogs.error(self.main_window,msg)
@@ -1015,31 +1015,29 @@ class Diamond:
         msg = "Failed to summarise data correctly. Incomplete data.\n"
         dialogs.error_tb(self.main_window,msg)
 
-    if (not data_summary_ok):
-        # try again
-        try:
-            data_summary = stk.data_summary(XML,detailed=True,ignoreWarnings=True)
-        except NotUniqueError as detail:
-            msg = "Failed to summarise data - non-unique data.\n"+detail.msg
-            dialogs.error(self.main_window,msg)
-            return
-        except InvalidSTKData as detail:
-            msg = "Failed to summarise data - invalid STK data.\n"+detail.msg
-            dialogs.error(self.main_window,msg)
-            return
-        except UninformativeTreeError as detail:
-            msg = "Failed to summarise data - uninformative tree.\n"+detail.msg
-            dialogs.error(self.main_window,msg)
-            return
-        except TreeParseError as detail:
-            msg = "Failed to summarise data - can't parse tree.\n"+detail.msg
-            dialogs.error(self.main_window,msg)
-            return
-        except:
-            msg = "Failed to summarise data. Sorry!\n"
-            msg += traceback.format_exc()
-            dialogs.error_tb(self.main_window,msg)
-            return
+    try:
+        data_summary = stk.data_summary(XML,detailed=True,ignoreWarnings=True)
+    except NotUniqueError as detail:
+        msg = "Failed to summarise data - non-unique data.\n"+detail.msg
+        dialogs.error(self.main_window,msg)
+        return
+    except InvalidSTKData as detail:
+        msg = "Failed to summarise data - invalid STK data.\n"+detail.msg
+        dialogs.error(self.main_window,msg)
+        return
+    except UninformativeTreeError as detail:
+        msg = "Failed to summarise data - uninformative tree.\n"+detail.msg
+        dialogs.error(self.main_window,msg)
+        return
+    except TreeParseError as detail:
+        msg = "Failed to summarise data - can't parse tree.\n"+detail.msg
+        dialogs.error(self.main_window,msg)
+        return
+    except:
+        msg = "Failed to summarise data. Sorry!\n"
+        msg += traceback.format_exc()
+        dialogs.error_tb(self.main_window,msg)
+        return
 
     textbox.get_buffer().set_text(data_summary)
     textbox.set_editable(False)